@@ -0,0 +1,331 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module decodes the acquisition flags (the ``ACQ_*`` bits of the
+'flags' header field) and implements a dock widget summarizing how many
+acquisitions carry each flag.
+
+All decoding is vectorized over the flags column of the header index: the
+population of every bit is computed from the distinct flag values
+(`numpy.unique`), the acquisitions carrying a flag with
+``(flags >> (bit - 1)) & 1`` over the whole column. Both are cached by
+`FlagIndex`, so moving to the next or previous acquisition with a flag is a
+binary search at any file size.
+"""
+
+import numpy
+import ismrmrd
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtWidgets import (QDockWidget, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton,
+                             QTableWidget, QTableWidgetItem, QHeaderView)
+
+#: ``(bit, name)`` of the ismrmrd acquisition flags (bits are 1-based).
+FLAGS = sorted((value, name) for name, value in ismrmrd.__dict__.items()
+               if name.startswith('ACQ_') and isinstance(value, int))
+
+_NAMES = dict(FLAGS)
+
+def flagName(bit):
+    """The name of flag `bit` (``bit N`` for bits without a name)."""
+    return _NAMES.get(bit, 'bit {0}'.format(bit))
+
+def flagNames(value):
+    """The names of the flags set in the flags value `value`."""
+    value = int(value)
+    return [flagName(bit) for bit in range(1, 65) if value >> (bit - 1) & 1]
+
+def flagMask(flags, bit):
+    """Boolean array: True where flag `bit` is set in the array `flags`."""
+    return (numpy.asarray(flags, dtype=numpy.uint64) >> numpy.uint64(bit - 1)) \
+        & numpy.uint64(1) != 0
+
+
+class FlagIndex(object):
+    """
+    Flag statistics of a complete header index (cached).
+
+    :Parameter index: the complete HeaderIndex
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.total = index.total
+        self.flags = index.column('flags')
+
+        # population of every bit, computed from the distinct values
+        unique, counts = numpy.unique(self.flags, return_counts=True)
+        bits = (unique.astype(numpy.uint64)[:, None] >> numpy.arange(64, dtype=numpy.uint64)) \
+            & numpy.uint64(1)
+        self.counts = bits.T.astype(numpy.int64) @ counts.astype(numpy.int64)
+        self.values = len(unique)
+
+        # dataset rows carrying a flag (by bit) and the last mapping to
+        # model rows of a filtered/sorted model
+        self._rows = {}
+        self._modelRows = None
+
+    def isCurrent(self, index):
+        """True if the flags were computed from `index` in its current state."""
+        return index is self.index and index.total == self.total
+
+    def summary(self):
+        """``(bit, name, acquisitions)`` of the named flags and of the other
+        bits that are set."""
+        return [(bit, flagName(bit), int(self.counts[bit - 1])) for bit in range(1, 65)
+                if bit in _NAMES or self.counts[bit - 1]]
+
+    def rows(self, bit):
+        """The (sorted) dataset rows of the acquisitions with flag `bit`."""
+        rows = self._rows.get(bit)
+        if rows is None:
+            rows = numpy.flatnonzero(flagMask(self.flags, bit))
+            self._rows[bit] = rows
+        return rows
+
+    def modelRows(self, bit, rowmap):
+        """The (sorted) model rows with flag `bit` of a model whose rows are
+        the dataset rows `rowmap` (None: all rows in order)."""
+        if rowmap is None:
+            return self.rows(bit)
+        if self._modelRows is not None and self._modelRows[0] == bit and \
+                self._modelRows[1] is rowmap:
+            return self._modelRows[2]
+        rows = numpy.flatnonzero(flagMask(self.flags[rowmap], bit))
+        self._modelRows = (bit, rowmap, rows)
+        return rows
+
+    def step(self, bit, rowmap, row, forward=True):
+        """Return the model row with flag `bit` after (or before) model row
+        `row`, None if there is none."""
+        rows = self.modelRows(bit, rowmap)
+        if forward:
+            pos = numpy.searchsorted(rows, row, side='right')
+            return int(rows[pos]) if pos < len(rows) else None
+        pos = numpy.searchsorted(rows, row, side='left') - 1
+        return int(rows[pos]) if pos >= 0 else None
+
+    def nbytes(self):
+        cached = sum(rows.nbytes for rows in self._rows.values())
+        if self._modelRows is not None:
+            cached += self._modelRows[2].nbytes
+        return cached
+
+
+class FlagWorker(QThread):
+    """
+    Background thread computing the FlagIndex of a header index.
+
+    :Parameter index: the complete HeaderIndex
+    """
+
+    def __init__(self, index, parent=None):
+        super(FlagWorker, self).__init__(parent)
+        self.index = index
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = FlagIndex(self.index)
+        except Exception as e:
+            self.error = e
+
+
+class FlagDock(QDockWidget):
+    """
+    A dock widget listing how many acquisitions carry each flag.
+
+    The check box of a flag shows it as a column of the table. The selected
+    flag can be used to filter the table or to move to the previous/next
+    acquisition with the flag.
+
+    :Parameters:
+
+    - `parent`: the parent of this widget
+    """
+
+    #: Emitted with a filter expression for the table.
+    filterRequested = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super(FlagDock, self).__init__('Acquisition flags', parent)
+        self.setObjectName('acquisition_flags_dock')
+        self.view = None
+        self.worker = None
+
+        self.statusLabel = QLabel()
+        self.statusLabel.setWordWrap(True)
+        self.table = QTableWidget(0, 3)
+        self.table.setHorizontalHeaderLabels(['Flag (column)', 'Bit', 'Acquisitions'])
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table.setSelectionBehavior(QTableWidget.SelectRows)
+        self.table.setSelectionMode(QTableWidget.SingleSelection)
+        self.table.itemChanged.connect(self.onItemChanged)
+        self.table.itemDoubleClicked.connect(lambda item: self.applyFilter())
+
+        self.btnPrevious = QPushButton('Previous')
+        self.btnPrevious.setToolTip('Show the previous acquisition with the selected flag')
+        self.btnPrevious.clicked.connect(lambda: self.step(False))
+        self.btnNext = QPushButton('Next')
+        self.btnNext.setToolTip('Show the next acquisition with the selected flag')
+        self.btnNext.clicked.connect(lambda: self.step(True))
+        self.btnFilter = QPushButton('Filter')
+        self.btnFilter.setToolTip('Show the acquisitions with the selected flag only')
+        self.btnFilter.clicked.connect(self.applyFilter)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.btnPrevious)
+        buttons.addWidget(self.btnNext)
+        buttons.addWidget(self.btnFilter)
+        buttons.addStretch(1)
+
+        widget = QWidget()
+        layout = QVBoxLayout(widget)
+        layout.addWidget(self.statusLabel)
+        layout.addWidget(self.table)
+        layout.addLayout(buttons)
+        self.setWidget(widget)
+
+        self.visibilityChanged.connect(self.refresh)
+
+    def setView(self, view):
+        """Show the flags of another dataset view."""
+        if view is self.view:
+            return
+        self.cancel()
+        if self.view is not None:
+            self.view.indexFinished.disconnect(self.onIndexFinished)
+        self.view = view
+        self.view.indexFinished.connect(self.onIndexFinished)
+        self.refresh(self.isVisible())
+
+    def onIndexFinished(self):
+        self.refresh(self.isVisible())
+
+    def flagIndex(self):
+        """The FlagIndex of the view if it is up to date (None otherwise)."""
+        flags = self.view.flagIndex if self.view is not None else None
+        index = self.view.headerIndex if self.view is not None else None
+        if flags is None or index is None or not flags.isCurrent(index):
+            return None
+        return flags
+
+    def refresh(self, visible=True):
+        """Show the flags of the view, compute them if needed (only while
+        the dock is shown)."""
+        if not visible or self.view is None or self.worker is not None:
+            return
+        if self.view.tableModel.headerType is not ismrmrd.AcquisitionHeader:
+            return self.clear('Only acquisitions have flags.')
+        if self.flagIndex() is not None:
+            return self.showSummary()
+        index = self.view.headerIndex
+        if index is None or not index.isComplete():
+            return self.clear('Waiting for the header index.' if self.view.tableModel.rbuffer.engine
+                              is not None else 'Streams have no header index.')
+
+        self.clear('Decoding the flags of {0} acquisitions...'.format(index.total))
+        self.worker = FlagWorker(index, self)
+        self.worker.finished.connect(self.onFinished)
+        self.worker.start()
+
+    def onFinished(self):
+        worker, self.worker = self.worker, None
+        if worker.error is not None:
+            return self.clear('Could not decode the flags: {0}'.format(worker.error))
+        self.view.flagIndex = worker.result
+        self.refresh(self.isVisible())
+
+    def cancel(self):
+        worker = self.worker
+        if worker is not None:
+            self.worker = None
+            worker.finished.disconnect(self.onFinished)
+            worker.wait()
+            worker.deleteLater()
+
+    def clear(self, message):
+        self.table.setRowCount(0)
+        self.statusLabel.setText(message)
+
+    def showSummary(self):
+        flags = self.flagIndex()
+        shown = self.view.tableModel.flagColumns()
+        current = self.table.currentRow()
+        summary = flags.summary()
+        self.table.blockSignals(True)
+        self.table.setRowCount(len(summary))
+        for row, (bit, name, count) in enumerate(summary):
+            item = QTableWidgetItem(name)
+            item.setData(Qt.UserRole, bit)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if bit in shown else Qt.Unchecked)
+            self.table.setItem(row, 0, item)
+            self.table.setItem(row, 1, QTableWidgetItem(str(bit)))
+            item = QTableWidgetItem('{0} ({1:.1f} %)'.format(count, 100.0 * count / max(flags.total, 1)))
+            item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+            self.table.setItem(row, 2, item)
+            if not count:
+                for col in range(3):
+                    self.table.item(row, col).setForeground(Qt.gray)
+        self.table.blockSignals(False)
+        if current >= 0:
+            self.table.setCurrentCell(current, 0)
+        self.statusLabel.setText('{0} acquisitions, {1} distinct flag values. Check a flag '
+                                 'to show it as a column.'.format(flags.total, flags.values))
+
+    def onItemChanged(self, item):
+        """Show or hide the column of a (un)checked flag."""
+        if item.column() != 0 or self.view is None:
+            return
+        bit = item.data(Qt.UserRole)
+        bits = [shown for shown in self.view.tableModel.flagColumns() if shown != bit]
+        if item.checkState() == Qt.Checked:
+            bits.append(bit)
+        self.view.tableModel.setFlagColumns(sorted(bits))
+
+    def selectedBit(self):
+        item = self.table.item(self.table.currentRow(), 0)
+        return item.data(Qt.UserRole) if item is not None else None
+
+    def step(self, forward):
+        """Show the previous/next acquisition with the selected flag."""
+        flags, bit = self.flagIndex(), self.selectedBit()
+        if flags is None or bit is None:
+            return
+        model, tableView = self.view.tableModel, self.view.tableView
+        current = tableView.currentIndex()
+        row = model.start + current.row() if current.isValid() else (-1 if forward else model.leaf_numrows)
+        target = flags.step(bit, model.rowmap, row, forward)
+        if target is None:
+            self.statusLabel.setText('No {0} acquisition with {1}.'.format(
+                'following' if forward else 'preceding', flagName(bit)))
+            return
+        tableView.goToRow(target)
+
+    def applyFilter(self):
+        bit = self.selectedBit()
+        if bit is not None and bit in _NAMES:
+            self.filterRequested.emit('flag({0})'.format(_NAMES[bit]))
+
+    def shutdown(self):
+        self.cancel()
@@ -0,0 +1,179 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements a command line benchmark of the reads the viewer
+does while browsing a file, e.g. to compare a file before and after it was
+rewritten by `Rechunk`.
+
+The acquisition buffer (`TableBuffer`) of every file is opened like the
+table opens it and timed for:
+
+- opening the file and the buffer;
+- the first page of the table;
+- scrolling: pages of the table moved by a few rows at a time (mouse wheel);
+- jumping: pages at random positions (dragging the scrollbar);
+- one pass over all headers (what the header index reads);
+- reading the payload of random acquisitions (plots).
+
+Usage::
+
+    python Benchmark.py original.h5 rewritten.h5 [--pages 200] [--repeat 3]
+
+The timings are wall clock times. After the first repetition the files are
+usually in the page cache of the operating system, the median of the
+repetitions is reported.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy
+import ismrmrd
+import TableBuffer
+import ReadEngine
+import ISMRMRDTableModel
+
+#: The number of rows a mouse wheel step scrolls.
+SCROLL_ROWS = 3
+
+#: The number of rows shown by the table (cells painted per page).
+VISIBLE_ROWS = 40
+
+#: The benchmark steps in the order they are run and reported.
+STEPS = ('open', 'first page', 'scroll', 'jump', 'header pass', 'payload')
+
+def touchRows(rbuffer, rows):
+    """Access the header of the first `rows` buffered rows like the painted
+    cells do."""
+    for row in range(min(rows, len(rbuffer.chunk))):
+        rbuffer.getCell(row)['head']['scan_counter']
+
+def runOnce(fileName, group, pages, seed):
+    """Run all steps on one file and return ``{step: seconds per operation}``."""
+    pageRows = ISMRMRDTableModel.CHUNK_SIZE
+    rng = numpy.random.RandomState(seed)
+    times = {}
+
+    t0 = time.perf_counter()
+    dset = ismrmrd.Dataset(fileName, '/' + group, False, mode='r')
+    rbuffer = TableBuffer.TableBuffer(dset, pageRows)
+    times['open'] = time.perf_counter() - t0
+    total = rbuffer.total_nrows()
+    last = max(total - pageRows, 0)
+
+    try:
+        t0 = time.perf_counter()
+        rbuffer.readBuffer(0, pageRows)
+        touchRows(rbuffer, VISIBLE_ROWS)
+        times['first page'] = time.perf_counter() - t0
+
+        # the table keeps a page of rows, scrolling moves it by a few rows
+        starts = numpy.minimum(numpy.arange(1, pages + 1) * SCROLL_ROWS, last)
+        t0 = time.perf_counter()
+        for start in starts:
+            rbuffer.readBuffer(int(start), int(start) + pageRows)
+            touchRows(rbuffer, VISIBLE_ROWS)
+        times['scroll'] = (time.perf_counter() - t0) / pages
+
+        starts = rng.randint(0, last + 1, pages)
+        t0 = time.perf_counter()
+        for start in starts:
+            rbuffer.readBuffer(int(start), int(start) + pageRows)
+            touchRows(rbuffer, VISIBLE_ROWS)
+        times['jump'] = (time.perf_counter() - t0) / pages
+
+        t0 = time.perf_counter()
+        if rbuffer.mmap is not None:
+            numpy.array(rbuffer.mmap['head'])
+        else:
+            rbuffer.engine.read(fields=['head'])
+        times['header pass'] = time.perf_counter() - t0
+
+        rows = rng.randint(0, max(total, 1), pages) if total else []
+        t0 = time.perf_counter()
+        for row in rows:
+            rbuffer.data[int(row)]
+        times['payload'] = (time.perf_counter() - t0) / max(len(rows), 1)
+    finally:
+        rbuffer = None
+        dset.close()
+    return times, total
+
+def describe(fileName, group):
+    """Return the header access and the layout summary of a file."""
+    dset = ismrmrd.Dataset(fileName, '/' + group, False, mode='r')
+    try:
+        info = dict(TableBuffer.TableBuffer(dset, ISMRMRDTableModel.CHUNK_SIZE).describe())
+    finally:
+        dset.close()
+    return info
+
+def formatSeconds(seconds):
+    if seconds >= 1.0:
+        return '{0:.2f} s'.format(seconds)
+    if seconds >= 1e-3:
+        return '{0:.2f} ms'.format(seconds * 1e3)
+    return '{0:.1f} us'.format(seconds * 1e6)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the reads of the viewer while browsing ISMRMRD files')
+    parser.add_argument('fileNames', nargs='+', metavar='fileName',
+                        help='ISMRMRD (HDF5) files to compare')
+    parser.add_argument('--group', default='dataset',
+                        help='the dataset group (default: dataset)')
+    parser.add_argument('--pages', type=int, default=200,
+                        help='pages read by the scroll and jump steps and acquisitions '
+                        'read by the payload step (default: 200)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='repetitions per file, the median is reported (default: 3)')
+    args = parser.parse_args(argv)
+
+    results = []
+    for fileName in args.fileNames:
+        runs = []
+        for rep in range(max(args.repeat, 1)):
+            times, total = runOnce(fileName, args.group, max(args.pages, 1), rep)
+            runs.append(times)
+        median = {step: float(numpy.median([run[step] for run in runs])) for step in STEPS}
+        info = describe(fileName, args.group)
+        results.append((fileName, total, info, median))
+    ReadEngine.shutdownPool()
+
+    width = max([len(os.path.basename(name)) for name in args.fileNames] + [12])
+    print('{0:<22}'.format('') + ''.join('{0:>{1}}'.format(os.path.basename(name), width + 2)
+                                           for name in args.fileNames))
+    rows = [('rows', lambda r: str(r[1])),
+            ('size', lambda r: '{0:.1f} MB'.format(os.path.getsize(r[0]) / 2 ** 20)),
+            ('layout', lambda r: r[2].get('Layout', '')),
+            ('chunk shape', lambda r: r[2].get('Chunk shape', '-')),
+            ('filters', lambda r: r[2].get('Filters', ''))]
+    rows += [(step + (' (per page)' if step in ('scroll', 'jump') else
+                      ' (per row)' if step == 'payload' else ''),
+              lambda r, step=step: formatSeconds(r[3][step])) for step in STEPS]
+    for label, value in rows:
+        print('{0:<22}'.format(label)[:22] + ''.join(
+            '{0:>{1}}'.format(value(result), width + 2) for result in results))
+    for fileName, _, info, _ in results:
+        print('{0}: {1}'.format(os.path.basename(fileName), info.get('Header access')))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,388 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements a dock widget with summary statistics of every
+column of the acquisition table (minimum, maximum, number of distinct
+values) and a histogram of the values of the selected column.
+
+The statistics are computed over the complete header index with
+`numpy.unique` (one pass per column, in a background thread). Only the
+histogram bars are kept: columns with few distinct values get one bar per
+value, numeric columns with many values are binned and multi-valued columns
+(e.g. position) show their most frequent values. Clicking a bar filters the
+table to the acquisitions of the bar (Ctrl+click narrows the current filter).
+"""
+
+import numpy
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtWidgets import (QDockWidget, QWidget, QVBoxLayout, QSplitter, QLabel,
+                             QTableWidget, QTableWidgetItem, QHeaderView, QApplication)
+
+#: The maximum number of histogram bars of a column.
+MAX_BARS = 64
+
+# pyqtgraph is imported when the first histogram is shown
+pg = None
+
+def formatValue(value):
+    """Format a value (or a vector of values) for the table and the bars."""
+    if numpy.ndim(value):
+        return '[' + ', '.join(formatValue(item) for item in value) + ']'
+    if isinstance(value, (float, numpy.floating)):
+        return '{0:g}'.format(value)
+    return str(value)
+
+def _literal(value):
+    """The filter expression literal of a value (floats round-trip)."""
+    if numpy.ndim(value):
+        return '[' + ', '.join(_literal(item) for item in value) + ']'
+    if isinstance(value, (float, numpy.floating)):
+        return repr(float(value))
+    return str(int(value))
+
+
+class ColumnStats(object):
+    """
+    The statistics of one column and its histogram bars.
+
+    :Parameters:
+
+    - `name`: the column name
+    - `values`: the values of all acquisitions (one row per acquisition)
+    """
+
+    def __init__(self, name, values):
+        self.name = name
+        self.count = len(values)
+        self.vector = values.ndim > 1
+        if self.vector:
+            unique, counts = numpy.unique(values.reshape(len(values), -1), axis=0,
+                                          return_counts=True)
+        else:
+            unique, counts = numpy.unique(values, return_counts=True)
+        self.unique = len(unique)
+        self.minimum = values.min() if len(values) else None
+        self.maximum = values.max() if len(values) else None
+
+        # the bars: distinct values, bins ``[edges[i], edges[i+1])`` or the
+        # most frequent values
+        self.edges = None
+        self.integer = numpy.issubdtype(unique.dtype, numpy.integer)
+        if self.unique <= MAX_BARS:
+            self.kind = 'values'
+            self.values, self.counts = unique, counts
+        elif not self.vector and numpy.issubdtype(unique.dtype, numpy.number):
+            self.kind = 'bins'
+            if self.integer:
+                # the edges are Python ints (those of 64 bit columns may not
+                # fit into int64), the offsets from the minimum are exact in
+                # uint64 arithmetic (also for signed columns)
+                low, high = int(unique[0]), int(unique[-1])
+                width = -(-(high - low + 1) // MAX_BARS)
+                nbins = -(-(high - low + 1) // width)
+                self.edges = numpy.array([low + bar * width for bar in range(nbins + 1)],
+                                         dtype=object)
+                offsets = unique.astype(numpy.uint64) - unique[:1].astype(numpy.uint64)
+                bins = (offsets // numpy.uint64(width)).astype(numpy.int64)
+                self.counts = numpy.bincount(bins, weights=counts, minlength=nbins)
+            else:
+                self.edges = numpy.histogram_bin_edges(unique, MAX_BARS)
+                self.counts, _ = numpy.histogram(unique, self.edges, weights=counts)
+            self.counts = self.counts.astype(numpy.int64)
+            self.values = self.edges[:-1]
+        else:
+            self.kind = 'most frequent'
+            order = numpy.argsort(counts, kind='stable')[::-1][:MAX_BARS]
+            self.values, self.counts = unique[order], counts[order]
+
+    def label(self, bar):
+        """The axis label of bar `bar`."""
+        if self.kind != 'bins':
+            return formatValue(self.values[bar])
+        if self.integer:
+            low, high = self.binRange(bar)
+            return str(low) if low == high else '{0}-{1}'.format(low, high)
+        return formatValue(self.edges[bar])
+
+    def binRange(self, bar):
+        """The first and last value of the integer bin `bar` (the last bin
+        ends at the maximum, which may be the largest value of the type)."""
+        return self.edges[bar], min(self.edges[bar + 1] - 1, int(self.maximum))
+
+    def expression(self, bar):
+        """The filter expression selecting the acquisitions of bar `bar`."""
+        if self.kind == 'bins' and self.integer:
+            low, high = self.binRange(bar)
+            return '({0} >= {1}) & ({0} <= {2})'.format(self.name, low, high)
+        if self.kind == 'bins':
+            last = bar == len(self.counts) - 1
+            return '({0} >= {1}) & ({0} {2} {3})'.format(
+                self.name, _literal(self.edges[bar]), '<=' if last else '<',
+                _literal(self.edges[bar + 1]))
+        if self.vector:
+            return 'np.all({0} == {1}, axis=1)'.format(self.name, _literal(self.values[bar]))
+        return '{0} == {1}'.format(self.name, _literal(self.values[bar]))
+
+    def describe(self):
+        """A title for the histogram."""
+        if self.kind == 'values':
+            return '{0}: {1} distinct values'.format(self.name, self.unique)
+        if self.kind == 'bins':
+            return '{0}: {1} distinct values in {2} bins'.format(
+                self.name, self.unique, len(self.counts))
+        return '{0}: the {1} most frequent of {2} distinct values'.format(
+            self.name, len(self.counts), self.unique)
+
+
+class StatisticsWorker(QThread):
+    """
+    Background thread computing the statistics of all columns.
+
+    :Parameters:
+
+    - `index`: the complete HeaderIndex
+    - `colnames`: the column names of the table model
+    """
+
+    #: Emitted with ``(columns done, columns)``.
+    progress = pyqtSignal(int, int)
+
+    def __init__(self, index, colnames, parent=None):
+        super(StatisticsWorker, self).__init__(parent)
+        self.index = index
+        self.colnames = colnames
+        self.total = index.total
+        self.cancelled = False
+        self.result = None
+        self.error = None
+
+    def run(self):
+        result = {}
+        try:
+            for done, name in enumerate(self.colnames):
+                if self.cancelled:
+                    return
+                result[name] = ColumnStats(name, self.index.column(name))
+                self.progress.emit(done + 1, len(self.colnames))
+        except Exception as e:
+            self.error = e
+            return
+        self.result = result
+
+    def cancel(self):
+        self.cancelled = True
+        self.wait()
+
+
+class StatisticsDock(QDockWidget):
+    """
+    A dock widget with the statistics of the columns of a dataset view.
+
+    The statistics are computed while the dock is shown, once the header
+    index of the view is complete. They are kept by the DatasetView
+    (``statistics``) and computed again if the dataset has grown.
+
+    :Parameters:
+
+    - `parent`: the parent of this widget
+    """
+
+    #: Emitted with the filter expression of a clicked histogram bar.
+    filterRequested = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super(StatisticsDock, self).__init__('Column statistics', parent)
+        self.setObjectName('column_statistics_dock')
+        self.view = None
+        self.worker = None
+        self.plot = None
+        self.bars = None
+        self.shown = None
+
+        self.statusLabel = QLabel()
+        self.table = QTableWidget(0, 4)
+        self.table.setHorizontalHeaderLabels(['Column', 'Min', 'Max', 'Unique'])
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table.setSelectionBehavior(QTableWidget.SelectRows)
+        self.table.setSelectionMode(QTableWidget.SingleSelection)
+        self.table.currentCellChanged.connect(self.showHistogram)
+
+        self.histogramTitle = QLabel()
+        self.histogramBox = QWidget()
+        self.histogramLayout = QVBoxLayout(self.histogramBox)
+        self.histogramLayout.setContentsMargins(0,0,0,0)
+        self.histogramLayout.addWidget(self.histogramTitle)
+
+        self.splitter = QSplitter(Qt.Vertical)
+        self.splitter.addWidget(self.table)
+        self.splitter.addWidget(self.histogramBox)
+
+        widget = QWidget()
+        layout = QVBoxLayout(widget)
+        layout.addWidget(self.statusLabel)
+        layout.addWidget(self.splitter)
+        self.setWidget(widget)
+
+        self.visibilityChanged.connect(self.refresh)
+
+    def setView(self, view):
+        """Show the statistics of another dataset view."""
+        if view is self.view:
+            return
+        self.cancel()
+        if self.view is not None:
+            self.view.indexFinished.disconnect(self.onIndexFinished)
+        self.view = view
+        self.view.indexFinished.connect(self.onIndexFinished)
+        self.refresh(self.isVisible())
+
+    def onIndexFinished(self):
+        self.refresh(self.isVisible())
+
+    def refresh(self, visible=True):
+        """Show the statistics of the view, compute them if needed (only
+        while the dock is shown)."""
+        if not visible or self.view is None or self.worker is not None:
+            return
+        index = self.view.headerIndex
+        stats = self.view.statistics
+        if stats is not None and (index is None or stats[0] == index.total):
+            self.showStatistics()
+            return
+        if index is None:
+            self.clear('Streams have no header index.' if self.view.tableModel.rbuffer.engine
+                       is None else 'Waiting for the header index.')
+            return
+        if not index.isComplete():
+            self.clear('Waiting for the header index ({0} of {1} rows).'.format(
+                index.nindexed, index.total))
+            return
+
+        self.clear('Computing the statistics of {0} acquisitions...'.format(index.total))
+        self.worker = StatisticsWorker(index, self.view.tableModel.colnames, self)
+        self.worker.progress.connect(lambda done, total: self.statusLabel.setText(
+            'Computing the statistics ({0} of {1} columns)...'.format(done, total)))
+        self.worker.finished.connect(self.onFinished)
+        self.worker.start()
+
+    def onFinished(self):
+        worker, self.worker = self.worker, None
+        if worker.error is not None:
+            self.clear('Could not compute the statistics: {0}'.format(worker.error))
+            return
+        self.view.statistics = (worker.total, worker.result)
+        self.showStatistics()
+        # the dataset may have grown meanwhile
+        self.refresh(self.isVisible())
+
+    def cancel(self):
+        worker = self.worker
+        if worker is not None:
+            self.worker = None
+            worker.finished.disconnect(self.onFinished)
+            worker.cancel()
+            worker.deleteLater()
+
+    def clear(self, message):
+        self.table.setRowCount(0)
+        self.showBars(None)
+        self.statusLabel.setText(message)
+
+    def showStatistics(self):
+        """Fill the table with the statistics of the view."""
+        total, stats = self.view.statistics
+        if self.shown is stats:
+            return
+        self.shown = stats
+        current = self.table.currentRow()
+        self.table.blockSignals(True)
+        self.table.setRowCount(len(stats))
+        for row, name in enumerate(self.view.tableModel.colnames):
+            column = stats[name]
+            values = (name, formatValue(column.minimum), formatValue(column.maximum),
+                      str(column.unique))
+            for col, text in enumerate(values):
+                item = QTableWidgetItem(text)
+                if col:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, col, item)
+        self.table.blockSignals(False)
+        self.statusLabel.setText('{0} acquisitions. Click a bar to filter the table '
+                                 '(Ctrl+click narrows the filter).'.format(total))
+        self.table.setCurrentCell(max(current, 0), 0)
+        self.showHistogram(self.table.currentRow())
+
+    def showHistogram(self, row, *args):
+        if self.view is None or self.view.statistics is None or row < 0:
+            self.showBars(None)
+            return
+        name = self.view.tableModel.colnames[row]
+        self.showBars(self.view.statistics[1].get(name))
+
+    def createPlot(self):
+        global pg
+        if pg is None:
+            import pyqtgraph
+            pg = pyqtgraph
+        self.plot = pg.PlotWidget()
+        self.plot.setMouseEnabled(x=False, y=False)
+        self.plot.hideButtons()
+        self.plot.setMinimumHeight(150)
+        self.plot.scene().sigMouseClicked.connect(self.onPlotClicked)
+        self.histogramLayout.addWidget(self.plot, 1)
+
+    def showBars(self, column):
+        """Show the histogram bars of a ColumnStats (None clears them)."""
+        self.bars = column
+        if column is None:
+            self.histogramTitle.clear()
+            if self.plot is not None:
+                self.plot.clear()
+            return
+        if self.plot is None:
+            self.createPlot()
+        self.plot.clear()
+        self.histogramTitle.setText(column.describe())
+        x = numpy.arange(len(column.counts))
+        self.plot.addItem(pg.BarGraphItem(x=x, height=column.counts, width=0.8,
+                                          brush=pg.mkBrush(80, 120, 200)))
+        step = max(1, len(x) // 12)
+        self.plot.getAxis('bottom').setTicks(
+            [[(bar, column.label(bar)) for bar in range(0, len(x), step)]])
+        self.plot.setXRange(-0.6, len(x) - 0.4, padding=0)
+        self.plot.setYRange(0, max(int(column.counts.max()), 1) * 1.05, padding=0)
+
+    def onPlotClicked(self, event):
+        if self.bars is None or self.view is None:
+            return
+        pos = self.plot.getPlotItem().vb.mapSceneToView(event.scenePos())
+        bar = int(round(pos.x()))
+        if not 0 <= bar < len(self.bars.counts) or abs(pos.x() - bar) > 0.4:
+            return
+        expression = self.bars.expression(bar)
+        current = self.view.tableModel.filter_expr.strip()
+        if current and QApplication.keyboardModifiers() & Qt.ControlModifier:
+            expression = '({0}) & ({1})'.format(current, expression)
+        self.filterRequested.emit(expression)
+
+    def shutdown(self):
+        self.cancel()
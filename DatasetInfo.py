@@ -0,0 +1,65 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements a dock widget reporting the storage layout of the
+acquisition dataset and how the viewer accesses it.
+"""
+
+from PyQt5.QtWidgets import QDockWidget, QTableWidget, QTableWidgetItem, QHeaderView
+
+class DatasetInfoDock(QDockWidget):
+    """
+    A dock widget with a two column (property, value) table.
+
+    :Parameters:
+
+    - `rbuffer`: the TableBuffer whose layout is reported
+    - `parent`: the parent of this widget
+    """
+
+    def __init__(self, rbuffer, parent=None):
+        super(DatasetInfoDock, self).__init__('Dataset layout', parent)
+        self.setObjectName('dataset_info_dock')
+        self.rbuffer = rbuffer
+
+        self.table = QTableWidget(0, 2)
+        self.table.setHorizontalHeaderLabels(['Property', 'Value'])
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeToContents)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.setWidget(self.table)
+
+        self.visibilityChanged.connect(self.refresh)
+
+    def setBuffer(self, rbuffer):
+        """Report the layout of another dataset."""
+        self.rbuffer = rbuffer
+        self.refresh(self.isVisible())
+
+    def refresh(self, visible=True):
+        """Fill the table (only while the dock is shown)."""
+        if not visible:
+            return
+
+        info = self.rbuffer.describe()
+        self.table.setRowCount(len(info))
+        for row, (name, value) in enumerate(info):
+            self.table.setItem(row, 0, QTableWidgetItem(name))
+            self.table.setItem(row, 1, QTableWidgetItem(value))
@@ -0,0 +1,298 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module inspects the storage layout of the HDF5 datasets of an ISMRMRD
+file (contiguous or chunked storage, filters, position in the file).
+
+For contiguous, unfiltered datasets the fixed size fields of the records
+(e.g. the acquisition headers) can be memory-mapped directly from the file,
+which avoids the copying read path of h5py.
+
+For chunked datasets the HDF5 raw data chunk cache is sized to the chunk
+shape (see `openDataset`) and reads can be aligned to chunk boundaries (see
+`DatasetLayout.alignRange`), so that compressed chunks are not decompressed
+several times.
+
+Files rewritten by `Rechunk` may contain a header sidecar next to a compound
+dataset (e.g. ``data_headers`` next to ``data``): a contiguous copy of the
+headers only, which can be memory-mapped even if the records themselves are
+chunked and compressed (see `openSidecar`).
+"""
+
+import numpy
+import h5py
+
+#: File drivers storing the raw data of a dataset in a single plain file.
+_MAPPABLE_DRIVERS = ('sec2', 'stdio')
+
+#: Lower bound of the chunk cache size (the HDF5 default) in bytes.
+MIN_CHUNK_CACHE = 2 ** 20
+
+#: Upper bound of the chunk cache size in bytes (raised to one chunk if a
+#: single chunk is larger).
+MAX_CHUNK_CACHE = 256 * 2 ** 20
+
+#: Aligned reads may cover at most this multiple of the requested rows.
+MAX_ALIGN_FACTOR = 4
+
+#: Name suffix of the header sidecar of a compound dataset.
+SIDECAR_SUFFIX = '_headers'
+
+_LAYOUT_NAMES = {
+    h5py.h5d.COMPACT: 'compact',
+    h5py.h5d.CONTIGUOUS: 'contiguous',
+    h5py.h5d.CHUNKED: 'chunked',
+}
+
+def _nextPrime(n):
+    """Return the smallest prime number >= n."""
+    n = max(n, 2)
+    while any(n % d == 0 for d in range(2, int(n ** 0.5) + 1)):
+        n += 1
+    return n
+
+def openDataset(group, name, bufferRows, nchunks=None):
+    """Open a dataset with a chunk cache sized for the viewer's reads.
+
+    The dataset is opened with a dataset access property list whose raw
+    data chunk cache can hold the chunks spanned by two buffers of
+    `bufferRows` rows (or `nchunks` chunks, e.g. for N-D image data).
+    Returns the `DatasetLayout` of the opened dataset.
+
+    :Parameters:
+    :param group: the h5py.Group containing the dataset
+    :param name: the dataset name
+    :param bufferRows: the number of rows read per buffer fault
+    :param nchunks: the number of chunks to cache (overrides `bufferRows`)
+    """
+
+    layout = DatasetLayout(group[name])
+    settings = layout.chunkCacheSettings(bufferRows, nchunks)
+    if settings is None:
+        return layout
+
+    # reopen the dataset (the cache settings only apply if the dataset is not
+    # open yet, so the handle used for the inspection is released first)
+    layout.dataset = None
+    dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+    dapl.set_chunk_cache(*settings)
+    layout.dataset = h5py.Dataset(h5py.h5d.open(group.id, name.encode(), dapl))
+    return layout
+
+def openSidecar(group, name, dataset):
+    """Return the `DatasetLayout` of the header sidecar of a dataset.
+
+    None is returned if there is no sidecar or if it does not match the
+    dataset: the number of rows, the header type and the first and last
+    headers are compared, so that a sidecar is not used once acquisitions
+    were appended or headers were edited after the file was rewritten.
+
+    :Parameters:
+    :param group: the h5py.Group containing the dataset
+    :param name: the dataset name
+    :param dataset: the h5py.Dataset whose headers are looked up
+    """
+
+    sidecar = group.get(name + SIDECAR_SUFFIX)
+    if not isinstance(sidecar, h5py.Dataset) or sidecar.shape != dataset.shape:
+        return None
+    if sidecar.dtype.names != ('head',) or dataset.dtype.names is None or \
+            'head' not in dataset.dtype.names or \
+            sidecar.dtype['head'] != dataset.dtype['head']:
+        return None
+    if len(dataset):
+        heads = dataset.fields(['head'])
+        for row in (0, len(dataset) - 1):
+            if heads[row].tobytes() != sidecar[row].tobytes():
+                return None
+    return DatasetLayout(sidecar)
+
+class DatasetLayout(object):
+    """Storage layout of a one dimensional (compound) HDF5 dataset.
+
+    :Parameter dataset: the h5py.Dataset being inspected
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        plist = dataset.id.get_create_plist()
+
+        self.layout = plist.get_layout()
+        self.chunks = dataset.chunks
+        self.filters = [plist.get_filter(ind)[3].decode('ascii', 'replace')
+                        for ind in range(plist.get_nfilters())]
+        self.external = plist.get_external_count() > 0
+
+        # the file type (the in-file record layout may differ from the
+        # memory type used by h5py)
+        self.fileType = dataset.id.get_type()
+
+        self.offset = None
+        if self.layout == h5py.h5d.CONTIGUOUS:
+            self.offset = dataset.id.get_offset()
+
+    def chunkBytes(self):
+        """The uncompressed size of one chunk in bytes (None if not chunked)."""
+        if self.chunks is None:
+            return None
+        return int(numpy.prod(self.chunks)) * self.fileType.get_size()
+
+    def chunkCacheSettings(self, bufferRows, nchunks=None):
+        """Return chunk cache settings ``(nslots, nbytes, w0)`` for reads of
+        `bufferRows` rows (or for `nchunks` chunks), or None if the dataset
+        is not chunked.
+        """
+
+        chunkBytes = self.chunkBytes()
+        if chunkBytes is None:
+            return None
+
+        # two buffers (current and neighbouring page) plus the partially
+        # covered chunks at their borders
+        if nchunks is None:
+            nchunks = 2 * (-(-bufferRows // self.chunks[0])) + 2
+        nbytes = min(max(nchunks * chunkBytes, MIN_CHUNK_CACHE),
+                     max(MAX_CHUNK_CACHE, chunkBytes))
+
+        # HDF5 recommends a prime number of slots, about 100 times the number
+        # of chunks fitting into the cache
+        nslots = _nextPrime(max(521, 100 * (nbytes // chunkBytes)))
+
+        return (nslots, nbytes, 0.75)
+
+    def alignRange(self, start, stop, total):
+        """Extend the row range ``[start, stop)`` to chunk boundaries.
+
+        The range is returned unchanged if the dataset is not chunked or if
+        the aligned range would be much larger than the requested one.
+
+        :Parameters:
+        :param start: the first row of the range
+        :param stop: the row following the last row of the range
+        :param total: the number of rows of the dataset
+        """
+
+        if self.chunks is None or stop <= start:
+            return start, stop
+
+        rows = self.chunks[0]
+        alignedStart = start - start % rows
+        alignedStop = min(-(-stop // rows) * rows, total)
+        if alignedStop - alignedStart > MAX_ALIGN_FACTOR * (stop - start):
+            return start, stop
+
+        return alignedStart, alignedStop
+
+    def isContiguous(self):
+        """True if the records are stored unfiltered in one block of the file."""
+        return (self.layout == h5py.h5d.CONTIGUOUS and not self.filters and
+                not self.external and self.offset is not None)
+
+    def fieldDtype(self, field):
+        """Return the in-file ``(dtype, offset)`` of the compound member `field`.
+
+        Returns None if the dataset is not a compound dataset or has no such
+        member.
+        """
+
+        if self.fileType.get_class() != h5py.h5t.COMPOUND:
+            return None
+        for ind in range(self.fileType.get_nmembers()):
+            if self.fileType.get_member_name(ind).decode() == field:
+                return (self.fileType.get_member_type(ind).dtype,
+                        self.fileType.get_member_offset(ind))
+        return None
+
+    def memmap(self, field):
+        """Memory-map the compound member `field` of all records.
+
+        The returned array has a single field named `field` and strides over
+        the full in-file records. None is returned if the dataset cannot be
+        mapped (chunked or filtered storage, variable length member, ...).
+        """
+
+        if not self.isContiguous() or \
+                self.dataset.file.driver not in _MAPPABLE_DRIVERS:
+            return None
+
+        member = self.fieldDtype(field)
+        if member is None or member[0].hasobject:
+            return None
+
+        dtype = numpy.dtype({'names': [field], 'formats': [member[0]],
+                             'offsets': [member[1]],
+                             'itemsize': self.fileType.get_size()})
+        nrows = self.dataset.shape[0]
+        if nrows == 0:
+            return None
+
+        try:
+            mmap = numpy.memmap(self.dataset.file.filename, dtype=dtype,
+                                mode='r', offset=self.offset, shape=(nrows,))
+        except (OSError, ValueError):
+            return None
+
+        # make sure the mapping really points at the records (e.g. user
+        # blocks shift the raw data addresses)
+        for row in (0, nrows - 1):
+            if mmap[row][field].tobytes() != \
+                    self.dataset[row:row + 1, field][0].tobytes():
+                return None
+
+        return mmap
+
+    def describe(self):
+        """Return a list of ``(property, value)`` pairs describing the layout."""
+        itemsize = self.fileType.get_size()
+        nrows = self.dataset.shape[0] if self.dataset.shape else 0
+        storage = self.dataset.id.get_storage_size()
+
+        info = [
+            ('Dataset', self.dataset.name),
+            ('Rows', str(nrows)),
+            ('Record size (in file)', '{0} bytes'.format(itemsize)),
+            ('Layout', _LAYOUT_NAMES.get(self.layout, str(self.layout))),
+        ]
+        if self.chunks is not None:
+            info.append(('Chunk shape', str(self.chunks)))
+            info.append(('Chunk size (uncompressed)', '{0} bytes'.format(self.chunkBytes())))
+        if self.offset is not None:
+            info.append(('File offset', str(self.offset)))
+        info.append(('Filters', ', '.join(self.filters) if self.filters else 'none'))
+        info.append(('External storage', 'yes' if self.external else 'no'))
+        # the payload of variable length members (data, traj) is stored in
+        # the global heap of the file: neither chunked nor filtered, and not
+        # part of the storage size of the dataset
+        vlen = [name for name in (self.dataset.dtype.names or ())
+                if h5py.check_vlen_dtype(self.dataset.dtype[name]) is not None]
+        if vlen:
+            info.append(('Storage size (records only)', '{0} bytes'.format(storage)))
+            if storage:
+                info.append(('Compression ratio (records only)',
+                             '{0:.2f}'.format(nrows * itemsize / storage)))
+            info.append(('Variable length payload', '{0}: global heap, not compressed'.format(
+                ', '.join(vlen))))
+        else:
+            info.append(('Storage size', '{0} bytes'.format(storage)))
+            if storage:
+                info.append(('Compression ratio', '{0:.2f}'.format(nrows * itemsize / storage)))
+
+        nslots, nbytes, w0 = self.dataset.id.get_access_plist().get_chunk_cache()
+        info.append(('Chunk cache', '{0} bytes, {1} slots, w0={2}'.format(nbytes, nslots, w0)))
+        return info
@@ -0,0 +1,377 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements the view of one ISMRMRD dataset group (e.g.
+``/dataset``): the acquisition table with its filter bar and plots, the
+waveform and image tabs and the header index.
+
+A file may contain several dataset groups (multi-scan files); the
+`Workspace.FileView` of the file keeps one `DatasetView` per opened group, so
+the buffers and indices of a group are kept while another one is shown.
+
+The state of a view is saved in the `SessionCache` when the file is closed
+(`sessionState`) and restored once the view has been painted for the first
+time (`restoreSession`).
+"""
+
+import numpy
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QSplitter, QTabWidget
+from PyQt5.QtWidgets import QAbstractItemView as _aiv
+import ISMRMRDTableView, ISMRMRDTableModel, ISMRMRDPlotWidgets
+import HeaderIndex, FilterBar, ISMRMRDWaveforms, ISMRMRDImages, SessionCache
+
+class DatasetView(QWidget):
+    """
+    The widgets and the header index of one ISMRMRD dataset group.
+
+    :Parameters:
+
+    - `dset`: the ismrmrd.Dataset (or stream source) of the group
+    - `rbuffer`: replaces the TableBuffer of `dset` (e.g. by a ring buffer)
+    - `parent`: the parent of this widget
+    """
+
+    #: Emitted with ``(indexed rows, total rows)`` while the index is built.
+    indexProgress = pyqtSignal(int, int)
+
+    #: Emitted once the header index is complete.
+    indexFinished = pyqtSignal()
+
+    #: Emitted with a message if building the header index failed.
+    indexFailed = pyqtSignal(str)
+
+    #: Emitted with a message for the status bar.
+    statusMessage = pyqtSignal(str)
+
+    def __init__(self, dset, rbuffer=None, parent=None):
+        super(DatasetView, self).__init__(parent)
+        self.dset = dset
+
+        # create table model and view
+        self.tableModel = ISMRMRDTableModel.TableModel(self.dset, rbuffer=rbuffer)
+        self.tableView = ISMRMRDTableView.TableView(self.tableModel)
+
+        # create plot area
+        self.plotWidget = ISMRMRDPlotWidgets.ISMRMRDPlotWidget(self.tableModel,self.tableView)
+
+        # connect table selection change event to plot update function
+        self.tableView.selectionModel().selectionChanged.connect(self.plotWidget.onSelectionChanged)
+
+        # set layout and widgets
+        _widget = QWidget()
+        _layout = QVBoxLayout(_widget)
+        self.filterBar = FilterBar.FilterBar(self.tableModel, self.tableView)
+        _layout.addWidget(self.filterBar)
+        self.splitter = QSplitter()
+        self.splitter.setOrientation(Qt.Vertical)
+        self.splitter.addWidget(self.tableView)
+        self.splitter.addWidget(self.plotWidget)
+        self.splitter.setStretchFactor(0,10)
+        self.splitter.setStretchFactor(1,1)
+        _layout.addWidget(self.splitter)
+
+        # waveforms and images tabs (created when opened for the first time)
+        self.tabs = None
+        self.waveformTab = None
+        self.imageTab = None
+        self.lazyTabs = {}
+        if ISMRMRDWaveforms.hasWaveforms(self.dset):
+            self.lazyTabs['Waveforms'] = self.createWaveformTab
+        if ISMRMRDImages.listImageSeries(self.dset):
+            self.lazyTabs['Images'] = self.createImageTab
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0,0,0,0)
+        if self.lazyTabs:
+            self.tabs = QTabWidget()
+            self.tabs.addTab(_widget, 'Acquisitions')
+            for title in self.lazyTabs:
+                self.tabs.addTab(QWidget(), title)
+            self.tabs.currentChanged.connect(self.createLazyTab)
+            layout.addWidget(self.tabs)
+        else:
+            layout.addWidget(_widget)
+
+        self.headerIndex = None
+        self.indexReleased = False
+
+        # the findings of the last validation (see `Validate.ValidationDock`)
+        self.validation = None
+
+        # ``(rows, {column: ColumnStats})`` (see `ColumnStatistics`)
+        self.statistics = None
+
+        # the decoded acquisition flags (see `AcquisitionFlags.FlagDock`)
+        self.flagIndex = None
+
+        # the spike scores of the acquisitions (see `SpikeDetector.SpikeDock`)
+        self.spikes = None
+
+        # the trajectory histogram (see `TrajectoryView.TrajectoryDock`)
+        self.trajectory = None
+        self.startupFinished = False
+
+        # the entry of the session cache restored at start-up (see
+        # `SessionCache.Session`)
+        self.session = None
+
+        # the rows of an active filter/sort are updated at most twice a second
+        self.rowMapTimer = QTimer(self)
+        self.rowMapTimer.setSingleShot(True)
+        self.rowMapTimer.setInterval(500)
+        self.rowMapTimer.timeout.connect(self.updateRowMap)
+
+    def finishStartup(self):
+        """Create the plots and start the header index (once the plotting
+        stack may be imported)."""
+        if self.startupFinished:
+            return
+        self.startupFinished = True
+        self.plotWidget.createPlots()
+        self.startHeaderIndex()
+        if self.session is not None:
+            self.restoreSession(self.session.state)
+
+    def startHeaderIndex(self):
+        rbuffer = self.tableModel.rbuffer
+        if rbuffer.engine is None:
+            # streams are not indexed
+            return
+        self.headerIndex = HeaderIndex.HeaderIndex(rbuffer.engine, rbuffer.total_nrows(),
+                                                   mmap=rbuffer.mmap, parent=self)
+        if self.session is not None and self.headerIndex.storage is not None:
+            # the index saved when the file was closed
+            saved = self.session.loadIndex(self.headerIndex.total, self.headerIndex.blockRows)
+            if saved is not None:
+                self.headerIndex.restore(*saved)
+        self.tableModel.setIndex(self.headerIndex)
+        self.headerIndex.progress.connect(self.onIndexProgress)
+        self.headerIndex.finished.connect(self.onIndexFinished)
+        self.headerIndex.failed.connect(self.onIndexFailed)
+        self.headerIndex.start()
+
+    def onIndexProgress(self, indexed, total):
+        if not self.rowMapTimer.isActive():
+            self.rowMapTimer.start()
+        self.indexProgress.emit(indexed, total)
+
+    def onIndexFinished(self):
+        self.rowMapTimer.stop()
+        self.updateRowMap()
+        self.indexFinished.emit()
+
+    def onIndexFailed(self, message):
+        # the rows indexed so far stay usable
+        self.rowMapTimer.stop()
+        self.updateRowMap()
+        self.indexFailed.emit(message)
+        self.statusMessage.emit('Indexing the headers failed: {0}'.format(message))
+
+    def updateRowMap(self):
+        # extend the filtered/sorted rows with the newly indexed blocks
+        if self.tableModel.rowmap is not None:
+            self.tableModel.updateRowMap(keep_position=True)
+            self.tableView.updateRowCount()
+        self.filterBar.updateStatus()
+
+    def createLazyTab(self, index):
+        """Replace the placeholder of a tab by its widget when the tab is
+        opened for the first time."""
+        title = self.tabs.tabText(index)
+        factory = self.lazyTabs.pop(title, None)
+        if factory is None:
+            return
+        placeholder = self.tabs.widget(index)
+        self.tabs.blockSignals(True)
+        self.tabs.removeTab(index)
+        self.tabs.insertTab(index, factory(), title)
+        self.tabs.setCurrentIndex(index)
+        self.tabs.blockSignals(False)
+        placeholder.deleteLater()
+
+    def createWaveformTab(self):
+        self.waveformTab = ISMRMRDWaveforms.WaveformTab(
+            self.dset, self.tableModel, self.tableView)
+        self.waveformTab.acquisitionRequested.connect(self.showAcquisition)
+        return self.waveformTab
+
+    def createImageTab(self):
+        self.imageTab = ISMRMRDImages.ImageTab(self.dset)
+        return self.imageTab
+
+    def showAcquisition(self, row):
+        """Show the acquisition in dataset row `row`."""
+        modelRow = self.tableModel.modelRow(row)
+        if modelRow is None:
+            self.statusMessage.emit('Acquisition {0} is filtered out.'.format(row))
+            return
+        if self.tabs is not None:
+            self.tabs.setCurrentIndex(0)
+        self.tableView.goToRow(modelRow)
+
+    def sessionState(self):
+        """Return the state saved in the session cache: scroll position,
+        selection, plot modes, column layout, filter and sort."""
+
+        model = self.tableModel
+        view = self.tableView
+        current = view.currentIndex()
+        plot = self.plotWidget
+        return {
+            'top': model.start + max(view.rowAt(0), 0),
+            'current': model.start + current.row() if current.isValid() else -1,
+            'column': current.column() if current.isValid() else 0,
+            'selection': [int(row) for row in view.selectedRows()],
+            'filter': model.filter_expr,
+            'sort': [model.sort_column, int(model.sort_order)],
+            'flag_columns': model.flagColumns(),
+            'columns': model.columnCount(),
+            'header': SessionCache.encodeBytes(view.horizontalHeader().saveState()),
+            'splitter': SessionCache.encodeBytes(self.splitter.saveState()),
+            'raw_mode': plot.rawCB.currentText(),
+            'traj_mode': plot.trajCB.currentText(),
+            'selection_mode': plot.selectionCB.currentText(),
+            'overlay': plot.overlaySB.value(),
+            'rate': plot.rateSB.value(),
+            'filtered_playback': plot.cbFiltered.isChecked(),
+        }
+
+    def warmRows(self):
+        """The dataset rows whose complete records are saved in the
+        session cache (the current and the selected acquisitions)."""
+        rows = list(self.tableView.selectedRows()[:SessionCache.MAX_WARM_ROWS])
+        current = self.tableView.currentIndex()
+        if current.isValid() and current.row() < self.tableModel.numrows:
+            rows.append(self.tableModel.datasetRow(current.row()))
+        return numpy.unique(numpy.asarray(rows, dtype=numpy.int64))
+
+    def restoreSession(self, state):
+        """Restore a state returned by `sessionState` (after the header
+        index has been started)."""
+
+        model = self.tableModel
+        view = self.tableView
+        plot = self.plotWidget
+
+        # plot modes (plotted with the restored current cell below)
+        for combo, text in ((plot.rawCB, state['raw_mode']), (plot.trajCB, state['traj_mode']),
+                            (plot.selectionCB, state['selection_mode'])):
+            if combo.findText(text) >= 0:
+                combo.blockSignals(True)
+                combo.setCurrentIndex(combo.findText(text))
+                combo.blockSignals(False)
+        plot.updateOverlayControls()
+        plot.overlaySB.blockSignals(True)
+        plot.overlaySB.setValue(state['overlay'])
+        plot.overlaySB.blockSignals(False)
+        plot.rateSB.setValue(state['rate'])
+        plot.cbFiltered.setChecked(state['filtered_playback'])
+        self.splitter.restoreState(SessionCache.decodeBytes(state['splitter']))
+
+        # columns, filter and sort (the flag columns are read from the index)
+        if state['flag_columns'] and self.headerIndex is not None:
+            model.setFlagColumns(state['flag_columns'])
+        if model.columnCount() == state['columns']:
+            view.horizontalHeader().restoreState(SessionCache.decodeBytes(state['header']))
+        if state['filter']:
+            self.filterBar.setExpression(state['filter'])
+        name, order = state['sort']
+        if name is not None and self.headerIndex is not None:
+            names = [model.columnName(col) for col in range(model.columnCount())]
+            if name in names:
+                model.sort(names.index(name), Qt.SortOrder(order))
+                view.hheader.setSortIndicator(names.index(name), Qt.SortOrder(order))
+        view.updateRowCount()
+
+        # scroll position, current cell and selection
+        if 0 <= state['current'] < model.leaf_numrows:
+            view.goToRow(state['current'], state['column'])
+        top = state['top']
+        if model.start <= top < model.start + model.numrows:
+            view.scrollTo(model.index(top - model.start, 0), _aiv.PositionAtTop)
+            if view.tricky_vscrollbar is not None and view.tricky_vscrollbar.isVisible():
+                view.syncView()
+        if len(state['selection']) > 1:
+            view.selected_rows = numpy.asarray(state['selection'], dtype=numpy.int64)
+            if model.rowmap is not None:
+                view.selected_rows = view.selected_rows[
+                    numpy.isin(view.selected_rows, model.rowmap)]
+            view.restoreSelection()
+            plot.onSelectionChanged()
+
+    def cacheBytes(self):
+        """The memory held by the caches of the view in bytes."""
+        nbytes = self.tableModel.rbuffer.cacheBytes()
+        if self.headerIndex is not None:
+            nbytes += self.headerIndex.nbytes()
+        if self.flagIndex is not None:
+            nbytes += self.flagIndex.nbytes()
+        if self.waveformTab is not None:
+            nbytes += self.waveformTab.tableModel.rbuffer.cacheBytes()
+            nbytes += self.waveformTab.headerIndex.nbytes()
+        if self.imageTab is not None:
+            nbytes += self.imageTab.cache.nbytes
+        return nbytes
+
+    def releaseCaches(self, shown=False):
+        """Free the caches of the view and return the number of bytes freed.
+
+        A `shown` view keeps its header index and the rows its tables show,
+        only the read buffers and the caches derived from the index are
+        freed. Otherwise the header index is released as well (unless a
+        filter or sort depends on it) and rebuilt by `restoreCaches`.
+        """
+
+        before = self.cacheBytes()
+        self.tableModel.releaseCache(shown)
+        if self.waveformTab is not None:
+            self.waveformTab.tableModel.releaseCache(shown)
+        if self.imageTab is not None:
+            self.imageTab.cache.clear()
+        self.flagIndex = None
+        index = self.headerIndex
+        if not shown and index is not None and index.nbytes() and \
+                self.tableModel.rowmap is None:
+            index.cancel()
+            self.tableModel.setIndex(None)
+            self.headerIndex = None
+            self.indexReleased = True
+            index.deleteLater()
+        return before - self.cacheBytes()
+
+    def restoreCaches(self):
+        """Read the rows released by `releaseCaches` again (the view is
+        shown) and rebuild a released header index in the background."""
+        self.tableModel.restoreCache()
+        if self.waveformTab is not None:
+            self.waveformTab.tableModel.restoreCache()
+        if self.indexReleased and self.startupFinished:
+            self.indexReleased = False
+            self.startHeaderIndex()
+
+    def shutdown(self):
+        """Stop the background threads (before the file is closed)."""
+        self.plotWidget.stopPlayback()
+        if self.headerIndex is not None:
+            self.headerIndex.cancel()
+        if self.waveformTab is not None:
+            self.waveformTab.shutdown()
+        if self.imageTab is not None:
+            self.imageTab.shutdown()
@@ -0,0 +1,340 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements the export of a subset of the acquisitions (the rows
+of the current filter, the selected acquisitions or a row range) to a new
+ISMRMRD file with the original XML header.
+
+The records are copied in batches: the sorted dataset rows are coalesced
+into runs of nearby rows (see `coalesce`), every run is read with a single
+hyperslab read through the `ReadEngine` (by the worker processes for
+compressed datasets) and written with a single write of the compound 'data'
+dataset of the new file. The export runs in a background thread reading
+through a read-only file handle of its own and can be cancelled (the
+incomplete file is removed).
+"""
+
+import os
+import time
+import numpy
+import h5py
+from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtWidgets import (QDialog, QRadioButton, QButtonGroup, QSpinBox, QLineEdit, QPushButton,
+                             QLabel, QProgressBar, QFileDialog, QMessageBox, QGridLayout, QHBoxLayout,
+                             QVBoxLayout)
+import Instrumentation
+import ReadEngine
+
+#: The maximum number of rows read (and written) at once.
+BATCH_ROWS = 4096
+
+#: Runs of rows separated by at most this many rows are read at once (the
+#: rows in between are read and dropped).
+MAX_GAP = 16
+
+def coalesce(rows, maxGap=MAX_GAP, maxRows=BATCH_ROWS):
+    """Split dataset rows into batches read with a single hyperslab read.
+
+    Returns a list of ``(start, stop, rows)``: the rows ``[start, stop)``
+    are read, `rows` (sorted) are kept.
+
+    :Parameters:
+    :param rows: the dataset rows to copy (any order, duplicates ignored)
+    :param maxGap: the maximum number of skipped rows within a batch
+    :param maxRows: the maximum number of rows read per batch
+    """
+
+    rows = numpy.unique(numpy.asarray(rows, dtype=numpy.int64))
+    if not len(rows):
+        return []
+    breaks = numpy.flatnonzero(numpy.diff(rows) > maxGap + 1) + 1
+    batches = []
+    for run in numpy.split(rows, breaks):
+        pos = 0
+        while pos < len(run):
+            stop = pos + int(numpy.searchsorted(run[pos:], run[pos] + maxRows))
+            part = run[pos:stop]
+            batches.append((int(part[0]), int(part[-1]) + 1, part))
+            pos = stop
+    return batches
+
+
+class ExportWorker(QThread):
+    """
+    Background thread copying acquisitions to a new ISMRMRD file.
+
+    :Parameters:
+
+    - `source`: a read-only h5py.File of the source file opened for the
+      thread (see `ReadEngine.reopenReadOnly`), closed when it is done
+    - `path`: the path of the source acquisition dataset, e.g.
+      ``/dataset/data`` (the XML header is taken from its group)
+    - `rows`: the dataset rows to copy
+    - `fileName`: the new file (overwritten)
+    - `groupName`: the name of the dataset group in the new file
+    """
+
+    #: Emitted with ``(written rows, total rows)`` after every batch.
+    progress = pyqtSignal(int, int)
+
+    def __init__(self, source, path, rows, fileName, groupName='dataset', parent=None):
+        super(ExportWorker, self).__init__(parent)
+        self.source = source
+        self.path = path
+        self.rows = rows
+        self.fileName = fileName
+        self.groupName = groupName
+        self.cancelled = False
+        self.error = None
+        self.written = 0
+        self.elapsed = 0.0
+
+    def createDataset(self, group, source, nrows):
+        """Create the acquisition dataset like the `source` one (type,
+        chunks and compression)."""
+        options = {}
+        if source.chunks is not None:
+            options['chunks'] = source.chunks
+            if source.compression is not None:
+                options['compression'] = source.compression
+                options['compression_opts'] = source.compression_opts
+            options['shuffle'] = source.shuffle
+        else:
+            options['chunks'] = True
+        return group.create_dataset('data', shape=(nrows,), maxshape=(None,),
+                                    dtype=source.dtype, **options)
+
+    @Instrumentation.probe('ExportWorker.run')
+    def run(self):
+        t0 = time.perf_counter()
+        batches = coalesce(self.rows)
+        total = sum(len(rows) for _, _, rows in batches)
+        try:
+            with self.source, h5py.File(self.fileName, 'w') as out:
+                data = self.source[self.path]
+                group = out.create_group(self.groupName)
+                if 'xml' in data.parent:
+                    group.copy(data.parent['xml'], 'xml')
+                target = self.createDataset(group, data, total)
+
+                engine = ReadEngine.ReadEngine(data)
+                blocks = engine.map(ranges=[(start, stop) for start, stop, _ in batches])
+                try:
+                    pos = 0
+                    for (start, stop, block), (_, _, rows) in zip(blocks, batches):
+                        if self.cancelled:
+                            break
+                        if len(rows) != stop - start:
+                            block = block[rows - start]
+                        target[pos:pos + len(rows)] = block
+                        pos += len(rows)
+                        self.written = pos
+                        self.progress.emit(pos, total)
+                finally:
+                    blocks.close()
+        except Exception as e:
+            self.error = e
+
+        if self.cancelled or self.error is not None:
+            try:
+                os.remove(self.fileName)
+            except OSError:
+                pass
+        self.elapsed = time.perf_counter() - t0
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ExportDialog(QDialog):
+    """
+    Dialog exporting acquisitions of a dataset view to a new file.
+
+    :Parameters:
+
+    - `view`: the DatasetView whose acquisitions are exported
+    - `parent`: the parent of this widget
+    """
+
+    def __init__(self, view, parent=None):
+        super(ExportDialog, self).__init__(parent)
+        self.setWindowTitle('Export acquisitions')
+        self.view = view
+        self.worker = None
+        # the file name whose overwriting was confirmed by the file dialog
+        self.confirmedName = None
+        model = view.tableModel
+        total = model.rbuffer.total_nrows()
+
+        # which rows
+        self.rbFilter = QRadioButton()
+        if model.rowmap is not None:
+            self.rbFilter.setText('Rows of the current filter ({0} acquisitions)'.format(len(model.rowmap)))
+        else:
+            self.rbFilter.setText('All acquisitions ({0})'.format(total))
+        selected = len(self.selectedRows())
+        self.rbSelected = QRadioButton('Selected acquisitions ({0})'.format(selected)
+                                       if selected > 1 else 'Selected acquisition')
+        self.rbSelected.setEnabled(selected > 0)
+        self.rbRange = QRadioButton('Dataset rows')
+        self.firstSB, self.lastSB = QSpinBox(), QSpinBox()
+        for spinBox in (self.firstSB, self.lastSB):
+            spinBox.setRange(0, max(total - 1, 0))
+        self.lastSB.setValue(max(total - 1, 0))
+        self.rbFilter.setChecked(True)
+        self.rowChoice = QButtonGroup(self)
+        for button in (self.rbFilter, self.rbSelected, self.rbRange):
+            self.rowChoice.addButton(button)
+
+        # target file
+        self.fileEdit = QLineEdit()
+        self.btnBrowse = QPushButton('Browse...')
+        self.btnBrowse.clicked.connect(self.browse)
+
+        self.progressBar = QProgressBar()
+        self.statusLabel = QLabel()
+        self.btnExport = QPushButton('Export')
+        self.btnExport.clicked.connect(self.export)
+        self.btnCancel = QPushButton('Cancel')
+        self.btnCancel.clicked.connect(self.cancel)
+        self.btnCancel.setEnabled(False)
+        self.btnClose = QPushButton('Close')
+        self.btnClose.clicked.connect(self.close)
+
+        rangeBox = QHBoxLayout()
+        rangeBox.addWidget(self.rbRange)
+        rangeBox.addWidget(self.firstSB)
+        rangeBox.addWidget(QLabel('to'))
+        rangeBox.addWidget(self.lastSB)
+        rangeBox.addStretch(1)
+
+        grid = QGridLayout()
+        grid.addWidget(QLabel('File:'), 0, 0)
+        grid.addWidget(self.fileEdit, 0, 1)
+        grid.addWidget(self.btnBrowse, 0, 2)
+
+        buttons = QHBoxLayout()
+        buttons.addStretch(1)
+        buttons.addWidget(self.btnExport)
+        buttons.addWidget(self.btnCancel)
+        buttons.addWidget(self.btnClose)
+
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.rbFilter)
+        layout.addWidget(self.rbSelected)
+        layout.addLayout(rangeBox)
+        layout.addLayout(grid)
+        layout.addWidget(self.progressBar)
+        layout.addWidget(self.statusLabel)
+        layout.addLayout(buttons)
+
+        if model.header_index is not None and not model.header_index.isComplete() \
+                and model.rowmap is not None:
+            self.statusLabel.setText('The header index is incomplete, the filter '
+                                     'only covers the rows indexed so far.')
+
+    def selectedRows(self):
+        """Return the dataset rows of the selected acquisitions."""
+        return self.view.tableView.selectedRows()
+
+    def rows(self):
+        """Return the dataset rows to export."""
+        model = self.view.tableModel
+        if self.rbSelected.isChecked():
+            return self.selectedRows()
+        if self.rbRange.isChecked():
+            return numpy.arange(self.firstSB.value(), self.lastSB.value() + 1)
+        if model.rowmap is not None:
+            return model.rowmap
+        return numpy.arange(model.rbuffer.total_nrows())
+
+    def browse(self):
+        fileName, _ = QFileDialog.getSaveFileName(
+            self, 'Export acquisitions', self.fileEdit.text(),
+            'ISMRMRD files (*.h5 *.hdf5 *.mrd);;All files (*)')
+        if fileName:
+            self.fileEdit.setText(fileName)
+            self.confirmedName = fileName
+
+    def confirmOverwrite(self, fileName):
+        """Ask before an existing file is overwritten (unless this was
+        confirmed in the file dialog already)."""
+        if not os.path.exists(fileName) or fileName == self.confirmedName:
+            return True
+        answer = QMessageBox.question(
+            self, 'Export acquisitions',
+            '{0} already exists.\nDo you want to replace it?'.format(fileName),
+            QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        return answer == QMessageBox.Yes
+
+    def export(self):
+        fileName = self.fileEdit.text().strip()
+        rbuffer = self.view.tableModel.rbuffer
+        if not fileName or self.worker is not None:
+            return
+        if rbuffer.engine is None:
+            self.statusLabel.setText('Streams cannot be exported.')
+            return
+        sourceName = rbuffer.data.file.filename
+        if os.path.abspath(fileName) == os.path.abspath(sourceName):
+            self.statusLabel.setText('Choose a file different from the source file.')
+            return
+        if not self.confirmOverwrite(fileName):
+            return
+
+        rows = self.rows()
+        self.progressBar.setRange(0, max(len(rows), 1))
+        self.progressBar.setValue(0)
+        try:
+            source = ReadEngine.reopenReadOnly(rbuffer.data.file)
+        except OSError as e:
+            self.statusLabel.setText('Could not open the source file: {0}'.format(e))
+            return
+        self.worker = ExportWorker(source, rbuffer.data.name, rows, fileName, parent=self)
+        self.worker.progress.connect(self.onProgress)
+        self.worker.finished.connect(self.onFinished)
+        self.btnExport.setEnabled(False)
+        self.btnCancel.setEnabled(True)
+        self.statusLabel.setText('Exporting {0} acquisitions...'.format(len(rows)))
+        self.worker.start()
+
+    def onProgress(self, written, total):
+        self.progressBar.setValue(written)
+
+    def onFinished(self):
+        worker, self.worker = self.worker, None
+        self.btnExport.setEnabled(True)
+        self.btnCancel.setEnabled(False)
+        if worker.error is not None:
+            self.statusLabel.setText('Export failed: {0}'.format(worker.error))
+        elif worker.cancelled:
+            self.statusLabel.setText('Cancelled.')
+        else:
+            self.statusLabel.setText('Wrote {0} acquisitions to {1} in {2:.1f} s'.format(
+                worker.written, os.path.basename(worker.fileName), worker.elapsed))
+
+    def cancel(self):
+        if self.worker is not None:
+            self.worker.cancel()
+
+    def done(self, result):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker.wait()
+        super(ExportDialog, self).done(result)
@@ -0,0 +1,104 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements the filter bar shown above the acquisition table.
+"""
+
+from PyQt5.QtWidgets import QWidget, QHBoxLayout, QLabel, QLineEdit, QPushButton
+import HeaderIndex
+
+class FilterBar(QWidget):
+    """
+    A line edit for the (vectorized) filter expression of a table model.
+
+    :Parameters:
+
+    - `tableModel`: the filtered TableModel
+    - `tableView`: the TableView showing the model
+    - `parent`: the parent of this widget
+    """
+
+    def __init__(self, tableModel, tableView, parent=None):
+        super(FilterBar, self).__init__(parent)
+        self.tableModel = tableModel
+        self.tableView = tableView
+
+        self.filterEdit = QLineEdit()
+        self.filterEdit.setPlaceholderText(
+            'e.g. (slice == 5) & ~flag(ACQ_IS_NOISE_MEASUREMENT)')
+        self.filterEdit.setToolTip(
+            'Vectorized filter expression over the header fields and encoding\n'
+            'counters. Combine conditions with &, | and ~; "row" is the dataset\n'
+            'row and flag(ACQ_...) tests an acquisition flag. Available functions:\n'
+            + ', '.join(HeaderIndex.FILTER_FUNCTIONS) + '.')
+        self.filterEdit.returnPressed.connect(self.applyFilter)
+        self.btnApply = QPushButton('Apply')
+        self.btnApply.clicked.connect(self.applyFilter)
+        self.btnClear = QPushButton('Clear')
+        self.btnClear.clicked.connect(self.clearFilter)
+        self.statusLabel = QLabel()
+
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(0,0,0,0)
+        layout.addWidget(QLabel('Filter:'))
+        layout.addWidget(self.filterEdit, 1)
+        layout.addWidget(self.btnApply)
+        layout.addWidget(self.btnClear)
+        layout.addWidget(self.statusLabel)
+
+        self.updateStatus()
+
+    def applyFilter(self):
+        """Apply the filter expression (errors are shown in the status)."""
+        try:
+            self.tableModel.setFilter(self.filterEdit.text())
+        except Exception as e:
+            self.statusLabel.setStyleSheet('color: red')
+            self.statusLabel.setText(str(e))
+            return
+
+        self.tableView.updateRowCount()
+        self.tableView.scrollToTop()
+        self.updateStatus()
+
+    def setExpression(self, expression):
+        """Show and apply a filter expression (e.g. of a histogram bar)."""
+        self.filterEdit.setText(expression)
+        self.applyFilter()
+
+    def clearFilter(self):
+        self.filterEdit.clear()
+        self.applyFilter()
+
+    def updateStatus(self):
+        """Show the number of matching rows and the index progress."""
+        model = self.tableModel
+        total = model.rbuffer.total_nrows()
+        self.statusLabel.setStyleSheet('')
+        if model.rowmap is None:
+            text = '{0} rows'.format(total)
+        else:
+            text = '{0} of {1} rows'.format(model.leaf_numrows, total)
+        index = model.header_index
+        if index is not None and index.error is not None:
+            self.statusLabel.setStyleSheet('color: red')
+            text += ' ({0} indexed, indexing failed: {1})'.format(index.nindexed, index.error)
+        elif index is not None and not index.isComplete():
+            text += ' ({0} indexed)'.format(index.nindexed)
+        self.statusLabel.setText(text)
@@ -0,0 +1,486 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements the comparison of the acquisition headers of two
+ISMRMRD datasets (files or dataset groups), e.g. to validate the output of
+converters and anonymizers.
+
+The acquisitions are aligned by their scan counter (by row if the scan
+counters are not unique) and every header column is compared at once with
+NumPy on the complete headers (taken from a complete `HeaderIndex` or the
+memory-mapped headers if possible). Optionally the payloads (data and
+trajectory) are compared by checksums, computed block-wise in the worker
+pool of the `ReadEngine`.
+
+Only the differing rows and columns are shown (`DiffTableModel`).
+"""
+
+import zlib
+import numpy
+from PyQt5.QtCore import Qt, QThread, QAbstractTableModel, QModelIndex, pyqtSignal
+from PyQt5.QtGui import QBrush, QColor
+from PyQt5.QtWidgets import (QDialog, QComboBox, QCheckBox, QPushButton, QLabel, QProgressBar,
+                             QTableView, QGridLayout, QHBoxLayout, QVBoxLayout)
+import Instrumentation
+import DatasetLayout
+import ReadEngine
+import ISMRMRDTableModel
+
+#: The name of the pseudo column of the payload checksums.
+PAYLOAD_COLUMN = 'payload'
+
+# background of the differing cells
+_DIFF_BRUSH = QBrush(QColor(255, 200, 200))
+
+def headerColumns(dtype):
+    """Return the column names of a header dtype (encoding counters by their
+    own name, like in the table model)."""
+    names = []
+    for name in dtype.names:
+        if name == 'idx':
+            names.extend(dtype['idx'].names)
+        else:
+            names.append(name)
+    return names
+
+def columnValues(heads, name):
+    """Return the values of the column `name` of the headers `heads`."""
+    if name in heads.dtype.names or 'idx' not in heads.dtype.names:
+        return heads[name]
+    return heads['idx'][name]
+
+def alignRows(headsA, headsB):
+    """Align the acquisitions of two datasets.
+
+    The acquisitions are matched by scan counter if it is unique in both
+    datasets, by row otherwise. Returns ``(rowsA, rowsB, onlyA, onlyB,
+    method)``: the matched rows (in the order of the rows of A), the rows
+    without a match and the name of the method used.
+    """
+
+    countersA, countersB = headsA['scan_counter'], headsB['scan_counter']
+    if len(numpy.unique(countersA)) == len(countersA) and \
+            len(numpy.unique(countersB)) == len(countersB):
+        _, rowsA, rowsB = numpy.intersect1d(countersA, countersB, assume_unique=True,
+                                            return_indices=True)
+        order = numpy.argsort(rowsA, kind='stable')
+        rowsA, rowsB = rowsA[order], rowsB[order]
+        onlyA = numpy.setdiff1d(numpy.arange(len(headsA)), rowsA, assume_unique=True)
+        onlyB = numpy.setdiff1d(numpy.arange(len(headsB)), rowsB, assume_unique=True)
+        return rowsA, rowsB, onlyA, onlyB, 'scan_counter'
+
+    nrows = min(len(headsA), len(headsB))
+    rows = numpy.arange(nrows)
+    return rows, rows, numpy.arange(nrows, len(headsA)), numpy.arange(nrows, len(headsB)), 'row'
+
+def differingPairs(valuesA, valuesB):
+    """Return the indices of the pairs of values that differ (NaNs in both
+    are equal, array valued columns differ if any element differs)."""
+    neq = valuesA != valuesB
+    if valuesA.dtype.kind == 'f':
+        neq &= ~(numpy.isnan(valuesA) & numpy.isnan(valuesB))
+    if neq.ndim > 1:
+        neq = neq.reshape(len(neq), -1).any(axis=1)
+    return numpy.flatnonzero(neq)
+
+def _payloadChecksums(block):
+    """CRC-32 of the trajectory and data of every acquisition (worker side)."""
+    sums = numpy.empty(len(block), dtype=numpy.uint32)
+    for ind, record in enumerate(block):
+        crc = zlib.crc32(numpy.ascontiguousarray(record['traj']).tobytes())
+        sums[ind] = zlib.crc32(numpy.ascontiguousarray(record['data']).tobytes(), crc)
+    return sums
+
+
+class DiffSource(object):
+    """
+    The acquisitions of one side of a comparison.
+
+    :Parameters:
+
+    - `label`: the name shown for the dataset
+    - `engine`: the ReadEngine of the acquisition dataset
+    - `index`: an optional HeaderIndex of the dataset
+    - `mmap`: optional memory-mapped headers of the dataset
+    - `h5file`: the h5py.File opened for the comparison (closed by `close`)
+    """
+
+    def __init__(self, label, engine, index=None, mmap=None, h5file=None):
+        self.label = label
+        self.engine = engine
+        self.index = index
+        self.mmap = mmap
+        self.h5file = h5file
+
+    @classmethod
+    def fromFile(cls, label, openFile, group, index=None):
+        """Open the acquisitions of a dataset group with a read-only file
+        handle of its own: the DiffWorker thread does not read through the
+        h5py objects of the GUI thread, which may close or reopen them.
+
+        :Parameters:
+        :param openFile: the h5py.File of the ISMRMRD file opened by the GUI
+        :param group: the name of the dataset group
+        :param index: the HeaderIndex of the group if it is shown
+        """
+
+        h5file = ReadEngine.reopenReadOnly(openFile)
+        try:
+            layout = DatasetLayout.openDataset(h5file[group], 'data',
+                                               ISMRMRDTableModel.CHUNK_SIZE)
+            mmap = layout.memmap('head')
+            if mmap is None:
+                sidecar = DatasetLayout.openSidecar(h5file[group], 'data', layout.dataset)
+                if sidecar is not None:
+                    mmap = sidecar.memmap('head')
+        except BaseException:
+            h5file.close()
+            raise
+        return cls(label, ReadEngine.ReadEngine(layout.dataset, layout), index, mmap, h5file)
+
+    def heads(self, cancelled=lambda: False):
+        """Return the headers of all acquisitions (None if cancelled)."""
+        if self.index is not None and self.index.isComplete():
+            return self.index.heads()
+        if self.mmap is not None:
+            return self.mmap['head']
+        blocks = []
+        for _, _, block in self.engine.map(fields=['head']):
+            if cancelled():
+                return None
+            blocks.append(block['head'])
+        if not blocks:
+            return self.engine.dataset.fields(['head'])[0:0]['head']
+        return numpy.concatenate(blocks)
+
+    def payloadChecksums(self, cancelled=lambda: False, progress=None):
+        """Return the payload checksums of all acquisitions (None if
+        cancelled)."""
+        sums = []
+        for start, stop, block in self.engine.map(_payloadChecksums, fields=['traj', 'data']):
+            if cancelled():
+                return None
+            sums.append(block)
+            if progress is not None:
+                progress(stop)
+        if not sums:
+            return numpy.zeros(0, dtype=numpy.uint32)
+        return numpy.concatenate(sums)
+
+    def close(self):
+        """Close the file if it was opened for the comparison."""
+        if self.h5file is not None:
+            self.h5file.close()
+            self.h5file = None
+
+
+class HeaderDiff(object):
+    """
+    The differences of the headers of two datasets.
+
+    :Parameters:
+
+    - `headsA`, `headsB`: the headers of all acquisitions of both datasets
+    """
+
+    @Instrumentation.probe('HeaderDiff.compare')
+    def __init__(self, headsA, headsB):
+        self.headsA = headsA
+        self.headsB = headsB
+        self.rowsA, self.rowsB, self.onlyA, self.onlyB, self.method = alignRows(headsA, headsB)
+
+        # differing pairs (indices into rowsA/rowsB) per column
+        self.pairs = {}
+        for name in headerColumns(headsA.dtype):
+            if name not in headerColumns(headsB.dtype):
+                continue
+            valuesA = columnValues(headsA, name)[self.rowsA]
+            valuesB = columnValues(headsB, name)[self.rowsB]
+            self.pairs[name] = differingPairs(valuesA, valuesB)
+        self.payloadA = self.payloadB = None
+        self.update()
+
+    def setPayloadChecksums(self, sumsA, sumsB):
+        """Add the payload comparison (checksums of all acquisitions)."""
+        self.payloadA, self.payloadB = sumsA, sumsB
+        self.pairs[PAYLOAD_COLUMN] = differingPairs(sumsA[self.rowsA], sumsB[self.rowsB])
+        self.update()
+
+    def update(self):
+        self.columns = [name for name, pairs in self.pairs.items() if len(pairs)]
+        self.counts = dict((name, len(self.pairs[name])) for name in self.columns)
+        if self.columns:
+            self.diffPairs = numpy.unique(numpy.concatenate(
+                [self.pairs[name] for name in self.columns]))
+        else:
+            self.diffPairs = numpy.zeros(0, dtype=numpy.intp)
+
+    def differs(self, pairs, name):
+        """True for the `pairs` (sorted indices) that differ in column `name`."""
+        found = self.pairs[name]
+        pos = numpy.minimum(numpy.searchsorted(found, pairs), max(len(found) - 1, 0))
+        return (found[pos] == pairs) if len(found) else numpy.zeros(len(pairs), dtype=bool)
+
+    def value(self, side, pair, name):
+        """Return the value of column `name` of a matched pair (side 0: A)."""
+        if side == 0:
+            row, heads, sums = self.rowsA[pair], self.headsA, self.payloadA
+        else:
+            row, heads, sums = self.rowsB[pair], self.headsB, self.payloadB
+        if name == PAYLOAD_COLUMN:
+            return '{0:08x}'.format(int(sums[row]))
+        value = columnValues(heads, name)[row]
+        if isinstance(value, numpy.ndarray):
+            return '[' + ','.join(str(v) for v in value) + ']'
+        return str(value)
+
+    def summary(self):
+        text = '{0} matched acquisitions (by {1}), {2} differ'.format(
+            len(self.rowsA), self.method.replace('_', ' '), len(self.diffPairs))
+        if len(self.onlyA) or len(self.onlyB):
+            text += '; {0} only in A, {1} only in B'.format(len(self.onlyA), len(self.onlyB))
+        return text
+
+
+class DiffWorker(QThread):
+    """
+    Background thread reading the headers (and payload checksums) of both
+    datasets and comparing them.
+
+    :Parameters:
+
+    - `sourceA`, `sourceB`: the DiffSource of both datasets
+    - `payload`: also compare the payload checksums
+    """
+
+    #: Emitted with a description of the current step and its progress in %.
+    progress = pyqtSignal(str, int)
+
+    def __init__(self, sourceA, sourceB, payload=False, parent=None):
+        super(DiffWorker, self).__init__(parent)
+        self.sources = (sourceA, sourceB)
+        self.payload = payload
+        self.cancelled = False
+        self.result = None
+        self.error = None
+
+    def run(self):
+        isCancelled = lambda: self.cancelled
+        try:
+            heads = []
+            for side, source in enumerate(self.sources):
+                self.progress.emit('Reading headers of ' + source.label, 50 * side)
+                heads.append(source.heads(isCancelled))
+                if self.cancelled:
+                    return
+            self.progress.emit('Comparing headers', 100)
+            result = HeaderDiff(heads[0], heads[1])
+
+            if self.payload:
+                sums = []
+                for side, source in enumerate(self.sources):
+                    total = max(len(heads[side]), 1)
+                    report = lambda done, side=side, label=source.label, total=total: \
+                        self.progress.emit('Payload checksums of ' + label,
+                                           50 * side + 50 * done // total)
+                    sums.append(source.payloadChecksums(isCancelled, report))
+                    if self.cancelled:
+                        return
+                result.setPayloadChecksums(sums[0], sums[1])
+            self.result = result
+        except Exception as e:
+            self.error = e
+
+    def cancel(self):
+        self.cancelled = True
+        self.wait()
+
+
+class DiffTableModel(QAbstractTableModel):
+    """
+    The differing acquisitions (rows) and header columns of a HeaderDiff.
+
+    Every row shows the values of both datasets (``A / B``) of the columns
+    that differ in at least one acquisition; the differing cells are
+    highlighted.
+
+    :Parameter diff: the HeaderDiff
+    """
+
+    def __init__(self, diff, parent=None):
+        super(DiffTableModel, self).__init__(parent)
+        self.diff = diff
+        self.columns = diff.columns
+        # differing cells, one column per differing header column
+        pairs = diff.diffPairs
+        self.mask = numpy.zeros((len(pairs), len(self.columns)), dtype=bool)
+        for col, name in enumerate(self.columns):
+            self.mask[:, col] = diff.differs(pairs, name)
+
+    def rowCount(self, index=QModelIndex()):
+        return 0 if index.isValid() else len(self.diff.diffPairs)
+
+    def columnCount(self, index=QModelIndex()):
+        return 0 if index.isValid() else 2 + len(self.columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Vertical:
+            return str(section)
+        if section < 2:
+            return ('row A', 'row B')[section]
+        name = self.columns[section - 2]
+        return '{0} ({1})'.format(name, self.diff.counts[name])
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, col = index.row(), index.column()
+        pair = int(self.diff.diffPairs[row])
+        if role == Qt.DisplayRole:
+            if col < 2:
+                rows = self.diff.rowsA if col == 0 else self.diff.rowsB
+                return str(int(rows[pair]))
+            name = self.columns[col - 2]
+            valueA, valueB = self.diff.value(0, pair, name), self.diff.value(1, pair, name)
+            if valueA == valueB:
+                return valueA
+            return '{0} / {1}'.format(valueA, valueB)
+        if role == Qt.BackgroundRole and col >= 2 and self.mask[row, col - 2]:
+            return _DIFF_BRUSH
+        return None
+
+
+class CompareDialog(QDialog):
+    """
+    Dialog comparing the acquisition headers of two open files or groups.
+
+    :Parameters:
+
+    - `fileViews`: the Workspace.FileView objects of the open files
+    - `parent`: the parent of this widget
+    """
+
+    def __init__(self, fileViews, parent=None):
+        super(CompareDialog, self).__init__(parent)
+        self.setWindowTitle('Compare headers')
+        self.fileViews = fileViews
+        self.worker = None
+        self.sources = []
+
+        self.comboA, self.comboB = QComboBox(), QComboBox()
+        for fileView in fileViews:
+            groups = fileView.groups or [(name, 0) for name in fileView.views]
+            for name, _ in groups:
+                view = fileView.views.get(name)
+                if view is not None and view.tableModel.rbuffer.engine is None:
+                    # streams cannot be compared
+                    continue
+                label = '{0}:/{1}'.format(fileView.title, name)
+                self.comboA.addItem(label, (fileView, name))
+                self.comboB.addItem(label, (fileView, name))
+        self.comboB.setCurrentIndex(min(1, self.comboB.count() - 1))
+
+        self.payloadCB = QCheckBox('Compare payloads (checksums)')
+        self.btnCompare = QPushButton('Compare')
+        self.btnCompare.clicked.connect(self.compare)
+        self.btnCancel = QPushButton('Cancel')
+        self.btnCancel.clicked.connect(self.cancel)
+        self.btnCancel.setEnabled(False)
+        self.progressBar = QProgressBar()
+        self.statusLabel = QLabel()
+        self.table = QTableView()
+
+        grid = QGridLayout()
+        grid.addWidget(QLabel('A:'), 0, 0)
+        grid.addWidget(self.comboA, 0, 1)
+        grid.addWidget(QLabel('B:'), 1, 0)
+        grid.addWidget(self.comboB, 1, 1)
+        grid.setColumnStretch(1, 1)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.payloadCB)
+        buttons.addStretch(1)
+        buttons.addWidget(self.btnCompare)
+        buttons.addWidget(self.btnCancel)
+
+        layout = QVBoxLayout(self)
+        layout.addLayout(grid)
+        layout.addLayout(buttons)
+        layout.addWidget(self.progressBar)
+        layout.addWidget(self.statusLabel)
+        layout.addWidget(self.table, 1)
+        self.resize(900, 600)
+
+    def source(self, combo, label):
+        """Return the DiffSource of the entry selected in `combo`."""
+        fileView, name = combo.currentData()
+        view = fileView.views.get(name)
+        text = '{0} ({1})'.format(label, combo.currentText())
+        index = view.headerIndex if view is not None else None
+        return DiffSource.fromFile(text, fileView.dset._file, name, index)
+
+    def compare(self):
+        if self.comboA.count() == 0 or self.worker is not None:
+            return
+        self.closeSources()
+        try:
+            self.sources = [self.source(self.comboA, 'A'), self.source(self.comboB, 'B')]
+        except (OSError, KeyError, ValueError) as e:
+            self.statusLabel.setText('Could not open the dataset: {0}'.format(e))
+            return
+        self.table.setModel(None)
+        self.worker = DiffWorker(self.sources[0], self.sources[1], self.payloadCB.isChecked(), self)
+        self.worker.progress.connect(self.onProgress)
+        self.worker.finished.connect(self.onFinished)
+        self.btnCompare.setEnabled(False)
+        self.btnCancel.setEnabled(True)
+        self.worker.start()
+
+    def onProgress(self, text, percent):
+        self.statusLabel.setText(text)
+        self.progressBar.setValue(percent)
+
+    def onFinished(self):
+        worker, self.worker = self.worker, None
+        self.btnCompare.setEnabled(True)
+        self.btnCancel.setEnabled(False)
+        if worker.error is not None:
+            self.statusLabel.setText('Comparison failed: {0}'.format(worker.error))
+        elif worker.result is None:
+            self.statusLabel.setText('Cancelled.')
+        else:
+            self.progressBar.setValue(100)
+            self.statusLabel.setText(worker.result.summary())
+            self.table.setModel(DiffTableModel(worker.result, self.table))
+
+    def cancel(self):
+        if self.worker is not None:
+            self.worker.cancel()
+
+    def closeSources(self):
+        for source in self.sources:
+            source.close()
+        self.sources = []
+
+    def done(self, result):
+        self.cancel()
+        self.closeSources()
+        super(CompareDialog, self).done(result)
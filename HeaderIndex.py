@@ -0,0 +1,463 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements an in-memory index of all the (acquisition) headers
+of a dataset.
+
+The index is built progressively in a background thread, block by block,
+with the `ReadEngine`. Every finished block is usable immediately: sorting,
+filtering and statistics work on the rows indexed so far, while the table
+model falls back to `TableBuffer` reads for rows that are not indexed yet.
+
+The index can grow with a dataset that is still being written (see
+`HeaderIndex.extend`); only the appended rows are read. An index saved by
+the `SessionCache` is restored with `HeaderIndex.restore`, again only the
+missing rows are read.
+
+A `TimestampIndex` maps time stamps to rows by binary search, e.g. to align
+waveforms with the acquisitions.
+"""
+
+import ast
+import types
+import functools
+import numpy
+import ismrmrd
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
+
+#: The numpy functions available in filter expressions, by name and as
+#: ``np.<name>`` (e.g. ``isin(slice, [0, 2])``).
+FILTER_FUNCTIONS = ('abs', 'all', 'any', 'isin', 'isnan', 'minimum', 'maximum', 'where',
+                    'floor', 'ceil', 'logical_and', 'logical_or', 'logical_not')
+
+_FILTER_NUMPY = types.SimpleNamespace(**dict(
+    (name, getattr(numpy, name)) for name in FILTER_FUNCTIONS))
+
+
+def checkExpression(tree):
+    """Reject filter expressions using more than the header fields and the
+    FILTER_FUNCTIONS: attributes other than ``np.<function>`` (e.g. methods
+    of the column arrays) and private names raise a ValueError."""
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute):
+            if not (isinstance(node.value, ast.Name) and node.value.id == 'np' and
+                    node.attr in FILTER_FUNCTIONS):
+                raise ValueError("'.{0}' is not allowed in filter expressions".format(node.attr))
+        elif isinstance(node, ast.Name) and node.id.startswith('_'):
+            raise ValueError("name '{0}' is not defined".format(node.id))
+
+
+class IndexBuilder(QThread):
+    """
+    The background thread filling a `HeaderIndex`.
+
+    :Parameter index: the index being built
+    """
+
+    #: Emitted after a block of rows ``(start, stop)`` has been indexed.
+    blockIndexed = pyqtSignal(int, int)
+
+    def __init__(self, index, parent=None):
+        super(IndexBuilder, self).__init__(parent)
+        self.index = index
+        self.cancelled = False
+        self.error = None
+
+    def run(self):
+        index = self.index
+        todo = index.missing()
+        results = index.engine.map(ranges=todo, fields=['head'])
+        try:
+            for start, stop, block in results:
+                if self.cancelled:
+                    break
+                index.records['head'][start:stop] = block['head']
+                index.markIndexed(start, stop)
+                self.blockIndexed.emit(start, stop)
+        except Exception as e:
+            # reported by HeaderIndex.failed, the indexed blocks are kept
+            self.error = e
+        finally:
+            results.close()
+
+
+class HeaderIndex(QObject):
+    """
+    Index of the headers of a (compound) dataset with a 'head' member.
+
+    :Parameters:
+
+    - `engine`: the ReadEngine used to read the dataset
+    - `total`: the number of rows of the dataset
+    - `mmap`: optional memory-mapped headers (the index is then complete
+      right away and nothing is read)
+    - `parent`: the parent of this object
+    """
+
+    #: Emitted with ``(indexed rows, total rows)`` whenever a block is done.
+    progress = pyqtSignal(int, int)
+
+    #: Emitted once all rows are indexed.
+    finished = pyqtSignal()
+
+    #: Emitted with a message if reading the headers failed.
+    failed = pyqtSignal(str)
+
+    def __init__(self, engine, total, mmap=None, parent=None):
+        super(HeaderIndex, self).__init__(parent)
+        self.engine = engine
+        self.total = total
+        self.blockRows = engine.blockRows()
+
+        # number of rows indexed per block (blocks are filled from their
+        # start, a block may be partial if the dataset has grown)
+        nblocks = -(-total // self.blockRows)
+        if mmap is not None:
+            self.storage = None
+            self.records = mmap
+            self.filled = numpy.array(
+                [stop - start for start, stop in self.blocks()], dtype=numpy.int64)
+        else:
+            # the pages of the (zero initialised) array are only committed
+            # when the blocks are filled
+            head = engine.dataset.dtype['head']
+            self.storage = numpy.zeros(total, dtype=[('head', head)])
+            self.records = self.storage[:total]
+            self.filled = numpy.zeros(nblocks, dtype=numpy.int64)
+        self.nindexed = self.total if mmap is not None else 0
+
+        self.builder = None
+        self.pending_total = None
+
+        # the error that stopped the last build (None if there was none)
+        self.error = None
+
+    def blocks(self):
+        """The ``(start, stop)`` blocks the index is built of."""
+        return [(start, min(start + self.blockRows, self.total))
+                for start in range(0, self.total, self.blockRows)]
+
+    def missing(self):
+        """The ``(start, stop)`` ranges that are not indexed yet."""
+        return [(start + int(filled), stop) for (start, stop), filled
+                in zip(self.blocks(), self.filled) if start + filled < stop]
+
+    def extend(self, total):
+        """Grow the index to `total` rows (the dataset is being appended to)
+        and index the new rows.
+
+        If the builder thread is busy, the index is extended once it is done.
+        """
+
+        if total <= self.total or self.storage is None:
+            return
+        if self.builder is not None:
+            self.pending_total = total
+            return
+
+        # grow the storage geometrically to keep the copies rare
+        if total > len(self.storage):
+            storage = numpy.zeros(max(total, 2 * len(self.storage)),
+                                  dtype=self.storage.dtype)
+            storage[:self.total] = self.storage[:self.total]
+            self.storage = storage
+        self.records = self.storage[:total]
+
+        nblocks = -(-total // self.blockRows)
+        self.filled = numpy.concatenate(
+            (self.filled, numpy.zeros(nblocks - len(self.filled), dtype=numpy.int64)))
+        self.total = total
+        self.start()
+
+    def restore(self, heads, filled):
+        """Fill the index with headers saved earlier (see `SessionCache`).
+
+        Only the missing blocks are read by `start`. Returns False (and
+        leaves the index empty) if the saved headers do not match.
+        """
+
+        if self.storage is None or self.nindexed or len(heads) != self.total or \
+                len(filled) != len(self.filled) or heads.dtype != self.records.dtype['head']:
+            return False
+        self.records['head'] = heads
+        self.filled = numpy.minimum(filled.astype(numpy.int64),
+                                    [stop - start for start, stop in self.blocks()])
+        self.nindexed = int(self.filled.sum())
+        return True
+
+    def start(self):
+        """Start building the index in the background."""
+        if self.isComplete() or self.builder is not None:
+            return
+        self.error = None
+        self.builder = IndexBuilder(self)
+        self.builder.blockIndexed.connect(self.onBlockIndexed)
+        self.builder.finished.connect(self.onBuilderFinished)
+        self.builder.start()
+
+    def cancel(self):
+        """Stop the background build (blocks indexed so far are kept)."""
+        if self.builder is not None:
+            self.builder.cancelled = True
+            self.builder.wait()
+            self.builder = None
+
+    def markIndexed(self, start, stop):
+        """Mark the rows ``[start, stop)`` of a block as indexed (builder
+        thread)."""
+        self.filled[start // self.blockRows] += stop - start
+        self.nindexed += stop - start
+
+    def onBlockIndexed(self, start, stop):
+        """Forward the progress of the builder thread (GUI thread)."""
+        self.progress.emit(self.nindexed, self.total)
+
+    def onBuilderFinished(self):
+        """Release the builder thread once it has terminated."""
+        builder, self.builder = self.builder, None
+        if builder is not None and builder.error is not None:
+            self.error = builder.error
+            self.pending_total = None
+            self.failed.emit(str(self.error))
+        elif self.pending_total is not None:
+            total, self.pending_total = self.pending_total, None
+            self.extend(total)
+        elif self.isComplete():
+            self.finished.emit()
+
+    def isComplete(self):
+        return self.nindexed >= self.total
+
+    def nbytes(self):
+        """The memory used by the indexed headers (0 if memory-mapped)."""
+        if self.storage is None:
+            return 0
+        return self.nindexed * self.storage.dtype.itemsize
+
+    def covers(self, start, stop):
+        """True if all rows of ``[start, stop)`` are indexed."""
+        if stop <= start:
+            return True
+        if stop > self.total:
+            return False
+        first = start // self.blockRows
+        last = (stop - 1) // self.blockRows
+        starts = numpy.arange(first, last + 1) * self.blockRows
+        needed = numpy.minimum(starts + self.blockRows, stop) - starts
+        return bool((self.filled[first:last + 1] >= needed).all())
+
+    def indexedRows(self):
+        """Return the (sorted) dataset rows indexed so far."""
+        if self.isComplete():
+            return numpy.arange(self.total)
+        rows = numpy.arange(self.total)
+        return rows[rows % self.blockRows < self.filled[rows // self.blockRows]]
+
+    def heads(self, rows=None):
+        """Return the headers of all rows or of the given `rows`."""
+        if rows is None:
+            return self.records['head']
+        return self.records['head'][rows]
+
+    def column(self, name, rows=None):
+        """Return the values of the header field `name`.
+
+        Encoding counters (the members of 'idx') are addressed by their own
+        name, like in the table model.
+
+        :Parameters:
+        :param name: the header field (or encoding counter) name
+        :param rows: optional array of dataset rows to return the values for
+        """
+
+        heads = self.records['head']
+        if name in heads.dtype.names or 'idx' not in heads.dtype.names:
+            values = heads[name]
+        else:
+            values = heads['idx'][name]
+        if rows is None:
+            return values
+        return values[rows]
+
+    def evaluate(self, expression, rows):
+        """Evaluate a filter expression for the given dataset `rows`.
+
+        The expression is evaluated vectorized: header fields and encoding
+        counters are arrays, combine conditions with ``&``, ``|`` and ``~``.
+        ``row`` is the dataset row, ``flag(ACQ_...)`` tests an acquisition
+        flag, e.g. ``(slice == 5) & ~flag(ACQ_IS_NOISE_MEASUREMENT)``. Only
+        the FILTER_FUNCTIONS may be called (see `checkExpression`).
+
+        Returns a boolean mask with one entry per row. Errors in the
+        expression are raised as exceptions.
+        """
+
+        namespace = FilterNamespace(self, rows)
+        tree = ast.parse(expression, '<filter>', 'eval')
+        checkExpression(tree)
+        code = compile(tree, '<filter>', 'eval')
+        result = eval(code, {'__builtins__': {}}, namespace)
+        return numpy.broadcast_to(numpy.asarray(result, dtype=bool), rows.shape)
+
+
+class FilterNamespace(object):
+    """
+    Lazy mapping resolving the names used in filter expressions.
+
+    Columns are only fetched from the index when the expression uses them.
+
+    :Parameters:
+
+    - `index`: the HeaderIndex
+    - `rows`: the dataset rows the expression is evaluated for
+    """
+
+    def __init__(self, index, rows):
+        self.index = index
+        self.rows = rows
+        self.heads = index.records['head']
+        self.cache = dict(vars(_FILTER_NUMPY), row=rows, flag=self.flag, np=_FILTER_NUMPY)
+
+    def flag(self, bit):
+        """True for the rows with the (1-based) ismrmrd flag `bit` set."""
+        return (self['flags'] >> numpy.uint64(bit - 1)) & numpy.uint64(1) != 0
+
+    def __getitem__(self, name):
+        try:
+            return self.cache[name]
+        except KeyError:
+            pass
+
+        names = self.heads.dtype.names
+        if name in names or ('idx' in names and name in self.heads['idx'].dtype.names):
+            value = self.index.column(name, self.rows)
+        elif name.startswith('ACQ_') and hasattr(ismrmrd, name):
+            value = getattr(ismrmrd, name)
+        else:
+            raise NameError("name '{0}' is not defined".format(name))
+        self.cache[name] = value
+        return value
+
+
+def _headField(block, name):
+    """Extract the header field `name` of a block of records (worker side)."""
+    return numpy.ascontiguousarray(block['head'][name])
+
+
+class TimestampIndex(object):
+    """
+    Rows of a dataset sorted by a time stamp header field.
+
+    :Parameters:
+
+    - `stamps`: the time stamps of all rows (in row order)
+    """
+
+    def __init__(self, stamps):
+        self.stamps = numpy.asarray(stamps)
+        self.order = numpy.argsort(self.stamps, kind='stable')
+        self.sorted = self.stamps[self.order]
+
+    @classmethod
+    def fromEngine(cls, engine, name, cancelled=lambda: False):
+        """Read the header field `name` of all rows block-wise (only the
+        field is kept in memory).
+
+        :Parameters:
+        :param engine: the ReadEngine of the dataset
+        :param name: the time stamp field, e.g. 'acquisition_time_stamp'
+        :param cancelled: callable polled between the blocks, None is
+            returned once it returns True
+        """
+
+        func = functools.partial(_headField, name=name)
+        blocks = []
+        results = engine.map(func, fields=['head'])
+        try:
+            for _, _, stamps in results:
+                if cancelled():
+                    return None
+                blocks.append(stamps)
+        finally:
+            results.close()
+        if not blocks:
+            return cls(numpy.zeros(0, dtype=numpy.uint32))
+        return cls(numpy.concatenate(blocks))
+
+    @classmethod
+    def fromIndex(cls, index, name):
+        """Take the time stamps from a complete HeaderIndex."""
+        return cls(index.column(name))
+
+    def __len__(self):
+        return len(self.stamps)
+
+    def nearest(self, stamp):
+        """Return the row whose time stamp is closest to `stamp` (the first
+        one if several rows have the same time stamp), None if empty."""
+        if not len(self.sorted):
+            return None
+        pos = int(numpy.searchsorted(self.sorted, stamp))
+        if pos == len(self.sorted) or (pos > 0 and
+                stamp - int(self.sorted[pos - 1]) <= int(self.sorted[pos]) - stamp):
+            pos -= 1
+            # first of equal stamps
+            pos = int(numpy.searchsorted(self.sorted, self.sorted[pos]))
+        return int(self.order[pos])
+
+    def between(self, first, last):
+        """Return the rows with ``first <= time stamp <= last`` (sorted by
+        time stamp)."""
+        lo = numpy.searchsorted(self.sorted, first, side='left')
+        hi = numpy.searchsorted(self.sorted, last, side='right')
+        return self.order[lo:hi]
+
+
+class TimestampBuilder(QThread):
+    """
+    The background thread reading the time stamps of a `TimestampIndex`.
+
+    :Parameters:
+
+    - `engine`: the ReadEngine of the dataset
+    - `name`: the time stamp field
+    - `parent`: the parent of this thread
+
+    Once finished, `stamps` holds the TimestampIndex (None if cancelled or
+    if reading failed, see `error`).
+    """
+
+    def __init__(self, engine, name, parent=None):
+        super(TimestampBuilder, self).__init__(parent)
+        self.engine = engine
+        self.name = name
+        self.cancelled = False
+        self.stamps = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.stamps = TimestampIndex.fromEngine(self.engine, self.name,
+                                                    lambda: self.cancelled)
+        except Exception as e:
+            self.error = e
+
+    def cancel(self):
+        self.cancelled = True
+        self.wait()
@@ -0,0 +1,277 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements a cached, parsed representation of the ISMRMRD XML
+header of a dataset and a dock widget for browsing it.
+
+The XML header of a dataset is read and parsed only once (see `getHeader`).
+All features needing header information (matrix size, trajectory type,
+encoding limits, ...) use the same cached instance.
+"""
+
+import weakref
+import xml.etree.ElementTree as ET
+from PyQt5.QtWidgets import QDockWidget, QWidget, QVBoxLayout, QHBoxLayout, QLineEdit, QPushButton, QTreeWidget, QTreeWidgetItem, QLabel
+from PyQt5.QtCore import Qt
+
+# parsed headers by data source
+_cache = weakref.WeakKeyDictionary()
+
+def getHeader(dset):
+    """Return the parsed XML header of `dset` (parsed on first use).
+
+    :Parameter dset: the ismrmrd.Dataset the header belongs to
+    """
+
+    try:
+        return _cache[dset]
+    except KeyError:
+        header = XMLHeader(dset.read_xml_header())
+        _cache[dset] = header
+        return header
+
+
+class XMLHeader(object):
+    """
+    A parsed ISMRMRD XML header.
+
+    Namespaces are stripped from the element tags so that elements can be
+    looked up with plain paths, e.g. ``encoding/trajectory``.
+
+    :Parameter xml: the XML header (bytes or str)
+    """
+
+    def __init__(self, xml):
+        self.xml = xml
+        try:
+            self.root = ET.fromstring(xml)
+        except ET.ParseError:
+            self.root = ET.Element('invalid XML header')
+        for element in self.root.iter():
+            if isinstance(element.tag, str) and '}' in element.tag:
+                element.tag = element.tag.split('}', 1)[1]
+
+        # element => parent map, built on first use
+        self._parents = None
+
+    def parent(self, element):
+        """Return the parent element of `element` (None for the root)."""
+        if self._parents is None:
+            self._parents = {child: parent for parent in self.root.iter()
+                             for child in parent}
+        return self._parents.get(element)
+
+    def text(self, path, default=None):
+        """Return the stripped text of the element at `path` or `default`."""
+        element = self.root.find(path)
+        if element is None or element.text is None:
+            return default
+        return element.text.strip()
+
+    def encoding(self, encoding=0):
+        """Return the `encoding` element with the given index (or None)."""
+        encodings = self.root.findall('encoding')
+        if encoding < len(encodings):
+            return encodings[encoding]
+        return None
+
+    def matrixSize(self, space='encodedSpace', encoding=0):
+        """Return the ``(x, y, z)`` matrix size of the given encoding space.
+
+        :Parameters:
+        :param space: 'encodedSpace' or 'reconSpace'
+        :param encoding: the encoding index
+        """
+
+        element = self.encoding(encoding)
+        if element is None:
+            return None
+        size = element.find(space + '/matrixSize')
+        if size is None:
+            return None
+        return tuple(int(size.findtext(dim, '1')) for dim in ('x', 'y', 'z'))
+
+    def trajectoryType(self, encoding=0):
+        """Return the trajectory type of the given encoding (e.g. 'radial')."""
+        element = self.encoding(encoding)
+        if element is None:
+            return None
+        return element.findtext('trajectory', '').strip() or None
+
+    def encodingLimits(self, encoding=0):
+        """Return the encoding limits as ``{name: (minimum, maximum, center)}``.
+
+        The names are those of the XML header, e.g. ``kspace_encoding_step_1``.
+        """
+
+        element = self.encoding(encoding)
+        limits = {}
+        if element is None or element.find('encodingLimits') is None:
+            return limits
+        for limit in element.find('encodingLimits'):
+            limits[limit.tag] = tuple(int(limit.findtext(name, '0'))
+                                      for name in ('minimum', 'maximum', 'center'))
+        return limits
+
+
+class XMLHeaderDock(QDockWidget):
+    """
+    A dock widget showing the XML header as a lazily populated tree.
+
+    The header is parsed when the dock is shown for the first time, child
+    items are only created when their parent item is expanded.
+
+    :Parameters:
+
+    - `dset`: the ismrmrd.Dataset whose header is shown
+    - `parent`: the parent of this widget
+    """
+
+    def __init__(self, dset, parent=None):
+        super(XMLHeaderDock, self).__init__('XML header', parent)
+        self.setObjectName('xml_header_dock')
+        self.dset = dset
+        self.header = None
+
+        # search bar
+        self.searchEdit = QLineEdit()
+        self.searchEdit.setPlaceholderText('Search elements and values')
+        self.searchEdit.returnPressed.connect(self.findNext)
+        self.searchEdit.textChanged.connect(self.resetSearch)
+        self.btnNext = QPushButton('Find next')
+        self.btnNext.clicked.connect(self.findNext)
+        self.searchLabel = QLabel()
+
+        searchBox = QHBoxLayout()
+        searchBox.setContentsMargins(0,0,0,0)
+        searchBox.addWidget(self.searchEdit, 1)
+        searchBox.addWidget(self.btnNext)
+        searchBox.addWidget(self.searchLabel)
+
+        # header tree
+        self.tree = QTreeWidget()
+        self.tree.setColumnCount(2)
+        self.tree.setHeaderLabels(['Element', 'Value'])
+        self.tree.itemExpanded.connect(self.populateItem)
+
+        _widget = QWidget()
+        _layout = QVBoxLayout(_widget)
+        _layout.setContentsMargins(0,0,0,0)
+        _layout.addLayout(searchBox)
+        _layout.addWidget(self.tree)
+        self.setWidget(_widget)
+
+        # search state
+        self.matches = []
+        self.matchIndex = -1
+
+        self.visibilityChanged.connect(self.loadHeader)
+
+    def setDataset(self, dset):
+        """Show the header of another dataset (parsed when the dock is shown)."""
+        if dset is self.dset:
+            return
+        self.dset = dset
+        self.header = None
+        self.tree.clear()
+        self.resetSearch()
+        self.loadHeader(self.isVisible())
+
+    def loadHeader(self, visible=True):
+        """Create the top level item of the tree on first show."""
+        if not visible or self.header is not None:
+            return
+
+        try:
+            self.header = getHeader(self.dset)
+        except LookupError:
+            # not received yet (streams) => try again when shown next time
+            return
+        self.items = {}
+        root = self.createItem(self.header.root)
+        self.tree.addTopLevelItem(root)
+        root.setExpanded(True)
+        self.tree.resizeColumnToContents(0)
+
+    def createItem(self, element):
+        """Create the (unpopulated) tree item of `element`."""
+        text = (element.text or '').strip()
+        item = QTreeWidgetItem([str(element.tag), text])
+        item.setData(0, Qt.UserRole, element)
+        if len(element) or element.attrib:
+            # placeholder child => shows the expand indicator
+            item.addChild(QTreeWidgetItem())
+        self.items[element] = item
+        return item
+
+    def populateItem(self, item):
+        """Replace the placeholder child of `item` by the real children."""
+        element = item.data(0, Qt.UserRole)
+        if element is None or item.childCount() != 1 or \
+                item.child(0).data(0, Qt.UserRole) is not None or \
+                item.child(0).text(0):
+            return
+
+        item.takeChild(0)
+        for name, value in element.attrib.items():
+            item.addChild(QTreeWidgetItem(['@' + name, value]))
+        item.addChildren([self.createItem(child) for child in element])
+
+    def itemFor(self, element):
+        """Return the tree item of `element`, populating its ancestors."""
+        path = []
+        while element is not None and element not in self.items:
+            path.append(element)
+            element = self.header.parent(element)
+        for ancestor in reversed(path):
+            parent = self.items[self.header.parent(ancestor)]
+            self.populateItem(parent)
+        return self.items.get(path[0] if path else element)
+
+    def resetSearch(self):
+        """Invalidate the search results after the search text changed."""
+        self.matches = []
+        self.matchIndex = -1
+        self.searchLabel.setText('')
+
+    def findNext(self):
+        """Select the next element whose tag or text matches the search."""
+        self.loadHeader()
+        text = self.searchEdit.text().strip().lower()
+        if not text:
+            return
+
+        if not self.matches:
+            self.matches = [element for element in self.header.root.iter()
+                            if text in str(element.tag).lower() or
+                            text in (element.text or '').lower()]
+            self.matchIndex = -1
+        if not self.matches:
+            self.searchLabel.setText('no match')
+            return
+
+        self.matchIndex = (self.matchIndex + 1) % len(self.matches)
+        item = self.itemFor(self.matches[self.matchIndex])
+        parent = item.parent()
+        while parent is not None:
+            parent.setExpanded(True)
+            parent = parent.parent()
+        self.tree.setCurrentItem(item)
+        self.tree.scrollToItem(item)
+        self.searchLabel.setText('{0}/{1}'.format(self.matchIndex + 1, len(self.matches)))
@@ -0,0 +1,462 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements the image tab, a browser for the image series stored
+by reconstructions in ``/dataset/image_*`` (groups with the datasets 'data',
+'header' and 'attributes').
+
+The image data is N-D, e.g. (images, channels, slices, y, x). Only the
+displayed 2D slice is read, as an HDF5 hyperslab of the data set. Slices
+are kept in an LRU cache with a byte budget (`SliceCache`) and the slices
+following the current one in the direction the slider was moved are read in
+the background (`SlicePrefetcher`).
+
+Window and level only change the lookup of the displayed slice (pyqtgraph
+`ImageItem` levels), the data is neither read nor converted again.
+"""
+
+import threading
+import collections
+import numpy
+import h5py
+from PyQt5.QtCore import Qt, QThread
+from PyQt5.QtWidgets import (QWidget, QListWidget, QListWidgetItem, QGridLayout, QHBoxLayout,
+                             QVBoxLayout, QLabel, QSlider, QComboBox, QPushButton, QCheckBox,
+                             QSplitter)
+import Instrumentation
+import DatasetLayout
+
+#: The byte budget of the slice cache (shared by all series of a file).
+CACHE_BYTES = 256 * 2 ** 20
+
+#: The number of slices prefetched in the direction of the slider movement.
+PREFETCH_SLICES = 8
+
+#: The percentiles of the slice values used by the automatic levels.
+AUTO_LEVEL_PERCENTILES = (0.5, 99.5)
+
+#: The parts of complex image data that can be displayed.
+COMPLEX_PARTS = ('Magnitude', 'Phase', 'Real', 'Imaginary')
+
+# names of the leading dimensions of ismrmrd image data
+_AXIS_NAMES = ('Image', 'Channel', 'Slice')
+
+pg = None
+
+def listImageSeries(dset):
+    """Return the (sorted) names of the image series of an ismrmrd dataset."""
+    try:
+        group = dset._dataset
+    except (AttributeError, KeyError):
+        return []
+
+    names = []
+    for name in group:
+        item = group.get(name, getclass=True)
+        if item is h5py.Group and isinstance(group[name].get('data'), h5py.Dataset) \
+                and group[name]['data'].ndim >= 2:
+            names.append(name)
+    return sorted(names)
+
+def sliceValues(raw, part='Magnitude'):
+    """Convert a slice of image data to the float32 values displayed.
+
+    :Parameters:
+    :param raw: the slice as read from the file (complex data may be a
+      compound of 'real' and 'imag')
+    :param part: one of `COMPLEX_PARTS` (ignored for real data)
+    """
+
+    if raw.dtype.names:
+        raw = raw['real'] + 1j * raw['imag'] if 'real' in raw.dtype.names \
+            else raw[raw.dtype.names[0]] + 1j * raw[raw.dtype.names[1]]
+    if numpy.iscomplexobj(raw):
+        if part == 'Phase':
+            raw = numpy.angle(raw)
+        elif part == 'Real':
+            raw = raw.real
+        elif part == 'Imaginary':
+            raw = raw.imag
+        else:
+            raw = numpy.abs(raw)
+    return numpy.asarray(raw, dtype=numpy.float32)
+
+
+class SliceCache(object):
+    """
+    Least recently used cache of image slices with a byte budget.
+
+    The cache is shared by the GUI thread and the prefetch thread.
+
+    :Parameter maxBytes: the maximum size of the cached slices in bytes
+    """
+
+    def __init__(self, maxBytes=CACHE_BYTES):
+        self.maxBytes = maxBytes
+        self.slices = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.slices
+
+    def get(self, key):
+        """Return the cached slice (marked as recently used) or None."""
+        with self.lock:
+            value = self.slices.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.slices.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Add a slice, evicting the least recently used ones if needed."""
+        with self.lock:
+            if key in self.slices:
+                return
+            self.slices[key] = value
+            self.nbytes += value.nbytes
+            # always keep the newest slice, even if it exceeds the budget
+            while self.nbytes > self.maxBytes and len(self.slices) > 1:
+                _, evicted = self.slices.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.slices.clear()
+            self.nbytes = 0
+
+
+class ImageSeries(object):
+    """
+    An image series (``/dataset/image_*`` group) read slice by slice.
+
+    :Parameters:
+
+    - `group`: the h5py.Group of the series
+    - `cache`: the SliceCache the slices are kept in
+    """
+
+    def __init__(self, group, cache):
+        self.group = group
+        self.name = group.name.rsplit('/', 1)[-1]
+        self.cache = cache
+
+        data = group['data']
+        # the chunk cache holds the chunks spanned by the prefetched slices
+        chunks = data.chunks
+        nchunks = None
+        if chunks is not None:
+            spanned = (-(-data.shape[-2] // chunks[-2])) * (-(-data.shape[-1] // chunks[-1]))
+            nchunks = spanned * (PREFETCH_SLICES + 2)
+        self.data = DatasetLayout.openDataset(group, 'data', 1, nchunks).dataset
+        self.shape = self.data.shape
+        self.dtype = self.data.dtype
+
+    def axisNames(self):
+        """The names of the leading (slider) dimensions."""
+        leading = len(self.shape) - 2
+        if leading == len(_AXIS_NAMES):
+            return list(_AXIS_NAMES)
+        return ['Dimension {0}'.format(ind) for ind in range(leading)]
+
+    def isComplex(self):
+        return self.dtype.names is not None or self.dtype.kind == 'c'
+
+    def describe(self):
+        return '{0}  {1}  {2}'.format(self.name, ' x '.join(str(n) for n in self.shape), self.dtype)
+
+    def key(self, position):
+        return (self.name, tuple(position))
+
+    def isCached(self, position):
+        return self.key(position) in self.cache
+
+    @Instrumentation.probe('ImageSeries.readSlice')
+    def readSlice(self, position):
+        """Read one 2D slice (hyperslab) at the leading indices `position`."""
+        return self.data[tuple(position)]
+
+    def slice(self, position):
+        """Return the slice at `position`, from the cache if possible."""
+        key = self.key(position)
+        value = self.cache.get(key)
+        if value is None:
+            value = self.readSlice(position)
+            self.cache.put(key, value)
+        return value
+
+    def header(self, image):
+        """Return the ImageHeader record of image `image` (None if missing)."""
+        try:
+            return self.group['header'][image]
+        except (KeyError, IndexError, ValueError):
+            return None
+
+
+class SlicePrefetcher(QThread):
+    """
+    Background thread reading the slices likely to be shown next.
+
+    Every request replaces the pending one, so the prefetcher never falls
+    behind a fast moving slider.
+    """
+
+    def __init__(self, parent=None):
+        super(SlicePrefetcher, self).__init__(parent)
+        self.condition = threading.Condition()
+        self.pending = []
+        self.stopped = False
+
+    def request(self, series, positions):
+        """Prefetch the slices of `series` at `positions` (in this order)."""
+        with self.condition:
+            self.pending = [(series, position) for position in positions]
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                series, position = self.pending.pop(0)
+            if series.isCached(position):
+                continue
+            try:
+                series.slice(position)
+            except (OSError, ValueError, KeyError):
+                # e.g. the file has been closed in the meantime
+                pass
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.pending = []
+            self.condition.notify()
+        self.wait()
+
+
+class ImageTab(QWidget):
+    """
+    Browser for the image series of an ismrmrd dataset.
+
+    :Parameters:
+
+    - `dset`: the ismrmrd.Dataset
+    - `parent`: the parent of this widget
+    """
+
+    def __init__(self, dset, parent=None):
+        global pg
+        super(ImageTab, self).__init__(parent)
+        if pg is None:
+            import pyqtgraph
+            pg = pyqtgraph
+
+        self.dset = dset
+        self.cache = SliceCache()
+        self.series = None
+        self.position = []
+        self.levels = None
+
+        self.prefetcher = SlicePrefetcher(self)
+        self.prefetcher.start()
+
+        # list of the series
+        self.seriesList = QListWidget()
+        for name in listImageSeries(dset):
+            item = QListWidgetItem(name)
+            item.setData(Qt.UserRole, name)
+            self.seriesList.addItem(item)
+        self.seriesList.currentItemChanged.connect(self.selectSeries)
+
+        # image view (the histogram region sets window and level)
+        self.imageView = pg.ImageView()
+        self.imageView.ui.roiBtn.hide()
+        self.imageView.ui.menuBtn.hide()
+        self.imageView.getView().invertY(True)
+        self.imageView.getImageItem().sigImageChanged.connect(self.updateLevelLabel)
+        self.imageView.getHistogramWidget().item.sigLevelsChanged.connect(self.onLevelsChanged)
+
+        # controls
+        self.sliderBox = QGridLayout()
+        self.sliders = []
+        self.sliderLabels = []
+
+        self.partCB = QComboBox()
+        self.partCB.addItems(COMPLEX_PARTS)
+        self.partCB.currentIndexChanged.connect(self.onPartChanged)
+        self.autoLevelCB = QCheckBox('Auto levels per slice')
+        self.btnAutoLevels = QPushButton('Auto levels')
+        self.btnAutoLevels.clicked.connect(self.autoLevels)
+        self.levelLabel = QLabel()
+        self.infoLabel = QLabel()
+
+        ctrlBox = QHBoxLayout()
+        ctrlBox.setContentsMargins(0,0,0,0)
+        ctrlBox.addWidget(QLabel('Complex data:'))
+        ctrlBox.addWidget(self.partCB)
+        ctrlBox.addWidget(self.autoLevelCB)
+        ctrlBox.addWidget(self.btnAutoLevels)
+        ctrlBox.addWidget(self.levelLabel)
+        ctrlBox.addStretch(1)
+
+        right = QWidget()
+        rightLayout = QVBoxLayout(right)
+        rightLayout.setContentsMargins(0,0,0,0)
+        rightLayout.addWidget(self.imageView, 1)
+        rightLayout.addLayout(self.sliderBox)
+        rightLayout.addLayout(ctrlBox)
+        rightLayout.addWidget(self.infoLabel)
+
+        self.splitter = QSplitter()
+        self.splitter.addWidget(self.seriesList)
+        self.splitter.addWidget(right)
+        self.splitter.setStretchFactor(0,1)
+        self.splitter.setStretchFactor(1,5)
+
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.splitter)
+
+        if self.seriesList.count():
+            self.seriesList.setCurrentRow(0)
+
+    def selectSeries(self, item, previous=None):
+        if item is None:
+            return
+        self.series = ImageSeries(self.dset._dataset[item.data(Qt.UserRole)], self.cache)
+        self.partCB.setEnabled(self.series.isComplex())
+        self.levels = None
+
+        # one slider per leading dimension
+        for slider, label in zip(self.sliders, self.sliderLabels):
+            self.sliderBox.removeWidget(slider)
+            self.sliderBox.removeWidget(label)
+            slider.deleteLater()
+            label.deleteLater()
+        self.sliders, self.sliderLabels = [], []
+        for axis, name in enumerate(self.series.axisNames()):
+            label = QLabel()
+            slider = QSlider(Qt.Horizontal)
+            slider.setRange(0, self.series.shape[axis] - 1)
+            slider.setEnabled(self.series.shape[axis] > 1)
+            slider.valueChanged.connect(
+                lambda value, axis=axis: self.onSliderMoved(axis, value))
+            self.sliderBox.addWidget(label, axis, 0)
+            self.sliderBox.addWidget(slider, axis, 1)
+            self.sliders.append(slider)
+            self.sliderLabels.append(label)
+        self.position = [0] * len(self.sliders)
+
+        self.showSlice()
+        self.imageView.autoRange()
+
+    def onSliderMoved(self, axis, value):
+        step = value - self.position[axis]
+        self.position[axis] = value
+        self.showSlice()
+        if step:
+            self.prefetch(axis, 1 if step > 0 else -1)
+
+    def prefetch(self, axis, direction):
+        """Prefetch the next slices along `axis` in `direction` (and the one
+        on the other side, in case the direction is reversed)."""
+        size = self.series.shape[axis]
+        offsets = list(range(1, PREFETCH_SLICES + 1)) + [-1]
+        positions = []
+        for offset in offsets:
+            value = self.position[axis] + direction * offset
+            if 0 <= value < size:
+                position = list(self.position)
+                position[axis] = value
+                positions.append(position)
+        self.prefetcher.request(self.series, positions)
+
+    def onPartChanged(self, *args):
+        self.levels = None
+        self.showSlice()
+
+    @Instrumentation.probe('ImageTab.showSlice')
+    def showSlice(self):
+        """Show the slice at the current slider position."""
+        if self.series is None:
+            return
+        for axis, (label, name) in enumerate(zip(self.sliderLabels, self.series.axisNames())):
+            label.setText('{0}: {1} / {2}'.format(name, self.position[axis],
+                                                 self.series.shape[axis] - 1))
+
+        values = sliceValues(self.series.slice(self.position), self.partCB.currentText())
+        if self.levels is None or self.autoLevelCB.isChecked():
+            self.levels = self.percentileLevels(values)
+        # the slice is (y, x), the levels are kept when the slice changes
+        self.imageView.setImage(values, autoRange=False, autoLevels=False,
+                                levels=self.levels, axes={'x': 1, 'y': 0},
+                                autoHistogramRange=False)
+        self.imageView.getHistogramWidget().item.setHistogramRange(*self.levels)
+        self.updateInfo()
+
+    def percentileLevels(self, values):
+        finite = values[numpy.isfinite(values)]
+        if not finite.size:
+            return (0.0, 1.0)
+        lo, hi = numpy.percentile(finite, AUTO_LEVEL_PERCENTILES)
+        if hi <= lo:
+            hi = lo + 1.0
+        return (float(lo), float(hi))
+
+    def autoLevels(self):
+        image = self.imageView.getImageItem().image
+        if image is None:
+            return
+        self.levels = self.percentileLevels(image)
+        self.imageView.setLevels(*self.levels)
+        self.imageView.getHistogramWidget().item.setHistogramRange(*self.levels)
+
+    def onLevelsChanged(self, *args):
+        self.levels = tuple(float(level) for level in self.imageView.getImageItem().getLevels())
+        self.updateLevelLabel()
+
+    def updateLevelLabel(self, *args):
+        if self.levels is None:
+            self.levelLabel.clear()
+            return
+        lo, hi = self.levels
+        self.levelLabel.setText('Window {0:.4g}, level {1:.4g}'.format(hi - lo, (hi + lo) / 2))
+
+    def updateInfo(self):
+        text = self.series.describe()
+        if len(self.position) == 3:
+            header = self.series.header(self.position[0])
+            if header is not None:
+                text += '   image_index {0}, image_series_index {1}, slice {2}'.format(
+                    header['image_index'], header['image_series_index'], header['slice'])
+        cache = self.cache
+        text += '   cache: {0} slices, {1:.1f} MB'.format(len(cache.slices), cache.nbytes / 2 ** 20)
+        self.infoLabel.setText(text)
+
+    def shutdown(self):
+        """Stop the prefetch thread."""
+        self.prefetcher.stop()
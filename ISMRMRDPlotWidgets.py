@@ -17,9 +17,115 @@
 # Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
 
 import numpy as np
-import pyqtgraph as pg
 import ismrmrd
-from PyQt5.QtWidgets import QWidget, QComboBox, QPushButton, QHBoxLayout, QVBoxLayout, QLabel
+import Instrumentation
+import ISMRMRDHeader
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QWidget, QComboBox, QPushButton, QHBoxLayout, QVBoxLayout, QLabel, QSpinBox, QCheckBox
+
+# pyqtgraph is imported on demand by ISMRMRDPlotWidget.createPlots() (keeps
+# it off the start-up path of the application)
+pg = None
+
+#: The ways a selection of several acquisitions is plotted: the current
+#: acquisition only, the mean, standard deviation or maximum over the
+#: selected acquisitions (per channel and sample) or an overlay of some of
+#: them.
+SELECTION_MODES = ('Current', 'Mean', 'Std', 'Max', 'Overlay')
+
+#: The maximum number of acquisitions read for an aggregate plot (larger
+#: selections are subsampled evenly).
+MAX_AGGREGATE_ROWS = 10000
+
+#: The maximum size of the payloads (coil data and trajectories) read for
+#: an aggregate plot or an overlay, in bytes (fewer acquisitions are read if
+#: they have many channels or samples, see `aggregateLimit`).
+MAX_AGGREGATE_BYTES = 64 * 2 ** 20
+
+#: Overlays of more acquisitions are plotted without legend.
+MAX_LEGEND_ENTRIES = 16
+
+def rawTransform(data, mode):
+    """Apply a raw plot mode to complex coil data (samples on the last axis,
+    e.g. ``(channels, samples)`` or ``(acquisitions, channels, samples)``)."""
+    if mode == 'Real':
+        return np.real(data)
+    elif mode == 'Imag':
+        return np.imag(data)
+    elif mode == 'FFT (magnitude)':
+        return abs(np.fft.fftshift(np.fft.fft(data), axes=-1))
+    elif mode == 'Phase':
+        return np.angle(data)
+    elif mode == 'Phase (unwrapped)':
+        return np.unwrap(np.angle(data))
+    return abs(data)
+
+def trajTransform(data, mode):
+    """Apply a trajectory plot mode to trajectories (samples on the second to
+    last axis, dimensions on the last axis)."""
+    if mode == 'FFT (magnitude)':
+        return abs(np.fft.fft(data, axis=-2))
+    return data
+
+def aggregateLimit(head, limit=MAX_AGGREGATE_ROWS):
+    """Return the number of acquisitions shaped like `head` (an acquisition
+    header) read for an aggregate plot: at most `limit` and as many as fit
+    into `MAX_AGGREGATE_BYTES`."""
+    samples = int(head['number_of_samples'])
+    payload = 8 * int(head['active_channels']) * samples + \
+        4 * int(head['trajectory_dimensions']) * samples
+    return max(1, min(limit, MAX_AGGREGATE_BYTES // max(payload, 1)))
+
+def subsample(values, limit):
+    """Return at most `limit` of `values`, evenly spaced over them."""
+    if len(values) <= limit:
+        return values
+    return values[np.linspace(0, len(values) - 1, limit).round().astype(np.int64)]
+
+def reduceAcquisitions(values, mode):
+    """Reduce stacked values over the acquisitions (the first axis)."""
+    if mode == 'Std':
+        return values.std(axis=0)
+    if mode == 'Max':
+        return values.max(axis=0)
+    return values.mean(axis=0)
+
+def stackAcquisitions(records):
+    """Stack the payloads of several acquisitions into single arrays.
+
+    The acquisitions with the most frequent shape (channels, samples and
+    trajectory dimensions) whose payload matches their header are stacked.
+
+    Returns ``(stacked, data, traj)``: the indices of the stacked records,
+    their coil data ``(acquisitions, channels, samples)`` and their
+    trajectories ``(acquisitions, samples, dimensions)``. `data` is None if
+    no record can be stacked, `traj` if there are no trajectories.
+
+    :Parameter records: the records (see `TableBuffer.readAcquisitions`)
+    """
+
+    heads = records['head']
+    shapes = np.stack((heads['active_channels'], heads['number_of_samples'],
+                       heads['trajectory_dimensions']), axis=1).astype(np.int64)
+    dataSizes = np.array([data.size for data in records['data']], dtype=np.int64)
+    trajSizes = np.array([traj.size for traj in records['traj']], dtype=np.int64)
+    valid = np.flatnonzero((dataSizes == 2 * shapes[:, 0] * shapes[:, 1]) &
+                           (trajSizes == shapes[:, 1] * shapes[:, 2]))
+    if not len(valid):
+        return valid, None, None
+
+    kinds, inverse, counts = np.unique(shapes[valid], axis=0, return_inverse=True,
+                                       return_counts=True)
+    best = np.argmax(counts)
+    stacked = valid[inverse.ravel() == best]
+    channels, samples, dimensions = (int(value) for value in kinds[best])
+
+    data = np.stack(list(records['data'][stacked])).astype(np.float32, copy=False)
+    data = data.view(np.complex64).reshape(len(stacked), channels, samples)
+    traj = None
+    if dimensions:
+        traj = np.stack(list(records['traj'][stacked])).reshape(len(stacked), samples, dimensions)
+    return stacked, data, traj
 
 class ISMRMRDPlotWidget(QWidget):
     def __init__(self,tableModel,tableView,parent=None):
@@ -46,6 +152,33 @@ class ISMRMRDPlotWidget(QWidget):
         self.trajCB.addItem('FFT (magnitude)')
         self.trajCB.setCurrentIndex(1)
 
+        # plot mode of a selection of several acquisitions
+        self.selectionCB = QComboBox()
+        self.selectionCB.addItems(SELECTION_MODES)
+        self.selectionCB.setToolTip('Plot of a selection of several acquisitions')
+        self.overlaySB = QSpinBox()
+        self.overlaySB.setRange(2, 256)
+        self.overlaySB.setValue(16)
+        self.overlaySB.setSuffix(' lines')
+        self.overlaySB.setToolTip('The number of overlaid acquisitions (evenly spaced over the selection)')
+        self.overlaySB.hide()
+
+        # cine playback through the acquisitions (see `Playback`)
+        self.btnPlay = QPushButton('Play')
+        self.btnPlay.setCheckable(True)
+        self.btnPlay.setToolTip('Step through the acquisitions from the current one')
+        self.rateSB = QSpinBox()
+        self.rateSB.setRange(1, 1000)
+        self.rateSB.setValue(60)
+        self.rateSB.setSuffix(' rows/s')
+        self.cbFiltered = QCheckBox('Filtered only')
+        self.cbFiltered.setToolTip('Only play the acquisitions of the current filter')
+        self.cbFiltered.setChecked(True)
+        self.playLabel = QLabel()
+        self.playback = None
+        self.followTable = False
+        self.trajTitle = ''
+
         # show XML button
         self.btnXML = QPushButton('Show XML header')
 
@@ -56,115 +189,361 @@ class ISMRMRDPlotWidget(QWidget):
         self.ctrlBarBox.addWidget(self.rawCB)
         self.ctrlBarBox.addWidget(QLabel('Trajectory plot:'))
         self.ctrlBarBox.addWidget(self.trajCB)
+        self.ctrlBarBox.addWidget(QLabel('Selection:'))
+        self.ctrlBarBox.addWidget(self.selectionCB)
+        self.ctrlBarBox.addWidget(self.overlaySB)
+        self.ctrlBarBox.addWidget(QLabel('  '))
+        self.ctrlBarBox.addWidget(self.btnPlay)
+        self.ctrlBarBox.addWidget(self.rateSB)
+        self.ctrlBarBox.addWidget(self.cbFiltered)
+        self.ctrlBarBox.addWidget(self.playLabel)
         self.ctrlBarBox.addWidget(QLabel('  '))
         self.ctrlBarBox.addWidget(self.btnXML)
         self.ctrlBarBox.addStretch(1)
-        
+
+        # create and set overall layout (vertical box), the plot widgets are
+        # added by createPlots()
+        self.vbox = QVBoxLayout()
+        self.vbox.setContentsMargins(0,0,0,0)
+        self.vbox.addLayout(self.ctrlBarBox)
+        self.setLayout(self.vbox)
+        self.resize(self.sizeHint())
+
+        self.rawPlot = None
+        self.trajPlot = None
+
+        # connect combobox change events to plot update function
+        self.rawCB.currentIndexChanged.connect(self.updatePlot)
+        self.trajCB.currentIndexChanged.connect(self.updatePlot)
+        self.selectionCB.currentIndexChanged.connect(self.updateOverlayControls)
+        self.selectionCB.currentIndexChanged.connect(self.updatePlot)
+        self.overlaySB.valueChanged.connect(self.updatePlot)
+
+        # aggregate plots follow the selection once it has settled
+        self.selectionTimer = QTimer(self)
+        self.selectionTimer.setSingleShot(True)
+        self.selectionTimer.setInterval(100)
+        self.selectionTimer.timeout.connect(self.updatePlot)
+
+        self.btnPlay.toggled.connect(self.togglePlayback)
+        self.rateSB.valueChanged.connect(self.setPlaybackRate)
+
+    def createPlots(self):
+        """Import pyqtgraph and create the raw and trajectory plot widgets.
+
+        This is deferred until the first plot update (or an idle callback of
+        the main window) so that the application window shows up without
+        paying for the plotting stack.
+        """
+
+        global pg
+
+        if self.rawPlot is not None:
+            return
+
+        if pg is None:
+            import pyqtgraph
+            pg = pyqtgraph
+
         # create raw and trajectory plot widgets
         self.rawPlot = pg.PlotWidget()
         self.rawPlot.hide()
         self.trajPlot = pg.PlotWidget()
         self.trajPlot.hide()
 
-        # create and set overall layout (vertical box)
-        vbox = QVBoxLayout()
-        vbox.setContentsMargins(0,0,0,0)
-        vbox.addLayout(self.ctrlBarBox)
-        vbox.addWidget(self.rawPlot,1)
-        vbox.addWidget(self.trajPlot,1)
-        self.setLayout(vbox)
+        self.vbox.addWidget(self.rawPlot,1)
+        self.vbox.addWidget(self.trajPlot,1)
 
-        self.resize(self.sizeHint())
         tabelHeight = self.tableView.height()
-        self.rawPlot.setMinimumHeight(tabelHeight/2)
-        self.trajPlot.setMinimumHeight(tabelHeight/2)
+        self.rawPlot.setMinimumHeight(tabelHeight//2)
+        self.trajPlot.setMinimumHeight(tabelHeight//2)
 
-        # connect combobox change events to plot update function
-        self.rawCB.currentIndexChanged.connect(self.updatePlot)
-        self.trajCB.currentIndexChanged.connect(self.updatePlot)
 
+    def onSelectionChanged(self, *args):
+        """Update the plots after the table selection has changed.
+
+        Aggregate plots are updated once the selection has settled (e.g.
+        while a range is extended with the mouse).
+        """
+        if self.playback is not None:
+            # the playback moves the selection itself
+            return
+        if self.selectionCB.currentText() != 'Current' and \
+                len(self.tableView.selectedRows()) > 1:
+            self.selectionTimer.start()
+        else:
+            self.updatePlot()
+
+    def updateOverlayControls(self):
+        self.overlaySB.setVisible(self.selectionCB.currentText() == 'Overlay')
+
+    def resetPlot(self, plot, title):
+        """Remove the curves and the legend entries of `plot` and set its title."""
+
+        # remove old plots and legend entries (the legend is created with
+        # the first plot and kept)
+        for item in plot.items():
+            plot.removeItem(item)
+        plot.getPlotItem().addLegend().clear()
+
+        plot.setTitle(title)
 
+    def plotLines(self, plot, lines):
+        """Plot the rows of `lines` (one curve and color per channel)."""
+        for ind in range(0,len(lines)):
+            color = pg.intColor(ind)
+            plot.plot(lines[ind,:],pen=pg.mkPen(color),name=' Channel ' + str(ind))
+
+    def plotOverlay(self, plot, lines, names):
+        """Plot groups of lines, one curve and color per acquisition.
+
+        :Parameters:
+        :param plot: the PlotWidget
+        :param lines: the lines ``(acquisitions, lines, samples)``
+        :param names: the legend entries of the acquisitions
+        """
+
+        count, nlines, samples = lines.shape
+        # the lines of an acquisition are separated by NaN (not connected)
+        x = np.tile(np.append(np.arange(samples, dtype=np.float64), np.nan), nlines)
+        y = np.concatenate((lines, np.full((count, nlines, 1), np.nan, dtype=lines.dtype)),
+                           axis=2).reshape(count, -1)
+        for ind in range(count):
+            color = pg.intColor(ind, max(count, 9))
+            plot.plot(x, y[ind], connect='finite', pen=pg.mkPen(color),
+                      name=names[ind] if count <= MAX_LEGEND_ENTRIES else None)
+
+    @Instrumentation.probe('ISMRMRDPlotWidget.updatePlot')
     def updatePlot(self, *args):
 
-        rawIndex = self.rawCB.currentIndex()
-        trajIndex = self.trajCB.currentIndex()
+        # make sure the plotting stack is available
+        self.createPlots()
+
+        rawMode = self.rawCB.currentText()
+        trajMode = self.trajCB.currentText()
+        mode = self.selectionCB.currentText()
+        rows = self.tableView.selectedRows()
+
+        if self.playback is not None:
+            # applied to the next frames of the playback
+            self.playback.setModes(rawMode, trajMode)
+            return
+
+        if (rawMode or trajMode) and mode != 'Current' and len(rows) > 1:
+            self.plotSelection(rows, mode, rawMode, trajMode)
+        else:
+            self.plotAcquisition(rawMode, trajMode)
+
+    def plotAcquisition(self, rawMode, trajMode):
+        """Plot the current acquisition."""
 
         # get current acquisition if data or trajectory plot enabled
-        if rawIndex != 0 or trajIndex != 0:
+        if rawMode or trajMode:
             # get currently selected row from table view
             row = self.tableView.currentIndex().row()
 
             # read corresponding acquisiton from table model buffer
-            aq = ismrmrd.Acquisition(self.tableModel.rbuffer.getCell(row)['head'])
+            record = self.tableModel.rbuffer.readAcquisition(row)
+            if record is None:
+                # evicted from a stream buffer
+                return
+            aq = ismrmrd.Acquisition(record['head'])
 
         # update raw data plot
-        if rawIndex != 0:
-            # get the data
-            data = self.tableModel.rbuffer.getCell(row)['data'].view(np.complex64).reshape((aq.active_channels, aq.number_of_samples))[:]
-        
-            # modifiy data depending on selected visualization
-            if self.rawCB.currentText() == 'Real':
-                dataOut = np.real(data)
-            elif self.rawCB.currentText() == 'Imag':
-                dataOut = np.imag(data)
-            elif self.rawCB.currentText() == 'FFT (magnitude)':
-                dataOut = abs(np.fft.fftshift(np.fft.fft(data)))
-            elif self.rawCB.currentText() == 'Phase':
-                dataOut = np.angle(data)
-            elif self.rawCB.currentText() == 'Phase (unwrapped)':
-                dataOut = np.unwrap(np.angle(data))
+        if rawMode:
+            # get the data (a payload not matching the header, see `Validate`,
+            # is plotted as a single channel)
+            data = record['data'].view(np.complex64)
+            if data.size == aq.active_channels * aq.number_of_samples:
+                data = data.reshape((aq.active_channels, aq.number_of_samples))
             else:
-                dataOut = abs(data)
-        
-            # remove old plots and legend entries
-            for item in self.rawPlot.items():
-                self.rawPlot.removeItem(item)
-            try:
-                self.rawPlot.legend.scene().removeItem(self.rawPlot.legend)
-            except Exception as e:
-                print(e)
-
-            #self.plotWidget.rawPlot.clear()
-            self.rawPlot.setTitle('Coil data')
-            self.rawPlot.legend = self.rawPlot.addLegend()
-
-            for ind in range(0,len(dataOut)):
-                color = pg.intColor(ind)
-                self.rawPlot.plot(dataOut[ind,:],pen=pg.mkPen(color),name=' Channel ' + str(ind))
+                data = data.reshape((1, -1))
 
+            self.resetPlot(self.rawPlot, 'Coil data')
+            self.plotLines(self.rawPlot, rawTransform(data, rawMode))
             self.rawPlot.show()
         else:
             self.rawPlot.hide()
 
 
         # update trajectory plot
-        if self.trajCB.currentIndex() != 0 and aq.traj.size > 0:
+        if trajMode and aq.traj.size > 0:
             # get the data
-            data = self.tableModel.rbuffer.getCell(row)['traj'].reshape((aq.number_of_samples,aq.trajectory_dimensions))[:]
-        
-            # modifiy data depending on selected visualization
-            if self.trajCB.currentText() == 'FFT (magnitude)':
-                dataOut = abs(np.fft.fft(data))
+            data = record['traj']
+            if data.size == aq.number_of_samples * aq.trajectory_dimensions:
+                data = data.reshape((aq.number_of_samples,aq.trajectory_dimensions))
+            else:
+                data = data.reshape((-1, 1))
+
+            self.resetPlot(self.trajPlot, self.trajectoryTitle())
+            self.plotLines(self.trajPlot, trajTransform(data, trajMode).T)
+            self.trajPlot.show()
+        else:
+            self.trajPlot.hide()
+
+    def plotSelection(self, rows, mode, rawMode, trajMode):
+        """Plot the mean, standard deviation or maximum of the selected
+        acquisitions per channel, or overlay some of them.
+
+        The payloads are read with a single read (see
+        `TableBuffer.readAcquisitions`) and stacked into one array, the
+        plot mode and the reduction are applied to the whole stack. Large
+        selections are subsampled so that the payloads read stay within
+        `MAX_AGGREGATE_BYTES`: the read is sized by the header of the
+        current acquisition (already in the table), the records read are
+        subsampled again by the first of them.
+
+        :Parameters:
+        :param rows: the selected dataset rows (sorted)
+        :param mode: the selection mode (one of `SELECTION_MODES`)
+        :param rawMode: the raw plot mode ('' if disabled)
+        :param trajMode: the trajectory plot mode ('' if disabled)
+        """
+
+        count = len(rows)
+        rbuffer = self.tableModel.rbuffer
+        limit = self.overlaySB.value() if mode == 'Overlay' else MAX_AGGREGATE_ROWS
+        current = self.tableView.currentIndex().row()
+        if 0 <= current < self.tableModel.numrows:
+            limit = aggregateLimit(rbuffer.getCell(current)['head'], limit)
+
+        records = rbuffer.readAcquisitions(subsample(rows, limit))
+        if not len(records):
+            # evicted from a stream buffer
+            self.plotAcquisition(rawMode, trajMode)
+            return
+        records = subsample(records, aggregateLimit(records['head'][0], limit))
+        stacked, data, traj = stackAcquisitions(records)
+
+        if len(stacked) == count:
+            text = '{0} of {1} acquisitions'.format(mode.lower(), count)
+        else:
+            text = '{0} of {1} of {2} acquisitions'.format(mode.lower(), len(stacked), count)
+        skipped = len(records) - len(stacked)
+        if skipped:
+            text += ', {0} of another shape left out'.format(skipped)
+        names = [' Scan {0}'.format(scan) for scan in records['head']['scan_counter'][stacked]]
+
+        # update raw data plot
+        if rawMode and data is not None:
+            values = rawTransform(data, rawMode)
+            self.resetPlot(self.rawPlot, 'Coil data ({0})'.format(text))
+            if mode == 'Overlay':
+                self.plotOverlay(self.rawPlot, values, names)
             else:
-                dataOut = data
-        
-            # remove old plots and legend entries
-            for item in self.trajPlot.items():
-                self.trajPlot.removeItem(item)
-            try:
-                self.trajPlot.legend.scene().removeItem(self.trajPlot.legend)
-            except Exception as e:
-                print(e)
-
-            #self.plotWidget.trajPlot.clear()
-            self.trajPlot.setTitle('Trajectory data')
-            self.trajPlot.legend = self.trajPlot.addLegend()
-
-            for ind in range(0,dataOut.shape[1]):
-                color = pg.intColor(ind)
-                self.trajPlot.plot(dataOut[:,ind],pen=pg.mkPen(color),name=' Channel ' + str(ind))
+                self.plotLines(self.rawPlot, reduceAcquisitions(values, mode))
+            self.rawPlot.show()
+        else:
+            self.rawPlot.hide()
 
+        # update trajectory plot (dimensions as lines)
+        if trajMode and traj is not None:
+            values = trajTransform(traj, trajMode).transpose(0, 2, 1)
+            self.resetPlot(self.trajPlot, '{0} ({1})'.format(self.trajectoryTitle(), text))
+            if mode == 'Overlay':
+                self.plotOverlay(self.trajPlot, values, names)
+            else:
+                self.plotLines(self.trajPlot, reduceAcquisitions(values, mode))
             self.trajPlot.show()
         else:
             self.trajPlot.hide()
 
+    def trajectoryTitle(self):
+        trajType = ISMRMRDHeader.getHeader(self.tableModel.dset).trajectoryType()
+        return 'Trajectory data ({0})'.format(trajType) if trajType else 'Trajectory data'
+
+    def togglePlayback(self, checked):
+        if checked:
+            self.startPlayback()
+        else:
+            self.stopPlayback()
+
+    def startPlayback(self):
+        """Play the acquisitions from the current one (see `Playback`).
+
+        The table follows the playback unless all acquisitions are played
+        while the table is filtered.
+        """
+
+        import Playback
+
+        if self.playback is not None:
+            return
+        self.createPlots()
+        model = self.tableModel
+        index = self.tableView.currentIndex()
+        current = model.start + index.row() if index.isValid() else 0
+
+        if model.rowmap is None:
+            rows = model.rbuffer.first_row + np.arange(model.leaf_numrows)
+            self.followTable = True
+        elif self.cbFiltered.isChecked():
+            rows = model.rowmap
+            self.followTable = True
+        else:
+            rows = np.arange(model.rbuffer.total_nrows())
+            current = model.datasetRow(index.row()) if index.isValid() else 0
+            self.followTable = False
+        if not len(rows):
+            self.btnPlay.setChecked(False)
+            return
+        if current >= len(rows) - 1:
+            current = 0
+
+        self.trajTitle = self.trajectoryTitle()
+        self.playback = Playback.Playback(model.rbuffer, rows, current, self.rateSB.value(),
+                                          self.rawCB.currentText(), self.trajCB.currentText(),
+                                          self)
+        self.playback.frameReady.connect(self.showFrame)
+        self.playback.finished.connect(self.onPlaybackFinished)
+        self.btnPlay.setText('Stop')
+        self.playback.start()
+
+    def stopPlayback(self):
+        if self.playback is not None:
+            self.playback.stop()
+
+    def setPlaybackRate(self, rate):
+        if self.playback is not None:
+            self.playback.setRate(rate)
+
+    def onPlaybackFinished(self):
+        playback, self.playback = self.playback, None
+        if playback is None:
+            return
+        self.btnPlay.blockSignals(True)
+        self.btnPlay.setChecked(False)
+        self.btnPlay.blockSignals(False)
+        self.btnPlay.setText('Play')
+        text = '{0} shown, {1} dropped'.format(playback.shown, playback.dropped)
+        if playback.error is not None:
+            text = 'Playback failed: {0}'.format(playback.error)
+        self.playLabel.setText(text)
+        playback.deleteLater()
+
+    def showFrame(self, frame):
+        """Show a frame of the playback and move the table to its
+        acquisition. The lines of the frame are uploaded into the curves
+        already shown if possible."""
+
+        title = ' (row {0}, scan {1})'.format(frame.row, frame.scan)
+        self.uploadLines(self.rawPlot, frame.raw, 'Coil data' + title)
+        self.uploadLines(self.trajPlot, frame.traj, self.trajTitle + title)
+        self.playLabel.setText('{0} shown, {1} dropped'.format(
+            self.playback.shown, self.playback.dropped))
+        if self.followTable:
+            self.tableView.goToRow(frame.position)
+
+    def uploadLines(self, plot, lines, title):
+        if lines is None:
+            plot.hide()
+            return
+        curves = plot.listDataItems()
+        if len(curves) != len(lines):
+            self.resetPlot(plot, title)
+            self.plotLines(plot, lines)
+        else:
+            plot.setTitle(title)
+            for curve, line in zip(curves, lines):
+                curve.setData(line)
+        plot.show()
@@ -23,11 +23,20 @@
 
 """
 This module implements a model (in the `MVC` sense) for the real data stored
-in a `ismrmrd.Dataset`.
+in a `ismrmrd.Dataset`: the headers of the acquisitions or, with another
+dataset name and header type, of the waveforms.
+
+If a header index is attached to the model (see `TableModel.setIndex`), rows
+covered by the index are served from memory and the model can be filtered
+and sorted. Filtering and sorting operate on the rows indexed so far; the
+model then maps its rows to dataset rows through a row map.
 """
 
+import numpy
 from PyQt5.QtCore import QAbstractTableModel, QModelIndex, Qt
 import TableBuffer
+import Instrumentation
+import AcquisitionFlags
 import ismrmrd
 
 #: The maximum number of rows to be read from the data source.
@@ -56,37 +65,70 @@ class TableModel(QAbstractTableModel):
         The total number of columnss visible, equal to those visible.
     :attribute start:
         The zero-based starting index of the chunk within the total rows.
+    :attribute header_index:
+        The HeaderIndex of the dataset (None until it is attached).
+    :attribute rowmap:
+        The dataset rows of the model rows if the model is filtered or
+        sorted, None otherwise.
+    :attribute flag_columns:
+        The acquisition flags (bits) shown as boolean columns after the
+        header columns.
+    :attribute value_columns:
+        ``[(name, values)]`` of columns computed for every dataset row (e.g.
+        spike scores) shown after the flag columns.
 
     """
 
-    def __init__(self, dset, parent=None):
+    def __init__(self, dset, parent=None, rbuffer=None, dataset='data',
+                 headerType=ismrmrd.AcquisitionHeader):
         """Create the model.
+
+        `rbuffer` replaces the TableBuffer of `dset` (e.g. by the ring
+        buffer of a TCP stream, see `StreamIngest`). `dataset` is the name of
+        the dataset within the ismrmrd group and `headerType` the ismrmrd
+        header structure of its records (e.g. 'waveforms' and
+        `ismrmrd.WaveformHeader`).
         """
 
         # The model data source (a ISMRMRD dataset) and its access buffer
         self.dset = dset
-        self.rbuffer = TableBuffer.TableBuffer(dset)
+        self.headerType = headerType
+        if rbuffer is None:
+            rbuffer = TableBuffer.TableBuffer(dset, CHUNK_SIZE, dataset)
+        self.rbuffer = rbuffer
 
         self.leaf_numrows = self.rbuffer.total_nrows()
         self.numrows = min(self.leaf_numrows, CHUNK_SIZE)
         self.start = 0
 
-        # get number of columns (ismrmrd acquisition header and encoding
-        # counter fields)
+        # True while the buffered rows are released (model not shown)
+        self.released = False
+
+        # header index, filter and sort state
+        self.header_index = None
+        self.rowmap = None
+        self.filter_expr = ''
+        self.sort_column = None
+        self.sort_order = Qt.AscendingOrder
+
+        # get number of columns (ismrmrd header fields and, for
+        # acquisitions, the encoding counter fields)
         self.colnames = []
-        
-        fields = ismrmrd.EncodingCounters._fields_
-        for item in fields:
-            self.colnames.append(item[0])
+
+        fields = [item[0] for item in headerType._fields_]
+        if 'idx' in fields:
+            for item in ismrmrd.EncodingCounters._fields_:
+                self.colnames.append(item[0])
+            fields.remove('idx')
 
         self.numcolsIdx = len(self.colnames)
 
-        fields = ismrmrd.AcquisitionHeader._fields_
         for item in fields:
-            self.colnames.append(item[0])
+            self.colnames.append(item)
 
-        self.colnames.remove('idx')
         self.numcols = len(self.colnames)
+        self.flag_columns = []
+        self.value_columns = []
 
         # track selected cell
         self.selected_cell = {'index': QModelIndex(), 'buffer_start': 0}
@@ -106,7 +148,88 @@ class TableModel(QAbstractTableModel):
             the model index being inspected.
         """
 
-        return 0 if index.isValid() else self.numcols
+        return 0 if index.isValid() else \
+            self.numcols + len(self.flag_columns) + len(self.value_columns)
+
+    def columnName(self, col):
+        """The name of column `col` (header field, encoding counter, flag or
+        value column)."""
+        if col < self.numcols:
+            return self.colnames[col]
+        col -= self.numcols
+        if col < len(self.flag_columns):
+            return AcquisitionFlags.flagName(self.flag_columns[col])
+        return self.value_columns[col - len(self.flag_columns)][0]
+
+    def flagColumns(self):
+        return list(self.flag_columns)
+
+    def setFlagColumns(self, bits):
+        """Show the acquisition flags `bits` as boolean columns."""
+        names = [AcquisitionFlags.flagName(bit) for bit in bits]
+        if self.sort_column is not None and self.sort_column not in self.colnames and \
+                self.sort_column not in names and self.sort_column not in self.valueColumns():
+            self.sort(-1)
+        if self.flag_columns:
+            self.beginRemoveColumns(QModelIndex(), self.numcols,
+                                    self.numcols + len(self.flag_columns) - 1)
+            self.flag_columns = []
+            self.endRemoveColumns()
+        if bits:
+            self.beginInsertColumns(QModelIndex(), self.numcols, self.numcols + len(bits) - 1)
+            self.flag_columns = list(bits)
+            self.endInsertColumns()
+
+    def valueColumns(self):
+        return [name for name, _ in self.value_columns]
+
+    def setValueColumn(self, name, values):
+        """Show (or update) the column `name` with the `values` of all
+        dataset rows."""
+        names = self.valueColumns()
+        if name in names:
+            self.value_columns[names.index(name)] = (name, values)
+            if self.sort_column == name:
+                self.updateRowMap(keep_position=True)
+            else:
+                col = self.numcols + len(self.flag_columns) + names.index(name)
+                self.dataChanged.emit(self.index(0, col), self.index(self.numrows - 1, col))
+            return
+        col = self.columnCount()
+        self.beginInsertColumns(QModelIndex(), col, col)
+        self.value_columns.append((name, values))
+        self.endInsertColumns()
+
+    def removeValueColumn(self, name):
+        names = self.valueColumns()
+        if name not in names:
+            return
+        if self.sort_column == name:
+            self.sort(-1)
+        col = self.numcols + len(self.flag_columns) + names.index(name)
+        self.beginRemoveColumns(QModelIndex(), col, col)
+        del self.value_columns[names.index(name)]
+        self.endRemoveColumns()
+
+    def columnValues(self, name, rows=None):
+        """The values of the column `name` of the dataset `rows` (all rows if
+        None) from the header index (or the values of a value column)."""
+        values = dict(self.value_columns).get(name)
+        if values is not None:
+            if rows is None:
+                return values
+            # rows appended after the values were computed have no value
+            rows = numpy.asarray(rows)
+            column = numpy.full(len(rows), numpy.nan, dtype=numpy.float64)
+            known = rows < len(values)
+            column[known] = values[rows[known]]
+            return column
+        if name not in self.colnames:
+            bit = dict((flag, bit) for bit, flag in AcquisitionFlags.FLAGS).get(name)
+            if bit is None and name.startswith('bit '):
+                bit = int(name[4:])
+            return AcquisitionFlags.flagMask(self.header_index.column('flags', rows), bit)
+        return self.header_index.column(name, rows)
 
     def rowCount(self, index=QModelIndex()):
         """The number of columns for the children of the given index.
@@ -119,6 +242,7 @@ class TableModel(QAbstractTableModel):
 
         return 0 if index.isValid() else self.numrows
 
+    @Instrumentation.probe('TableModel.loadData')
     def loadData(self, start, length):
         """Load the model with fresh data from the buffer.
 
@@ -139,8 +263,181 @@ class TableModel(QAbstractTableModel):
         actual_start = stop - self.numrows
         start = max(min(actual_start, start), 0)
 
-        self.rbuffer.readBuffer(start, stop)
+        if self.rowmap is not None:
+            # filtered/sorted => the rows are always indexed
+            rows = self.rowmap[start:stop]
+            self.rbuffer.setRecords(self.header_index.records[rows], start, rows)
+        elif self.header_index is not None and self.header_index.covers(start, stop):
+            self.rbuffer.setRecords(self.header_index.records[start:stop], start)
+        else:
+            self.rbuffer.readBuffer(start, stop)
         self.start = start
+        self.released = False
+
+    def refresh(self):
+        """Take the acquisitions appended to the dataset into account.
+
+        Used for files that are still being written (see `LiveTail`) and
+        for streams, whose oldest rows may be evicted meanwhile. The rows
+        already shown are not read again. Returns the number of new rows.
+        """
+
+        old_rows = self.rbuffer.total_nrows()
+        old_first = self.rbuffer.first_row
+        try:
+            total = self.rbuffer.refresh()
+        except OSError:
+            # the appended rows are not readable through the current file
+            # handle => reopen the file (the index builder reads through it)
+            if self.header_index is not None:
+                self.header_index.cancel()
+            self.rbuffer.reopen()
+            total = self.rbuffer.refresh()
+            if self.header_index is not None:
+                self.header_index.start()
+        evicted = self.rbuffer.first_row - old_first
+        if total <= old_rows and not evicted:
+            return 0
+
+        if self.header_index is not None:
+            self.header_index.extend(total)
+
+        # a filtered/sorted model is updated from the growing index
+        if self.rowmap is None:
+            self.leaf_numrows = total
+            numrows = min(self.leaf_numrows, CHUNK_SIZE)
+            if numrows > self.numrows:
+                self.beginInsertRows(QModelIndex(), self.numrows, numrows - 1)
+                self.numrows = numrows
+                self.loadData(self.start, self.numrows)
+                self.endInsertRows()
+            elif evicted:
+                # keep showing the same rows (as long as they are buffered)
+                self.loadData(self.start - evicted, self.numrows)
+
+        return total + evicted - old_rows
+
+    def datasetRow(self, row):
+        """Return the dataset row of the model row `row` of the current chunk."""
+        return self.rbuffer.datasetRow(row)
+
+    def datasetRows(self):
+        """Return the dataset rows of the rows of the current chunk."""
+        return numpy.array([self.rbuffer.datasetRow(row) for row in range(self.numrows)],
+                           dtype=numpy.int64)
+
+    def modelRow(self, row):
+        """Return the (absolute) model row showing the dataset row `row`.
+
+        Returns None if the row is filtered out or not indexed yet.
+        """
+
+        if self.rowmap is None:
+            return row if 0 <= row < self.leaf_numrows else None
+        found = numpy.flatnonzero(self.rowmap == row)
+        return int(found[0]) if len(found) else None
+
+    def releaseCache(self, shown=False):
+        """Release the buffered rows. The rows of the current chunk are kept
+        if the model is `shown`, otherwise they are read again by
+        `restoreCache`."""
+        self.rbuffer.releaseCache(keepChunk=shown)
+        self.released = self.released or not shown
+
+    def restoreCache(self):
+        """Read the rows of the current chunk again after `releaseCache`."""
+        if self.released:
+            self.loadData(self.start, self.numrows)
+
+    def setIndex(self, index):
+        """Attach a (possibly still growing) HeaderIndex to the model."""
+        self.header_index = index
+
+    def setFilter(self, expression):
+        """Filter the model rows with a vectorized expression.
+
+        See `HeaderIndex.HeaderIndex.evaluate` for the expression syntax. An
+        empty expression removes the filter. Errors in the expression are
+        raised (and the previous filter is kept).
+        """
+
+        expression = expression.strip()
+        if expression:
+            if self.header_index is None:
+                raise RuntimeError('The header index is not available yet.')
+            # validate the expression before applying it
+            rows = self.header_index.indexedRows()[:1]
+            self.header_index.evaluate(expression, rows)
+        self.filter_expr = expression
+        self.updateRowMap()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        """Sort the model rows by `column` (stable, on the indexed rows).
+
+        A negative column removes the sorting.
+        """
+
+        if column >= 0 and self.header_index is None:
+            return
+        self.sort_column = self.columnName(column) if column >= 0 else None
+        self.sort_order = order
+        self.updateRowMap()
+
+    def updateRowMap(self, keep_position=False):
+        """Recompute the row map from the filter and sort settings.
+
+        :Parameter keep_position: keep the current chunk start (used when
+            the index has grown), otherwise the model restarts at row 0.
+
+        If the index has grown and the new rows are only appended to the
+        row map (filtered, not sorted), the rows are inserted without a
+        model reset, so that the selection is kept.
+        """
+
+        if not self.filter_expr and self.sort_column is None:
+            rowmap = None
+            leaf_numrows = self.rbuffer.total_nrows()
+        else:
+            rowmap = self.header_index.indexedRows()
+            if self.filter_expr:
+                rowmap = rowmap[self.header_index.evaluate(self.filter_expr, rowmap)]
+            if self.sort_column is not None:
+                keys = self.columnValues(self.sort_column, rowmap)
+                if keys.ndim > 1:
+                    order = numpy.lexsort(keys.reshape(len(keys), -1).T[::-1])
+                else:
+                    order = numpy.argsort(keys, kind='stable')
+                if self.sort_order == Qt.DescendingOrder:
+                    order = order[::-1]
+                    if keys.ndim == 1 and keys.dtype.kind == 'f':
+                        # rows without a value (NaN) stay last
+                        missing = numpy.isnan(keys[order])
+                        order = numpy.concatenate((order[~missing], order[missing]))
+                rowmap = rowmap[order]
+            leaf_numrows = len(rowmap)
+
+        old = self.rowmap
+        if keep_position and old is not None and rowmap is not None and \
+                len(rowmap) >= len(old) and numpy.array_equal(rowmap[:len(old)], old):
+            # the newly indexed rows only extend the row map (filtered, not
+            # sorted): keep the model and its selection, append the rows
+            self.rowmap = rowmap
+            self.leaf_numrows = leaf_numrows
+            numrows = min(self.leaf_numrows, CHUNK_SIZE)
+            if numrows > self.numrows:
+                self.beginInsertRows(QModelIndex(), self.numrows, numrows - 1)
+                self.numrows = numrows
+                self.loadData(self.start, self.numrows)
+                self.endInsertRows()
+            return
+
+        self.beginResetModel()
+        self.rowmap = rowmap
+        self.leaf_numrows = leaf_numrows
+        self.numrows = min(self.leaf_numrows, CHUNK_SIZE)
+        self.selected_cell = {'index': QModelIndex(), 'buffer_start': 0}
+        self.loadData(self.start if keep_position else 0, self.numrows)
+        self.endResetModel()
 
     def get_corner_span(self):
         """Must return ``(row_span, col_span)`` tuple for the top-left cell."""
@@ -175,11 +472,12 @@ class TableModel(QAbstractTableModel):
             #if hasattr(self.leaf, 'description'):
             #    return str(self.leaf.colnames[section])
             #return str(section)
-            return self.colnames[section]
+            return self.columnName(section)
 
         # Rows-labels
-        return str(self.start + section)
+        return str(self.datasetRow(section))
 
+    @Instrumentation.probe('TableModel.data')
     def data(self, index, role=Qt.DisplayRole):
         """Returns the data stored under the given role for the item
         referred to by the index.
@@ -198,36 +496,26 @@ class TableModel(QAbstractTableModel):
 
         if role == Qt.DisplayRole:
 
+            # read the field straight from the (numpy) header record
+            head = self.rbuffer.getCell(row)['head']
+            if col >= self.numcols + len(self.flag_columns): # value columns
+                values = self.value_columns[col - self.numcols - len(self.flag_columns)][1]
+                datasetRow = self.datasetRow(row)
+                if datasetRow >= len(values) or numpy.isnan(values[datasetRow]):
+                    return ''
+                return '{0:.1f}'.format(values[datasetRow])
+            if col >= self.numcols: # flag columns
+                bit = self.flag_columns[col - self.numcols]
+                return str(int(head['flags']) >> (bit - 1) & 1)
             if col < self.numcolsIdx: # index fields
-                aq = ismrmrd.Acquisition(self.rbuffer.getCell(row)['head'])
-                cell = getattr(aq.idx,self.colnames[col])
-                
+                cell = head['idx'][self.colnames[col]]
             else: # header fields
-                aq = ismrmrd.Acquisition(self.rbuffer.getCell(row)['head'])
-                cell = getattr(aq,self.colnames[col])
-
-            # check if the current cell is the encoding counter field
-            if isinstance(cell,ismrmrd.EncodingCounters):
-                return None
-            else: # otherwise no special treatment
-                # check what kind of data we have at hand (array or scalar)
-                try:
-                    # if no error => we have an array => fromat as such
-                    ret = '['
-                    cellIterator = iter(cell)
-                    firstItem = next(cellIterator)
-                    ret += str(firstItem)
-
-                    for item in cellIterator:
-                        ret += ',' + str(item)
-
-                    ret += ']'
-            
-                except Exception as e:
-                    # if error => we have a scalar
-                    ret = str(cell)
-
-                return ret
+                cell = head[self.colnames[col]]
+
+            # check what kind of data we have at hand (array or scalar)
+            if numpy.ndim(cell):
+                return '[' + ','.join(str(item) for item in cell) + ']'
+            return str(cell)
 
         if role == Qt.TextAlignmentRole:
             return Qt.AlignLeft | Qt.AlignCenter
@@ -37,9 +37,12 @@ tabular way:
 __docformat__ = 'restructuredtext'
 
 from PyQt5.QtGui import QPalette, QBrush, QFontMetrics, QHoverEvent, QCursor
-from PyQt5.QtWidgets import QAbstractItemView, QStyledItemDelegate, QStyle, QTableView, QHeaderView, QAbstractSlider, QToolTip
-from PyQt5.QtCore import Qt, QCoreApplication, QPoint
+from PyQt5.QtWidgets import QAbstractItemView, QStyledItemDelegate, QStyle, QTableView, QHeaderView, QAbstractSlider, QToolTip, QApplication
+from PyQt5.QtCore import Qt, QCoreApplication, QPoint, QItemSelection, QItemSelectionModel
+import numpy
 import Scrollbar
+import Instrumentation
+import AcquisitionFlags
 import ismrmrd
 
 _aiv = QAbstractItemView
@@ -53,6 +56,7 @@ class TableDelegate(QStyledItemDelegate):
     """
 
 
+    @Instrumentation.probe('TableDelegate.paint')
     def paint(self, painter, option, index):
         """Renders the delegate for the item specified by index.
 
@@ -122,35 +126,40 @@ class TableView(QTableView):
         self.tmodel = tmodel  # This is a MUST
         self.leaf_numrows = leaf_numrows = self.tmodel.leaf_numrows
         self.selection_model = self.selectionModel()
-        self.setSelectionMode(_aiv.SingleSelection)
+        self.setSelectionMode(_aiv.ExtendedSelection)
         self.setSelectionBehavior(_aiv.SelectItems)
 
-        # Setup the actual vertical scrollbar
+        # the dataset rows of the selected cells. The selection model only
+        # knows rows of the current buffer, a selection of several rows is
+        # kept here and selected again after buffer faults
+        self.selected_rows = numpy.empty(0, dtype=numpy.int64)
+
+        # dataset rows marked in the scrollbar (e.g. spikes)
+        self.marked_rows = numpy.empty(0, dtype=numpy.int64)
+
+        # Setup the actual vertical scrollbar (marking rows, see
+        # setMarkedRows)
         self.setVerticalScrollMode(_aiv.ScrollPerItem)
+        self.setVerticalScrollBar(Scrollbar.MarkedScrollBar())
         self.vscrollbar = self.verticalScrollBar()
 
         # configure move over event capture
         self.clicked.connect(self.cellClicked)
 
-        # get flag names for flag tooltip
-        self.flagsDict = {}
-        for name,value in ismrmrd.__dict__.items():
-            if name.startswith('ACQ_'):
-                self.flagsDict[value] = name
-
         # set data model
         self.setModel(tmodel)
+        tmodel.modelAboutToBeReset.connect(self.onModelAboutToBeReset)
+        tmodel.modelReset.connect(self.onModelReset)
+
+        # the dataset row and column of the current cell across a model
+        # reset (see onModelAboutToBeReset)
+        self.reset_current = None
 
         # For potentially huge datasets use a customised scrollbar
+        self.tricky_vscrollbar = None
+        self.valid_current_buffer = 0
         if leaf_numrows > tmodel.numrows:
-            self.setItemDelegate(TableDelegate())
-            self.rbuffer_fault = False
-            self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
-            self.tricky_vscrollbar = Scrollbar.ScrollBar(self)
-            self.max_value = self.tricky_vscrollbar.setMaxValue(
-                self.leaf_numrows)
-            self.tricky_vscrollbar.setMinimum(0)
-            self.interval_size = self.mapSlider2Leaf()
+            self.setupTrickyScrollbar()
 
         # Setup the vertical header width
         self.vheader = QHeaderView(Qt.Vertical)
@@ -165,49 +174,146 @@ class TableView(QTableView):
         self.vheader.setDefaultSectionSize(24);
         self.vheader.setVisible(False)
 
-        # setup column widths
-        metrics = QFontMetrics(self.vheader.font())
-
-        for ind in range(0,len(self.tmodel.colnames)):
-            colName = self.tmodel.colnames[ind]
-            width = metrics.boundingRect(colName).width() + 10
-            self.setColumnWidth(ind,width)
+        # setup column widths (also of flag columns added later)
+        self.setupColumnWidths()
+        tmodel.columnsInserted.connect(
+            lambda parent, first, last: self.setupColumnWidths(first, last + 1))
 
         # setup the text elide mode
         self.setTextElideMode(Qt.ElideRight)
 
-        # connect signals to slots
-        if leaf_numrows > tmodel.numrows:
-            self.tricky_vscrollbar.actionTriggered.connect(self.navigateWithMouse)
+        # sorting by clicking the column headers (handled by the model on
+        # the indexed rows)
+        self.hheader = self.horizontalHeader()
+        self.hheader.setSectionsClickable(True)
+        self.hheader.setSortIndicatorShown(True)
+        self.hheader.setSortIndicator(-1, Qt.AscendingOrder)
+        self.hheader.sectionClicked.connect(self.sortBySection)
 
         ## Instead of invoking updateView().
 
         self.setSpan(0, 0, *tmodel.get_corner_span())
 
 
-    def cellClicked(self,clickedIndex):
+    def setupColumnWidths(self, first=0, last=None):
+        """Size the columns ``[first, last)`` to their names."""
+        metrics = QFontMetrics(self.vheader.font())
+
+        if last is None:
+            last = self.tmodel.columnCount()
+        for ind in range(first, last):
+            colName = self.tmodel.columnName(ind)
+            width = metrics.boundingRect(colName).width() + 10
+            self.setColumnWidth(ind,width)
+
+    def setupTrickyScrollbar(self):
+        """Replace the vertical scrollbar by the tricky scrollbar."""
+        self.setItemDelegate(TableDelegate())
+        self.rbuffer_fault = False
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
+        self.tricky_vscrollbar = Scrollbar.ScrollBar(self)
+        self.max_value = self.tricky_vscrollbar.setMaxValue(
+            self.leaf_numrows)
+        self.tricky_vscrollbar.setMinimum(0)
+        self.interval_size = self.mapSlider2Leaf()
+        self.tricky_vscrollbar.actionTriggered.connect(self.navigateWithMouse)
+        self.updateMarkers()
+
+    def updateRowCount(self):
+        """Adapt the view after the number of model rows has changed.
+
+        This happens when the model is filtered or sorted. The tricky
+        scrollbar is created, updated or hidden as needed.
         """
-        Show tooltip with flag names upon "flag" cell selection.
+
+        tmodel = self.tmodel
+        self.leaf_numrows = tmodel.leaf_numrows
+        self.valid_current_buffer = tmodel.start
+
+        if self.leaf_numrows > tmodel.numrows:
+            if self.tricky_vscrollbar is None:
+                self.setupTrickyScrollbar()
+            else:
+                self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
+                self.vscrollbar.setVisible(False)
+                self.tricky_vscrollbar.setVisible(True)
+                self.max_value = self.tricky_vscrollbar.setMaxValue(
+                    self.leaf_numrows)
+                self.interval_size = self.mapSlider2Leaf()
+            self.syncView()
+        elif self.tricky_vscrollbar is not None:
+            self.tricky_vscrollbar.setVisible(False)
+            self.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
+            self.vscrollbar.setVisible(True)
+
+        self.updateMarkers()
+        self.updateView()
+
+    def goToRow(self, row, column=0):
+        """Select the model row `row` (an absolute row, not a row of the
+        current buffer) and scroll it into view.
+        """
+
+        model = self.tmodel
+        if not 0 <= row < self.leaf_numrows:
+            return
+        if not model.start <= row < model.start + model.numrows:
+            model.loadData(row - model.numrows // 2, model.numrows)
+            self.updateView()
+        index = model.index(row - model.start, column)
+        self.setCurrentIndex(index)
+        self.scrollTo(index, _aiv.PositionAtCenter)
+        if self.tricky_vscrollbar is not None and self.tricky_vscrollbar.isVisible():
+            self.syncView()
+
+    def scrollToEnd(self):
+        """Show the last rows of the dataset without moving the current cell.
+
+        Used to follow files that are still being written.
         """
 
-        if self.tmodel.colnames[clickedIndex.column()] == 'flags':
-            # get the cell value (and convert to integer)
-            x = int(self.tmodel.data(clickedIndex))
+        model = self.tmodel
+        if model.start + model.numrows < self.leaf_numrows:
+            model.loadData(self.leaf_numrows - model.numrows, model.numrows)
+            self.updateView()
+        self.scrollToBottom()
+        if self.tricky_vscrollbar is not None and self.tricky_vscrollbar.isVisible():
+            self.tricky_vscrollbar.setValue(self.max_value)
+
+    def sortBySection(self, section):
+        """Sort by the clicked column.
+
+        Clicking the sorted column again toggles the order, a third click
+        removes the sorting.
+        """
+
+        model = self.tmodel
+        if model.header_index is None:
+            self.hheader.setSortIndicator(-1, Qt.AscendingOrder)
+            return
+
+        if model.sort_column != model.columnName(section):
+            column, order = section, Qt.AscendingOrder
+        elif model.sort_order == Qt.AscendingOrder:
+            column, order = section, Qt.DescendingOrder
+        else:
+            column, order = -1, Qt.AscendingOrder
 
-            # extract reversed bit string => index 0 returns LSB
-            bits = format(x,'b')[::-1]
+        model.sort(column, order)
+        self.hheader.setSortIndicator(column, order)
+        self.updateRowCount()
+        self.scrollToTop()
 
-            # extract flag names using the flag dictionary
-            text = ''
-            for indBit in range(0,len(bits)):
-                if bits[indBit] != '0':
-                    try:
-                        text += self.flagsDict[indBit+1] + '\n'
-                    except Exception as e:
-                        text += 'Unknown FLAG!!!\n'
+    def cellClicked(self,clickedIndex):
+        """
+        Show tooltip with flag names upon "flag" cell selection.
+        """
 
-            # remove last new line character
-            text = text[0:-1]
+        if self.tmodel.columnName(clickedIndex.column()) == 'flags' and \
+                self.tmodel.headerType is ismrmrd.AcquisitionHeader:
+            # decode the flags of the header record (not of the cell text)
+            flags = self.tmodel.rbuffer.getCell(clickedIndex.row())['head']['flags']
+            text = '\n'.join(AcquisitionFlags.flagNames(flags)) or 'No flags set'
 
             # get mouse position and display tooltip
             cursor = QCursor()
@@ -268,9 +374,104 @@ class TableView(QTableView):
             Qt.Vertical, 0, tmodel.numrows - 1)
         top_left = tmodel.index(0, 0)
         bottom_right = tmodel.index(tmodel.numrows - 1,
-                                    tmodel.numcols - 1)
+                                    tmodel.columnCount() - 1)
         self.dataChanged(top_left, bottom_right)
         self.setSpan(0, 0, *tmodel.get_corner_span())
+        self.restoreSelection()
+
+    def setMarkedRows(self, rows):
+        """Mark the dataset `rows` in the vertical scrollbar."""
+        self.marked_rows = numpy.asarray(rows, dtype=numpy.int64)
+        self.updateMarkers()
+
+    def updateMarkers(self):
+        """Place the markers of the marked rows at their model rows (in
+        the regular and the tricky scrollbar, whichever is shown)."""
+        rowmap = self.tmodel.rowmap
+        if rowmap is None:
+            rows = self.marked_rows
+        else:
+            rows = numpy.flatnonzero(numpy.isin(rowmap, self.marked_rows))
+        positions = rows / max(self.leaf_numrows - 1, 1)
+        self.vscrollbar.setMarkers(positions)
+        if self.tricky_vscrollbar is not None:
+            self.tricky_vscrollbar.setMarkers(positions)
+
+    def selectedRows(self):
+        """Return the (sorted) dataset rows of the selected cells."""
+        return self.selected_rows
+
+    def updateSelectedRows(self):
+        """Track the dataset rows of the selection after it has changed.
+
+        Rows selected in other buffers are kept while Ctrl is pressed (the
+        selection is extended), otherwise the selection is that of the
+        current buffer.
+        """
+
+        model = self.tmodel
+        rows = set(index.row() for index in self.selectionModel().selectedIndexes())
+        selected = numpy.array([model.datasetRow(row) for row in rows if row < model.numrows],
+                               dtype=numpy.int64)
+        if len(self.selected_rows) and \
+                QApplication.keyboardModifiers() & Qt.ControlModifier:
+            kept = self.selected_rows[~numpy.isin(self.selected_rows, model.datasetRows())]
+            selected = numpy.concatenate((kept, selected))
+        self.selected_rows = numpy.unique(selected)
+
+    def restoreSelection(self):
+        """Select the buffered rows of a selection of several rows again.
+
+        Called after the buffer has changed, the selection model is updated
+        without signals (the selected acquisitions are the same).
+        """
+
+        if len(self.selected_rows) < 2:
+            return
+        model = self.tmodel
+        mask = numpy.isin(model.datasetRows(), self.selected_rows).astype(numpy.int8)
+        edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], mask, [0]))))
+        selection = QItemSelection()
+        lastColumn = model.columnCount() - 1
+        for first, stop in zip(edges[::2], edges[1::2]):
+            selection.select(model.index(int(first), 0), model.index(int(stop) - 1, lastColumn))
+        selectionModel = self.selectionModel()
+        selectionModel.blockSignals(True)
+        selectionModel.select(selection, QItemSelectionModel.ClearAndSelect)
+        selectionModel.blockSignals(False)
+        self.viewport().update()
+
+    def onModelAboutToBeReset(self):
+        """Remember the current cell before the model is filtered or sorted
+        (or its row map is rebuilt while the index grows)."""
+        current = self.currentIndex()
+        self.reset_current = None
+        if current.isValid() and current.row() < self.tmodel.numrows:
+            self.reset_current = (self.tmodel.datasetRow(current.row()), current.column())
+
+    def onModelReset(self):
+        """Keep the current cell and the selected rows that are still shown
+        after the model has been filtered or sorted.
+
+        The selection model is updated without signals: the current
+        acquisition is the same, the plots stay as they are.
+        """
+        model = self.tmodel
+        rowmap = model.rowmap
+        if rowmap is not None:
+            self.selected_rows = self.selected_rows[numpy.isin(self.selected_rows, rowmap)]
+
+        current, self.reset_current = self.reset_current, None
+        if current is not None:
+            row = model.modelRow(current[0])
+            if row is not None and model.start <= row < model.start + model.numrows:
+                selectionModel = self.selectionModel()
+                selectionModel.blockSignals(True)
+                selectionModel.setCurrentIndex(model.index(row - model.start, current[1]),
+                                               QItemSelectionModel.ClearAndSelect)
+                selectionModel.blockSignals(False)
+                self.viewport().update()
+        self.restoreSelection()
 
     def navigateWithMouse(self, slider_action):
         """Navigate the view with the mouse.
@@ -661,7 +862,7 @@ class TableView(QTableView):
 
         model = self.tmodel
         table_rows = model.numrows
-        index = model.index(table_rows - 1, model.numcols - 1)
+        index = model.index(table_rows - 1, model.columnCount() - 1)
         # Update buffer if needed
         last_row = model.start + table_rows
         if last_row < self.leaf_numrows:
@@ -882,6 +1083,7 @@ class TableView(QTableView):
         - `deselected`: the previous selection (maybe empty)
         """
 
+        self.updateSelectedRows()
         model = self.tmodel
         if model.numrows < self.leaf_numrows:
             # Get the selected indexes from the QItemSelection object
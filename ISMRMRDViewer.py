@@ -16,94 +16,434 @@
 #
 # Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
 
+import time
+
+# reference time for the time-to-first-paint measurement
+_startTime = time.perf_counter()
+
 import sys
 import os.path
-import webbrowser
-import tempfile
-from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QSplitter, QMessageBox
-from PyQt5.QtGui import QIcon
-from PyQt5.QtCore import Qt
-import ismrmrd
-import images_qr
-import ISMRMRDTableView, ISMRMRDTableModel, ISMRMRDPlotWidgets
+import atexit
+import argparse
+import functools
+import multiprocessing
+from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, QProgressBar, QTabWidget, QFileDialog
+from PyQt5.QtGui import QIcon, QKeySequence
+from PyQt5.QtCore import Qt, QEvent, QTimer
+import Instrumentation
+import ReadEngine
+import ISMRMRDHeader, DatasetInfo, Workspace, HeaderDiff, Export, Validate, ColumnStatistics, AcquisitionFlags, SpikeDetector, TrajectoryView, SessionCache
 
 class ISMRMRDViewer(QMainWindow):
-    def __init__(self,fileName,parent=None):
+    def __init__(self,fileNames,follow=False,listen=None,streamMemory=None,memoryBudget=None,sessionCache=None,parent=None):
         super(ISMRMRDViewer,self).__init__(parent)
+        if isinstance(fileNames, str):
+            fileNames = [fileNames]
+        self.follow = follow
+        self.firstPaintDone = False
+        self.startupFinished = False
+        self.indexProgress = None
 
-        # set icon
-        self.setWindowIcon(QIcon(':/icon_256.ico'))
+        # one tab per file, the caches of all files share a memory budget
+        self.budget = Workspace.CacheBudget(memoryBudget or Workspace.DEFAULT_BUDGET, self)
+
+        # the views of reopened files are restored from the session cache
+        # (disabled with a size of 0)
+        if sessionCache is None:
+            sessionCache = SessionCache.DEFAULT_CACHE_BYTES
+        self.sessions = SessionCache.SessionCache(maxBytes=sessionCache) if sessionCache else None
+        self.files = QTabWidget()
+        self.files.setDocumentMode(True)
+        self.files.setTabsClosable(True)
+        self.files.setTabBarAutoHide(True)
+        self.files.tabCloseRequested.connect(self.closeFile)
+        self.setCentralWidget(self.files)
+
+        # open the files (and the stream)
+        if listen is not None:
+            self.openFile(None, listen=listen, streamMemory=streamMemory)
+        for fileName in fileNames or []:
+            self.openFile(fileName)
+        if not self.files.count():
+            quit()
+        self.files.currentChanged.connect(self.onFileChanged)
+        view = self.currentView()
+        self.dset = view.dset
+
+        # file menu
+        fileMenu = self.menuBar().addMenu('&File')
+        action = fileMenu.addAction('&Open...')
+        action.setShortcut(QKeySequence.Open)
+        action.triggered.connect(self.showOpenDialog)
+        action = fileMenu.addAction('&Close')
+        action.setShortcut(QKeySequence.Close)
+        action.triggered.connect(lambda: self.closeFile(self.files.currentIndex()))
+        fileMenu.addSeparator()
+        action = fileMenu.addAction('&Export acquisitions...')
+        action.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_E))
+        action.triggered.connect(self.showExportDialog)
+        action = fileMenu.addAction('Compare &headers...')
+        action.triggered.connect(self.showCompareDialog)
+        action = fileMenu.addAction('&Validate')
+        action.setShortcut(QKeySequence(Qt.CTRL + Qt.SHIFT + Qt.Key_V))
+        action.triggered.connect(self.validate)
+
+        # view menu
+        self.viewMenu = self.menuBar().addMenu('&View')
+
+        # XML header dock (the header is parsed when the dock is first shown)
+        self.xmlDock = ISMRMRDHeader.XMLHeaderDock(self.dset, self)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.xmlDock)
+        self.xmlDock.hide()
+        self.viewMenu.addAction(self.xmlDock.toggleViewAction())
+
+        # storage layout dock
+        self.infoDock = DatasetInfo.DatasetInfoDock(view.tableModel.rbuffer, self)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.infoDock)
+        self.infoDock.hide()
+        self.viewMenu.addAction(self.infoDock.toggleViewAction())
+
+        # column statistics (clicking a histogram bar filters the table)
+        self.statisticsDock = ColumnStatistics.StatisticsDock(self)
+        self.statisticsDock.setView(view)
+        self.statisticsDock.filterRequested.connect(
+            lambda expression: self.currentView().filterBar.setExpression(expression))
+        self.addDockWidget(Qt.RightDockWidgetArea, self.statisticsDock)
+        self.statisticsDock.hide()
+        self.viewMenu.addAction(self.statisticsDock.toggleViewAction())
+
+        # acquisition flags (population, flag columns and navigation)
+        self.flagDock = AcquisitionFlags.FlagDock(self)
+        self.flagDock.setView(view)
+        self.flagDock.filterRequested.connect(
+            lambda expression: self.currentView().filterBar.setExpression(expression))
+        self.addDockWidget(Qt.RightDockWidgetArea, self.flagDock)
+        self.flagDock.hide()
+        self.viewMenu.addAction(self.flagDock.toggleViewAction())
+
+        # validation findings (activating a finding shows its acquisition)
+        self.validationDock = Validate.ValidationDock(self)
+        self.validationDock.setView(view)
+        self.validationDock.rowRequested.connect(
+            lambda row: self.currentView().showAcquisition(row))
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.validationDock)
+        self.validationDock.hide()
+        self.viewMenu.addAction(self.validationDock.toggleViewAction())
+
+        # spike detection (activating an acquisition shows it)
+        self.spikeDock = SpikeDetector.SpikeDock(self)
+        self.spikeDock.setView(view)
+        self.spikeDock.rowRequested.connect(
+            lambda row: self.currentView().showAcquisition(row))
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.spikeDock)
+        self.spikeDock.hide()
+        self.viewMenu.addAction(self.spikeDock.toggleViewAction())
+
+        # k-space scatter of the trajectories of many acquisitions
+        self.trajectoryDock = TrajectoryView.TrajectoryDock(self)
+        self.trajectoryDock.setView(view)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.trajectoryDock)
+        self.trajectoryDock.hide()
+        self.viewMenu.addAction(self.trajectoryDock.toggleViewAction())
+
+        # follow mode for files that are still being written
+        self.pollAction = None
+        if listen is not None or follow:
+            self.setupFollowMenu()
+
+        # performance HUD (only available if the probes are enabled)
+        if Instrumentation.ENABLED:
+            self.setupPerformanceHUD()
+
+        self.updateWindowTitle()
+        self.setAttribute(Qt.WA_DeleteOnClose)
+
+        # the remaining start-up work (icon resources, plotting stack) is
+        # done once the table has been painted for the first time
+        view.tableView.viewport().installEventFilter(self)
+        view.tableView.selectionModel().selectionChanged.connect(self.finishStartup)
+
+        # show window
+        self.showMaximized()
+
+    def openFile(self, fileName, listen=None, streamMemory=None):
+        """Open a file (or a stream) in a new tab.
+
+        Returns the FileView, None if the file could not be opened.
+        """
 
-        # try to open ISMRMRD file
         try:
-            self.dset = ismrmrd.Dataset(fileName, '/dataset', False)
+            fileView = Workspace.FileView(fileName, follow=self.follow and listen is None,
+                                          listen=listen, streamMemory=streamMemory,
+                                          sessions=self.sessions)
         except Exception as e:
+            import images_qr
             msg = QMessageBox()
             msg.setIcon(QMessageBox.Critical)
             msg.setWindowIcon(QIcon(':/icon_256.ico'))
             msg.setWindowTitle("ISMRMRD Viewer Error")
             msg.setText("Could not read specified file!")
+            msg.setInformativeText('{0}\n{1}'.format(fileName or listen, e))
             msg.exec_()
-            quit()
-        
-        # create table model and view
-        self.tableModel = ISMRMRDTableModel.TableModel(self.dset)
-        self.tableView = ISMRMRDTableView.TableView(self.tableModel)
-
-        # create plot area
-        self.plotWidget = ISMRMRDPlotWidgets.ISMRMRDPlotWidget(self.tableModel,self.tableView)
-
-        # connect table selection change event to plot update function
-        self.tableView.selectionModel().selectionChanged.connect(self.plotWidget.updatePlot)
-
-        # connect xml button click event to handler method
-        self.plotWidget.btnXML.clicked.connect(self.showXML)
-
-        # set window layout and widgets
-        _widget = QWidget()
-        _layout = QVBoxLayout(_widget)
-        self.splitter = QSplitter()
-        self.splitter.setOrientation(Qt.Vertical)
-        self.splitter.addWidget(self.tableView)
-        self.splitter.addWidget(self.plotWidget)
-        self.splitter.setStretchFactor(0,10)
-        self.splitter.setStretchFactor(1,1)
-        _layout.addWidget(self.splitter)
-        self.setCentralWidget(_widget)
-
-        self.setWindowTitle('ISMRM RAW DATA VIEWER: ' + fileName)
-        self.setAttribute(Qt.WA_DeleteOnClose)
-        
-        # show window
-        self.showMaximized()
+            return None
 
-    def showXML(self):
-        # get the xml string
-        xml = self.dset.read_xml_header()
+        for view in fileView.views.values():
+            self.addView(view)
+        fileView.viewCreated.connect(self.addView)
+        fileView.viewChanged.connect(self.activateView)
+        fileView.statusMessage.connect(self.statusBar().showMessage)
+        if fileView.streamStatus is not None:
+            self.statusBar().addPermanentWidget(fileView.streamStatus)
+
+        index = self.files.addTab(fileView, os.path.basename(fileView.title))
+        self.files.setTabToolTip(index, fileView.title)
+        self.files.setCurrentIndex(index)
+        return fileView
+
+    def showOpenDialog(self):
+        fileNames, _ = QFileDialog.getOpenFileNames(
+            self, 'Open ISMRMRD files', '', 'ISMRMRD files (*.h5 *.hdf5 *.mrd);;All files (*)')
+        for fileName in fileNames:
+            self.openFile(fileName)
+
+    def showExportDialog(self):
+        """Export acquisitions of the current dataset to a new file."""
+        dialog = Export.ExportDialog(self.currentView(), self)
+        dialog.setAttribute(Qt.WA_DeleteOnClose)
+        dialog.show()
 
-        # write xml to temporary file
-        tempFile = os.path.join(tempfile.gettempdir(),'ISMRMRDViewerTempXML.xml')
-        with open(tempFile, "wb") as textFile:
-            textFile.write(xml)
+    def showCompareDialog(self):
+        """Compare the acquisition headers of two open files or groups."""
+        fileViews = [self.files.widget(index) for index in range(self.files.count())]
+        dialog = HeaderDiff.CompareDialog(fileViews, self)
+        dialog.setAttribute(Qt.WA_DeleteOnClose)
+        dialog.show()
 
-        # open xml viewer (web browser)
-        webbrowser.open(tempFile)
+    def validate(self):
+        """Validate the acquisitions of the current dataset."""
+        self.validationDock.show()
+        self.validationDock.raise_()
+        self.validationDock.validate()
+
+    def closeFile(self, index):
+        """Close the file of tab `index` (the last file closes the window)."""
+        if self.files.count() <= 1:
+            self.close()
+            return
+        fileView = self.files.widget(index)
+        fileView.shutdown()
+        for view in fileView.views.values():
+            self.budget.unregister(view)
+        self.files.removeTab(index)
+        if fileView.streamStatus is not None:
+            self.statusBar().removeWidget(fileView.streamStatus)
+        fileView.closeFiles()
+        fileView.deleteLater()
+
+    def addView(self, view):
+        """Connect a new DatasetView of one of the files."""
+        view.plotWidget.btnXML.clicked.connect(self.showXML)
+        view.statusMessage.connect(self.statusBar().showMessage)
+        view.indexProgress.connect(functools.partial(self.onIndexProgress, view))
+        view.indexFinished.connect(functools.partial(self.onIndexFinished, view))
+        view.indexFailed.connect(lambda message, view=view: self.onIndexFinished(view))
+        self.budget.register(view)
+
+    def currentFile(self):
+        return self.files.currentWidget()
+
+    def currentView(self):
+        return self.currentFile().currentView()
+
+    def onFileChanged(self, index):
+        if index >= 0:
+            self.activateView(self.currentView())
+
+    def activateView(self, view):
+        """Show the docks and the progress of `view` (after the file tab or
+        the dataset group was switched)."""
+        self.dset = view.dset
+        self.budget.touch(view)
+        view.restoreCaches()
+
+        self.xmlDock.setDataset(view.dset)
+        self.infoDock.setBuffer(view.tableModel.rbuffer)
+        self.validationDock.setView(view)
+        self.statisticsDock.setView(view)
+        self.flagDock.setView(view)
+        self.spikeDock.setView(view)
+        self.trajectoryDock.setView(view)
+        if self.pollAction is not None:
+            liveTail = self.currentFile().liveTail
+            self.pollAction.setEnabled(liveTail is not None)
+            self.scrollAction.setEnabled(liveTail is not None)
+            if liveTail is not None:
+                self.pollAction.setChecked(liveTail.isActive())
+                self.scrollAction.setChecked(liveTail.autoScroll)
+        if self.startupFinished:
+            view.finishStartup()
+            self.updateIndexProgress(view)
+        self.updateWindowTitle()
+
+    def updateWindowTitle(self):
+        self.setWindowTitle('ISMRM RAW DATA VIEWER: ' + self.currentFile().title)
+
+    def eventFilter(self, obj, event):
+        """Detect the first paint event of the table view."""
+        if not self.firstPaintDone and event.type() == QEvent.Paint:
+            self.firstPaintDone = True
+            Instrumentation.mark('time-to-first-paint', time.perf_counter() - _startTime)
+            obj.removeEventFilter(self)
+
+            # finish start-up as soon as the event loop is idle
+            QTimer.singleShot(0, self.finishStartup)
+        return False
+
+    def finishStartup(self):
+        """Load the deferred parts of the application.
+
+        This is called from an idle callback after the first paint or upon
+        the first selection, whichever comes first.
+        """
+
+        if self.startupFinished:
+            return
+        self.startupFinished = True
+
+        # set icon (the resource module registers the icons on import)
+        import images_qr
+        self.setWindowIcon(QIcon(':/icon_256.ico'))
+
+        # progress of the header index in the status bar (shown while indexing)
+        self.indexProgress = QProgressBar()
+        self.indexProgress.setMaximumWidth(200)
+        self.indexProgress.setFormat('Indexing headers %p%')
+        self.statusBar().addPermanentWidget(self.indexProgress)
+        self.indexProgress.hide()
+
+        # import pyqtgraph and create the plots, build the header index in
+        # the background
+        view = self.currentView()
+        view.finishStartup()
+        self.updateIndexProgress(view)
+
+        if Instrumentation.ENABLED:
+            Instrumentation.mark('time-to-interactive', time.perf_counter() - _startTime)
+            self.statusBar().showMessage('First paint after {0:.0f} ms (F12 toggles the performance HUD)'.format(
+                Instrumentation.marks().get('time-to-first-paint', 0.0) * 1e3))
+
+    def updateIndexProgress(self, view):
+        """Show the index progress of `view` (hidden once complete)."""
+        index = view.headerIndex
+        if index is None or index.isComplete() or index.error is not None:
+            self.indexProgress.hide()
+            return
+        self.onIndexProgress(view, index.nindexed, index.total)
+
+    def onIndexProgress(self, view, indexed, total):
+        if view is not self.currentView():
+            return
+        self.indexProgress.setRange(0, total)
+        self.indexProgress.setValue(indexed)
+        self.indexProgress.show()
+
+    def onIndexFinished(self, view):
+        if view is self.currentView():
+            self.indexProgress.hide()
+
+    def closeEvent(self, event):
+        # stop the background threads before the files are closed
+        self.validationDock.shutdown()
+        self.statisticsDock.shutdown()
+        self.flagDock.shutdown()
+        self.spikeDock.shutdown()
+        self.trajectoryDock.shutdown()
+        for index in range(self.files.count()):
+            self.files.widget(index).shutdown()
+        super(ISMRMRDViewer, self).closeEvent(event)
+
+    def setupFollowMenu(self):
+        # the actions apply to the live tail of the current file
+        followMenu = self.menuBar().addMenu('&Follow')
+        self.pollAction = followMenu.addAction('Poll for new acquisitions')
+        self.pollAction.setCheckable(True)
+        self.pollAction.toggled.connect(
+            lambda checked: self.currentFile().liveTail and self.currentFile().liveTail.setActive(checked))
+        self.scrollAction = followMenu.addAction('Auto-scroll')
+        self.scrollAction.setCheckable(True)
+        self.scrollAction.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_T))
+        self.scrollAction.toggled.connect(
+            lambda checked: self.currentFile().liveTail and self.currentFile().liveTail.setAutoScroll(checked))
+        self.activateView(self.currentView())
+
+    def setupPerformanceHUD(self):
+        # import here => the HUD module is only loaded when profiling
+        import PerformanceHUD
+
+        self.perfHUD = PerformanceHUD.PerformanceHUD(self)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.perfHUD)
+        self.perfHUD.hide()
+
+        # toggle action in the view menu (F12)
+        action = self.perfHUD.toggleViewAction()
+        action.setShortcut(QKeySequence(Qt.Key_F12))
+        self.viewMenu.addAction(action)
+        self.statusBar().showMessage('Profiling enabled (F12 toggles the performance HUD)')
+
+    def showXML(self):
+        # show the XML header dock
+        self.xmlDock.show()
+        self.xmlDock.raise_()
 
 
 # main application entry point
 if __name__ == "__main__":
+    # support for the read engine worker processes in frozen executables
+    multiprocessing.freeze_support()
+
     app  = QApplication(sys.argv)
-    
-    # check command line arguments => we expect a filepath
-    if len(sys.argv) > 1:
-        fileName = sys.argv[1]
 
+    # parse command line arguments => we expect a filepath
+    parser = argparse.ArgumentParser(description='ISMRM raw data viewer')
+    parser.add_argument('fileNames', nargs='*', metavar='fileName',
+                        help='ISMRMRD (HDF5) files (one tab per file)')
+    parser.add_argument('--profile', action='store_true',
+                        help='enable the timing probes and the performance HUD '
+                        '(same as setting ISMRMRDVIEWER_PROFILE=1)')
+    parser.add_argument('--listen', metavar='[HOST:]PORT',
+                        help='receive acquisitions over TCP (ISMRMRD streaming '
+                        'protocol) instead of reading a file')
+    parser.add_argument('--stream-memory', type=int, default=256, metavar='MB',
+                        help='memory for the acquisitions of a stream (header table '
+                        'and data); the oldest acquisitions are evicted (default: 256)')
+    parser.add_argument('--follow', action='store_true',
+                        help='open the file as SWMR reader and show acquisitions '
+                        'appended while it is being written')
+    parser.add_argument('--memory-budget', type=int, default=1024, metavar='MB',
+                        help='memory shared by the caches of all open files; the '
+                        'caches of hidden files are released first (default: 1024)')
+    parser.add_argument('--session-cache', type=int, default=256, metavar='MB',
+                        help='disk space for the saved state and data of closed files, '
+                        'used to restore them when reopened; 0 disables (default: 256)')
+    args, _ = parser.parse_known_args(app.arguments()[1:])
+
+    # dump the collected statistics when the application terminates
+    if Instrumentation.ENABLED:
+        atexit.register(lambda: print(Instrumentation.report(), file=sys.stderr))
+
+    # check command line arguments => we expect a filepath
+    if args.fileNames or args.listen:
         # create application window
-        appWin = ISMRMRDViewer(fileName)
+        appWin = ISMRMRDViewer(args.fileNames, follow=args.follow, listen=args.listen,
+                               streamMemory=args.stream_memory * 2 ** 20,
+                               memoryBudget=args.memory_budget * 2 ** 20,
+                               sessionCache=args.session_cache * 2 ** 20)
         app.exec_()
+        ReadEngine.shutdownPool()
     else:
         # show a message box to inform the user that he needs to supply a file
         # path as application argument
+        import images_qr
         msg = QMessageBox()
         msg.setIcon(QMessageBox.Critical)
         msg.setWindowIcon(QIcon(':/icon_256.ico'))
@@ -0,0 +1,336 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements the waveform tab (ECG, pulse, respiration, gradient
+waveforms stored in ``/dataset/waveforms``).
+
+The waveform headers are shown by the same table model and view as the
+acquisitions (chunked, header-only buffer faults) with a header index of
+their own, built once the tab is opened. The waveform data is plotted with
+pyqtgraph's peak decimation, clipped to the visible range.
+
+Waveforms and acquisitions are aligned by their time stamps through sorted
+time stamp indices (`HeaderIndex.TimestampIndex`), built on first use: from
+the header index if it is complete, otherwise in a background thread (the
+alignment shows "Aligning..." meanwhile).
+"""
+
+import numpy
+import ismrmrd
+from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtWidgets import QWidget, QComboBox, QHBoxLayout, QVBoxLayout, QLabel, QPushButton, QSplitter
+import Instrumentation
+import HeaderIndex
+import ISMRMRDTableModel, ISMRMRDTableView
+
+#: The duration of a time stamp tick in milliseconds (the convention of the
+#: Siemens converters, the ISMRMRD format does not define a unit).
+TIME_STAMP_TICK_MS = 2.5
+
+#: The number of waveforms shown on each side of the selected one by the
+#: continuous trace.
+TRACE_NEIGHBOURS = 25
+
+# names of the waveform ids defined by the ISMRMRD format
+_WAVEFORM_NAMES = {0: 'ECG', 1: 'Pulse oximetry', 2: 'Respiratory',
+                   3: 'External 1', 4: 'External 2'}
+
+pg = None
+
+def waveformName(waveform_id):
+    if waveform_id >= 1024:
+        return 'User waveform {0}'.format(waveform_id)
+    return _WAVEFORM_NAMES.get(waveform_id, 'Waveform {0}'.format(waveform_id))
+
+def hasWaveforms(dset):
+    """True if the ismrmrd dataset (group) contains waveforms."""
+    try:
+        return 'waveforms' in dset._dataset
+    except (AttributeError, KeyError):
+        return False
+
+
+class WaveformPlotWidget(QWidget):
+    """
+    Plot of the selected waveform (or of a continuous trace around it).
+
+    :Parameters:
+
+    - `tableModel`: the waveform TableModel
+    - `tableView`: the waveform TableView
+    - `parent`: the parent of this widget
+    """
+
+    def __init__(self, tableModel, tableView, parent=None):
+        super(WaveformPlotWidget, self).__init__(parent)
+        self.tableModel = tableModel
+        self.tableView = tableView
+
+        self.traceCB = QComboBox()
+        self.traceCB.addItem('Selected waveform')
+        self.traceCB.addItem('Continuous trace (same waveform id)')
+        self.traceCB.currentIndexChanged.connect(self.updatePlot)
+
+        self.ctrlBarBox = QHBoxLayout()
+        self.ctrlBarBox.setContentsMargins(0,0,0,0)
+        self.ctrlBarBox.addWidget(QLabel('Waveform plot:'))
+        self.ctrlBarBox.addWidget(self.traceCB)
+        self.ctrlBarBox.addStretch(1)
+
+        self.vbox = QVBoxLayout(self)
+        self.vbox.setContentsMargins(0,0,0,0)
+        self.vbox.addLayout(self.ctrlBarBox)
+
+        self.plot = None
+
+    def createPlot(self):
+        """Import pyqtgraph and create the (decimating) plot widget."""
+        global pg
+
+        if self.plot is not None:
+            return
+        if pg is None:
+            import pyqtgraph
+            pg = pyqtgraph
+
+        self.plot = pg.PlotWidget()
+        self.plot.setClipToView(True)
+        self.plot.setDownsampling(auto=True, mode='peak')
+        self.plot.setLabel('bottom', 'time', 'ms')
+        self.vbox.addWidget(self.plot, 1)
+
+    def traceRecords(self, row):
+        """Read the waveforms around the dataset row `row` with the same id."""
+        rbuffer = self.tableModel.rbuffer
+        head = rbuffer.getCell(row)['head']
+        drow = self.tableModel.datasetRow(row)
+        lo = max(drow - TRACE_NEIGHBOURS, 0)
+        hi = min(drow + TRACE_NEIGHBOURS + 1, rbuffer.total_nrows())
+        records = rbuffer.data[lo:hi]
+        return records[records['head']['waveform_id'] == head['waveform_id']]
+
+    @Instrumentation.probe('WaveformPlotWidget.updatePlot')
+    def updatePlot(self, *args):
+        self.createPlot()
+
+        row = self.tableView.currentIndex().row()
+        if row < 0:
+            return
+
+        if self.traceCB.currentIndex() == 1:
+            records = self.traceRecords(row)
+        else:
+            records = [self.tableModel.rbuffer.readAcquisition(row)]
+
+        # one curve per channel over the time of all records
+        times, values = [], []
+        for record in records:
+            head = record['head']
+            nsamples, channels = int(head['number_of_samples']), int(head['channels'])
+            times.append(float(head['time_stamp']) * TIME_STAMP_TICK_MS +
+                         numpy.arange(nsamples) * float(head['sample_time_us']) / 1e3)
+            values.append(numpy.asarray(record['data']).reshape((channels, nsamples)))
+
+        self.plot.clear()
+        if not times:
+            return
+        head = records[0]['head']
+        self.plot.setTitle(waveformName(int(head['waveform_id'])))
+        channels = min(value.shape[0] for value in values)
+        time = numpy.concatenate(times)
+        for ind in range(channels):
+            data = numpy.concatenate([value[ind] for value in values])
+            self.plot.plot(time, data, pen=pg.mkPen(pg.intColor(ind)))
+
+
+class WaveformTab(QWidget):
+    """
+    Table and plot of the waveforms of an ismrmrd dataset.
+
+    :Parameters:
+
+    - `dset`: the ismrmrd.Dataset
+    - `acqModel`: the acquisition TableModel (for the time alignment)
+    - `acqView`: the acquisition TableView
+    - `parent`: the parent of this widget
+    """
+
+    #: Emitted with the dataset row of the acquisition to show.
+    acquisitionRequested = pyqtSignal(int)
+
+    def __init__(self, dset, acqModel, acqView, parent=None):
+        super(WaveformTab, self).__init__(parent)
+        self.acqModel = acqModel
+        self.acqView = acqView
+
+        self.tableModel = ISMRMRDTableModel.TableModel(
+            dset, dataset='waveforms', headerType=ismrmrd.WaveformHeader)
+        self.tableView = ISMRMRDTableView.TableView(self.tableModel)
+        self.plotWidget = WaveformPlotWidget(self.tableModel, self.tableView)
+        self.tableView.selectionModel().selectionChanged.connect(self.plotWidget.updatePlot)
+        self.tableView.selectionModel().selectionChanged.connect(self.updateAlignment)
+
+        # time alignment with the acquisitions
+        self.alignLabel = QLabel()
+        self.btnToAcquisition = QPushButton('Go to acquisition')
+        self.btnToAcquisition.clicked.connect(self.goToAcquisition)
+        self.btnFromAcquisition = QPushButton('Go to time of selected acquisition')
+        self.btnFromAcquisition.clicked.connect(self.goToAcquisitionTime)
+        alignBox = QHBoxLayout()
+        alignBox.setContentsMargins(0,0,0,0)
+        alignBox.addWidget(self.alignLabel, 1)
+        alignBox.addWidget(self.btnToAcquisition)
+        alignBox.addWidget(self.btnFromAcquisition)
+
+        self.splitter = QSplitter()
+        self.splitter.setOrientation(Qt.Vertical)
+        self.splitter.addWidget(self.tableView)
+        self.splitter.addWidget(self.plotWidget)
+        self.splitter.setStretchFactor(0,2)
+        self.splitter.setStretchFactor(1,1)
+
+        layout = QVBoxLayout(self)
+        layout.addLayout(alignBox)
+        layout.addWidget(self.splitter)
+
+        # header index of the waveforms (sorting)
+        rbuffer = self.tableModel.rbuffer
+        self.headerIndex = HeaderIndex.HeaderIndex(rbuffer.engine, rbuffer.total_nrows(),
+                                                   mmap=rbuffer.mmap, parent=self)
+        self.tableModel.setIndex(self.headerIndex)
+        self.headerIndex.start()
+
+        # time stamp indices of the acquisitions and the waveforms (built on
+        # first use), their background builders and the action waiting for
+        # them
+        self.stamps = {}
+        self.stampBuilders = {}
+        self.stampError = None
+        self.pendingAction = None
+
+        self.updateAlignment()
+
+    def timeStamps(self, model, name):
+        """Return the TimestampIndex of the field `name` of a table model,
+        None while it is built in the background (`updateAlignment` and the
+        pending action are called once it is ready)."""
+
+        stamps = self.stamps.get(name)
+        if stamps is not None:
+            return stamps
+        index = model.header_index
+        if index is not None and index.isComplete():
+            stamps = self.stamps[name] = HeaderIndex.TimestampIndex.fromIndex(index, name)
+            return stamps
+        if name not in self.stampBuilders:
+            builder = HeaderIndex.TimestampBuilder(model.rbuffer.engine, name, self)
+            builder.finished.connect(self.onStampsBuilt)
+            self.stampBuilders[name] = builder
+            builder.start()
+        return None
+
+    def acquisitionStamps(self):
+        return self.timeStamps(self.acqModel, 'acquisition_time_stamp')
+
+    def waveformTimeStamps(self):
+        return self.timeStamps(self.tableModel, 'time_stamp')
+
+    def onStampsBuilt(self):
+        for name, builder in list(self.stampBuilders.items()):
+            if not builder.isFinished():
+                continue
+            del self.stampBuilders[name]
+            if builder.error is not None:
+                self.stampError = builder.error
+            elif builder.stamps is not None:
+                self.stamps[name] = builder.stamps
+        self.updateAlignment()
+        action, self.pendingAction = self.pendingAction, None
+        if action is not None and self.stampError is None:
+            action()
+
+    def showAligning(self):
+        if self.stampError is not None:
+            self.alignLabel.setText('Cannot read the time stamps: {0}'.format(self.stampError))
+        else:
+            self.alignLabel.setText('Aligning...')
+
+    def selectedStamp(self):
+        row = self.tableView.currentIndex().row()
+        if row < 0:
+            return None
+        return int(self.tableModel.rbuffer.getCell(row)['head']['time_stamp'])
+
+    def updateAlignment(self, *args):
+        stamp = self.selectedStamp()
+        self.btnToAcquisition.setEnabled(stamp is not None)
+        if stamp is None:
+            self.alignLabel.setText('Select a waveform to align it with the acquisitions.')
+            return
+        stamps = self.acquisitionStamps()
+        if stamps is None:
+            self.showAligning()
+            return
+        row = stamps.nearest(stamp)
+        if row is None:
+            self.alignLabel.setText('No acquisitions.')
+            return
+        acqStamp = int(stamps.stamps[row])
+        self.alignLabel.setText('Waveform time stamp {0}: nearest acquisition {1} '
+                                '(time stamp {2}, {3:+.1f} ms)'.format(
+                                    stamp, row, acqStamp,
+                                    (acqStamp - stamp) * TIME_STAMP_TICK_MS))
+
+    def goToAcquisition(self):
+        stamp = self.selectedStamp()
+        if stamp is None:
+            return
+        stamps = self.acquisitionStamps()
+        if stamps is None:
+            self.pendingAction = self.goToAcquisition
+            return
+        row = stamps.nearest(stamp)
+        if row is not None:
+            self.acquisitionRequested.emit(row)
+
+    def goToAcquisitionTime(self):
+        """Select the waveform closest in time to the selected acquisition."""
+        row = self.acqView.currentIndex().row()
+        if row < 0:
+            return
+        stamp = int(self.acqModel.rbuffer.getCell(row)['head']['acquisition_time_stamp'])
+        stamps = self.waveformTimeStamps()
+        if stamps is None:
+            self.showAligning()
+            self.pendingAction = self.goToAcquisitionTime
+            return
+        waveform = stamps.nearest(stamp)
+        if waveform is None:
+            return
+        modelRow = self.tableModel.modelRow(waveform)
+        if modelRow is not None:
+            self.tableView.goToRow(modelRow)
+
+    def shutdown(self):
+        """Stop the index and time stamp builder threads."""
+        self.headerIndex.cancel()
+        for builder in self.stampBuilders.values():
+            builder.finished.disconnect()
+            builder.cancel()
+        self.stampBuilders = {}
@@ -0,0 +1,229 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements optional timing probes for the hot paths of the
+viewer (buffer reads, model data access, cell painting and plotting).
+
+Probes are enabled by setting the ``ISMRMRDVIEWER_PROFILE`` environment
+variable or by passing ``--profile`` on the command line. The decision is
+taken once, at import time: when profiling is disabled the `probe` decorator
+returns the decorated function unchanged, so the instrumentation does not
+cost anything.
+
+The module does not depend on Qt so that it can be used from worker
+processes and command line tools as well.
+"""
+
+import os
+import sys
+import math
+import time
+import threading
+import functools
+import collections
+
+#: Values of ``ISMRMRDVIEWER_PROFILE`` that leave the probes disabled.
+_DISABLED_VALUES = ('', '0', 'false', 'no', 'off')
+
+#: Characters of the histogram bars, from empty to the largest bucket.
+_HISTOGRAM_RAMP = ' .:-=+*#%@'
+
+
+def profilingRequested(environ=os.environ, argv=sys.argv):
+    """True if profiling is requested by the environment or the command
+    line (``ISMRMRDVIEWER_PROFILE=0`` or ``false`` disables it)."""
+    value = environ.get('ISMRMRDVIEWER_PROFILE', '').strip().lower()
+    return value not in _DISABLED_VALUES or '--profile' in argv
+
+
+#: True if the timing probes are active for this process.
+ENABLED = profilingRequested()
+
+#: The number of most recent samples kept per probe for percentiles.
+HISTORY_SIZE = 4096
+
+_lock = threading.Lock()
+_stats = collections.OrderedDict()
+_counters = collections.OrderedDict()
+_marks = collections.OrderedDict()
+
+
+class ProbeStats(object):
+    """Aggregated timings of a single probe.
+
+    Besides the total count and the number of bytes read, a log2 histogram
+    of the durations (in microseconds) and a bounded history of the most
+    recent samples (used for the percentiles) are kept.
+
+    :Parameter name: the probe name
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.nbytes = 0
+        self.histogram = collections.Counter()
+        self.samples = collections.deque(maxlen=HISTORY_SIZE)
+
+    def add(self, seconds, nbytes=0):
+        """Add a single timing sample (in seconds) to the statistics."""
+        with _lock:
+            self.count += 1
+            self.total += seconds
+            self.nbytes += nbytes
+            self.samples.append(seconds)
+            self.histogram[int(math.log2(max(seconds * 1e6, 1.0)))] += 1
+
+    def percentile(self, q):
+        """Return the `q`-th percentile (0-100) of the recent samples."""
+        with _lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        ind = min(len(samples) - 1, int(round(q / 100.0 * (len(samples) - 1))))
+        return samples[ind]
+
+    def histogramText(self):
+        """Return the log2 histogram of the durations as a one-line bar
+        chart, e.g. ``8us-1ms  .:#*-``, one character per bucket."""
+        with _lock:
+            histogram = dict(self.histogram)
+        if not histogram:
+            return ''
+        first, last = min(histogram), max(histogram)
+        peak = max(histogram.values())
+        bars = ''.join(
+            _HISTOGRAM_RAMP[int(math.ceil(histogram.get(bucket, 0) * (len(_HISTOGRAM_RAMP) - 1)
+                                          / float(peak)))]
+            for bucket in range(first, last + 1))
+        return '{0}-{1} {2}'.format(formatMicroseconds(2 ** first),
+                                    formatMicroseconds(2 ** (last + 1)), bars)
+
+
+def stats(name):
+    """Return the `ProbeStats` instance of the probe `name`.
+
+    The statistics object is created on first use.
+    """
+
+    with _lock:
+        try:
+            return _stats[name]
+        except KeyError:
+            _stats[name] = ProbeStats(name)
+            return _stats[name]
+
+
+def probe(name, nbytes=None):
+    """Decorator timing every call of the decorated function.
+
+    :Parameters:
+    :param name: the name under which the timings are aggregated.
+    :param nbytes: optional callable invoked with the call arguments after
+        the call returned. It must return the number of bytes read by the
+        call.
+    """
+
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        probeStats = stats(name)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t0
+                probeStats.add(elapsed, nbytes(*args, **kwargs) if nbytes else 0)
+        return wrapper
+
+    return decorator
+
+
+def count(name, n=1):
+    """Increment the event counter `name` by `n`.
+
+    Callers on hot paths should guard the call with `ENABLED`.
+    """
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def mark(name, seconds):
+    """Record a one-off duration such as the startup time."""
+    with _lock:
+        _marks[name] = seconds
+
+
+def snapshot():
+    """Return a list of ``(name, count, p50, p99, nbytes, histogram)``
+    tuples (see `ProbeStats.histogramText`)."""
+    with _lock:
+        probes = list(_stats.values())
+    return [(p.name, p.count, p.percentile(50), p.percentile(99), p.nbytes,
+             p.histogramText()) for p in probes]
+
+
+def counters():
+    """Return a copy of the event counters."""
+    with _lock:
+        return collections.OrderedDict(_counters)
+
+
+def marks():
+    """Return a copy of the recorded one-off durations."""
+    with _lock:
+        return collections.OrderedDict(_marks)
+
+
+def formatMicroseconds(us):
+    """Format a duration in microseconds with a fitting unit."""
+    if us < 1000:
+        return '{0}us'.format(int(us))
+    if us < 1000000:
+        return '{0:g}ms'.format(round(us / 1e3, 1))
+    return '{0:g}s'.format(round(us / 1e6, 1))
+
+
+def formatBytes(nbytes):
+    """Format a number of bytes in a human readable way."""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if nbytes < 1024:
+            return '{0:.0f} {1}'.format(nbytes, unit)
+        nbytes /= 1024.0
+    return '{0:.1f} TB'.format(nbytes)
+
+
+def report():
+    """Return a plain text table of all probes, counters and marks."""
+    lines = ['{0:<32}{1:>10}{2:>12}{3:>12}{4:>12}  {5}'.format(
+        'probe', 'count', 'p50 [ms]', 'p99 [ms]', 'read', 'durations (log2 buckets)')]
+    for name, n, p50, p99, nbytes, histogram in snapshot():
+        lines.append('{0:<32}{1:>10}{2:>12.3f}{3:>12.3f}{4:>12}  {5}'.format(
+            name, n, p50 * 1e3, p99 * 1e3, formatBytes(nbytes), histogram))
+    for name, value in counters().items():
+        lines.append('{0:<32}{1:>10}'.format(name, value))
+    for name, seconds in marks().items():
+        lines.append('{0:<32}{1:>22.1f} ms'.format(name, seconds * 1e3))
+    return '\n'.join(lines)
@@ -0,0 +1,148 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements the follow (live tail) mode for ISMRMRD files that
+are still being written, e.g. by a reconstruction or scanner process.
+
+The file is opened as an HDF5 SWMR (single writer, multiple readers) reader.
+A timer polls the extent of the acquisition dataset, which only costs a
+metadata refresh; the table then grows by the appended rows without reading
+the existing ones again.
+
+The writer has to use the latest file format and switch to SWMR mode, e.g.
+with h5py::
+
+    f = h5py.File(name, 'w', libver='latest')
+    ...  # create the (chunked, extendable) datasets
+    f.swmr_mode = True
+    ...  # append acquisitions, then f.flush()
+
+The file has to be flushed, not only the dataset: the payload of the
+acquisitions is stored in the global heap of the file. `SWMRWriter` writes
+such a file with synthetic acquisitions.
+
+HDF5 does not support variable length data (the acquisition payload) in
+SWMR mode: a reader does not see the file space the writer allocates for
+it later on. If appended rows cannot be read, the file is reopened (see
+`TableBuffer.TableBuffer.reopen`).
+"""
+
+import h5py
+import ismrmrd
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+import ReadEngine
+
+#: The default poll interval in milliseconds.
+POLL_INTERVAL = 500
+
+class SWMRDataset(ismrmrd.Dataset):
+    """
+    An `ismrmrd.Dataset` opened read-only as SWMR reader.
+
+    :Parameters:
+
+    - `filename`: the ISMRMRD file
+    - `dataset_name`: the name of the dataset group
+    """
+
+    def __init__(self, filename, dataset_name='dataset'):
+        self._filename = filename
+        self._dataset_name = dataset_name
+        self._file = self.open()
+
+    def open(self):
+        try:
+            return ReadEngine.openReadOnly(self._filename, swmr=True)
+        except (OSError, ValueError):
+            # e.g. files of an old format version => plain read-only access
+            return h5py.File(self._filename, 'r')
+
+    def reopen(self):
+        """Close and reopen the file (all its h5py objects become invalid)."""
+        self._file.close()
+        self._file = self.open()
+
+
+class LiveTail(QObject):
+    """
+    Poll a growing acquisition dataset and extend the table.
+
+    :Parameters:
+
+    - `tableModel`: the TableModel of the dataset
+    - `tableView`: the TableView showing the model
+    - `interval`: the poll interval in milliseconds
+    - `parent`: the parent of this object
+    """
+
+    #: Emitted with the number of rows appended since the last poll.
+    rowsAppended = pyqtSignal(int)
+
+    def __init__(self, tableModel, tableView, interval=POLL_INTERVAL, parent=None):
+        super(LiveTail, self).__init__(parent)
+        self.tableModel = tableModel
+        self.tableView = tableView
+        self.autoScroll = False
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.poll)
+
+    def setTarget(self, tableModel, tableView):
+        """Follow another table (e.g. after switching the dataset group)."""
+        self.tableModel = tableModel
+        self.tableView = tableView
+        if self.autoScroll:
+            self.tableView.scrollToEnd()
+
+    def start(self):
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def isActive(self):
+        return self.timer.isActive()
+
+    def setActive(self, active):
+        if active:
+            self.start()
+        else:
+            self.stop()
+
+    def setAutoScroll(self, enabled):
+        """Keep the last rows in view while the dataset grows."""
+        self.autoScroll = enabled
+        if enabled:
+            self.tableView.scrollToEnd()
+
+    def poll(self):
+        """Check for appended acquisitions and show them."""
+        try:
+            appended = self.tableModel.refresh()
+        except (OSError, RuntimeError):
+            # the writer may be in the middle of an update => next poll
+            return
+        if not appended:
+            return
+
+        self.tableView.updateRowCount()
+        if self.autoScroll:
+            self.tableView.scrollToEnd()
+        self.rowsAppended.emit(appended)
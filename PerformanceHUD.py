@@ -0,0 +1,65 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements a dock widget showing the live statistics collected
+by the `Instrumentation` probes.
+"""
+
+from PyQt5.QtWidgets import QDockWidget, QPlainTextEdit
+from PyQt5.QtGui import QFontDatabase
+from PyQt5.QtCore import QTimer
+import Instrumentation
+
+#: The refresh interval of the HUD in milliseconds.
+REFRESH_INTERVAL = 500
+
+class PerformanceHUD(QDockWidget):
+    """
+    A dock widget with a periodically refreshed table of probe statistics.
+
+    The statistics are only refreshed while the dock is visible.
+
+    :Parameter parent: the parent of this widget
+    """
+
+    def __init__(self, parent=None):
+        super(PerformanceHUD, self).__init__('Performance', parent)
+        self.setObjectName('performance_hud')
+
+        self.text = QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.setWidget(self.text)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(REFRESH_INTERVAL)
+        self.timer.timeout.connect(self.refresh)
+        self.visibilityChanged.connect(self.toggleTimer)
+
+    def toggleTimer(self, visible):
+        """Only poll the statistics while the dock is shown."""
+        if visible:
+            self.refresh()
+            self.timer.start()
+        else:
+            self.timer.stop()
+
+    def refresh(self):
+        """Update the statistics table."""
+        self.text.setPlainText(Instrumentation.report())
@@ -0,0 +1,304 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements the cine playback of acquisitions: the plots step
+through a sequence of acquisitions at a fixed rate (rows per second).
+
+The frames are produced by a pipeline of three stages:
+
+- the reader thread (`PlaybackReader`) reads the payloads ahead of the
+  playhead in batches (`TableBuffer.readAcquisitions`);
+- the transform thread (`PlaybackTransform`) applies the plot modes and
+  queues the finished frames;
+- the GUI thread (`Playback.tick`) moves the playhead with the wall clock,
+  shows the latest finished frame at or before the playhead and moves the
+  table to its acquisition.
+
+A stage never waits for a slower one: rows behind the playhead are skipped
+by the reader and the transform, and frames the GUI had no time to show are
+dropped. The playback thus keeps its rate and shows fewer frames if the
+file or the plotting is too slow.
+"""
+
+import time
+import queue
+import threading
+import collections
+import numpy
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal
+import ISMRMRDPlotWidgets
+
+#: The number of rows the reader reads at once.
+BATCH_ROWS = 16
+
+#: The maximum number of rows read ahead of the playhead.
+PREFETCH_ROWS = 128
+
+#: The shortest interval between two shown frames in ms (display rate).
+MIN_INTERVAL = 16
+
+#: A finished frame: its position in the sequence, its dataset row and scan
+#: counter, the coil data lines ``(channels, samples)`` and the trajectory
+#: lines ``(dimensions, samples)`` (None if not plotted).
+Frame = collections.namedtuple('Frame', 'position row scan raw traj')
+
+
+class PlaybackReader(QThread):
+    """
+    The reader stage: reads the payloads of the sequence ahead of the
+    playhead and queues ``(position, row, record)``.
+
+    :Parameter playback: the Playback
+    """
+
+    def __init__(self, playback, parent=None):
+        super(PlaybackReader, self).__init__(parent)
+        self.playback = playback
+
+    def run(self):
+        playback = self.playback
+        rows = playback.rows
+        position = playback.playhead
+        while not playback.stopped and position < len(rows):
+            # never read rows the playhead has passed
+            if position < playback.playhead:
+                playback.countDropped(playback.playhead - position)
+                position = playback.playhead
+            if position - playback.playhead >= PREFETCH_ROWS:
+                time.sleep(0.002)
+                continue
+
+            batch = rows[position:position + BATCH_ROWS]
+            try:
+                records = self.readBatch(batch)
+            except Exception as e:
+                playback.error = e
+                break
+            for offset, row in enumerate(batch):
+                item = (position + offset, int(row), records.get(int(row)))
+                while not playback.stopped:
+                    try:
+                        playback.records.put(item, timeout=0.05)
+                        break
+                    except queue.Full:
+                        pass
+            position += len(batch)
+
+        # end of the sequence
+        while not playback.stopped:
+            try:
+                playback.records.put(None, timeout=0.05)
+                break
+            except queue.Full:
+                pass
+
+    def readBatch(self, rows):
+        """Read the acquisitions of `rows` with one read and return them by
+        dataset row."""
+        rbuffer = self.playback.rbuffer
+        unique = numpy.unique(rows)
+        records = rbuffer.readAcquisitions(unique)
+        if len(records) == len(unique):
+            return dict(zip(unique.tolist(), records))
+        # rows evicted from a stream buffer meanwhile
+        found = {}
+        for row in unique.tolist():
+            record = rbuffer.readAcquisitions([row])
+            if len(record):
+                found[row] = record[0]
+        return found
+
+
+class PlaybackTransform(QThread):
+    """
+    The transform stage: applies the plot modes to the queued records and
+    appends the finished frames to ``Playback.frames``. A record the plot
+    modes cannot be applied to is dropped, other errors stop the playback
+    (``Playback.error``).
+
+    :Parameter playback: the Playback
+    """
+
+    def __init__(self, playback, parent=None):
+        super(PlaybackTransform, self).__init__(parent)
+        self.playback = playback
+
+    def run(self):
+        playback = self.playback
+        try:
+            while not playback.stopped:
+                try:
+                    item = playback.records.get(timeout=0.05)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    return
+                position, row, record = item
+                if position < playback.playhead or record is None:
+                    playback.countDropped(1)
+                    continue
+                try:
+                    frame = transformRecord(position, row, record, playback.rawMode,
+                                            playback.trajMode)
+                except (ValueError, TypeError):
+                    # e.g. a payload that is not complex data
+                    playback.countDropped(1)
+                    continue
+                with playback.lock:
+                    playback.frames.append(frame)
+        except Exception as e:
+            playback.error = e
+        finally:
+            # the GUI stops once the remaining frames are shown
+            playback.transformDone = True
+
+
+def transformRecord(position, row, record, rawMode, trajMode):
+    """Apply the plot modes to an acquisition record and return the Frame."""
+
+    head = record['head']
+    channels = int(head['active_channels'])
+    samples = int(head['number_of_samples'])
+    dimensions = int(head['trajectory_dimensions'])
+
+    raw = None
+    if rawMode:
+        # a payload not matching the header is plotted as a single channel
+        data = numpy.asarray(record['data'], dtype=numpy.float32).view(numpy.complex64)
+        if data.size == channels * samples:
+            data = data.reshape((channels, samples))
+        else:
+            data = data.reshape((1, -1))
+        raw = ISMRMRDPlotWidgets.rawTransform(data, rawMode)
+
+    traj = None
+    if trajMode and len(record['traj']):
+        data = numpy.asarray(record['traj'])
+        if data.size == samples * dimensions:
+            data = data.reshape((samples, dimensions))
+        else:
+            data = data.reshape((-1, 1))
+        traj = ISMRMRDPlotWidgets.trajTransform(data, trajMode).T
+
+    return Frame(position, row, int(head['scan_counter']), raw, traj)
+
+
+class Playback(QObject):
+    """
+    Plays a sequence of acquisitions at a fixed rate.
+
+    :Parameters:
+
+    - `rbuffer`: the acquisition buffer (see `TableBuffer.readAcquisitions`)
+    - `rows`: the dataset rows of the sequence
+    - `start`: the position in `rows` to start at
+    - `rate`: the playback rate in rows per second
+    - `rawMode`, `trajMode`: the plot modes ('' if disabled)
+    - `parent`: the parent of this object
+    """
+
+    #: Emitted with every frame to be shown (in the GUI thread).
+    frameReady = pyqtSignal(object)
+
+    #: Emitted when the playback has stopped (end of the sequence or `stop`).
+    finished = pyqtSignal()
+
+    def __init__(self, rbuffer, rows, start, rate, rawMode, trajMode, parent=None):
+        super(Playback, self).__init__(parent)
+        self.rbuffer = rbuffer
+        self.rows = numpy.asarray(rows, dtype=numpy.int64)
+        self.rawMode = rawMode
+        self.trajMode = trajMode
+        self.stopped = False
+        self.transformDone = False
+        self.error = None
+
+        # the position of the playhead in the sequence (written by the GUI
+        # thread only)
+        self.playhead = min(max(start, 0), max(len(self.rows) - 1, 0))
+
+        # reader -> transform queue, transform -> GUI frames
+        self.records = queue.Queue(maxsize=PREFETCH_ROWS)
+        self.frames = collections.deque()
+        self.lock = threading.Lock()
+
+        # counters (the dropped rows are counted by all stages)
+        self.shown = 0
+        self.dropped = 0
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.tick)
+        self.reader = PlaybackReader(self, self)
+        self.transform = PlaybackTransform(self, self)
+        self.setRate(rate)
+
+    def countDropped(self, count):
+        with self.lock:
+            self.dropped += count
+
+    def setRate(self, rate):
+        """Change the rate (rows per second) from the current playhead."""
+        self.rate = max(float(rate), 1e-3)
+        self.first = self.playhead
+        self.t0 = time.perf_counter()
+        self.timer.setInterval(max(MIN_INTERVAL, int(1000 / self.rate)))
+
+    def setModes(self, rawMode, trajMode):
+        """Change the plot modes (applied to the frames not finished yet)."""
+        self.rawMode = rawMode
+        self.trajMode = trajMode
+
+    def start(self):
+        self.t0 = time.perf_counter()
+        self.reader.start()
+        self.transform.start()
+        self.timer.start()
+
+    def tick(self):
+        """Move the playhead and emit the latest finished frame at or before
+        it (the older finished frames are dropped)."""
+
+        last = len(self.rows) - 1
+        self.playhead = min(self.first + int((time.perf_counter() - self.t0) * self.rate), last)
+
+        frame = None
+        with self.lock:
+            while self.frames and self.frames[0].position <= self.playhead:
+                if frame is not None:
+                    self.dropped += 1
+                frame = self.frames.popleft()
+            pending = len(self.frames)
+        if frame is not None:
+            self.shown += 1
+            self.frameReady.emit(frame)
+
+        finished = self.transformDone and not pending
+        if self.error is not None or (self.playhead == last and (
+                finished or (frame is not None and frame.position == last))):
+            self.stop()
+
+    def stop(self):
+        """Stop the pipeline threads (waits for them)."""
+        if self.stopped:
+            return
+        self.stopped = True
+        self.timer.stop()
+        self.reader.wait()
+        self.transform.wait()
+        self.finished.emit()
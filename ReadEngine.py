@@ -0,0 +1,249 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements a read engine for whole-dataset passes (header index
+builds, statistics, exports, ...).
+
+The dataset rows are split into chunk-aligned blocks. For filtered
+(compressed) datasets, or if a per-block function is given, the blocks are
+handed to a pool of worker processes. Each worker holds its own read-only
+h5py handle, so decompression runs on all cores. The results are yielded in
+row order. Otherwise the blocks are read in the calling process.
+
+The worker pool is shared by all engines of the application.
+"""
+
+import os
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
+import numpy
+import Instrumentation
+
+#: The default number of rows per block (rounded to whole chunks).
+BLOCK_ROWS = 8192
+
+_pool = None
+_poolLock = threading.Lock()
+
+# open datasets of a worker process by (file name, dataset path)
+_handles = {}
+
+def workerCount():
+    """The number of worker processes of the shared pool."""
+    return max(1, os.cpu_count() or 1)
+
+def getPool():
+    """Return the shared process pool (created on first use).
+
+    The pool uses the 'spawn' start method: forking a process holding open
+    HDF5 files is not safe.
+    """
+
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workerCount(),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_initWorker)
+        return _pool
+
+def shutdownPool():
+    """Terminate the worker processes of the shared pool."""
+    global _pool
+    with _poolLock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+def _initWorker():
+    """Worker initializer.
+
+    The viewer process may hold the file open (and locked), so HDF5 file
+    locking is disabled for the read-only handles of the workers.
+    """
+
+    os.environ['HDF5_USE_FILE_LOCKING'] = 'FALSE'
+
+def openReadOnly(filename, swmr=False):
+    """Open an HDF5 file read-only without taking the HDF5 file lock.
+
+    With `swmr` the file is opened as a SWMR reader (for files still being
+    written).
+    """
+    import h5py
+
+    try:
+        return h5py.File(filename, 'r', swmr=swmr, locking=False)
+    except TypeError:
+        # h5py < 3.5 => rely on HDF5_USE_FILE_LOCKING
+        return h5py.File(filename, 'r', swmr=swmr)
+
+def reopenReadOnly(h5file):
+    """Open another read-only handle of an HDF5 file that is open in this
+    process, e.g. for a background thread.
+
+    The file is opened with the access properties of `h5file` (and as SWMR
+    reader if `h5file` is one): HDF5 refuses to open a file a second time
+    with other file locking settings.
+    """
+    import h5py
+
+    flags = h5py.h5f.ACC_RDONLY
+    if h5file.swmr_mode:
+        flags |= h5py.h5f.ACC_SWMR_READ
+    fid = h5py.h5f.open(os.fsencode(h5file.filename), flags, fapl=h5file.id.get_access_plist())
+    return h5py.File(fid)
+
+def _workerDataset(filename, path, swmr=False):
+    """Return the (cached) read-only dataset handle of a worker process."""
+    key = (filename, path)
+    try:
+        return _handles[key]
+    except KeyError:
+        _handles[key] = openReadOnly(filename, swmr)[path]
+        return _handles[key]
+
+def _readBlock(dataset, start, stop, fields):
+    """Read the rows ``[start, stop)`` (optionally only some compound fields)."""
+    if fields:
+        return dataset.fields(list(fields))[start:stop]
+    return dataset[start:stop]
+
+def _workerTask(filename, path, start, stop, fields, func, swmr=False):
+    """Read a block in a worker process and optionally apply `func` to it."""
+    dataset = _workerDataset(filename, path, swmr)
+    if swmr and stop > dataset.shape[0]:
+        # rows appended since the handle was opened (live tail)
+        dataset.refresh()
+    try:
+        block = _readBlock(dataset, start, stop, fields)
+    except OSError:
+        if not swmr:
+            raise
+        # the appended rows may only be readable after reopening the file
+        dataset.file.close()
+        del _handles[(filename, path)]
+        block = _readBlock(_workerDataset(filename, path, swmr), start, stop, fields)
+    if func is not None:
+        return func(block)
+    return block
+
+
+class ReadEngine(object):
+    """
+    Parallel reader of row blocks of a one dimensional HDF5 dataset.
+
+    :Parameters:
+
+    - `dataset`: the h5py.Dataset to read (used directly for serial reads)
+    - `layout`: the DatasetLayout of the dataset (optional)
+    """
+
+    def __init__(self, dataset, layout=None):
+        self.dataset = dataset
+        self.filename = dataset.file.filename
+        self.path = dataset.name
+        self.swmr = dataset.file.swmr_mode
+        self.chunks = layout.chunks if layout is not None else dataset.chunks
+        self.filtered = bool(layout.filters) if layout is not None else \
+            dataset.compression is not None
+
+    def blockRows(self, rows=None):
+        """The number of rows per block, a multiple of the chunk rows."""
+        rows = rows or BLOCK_ROWS
+        if self.chunks is not None:
+            rows = max(1, int(round(rows / self.chunks[0]))) * self.chunks[0]
+        return rows
+
+    def ranges(self, start=0, stop=None, rows=None):
+        """Split ``[start, stop)`` into chunk-aligned ``(start, stop)`` blocks."""
+        if stop is None:
+            stop = self.dataset.shape[0]
+        rows = self.blockRows(rows)
+        blocks = []
+        pos = start
+        while pos < stop:
+            end = min(stop, (pos // rows + 1) * rows)
+            blocks.append((pos, end))
+            pos = end
+        return blocks
+
+    def isParallel(self, func=None):
+        """True if blocks are processed by the worker pool."""
+        return workerCount() > 1 and (self.filtered or func is not None)
+
+    def map(self, func=None, start=0, stop=None, fields=None, rows=None,
+            ranges=None, parallel=None):
+        """Process blocks of rows and yield ``(start, stop, result)`` in order.
+
+        :Parameters:
+        :param func: picklable (module level) function applied to every block
+            (the read structured array); if None the blocks are yielded.
+        :param start: the first row
+        :param stop: the row following the last row (default: all rows)
+        :param fields: optional list of compound fields to read
+        :param rows: the approximate number of rows per block
+        :param ranges: explicit list of ``(start, stop)`` blocks
+        :param parallel: force (True) or avoid (False) the worker pool
+        """
+
+        if ranges is None:
+            ranges = self.ranges(start, stop, rows)
+        if parallel is None:
+            parallel = self.isParallel(func)
+
+        if Instrumentation.ENABLED:
+            Instrumentation.count('ReadEngine.parallel blocks' if parallel else
+                                  'ReadEngine.serial blocks', len(ranges))
+
+        if not parallel:
+            for blockStart, blockStop in ranges:
+                block = _readBlock(self.dataset, blockStart, blockStop, fields)
+                yield blockStart, blockStop, func(block) if func is not None else block
+            return
+
+        # keep a bounded number of blocks in flight and yield them in order
+        pool = getPool()
+        pending = collections.deque()
+        todo = iter(ranges)
+        inflight = 2 * workerCount()
+        try:
+            for blockStart, blockStop in todo:
+                pending.append((blockStart, blockStop, pool.submit(
+                    _workerTask, self.filename, self.path, blockStart,
+                    blockStop, fields, func, self.swmr)))
+                if len(pending) >= inflight:
+                    blockStart, blockStop, future = pending.popleft()
+                    yield blockStart, blockStop, future.result()
+            while pending:
+                blockStart, blockStop, future = pending.popleft()
+                yield blockStart, blockStop, future.result()
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+
+    def read(self, start=0, stop=None, fields=None):
+        """Read ``[start, stop)`` block-wise and return a single array."""
+        blocks = [block for _, _, block in self.map(None, start, stop, fields)]
+        if not blocks:
+            return self.dataset.fields(list(fields))[0:0] if fields else self.dataset[0:0]
+        return numpy.concatenate(blocks)
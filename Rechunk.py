@@ -0,0 +1,257 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements a command line tool rewriting an ISMRMRD file with a
+storage layout tuned for the access pattern of the viewer:
+
+- the acquisition and waveform datasets are chunked along the rows, one
+  chunk per page of the table (`ISMRMRDTableModel.CHUNK_SIZE` rows), and
+  optionally compressed;
+- a header sidecar (e.g. ``data_headers``, see `DatasetLayout.openSidecar`)
+  holds a contiguous, unfiltered copy of the headers. The table, the header
+  index and the header diff memory-map it and never read the records
+  holding the payload;
+- N-D image data is chunked by 2D slice, the unit read by the image browser.
+
+All other objects (XML header, image headers and attributes, ...) are copied
+unchanged. Note that the payload of acquisitions and waveforms is variable
+length data stored in the global heap of the file: chunking and compression
+only apply to the fixed size part of the records.
+
+Usage::
+
+    python Rechunk.py scanner.h5 viewer.h5 [--chunk-rows 1000] [--compression gzip]
+
+`Benchmark` compares browsing the original and the rewritten file.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy
+import h5py
+import DatasetLayout
+import ISMRMRDTableModel
+
+#: The default number of rows per chunk of the acquisition datasets.
+CHUNK_ROWS = ISMRMRDTableModel.CHUNK_SIZE
+
+#: The number of chunks copied at once.
+BATCH_CHUNKS = 4
+
+#: The compression filters that can be chosen.
+COMPRESSIONS = ('none', 'gzip', 'lzf')
+
+#: The default gzip level (fast, most of the gain of higher levels).
+DEFAULT_LEVEL = 4
+
+def isRecordDataset(dataset):
+    """True if `dataset` is a one dimensional compound dataset with a 'head'
+    member (acquisitions or waveforms)."""
+    return dataset.ndim == 1 and dataset.dtype.names is not None and \
+        'head' in dataset.dtype.names
+
+def isImageData(dataset):
+    """True if `dataset` is the N-D data of an image series."""
+    return dataset.name.rsplit('/', 1)[-1] == 'data' and dataset.ndim >= 3
+
+def filterOptions(compression, level):
+    """Return the h5py dataset creation options of a compression filter."""
+    if compression in (None, 'none'):
+        return {}
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': level, 'shuffle': True}
+    return {'compression': compression, 'shuffle': True}
+
+def layoutText(dataset):
+    """A short description of the storage layout of `dataset`."""
+    if dataset.chunks is None:
+        text = 'contiguous'
+    else:
+        text = 'chunks {0}'.format(dataset.chunks)
+    if dataset.compression is not None:
+        text += ', ' + dataset.compression
+    return text
+
+def rewriteRecords(source, group, chunkRows, options, sidecar=True, progress=None):
+    """Copy a record dataset with row-aligned chunks (and its header sidecar).
+
+    The rows are copied in batches of whole chunks, every batch is read with
+    a single read and written with a single write.
+
+    :Parameters:
+    :param source: the h5py.Dataset to copy
+    :param group: the target h5py.Group
+    :param chunkRows: the number of rows per chunk
+    :param options: the compression options (see `filterOptions`)
+    :param sidecar: write the header sidecar
+    :param progress: optional callable ``(name, copied rows, total rows)``
+    """
+
+    name = source.name.rsplit('/', 1)[-1]
+    nrows = source.shape[0]
+    target = group.create_dataset(name, shape=(nrows,), maxshape=(None,), dtype=source.dtype,
+                                  chunks=(chunkRows,), **options)
+    target.attrs.update(source.attrs)
+
+    heads = None
+    if sidecar and nrows:
+        # contiguous and unfiltered, so that it can be memory-mapped
+        heads = group.create_dataset(name + DatasetLayout.SIDECAR_SUFFIX, shape=(nrows,),
+                                     dtype=numpy.dtype([('head', source.dtype['head'])]))
+
+    batchRows = chunkRows * BATCH_CHUNKS
+    for start in range(0, nrows, batchRows):
+        stop = min(start + batchRows, nrows)
+        block = source[start:stop]
+        target[start:stop] = block
+        if heads is not None:
+            record = numpy.empty(stop - start, dtype=heads.dtype)
+            record['head'] = block['head']
+            heads[start:stop] = record
+        if progress is not None:
+            progress(source.name, stop, nrows)
+    return target
+
+def rewriteImage(source, group, options, progress=None):
+    """Copy N-D image data with one chunk per 2D slice.
+
+    :Parameters:
+    :param source: the h5py.Dataset to copy
+    :param group: the target h5py.Group
+    :param options: the compression options (see `filterOptions`)
+    :param progress: optional callable ``(name, copied images, images)``
+    """
+
+    name = source.name.rsplit('/', 1)[-1]
+    chunks = (1,) * (source.ndim - 2) + source.shape[-2:]
+    target = group.create_dataset(name, shape=source.shape, dtype=source.dtype,
+                                  chunks=chunks if source.size else None, **options)
+    target.attrs.update(source.attrs)
+    for image in range(source.shape[0]):
+        target[image] = source[image]
+        if progress is not None:
+            progress(source.name, image + 1, source.shape[0])
+    return target
+
+def copyGroup(source, target, chunkRows, options, sidecar=True, progress=None, rewritten=None):
+    """Copy the members of `source` to `target`, rewriting record datasets
+    and image data (see `rechunk`)."""
+
+    target.attrs.update(source.attrs)
+    for name in source:
+        kind = source.get(name, getclass=True)
+        if kind is h5py.Group:
+            copyGroup(source[name], target.create_group(name), chunkRows, options,
+                      sidecar, progress, rewritten)
+            continue
+        if kind is not h5py.Dataset:
+            # committed data types (dangling links are dropped)
+            if kind is not None:
+                source.copy(name, target, name)
+            continue
+
+        dataset = source[name]
+        if name.endswith(DatasetLayout.SIDECAR_SUFFIX) and \
+                name[:-len(DatasetLayout.SIDECAR_SUFFIX)] in source:
+            # the sidecar of a file rewritten before, written again below
+            continue
+        if isRecordDataset(dataset):
+            written = rewriteRecords(dataset, target, chunkRows, options, sidecar, progress)
+        elif isImageData(dataset):
+            written = rewriteImage(dataset, target, options, progress)
+        else:
+            source.copy(name, target, name)
+            continue
+        if rewritten is not None:
+            rewritten.append((dataset.name, layoutText(dataset), layoutText(written)))
+
+def rechunk(inputName, outputName, chunkRows=CHUNK_ROWS, compression=None,
+            level=DEFAULT_LEVEL, sidecar=True, progress=None):
+    """Rewrite an ISMRMRD file with a layout tuned for the viewer.
+
+    Returns a list of ``(dataset, old layout, new layout)`` of the rewritten
+    datasets. The output file is removed if the copy fails.
+
+    :Parameters:
+    :param inputName: the ISMRMRD file to read
+    :param outputName: the file to write (overwritten)
+    :param chunkRows: the number of rows per chunk of record datasets
+    :param compression: one of `COMPRESSIONS` (None: no compression)
+    :param level: the gzip compression level
+    :param sidecar: write header sidecars
+    :param progress: optional callable ``(dataset, copied, total)``
+    """
+
+    if os.path.abspath(inputName) == os.path.abspath(outputName):
+        raise ValueError('the output file must differ from the input file')
+
+    options = filterOptions(compression, level)
+    rewritten = []
+    try:
+        with h5py.File(inputName, 'r') as source, h5py.File(outputName, 'w') as target:
+            copyGroup(source, target, chunkRows, options, sidecar, progress, rewritten)
+    except BaseException:
+        try:
+            os.remove(outputName)
+        except OSError:
+            pass
+        raise
+    return rewritten
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Rewrite an ISMRMRD file with a storage layout tuned for the viewer')
+    parser.add_argument('input', help='the ISMRMRD (HDF5) file to rewrite')
+    parser.add_argument('output', help='the file to write (overwritten)')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, metavar='ROWS',
+                        help='rows per chunk of the acquisition and waveform datasets '
+                        '(default: {0}, the page size of the table)'.format(CHUNK_ROWS))
+    parser.add_argument('--compression', choices=COMPRESSIONS, default='none',
+                        help='compression filter (default: none)')
+    parser.add_argument('--level', type=int, default=DEFAULT_LEVEL, choices=range(10),
+                        metavar='0-9', help='gzip compression level (default: {0})'.format(
+                            DEFAULT_LEVEL))
+    parser.add_argument('--no-sidecar', action='store_true',
+                        help='do not write the contiguous header sidecars')
+    args = parser.parse_args(argv)
+
+    def progress(name, copied, total):
+        print('\r{0}: {1}/{2}'.format(name, copied, total), end='', file=sys.stderr)
+        if copied == total:
+            print(file=sys.stderr)
+
+    t0 = time.perf_counter()
+    try:
+        rewritten = rechunk(args.input, args.output, max(args.chunk_rows, 1), args.compression,
+                            args.level, not args.no_sidecar, progress)
+    except (OSError, ValueError) as e:
+        print('Rechunk failed: {0}'.format(e), file=sys.stderr)
+        return 1
+
+    for name, before, after in rewritten:
+        print('{0}: {1} -> {2}'.format(name, before, after))
+    print('{0} -> {1} ({2:.1f} MB -> {3:.1f} MB) in {4:.1f} s'.format(
+        args.input, args.output, os.path.getsize(args.input) / 2 ** 20,
+        os.path.getsize(args.output) / 2 ** 20, time.perf_counter() - t0))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
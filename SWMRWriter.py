@@ -0,0 +1,159 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements a command line tool writing an ISMRMRD file the way
+a scanner or reconstruction process does while the viewer follows it (see
+`LiveTail`): the file is created with the latest file format, switched to
+SWMR mode and acquisitions are appended in batches.
+
+The acquisitions are synthetic (a scan counter, 32 phase encoding steps per
+slice and complex noise as data).
+
+Usage::
+
+    python SWMRWriter.py growing.h5 [--rows 256] [--append 64] [--count 20] [--interval 0.5]
+    python ISMRMRDViewer.py --follow growing.h5
+
+With ``--stdin`` a batch is appended for every line read from the standard
+input instead (used by the tests). The writer prints ``ready`` once the file
+can be opened by readers and the number of rows after every batch.
+"""
+
+import sys
+import time
+import argparse
+import numpy
+import h5py
+from ismrmrd.hdf5 import acquisition_dtype
+
+#: The XML header of the written files.
+XML = (b'<?xml version="1.0"?><ismrmrdHeader xmlns="http://www.ismrm.org/ISMRMRD">'
+       b'<encoding><encodedSpace><matrixSize><x>64</x><y>32</y><z>1</z></matrixSize>'
+       b'<fieldOfView_mm><x>300</x><y>300</y><z>5</z></fieldOfView_mm></encodedSpace>'
+       b'<reconSpace><matrixSize><x>32</x><y>32</y><z>1</z></matrixSize>'
+       b'<fieldOfView_mm><x>300</x><y>300</y><z>5</z></fieldOfView_mm></reconSpace>'
+       b'<trajectory>cartesian</trajectory></encoding></ismrmrdHeader>')
+
+def acquisitionRecords(start, stop, channels=2, samples=64, seed=None):
+    """Return the synthetic acquisitions of the rows ``[start, stop)`` (also
+    the test data, see ``conftest.py``). The noise is seeded with `seed`
+    (default: `start`)."""
+    rows = numpy.arange(start, stop)
+    records = numpy.zeros(len(rows), dtype=acquisition_dtype)
+    head = records['head']
+    head['version'] = 1
+    head['scan_counter'] = rows
+    head['acquisition_time_stamp'] = rows * 2
+    head['number_of_samples'] = samples
+    head['active_channels'] = channels
+    head['available_channels'] = channels
+    head['center_sample'] = samples // 2
+    head['idx']['kspace_encode_step_1'] = rows % 32
+    head['idx']['slice'] = (rows // 32) % 4
+    rng = numpy.random.default_rng(start if seed is None else seed)
+    for row in range(len(rows)):
+        records[row]['data'] = rng.standard_normal(2 * channels * samples).astype(numpy.float32)
+        records[row]['traj'] = numpy.zeros(0, numpy.float32)
+    return records
+
+class SWMRWriter(object):
+    """
+    An ISMRMRD file written in SWMR mode.
+
+    :Parameters:
+
+    - `fileName`: the file to write (overwritten)
+    - `rows`: the number of acquisitions written before SWMR mode is enabled
+    - `chunkRows`: the rows per chunk of the acquisition dataset
+    - `channels`, `samples`: the shape of the data of the acquisitions
+    """
+
+    def __init__(self, fileName, rows=256, chunkRows=256, channels=2, samples=64):
+        self.channels = channels
+        self.samples = samples
+        self.file = h5py.File(fileName, 'w', libver='latest')
+        group = self.file.create_group('dataset')
+        group.create_dataset('xml', (1,), dtype=h5py.special_dtype(vlen=bytes))[0] = XML
+        self.data = group.create_dataset('data', (rows,), maxshape=(None,),
+                                         chunks=(max(chunkRows, 1),), dtype=acquisition_dtype)
+        if rows:
+            self.data[:] = acquisitionRecords(0, rows, channels, samples)
+        self.file.swmr_mode = True
+        self.file.flush()
+
+    def rows(self):
+        return self.data.shape[0]
+
+    def append(self, nrows):
+        """Append `nrows` acquisitions and make them visible to the readers."""
+        start = self.rows()
+        self.data.resize((start + nrows,))
+        self.data[start:] = acquisitionRecords(start, start + nrows, self.channels, self.samples)
+        self.file.flush()
+        return self.rows()
+
+    def close(self):
+        self.file.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Write an ISMRMRD file in SWMR mode, appending acquisitions in batches')
+    parser.add_argument('fileName', help='the ISMRMRD (HDF5) file to write (overwritten)')
+    parser.add_argument('--rows', type=int, default=256,
+                        help='acquisitions written before SWMR mode is enabled (default: 256)')
+    parser.add_argument('--append', type=int, default=64, metavar='ROWS',
+                        help='acquisitions appended per batch (default: 64)')
+    parser.add_argument('--count', type=int, default=20,
+                        help='number of batches, 0: until interrupted (default: 20)')
+    parser.add_argument('--interval', type=float, default=0.5, metavar='SECONDS',
+                        help='time between the batches (default: 0.5)')
+    parser.add_argument('--stdin', action='store_true',
+                        help='append a batch for every line read from the standard input')
+    parser.add_argument('--chunk-rows', type=int, default=256, metavar='ROWS',
+                        help='rows per chunk of the acquisition dataset (default: 256)')
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--samples', type=int, default=64)
+    args = parser.parse_args(argv)
+
+    try:
+        writer = SWMRWriter(args.fileName, args.rows, args.chunk_rows, args.channels,
+                            args.samples)
+    except (OSError, ValueError) as e:
+        print('SWMRWriter failed: {0}'.format(e), file=sys.stderr)
+        return 1
+
+    print('ready', flush=True)
+    batches = 0
+    try:
+        while not args.count or batches < args.count:
+            if args.stdin:
+                if not sys.stdin.readline():
+                    break
+            else:
+                time.sleep(args.interval)
+            print(writer.append(args.append), flush=True)
+            batches += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -33,12 +33,55 @@ datasets with a larger number of rows than that provided by the view widget.
 
 __docformat__ = 'restructuredtext'
 
+import numpy
 from PyQt5.QtCore import Qt
 from PyQt5.QtCore import QEvent
-from PyQt5.QtWidgets import QScrollBar
+from PyQt5.QtGui import QPainter, QColor
+from PyQt5.QtWidgets import QScrollBar, QStyle, QStyleOptionSlider
 
 
-class ScrollBar(QScrollBar):
+class MarkedScrollBar(QScrollBar):
+    """
+    A vertical scrollbar marking rows in its groove (e.g. acquisitions with
+    spikes). Used as the regular scrollbar of the table views and as the
+    base of the tricky scrollbar of huge datasets.
+
+    :Parameter parent: the parent of this widget
+    """
+
+    def __init__(self, parent=None):
+        super(MarkedScrollBar, self).__init__(parent)
+        self.setOrientation(Qt.Vertical)
+
+        # positions (0..1) of the rows marked in the groove
+        self.markers = numpy.empty(0)
+
+    def setMarkers(self, positions):
+        """Mark rows in the groove of the scrollbar.
+
+        :Parameter positions: the positions of the rows (0: first row, 1:
+            last row)
+        """
+        self.markers = numpy.asarray(positions, dtype=numpy.float64)
+        self.update()
+
+    def paintEvent(self, e):
+        QScrollBar.paintEvent(self, e)
+        if not len(self.markers):
+            return
+        option = QStyleOptionSlider()
+        self.initStyleOption(option)
+        groove = self.style().subControlRect(QStyle.CC_ScrollBar, option,
+                                             QStyle.SC_ScrollBarGroove, self)
+        # one marker per pixel row
+        ys = numpy.unique((groove.top() + self.markers * (groove.height() - 1)).astype(int))
+        painter = QPainter(self)
+        painter.setPen(QColor(220, 0, 0))
+        for y in ys:
+            painter.drawLine(groove.left() + 1, int(y), groove.right() - 1, int(y))
+
+
+class ScrollBar(MarkedScrollBar):
     """
     A specialised scrollbar for views of huge datasets.
 
@@ -61,7 +104,6 @@ class ScrollBar(QScrollBar):
         super(ScrollBar, self).__init__(parent)
         view.vscrollbar.setVisible(False)
         parent.layout().addWidget(self)
-        self.setOrientation(Qt.Vertical)
         self.setObjectName('tricky_vscrollbar')
 
     def event(self, e):
@@ -0,0 +1,308 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements the session cache: the state of a dataset view
+(scroll position, selection, plot modes, column layout, filter and sort) is
+saved when a file is closed and restored when it is opened again, together
+with a warm cache of its data.
+
+Every dataset group of a file has one cache entry of two numpy archives in
+the cache directory:
+
+- ``<key>.state.npz`` (compressed): the view state and the complete records
+  (header, trajectory and data) of the current and the selected
+  acquisitions, so that the restored plots do not read any payload. The
+  pages of the table are not saved, their headers are in the index;
+- ``<key>.index.npz`` (not compressed, it is written while the viewer
+  closes): the header index (see `HeaderIndex.restore`), so that filtering
+  and sorting work right away and an interrupted index build resumes where
+  it stopped. Indexes larger than `MAX_INDEX_BYTES` are not saved.
+
+The key is made of the path of the file, the group and the identity of the
+file (its size and modification time): an entry is never used for a file
+that has changed since, it is replaced by the next save. The entries share
+a total size cap, the least recently used entries are removed first.
+"""
+
+import os
+import json
+import hashlib
+import numpy
+from PyQt5.QtCore import QByteArray
+
+#: The default total size of the cache entries in bytes.
+DEFAULT_CACHE_BYTES = 256 * 2 ** 20
+
+#: The maximum number of acquisitions whose complete records are kept.
+MAX_WARM_ROWS = 64
+
+#: The maximum size of a saved header index in bytes (about 200000
+#: acquisitions, written in a fraction of a second).
+MAX_INDEX_BYTES = 64 * 2 ** 20
+
+#: The version of the saved state (entries of other versions are ignored).
+STATE_VERSION = 1
+
+
+def cacheDirectory():
+    """The default cache directory (``$XDG_CACHE_HOME/ismrmrd-viewer``)."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'ismrmrd-viewer')
+
+
+def encodeBytes(data):
+    """Encode a QByteArray (e.g. a header view state) for the JSON state."""
+    return bytes(data.toBase64()).decode('ascii')
+
+
+def decodeBytes(text):
+    return QByteArray.fromBase64(text.encode('ascii'))
+
+
+def packRecords(records):
+    """Split complete acquisition records into plain arrays (the variable
+    length trajectories and data are concatenated)."""
+    arrays = {'warm_heads': records['head']}
+    for name in ('traj', 'data'):
+        parts = [numpy.asarray(value, dtype=numpy.float32) for value in records[name]]
+        arrays['warm_' + name] = numpy.concatenate(parts) if parts else numpy.zeros(0, numpy.float32)
+        arrays['warm_{0}_sizes'.format(name)] = numpy.array([len(part) for part in parts],
+                                                           dtype=numpy.int64)
+    return arrays
+
+
+def unpackRecords(archive, dtype):
+    """Rebuild the records packed by `packRecords` with the record `dtype`
+    of the dataset (None if the headers do not match)."""
+    heads = archive['warm_heads']
+    if heads.dtype != dtype['head']:
+        return None
+    records = numpy.empty(len(heads), dtype=dtype)
+    records['head'] = heads
+    for name in ('traj', 'data'):
+        values = archive['warm_' + name]
+        offsets = numpy.concatenate(([0], numpy.cumsum(archive['warm_{0}_sizes'.format(name)])))
+        for row in range(len(heads)):
+            records[name][row] = values[offsets[row]:offsets[row + 1]]
+    return records
+
+
+class Session(object):
+    """
+    A cache entry loaded for a dataset group.
+
+    :Parameters:
+
+    - `cache`: the SessionCache
+    - `key`: the key of the entry
+    - `state`: the saved view state (dict)
+    - `warmRows`, `warmRecords`: the dataset rows and the complete records
+      of the acquisitions shown last (None if not available)
+    """
+
+    def __init__(self, cache, key, state, warmRows=None, warmRecords=None):
+        self.cache = cache
+        self.key = key
+        self.state = state
+        self.warmRows = warmRows
+        self.warmRecords = warmRecords
+
+        # the number of rows of the restored index (not saved again if the
+        # index has not grown meanwhile)
+        self.indexedRows = None
+
+    def loadIndex(self, total, blockRows):
+        """Return the saved ``(heads, filled)`` of the header index (None if
+        there is none or if it does not match the dataset)."""
+        path = self.cache.path(self.key, 'index')
+        try:
+            with numpy.load(path) as archive:
+                filled = archive['filled']
+                if int(archive['total']) != total or int(archive['block_rows']) != blockRows:
+                    return None
+                heads = archive['heads']
+        except (OSError, KeyError, ValueError):
+            return None
+        self.cache.touch(path)
+        self.indexedRows = int(filled.sum())
+        return heads, filled
+
+
+class SessionCache(object):
+    """
+    The on-disk cache of the view states and warm data of the opened files.
+
+    :Parameters:
+
+    - `directory`: the cache directory (default: `cacheDirectory`)
+    - `maxBytes`: the total size cap of the entries in bytes
+    """
+
+    def __init__(self, directory=None, maxBytes=DEFAULT_CACHE_BYTES):
+        self.directory = directory or cacheDirectory()
+        self.maxBytes = maxBytes
+
+    def entryKey(self, fileName, group):
+        """Return ``(prefix, key)``: the prefix is shared by the entries of
+        the file and group, the key adds the identity of the file."""
+        path = os.path.abspath(fileName)
+        stat = os.stat(path)
+        prefix = hashlib.sha1('{0}\0{1}'.format(path, group).encode('utf-8')).hexdigest()[:16]
+        identity = hashlib.sha1('{0}\0{1}'.format(
+            stat.st_size, stat.st_mtime_ns).encode('ascii')).hexdigest()[:16]
+        return prefix, '{0}-{1}'.format(prefix, identity)
+
+    def path(self, key, part):
+        return os.path.join(self.directory, '{0}.{1}.npz'.format(key, part))
+
+    def touch(self, path):
+        """Mark an entry file as used (the LRU order is the file time)."""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def load(self, fileName, group, dtype):
+        """Return the `Session` saved for the dataset `group` of a file (None
+        if there is none for the current file contents).
+
+        :Parameter dtype: the record dtype of the acquisition dataset
+        """
+
+        try:
+            key = self.entryKey(fileName, group)[1]
+            path = self.path(key, 'state')
+            with numpy.load(path) as archive:
+                state = json.loads(str(archive['state']))
+                if state.get('version') != STATE_VERSION:
+                    return None
+                warmRows = warmRecords = None
+                if 'warm_rows' in archive.files:
+                    warmRecords = unpackRecords(archive, dtype)
+                    if warmRecords is not None:
+                        warmRows = archive['warm_rows']
+        except (OSError, KeyError, ValueError):
+            return None
+        self.touch(path)
+        return Session(self, key, state, warmRows, warmRecords)
+
+    def save(self, fileName, group, state, warmRows=None, warmRecords=None, index=None,
+             session=None):
+        """Save the entry of the dataset `group` of a file and enforce the
+        size cap.
+
+        :Parameters:
+        :param state: the view state (dict, see `DatasetView.sessionState`)
+        :param warmRows: the dataset rows of `warmRecords`
+        :param warmRecords: complete records of the acquisitions shown last
+        :param index: the HeaderIndex to save (None: keep the saved one)
+        :param session: the Session loaded for the group, if any
+        """
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            prefix, key = self.entryKey(fileName, group)
+        except OSError:
+            return
+
+        # remove the entries of former contents of the file
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix + '-') and not name.startswith(key + '.'):
+                self.remove(os.path.join(self.directory, name))
+
+        state = dict(state, version=STATE_VERSION)
+        arrays = {'state': numpy.array(json.dumps(state))}
+        if warmRecords is not None and len(warmRecords):
+            arrays['warm_rows'] = numpy.asarray(warmRows, dtype=numpy.int64)
+            arrays.update(packRecords(warmRecords))
+        self.write(self.path(key, 'state'), arrays)
+
+        indexPath = self.path(key, 'index')
+        if index is not None and index.storage is not None and index.nindexed:
+            unchanged = session is not None and session.key == key and \
+                session.indexedRows == index.nindexed and os.path.exists(indexPath)
+            if unchanged:
+                self.touch(indexPath)
+            elif index.nbytes() <= min(self.maxBytes, MAX_INDEX_BYTES):
+                self.write(indexPath, {'heads': index.records['head'], 'filled': index.filled,
+                                       'total': numpy.array(index.total),
+                                       'block_rows': numpy.array(index.blockRows)},
+                           compress=False)
+        self.enforce(keep=key)
+
+    def write(self, path, arrays, compress=True):
+        """Write an archive (replaced atomically)."""
+        temporary = path + '.tmp'
+        try:
+            with open(temporary, 'wb') as f:
+                if compress:
+                    numpy.savez_compressed(f, **arrays)
+                else:
+                    numpy.savez(f, **arrays)
+            os.replace(temporary, path)
+        except OSError:
+            self.remove(temporary)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def entries(self):
+        """Return ``{key: (last use, bytes, paths)}`` of the cache entries."""
+        entries = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith('.npz'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            key = name.split('.')[0]
+            used, nbytes, paths = entries.get(key, (0.0, 0, []))
+            entries[key] = (max(used, stat.st_mtime), nbytes + stat.st_size, paths + [path])
+        return entries
+
+    def enforce(self, keep=None):
+        """Remove the least recently used entries until the cache fits the
+        size cap. The entry `keep` (just saved) goes last: only its index
+        is removed if it exceeds the cap on its own."""
+
+        entries = self.entries()
+        total = sum(nbytes for _, nbytes, _ in entries.values())
+        order = sorted(entries, key=lambda key: (key == keep, entries[key][0]))
+        for key in order:
+            if total <= self.maxBytes:
+                break
+            used, nbytes, paths = entries[key]
+            if key == keep:
+                path = self.path(key, 'index')
+                if path in paths:
+                    total -= os.path.getsize(path)
+                    self.remove(path)
+                continue
+            for path in paths:
+                self.remove(path)
+            total -= nbytes
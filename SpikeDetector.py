@@ -0,0 +1,391 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements the detection of RF spikes (the cause of herringbone
+artifacts) in the coil data of all acquisitions of a dataset, and a dock
+widget listing the acquisitions with spikes.
+
+A spike is a single sample whose magnitude stands out from its neighbours
+on the readout. Every line (acquisition and channel) is compared to its
+running median along the samples; the residual is scaled by its median
+absolute deviation (MAD) over the line, which gives a robust z-score per
+sample. The score of an acquisition is the largest z-score over its
+channels and samples. Samples around the echo (``center_sample`` of the
+header) are not scored, the echo peak is not a spike.
+
+The scores are computed in one chunked pass of the `ReadEngine`: blocks of
+acquisitions are read and scored by the worker processes, the lines of a
+block with the same shape are stacked and scored in groups. Blocks and
+groups are sized by their number of samples (acquisitions x channels x
+samples, see `BLOCK_SAMPLES`), the running median needs several times the
+memory of the lines it is computed for.
+"""
+
+import time
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtWidgets import (QDockWidget, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,
+                             QCheckBox, QDoubleSpinBox, QProgressBar, QLabel, QTreeWidget,
+                             QTreeWidgetItem)
+
+#: The width (in samples) of the running median of the magnitude.
+MEDIAN_WIDTH = 5
+
+#: Samples within this distance of the echo (center_sample) are not scored.
+ECHO_SAMPLES = 3
+
+#: The default score from which an acquisition is flagged.
+DEFAULT_THRESHOLD = 20.0
+
+#: The maximum number of acquisitions read and scored per block.
+BLOCK_ROWS = 1024
+
+#: The approximate number of samples (acquisitions x channels x samples)
+#: read per block and scored at once.
+BLOCK_SAMPLES = 2 ** 20
+
+#: The name of the score column of the table.
+SCORE_COLUMN = 'spike score'
+
+#: The flagged acquisitions listed by the dock (the highest scores).
+MAX_LISTED = 1000
+
+def blockRows(channels, samples):
+    """Return the number of acquisitions with `channels` and `samples`
+    read or scored at once (see `BLOCK_SAMPLES`)."""
+    return max(1, min(BLOCK_ROWS, BLOCK_SAMPLES // max(int(channels) * int(samples), 1)))
+
+def scoreLines(data, centers):
+    """Return the spike z-score of every sample of stacked lines.
+
+    :Parameters:
+    :param data: the coil data ``(acquisitions, channels, samples)``
+    :param centers: the echo sample of every acquisition (0: unknown)
+    """
+
+    magnitude = numpy.abs(data)
+    samples = magnitude.shape[-1]
+    if samples < MEDIAN_WIDTH:
+        return numpy.zeros_like(magnitude)
+
+    # residual to the running median along the samples
+    half = MEDIAN_WIDTH // 2
+    padded = numpy.pad(magnitude, ((0, 0), (0, 0), (half, half)), mode='edge')
+    residual = magnitude - numpy.median(sliding_window_view(padded, MEDIAN_WIDTH, axis=-1),
+                                        axis=-1)
+
+    # robust z-score: median and MAD of the residual of every line
+    center = numpy.median(residual, axis=-1, keepdims=True)
+    mad = numpy.median(numpy.abs(residual - center), axis=-1, keepdims=True)
+    scale = numpy.maximum(1.4826 * mad, numpy.finfo(numpy.float32).tiny)
+    score = (residual - center) / scale
+
+    # the echo peak is not a spike
+    centers = numpy.asarray(centers, dtype=numpy.int64)[:, None]
+    echo = (centers > 0) & (abs(numpy.arange(samples)[None, :] - centers) <= ECHO_SAMPLES)
+    score[numpy.broadcast_to(echo[:, None, :], score.shape)] = 0
+    return score
+
+def _spikeScores(block):
+    """The score, channel and sample of the highest z-score of every
+    acquisition of a block (worker side). Acquisitions whose payload does
+    not match the header get a NaN score."""
+
+    heads = block['head']
+    count = len(block)
+    scores = numpy.full(count, numpy.nan, dtype=numpy.float32)
+    channels = numpy.full(count, -1, dtype=numpy.int16)
+    samples = numpy.full(count, -1, dtype=numpy.int32)
+
+    active = heads['active_channels'].astype(numpy.int64)
+    length = heads['number_of_samples'].astype(numpy.int64)
+    sizes = numpy.fromiter(map(len, block['data']), numpy.int64, count)
+    valid = (sizes == 2 * active * length) & (sizes > 0)
+    shapes = active * 65536 + length
+
+    # stack and score the lines of every shape in groups
+    for shape in numpy.unique(shapes[valid]):
+        shapeRows = numpy.flatnonzero(valid & (shapes == shape))
+        nchannels, nsamples = divmod(int(shape), 65536)
+        step = blockRows(nchannels, nsamples)
+        for first in range(0, len(shapeRows), step):
+            rows = shapeRows[first:first + step]
+            data = numpy.stack(list(block['data'][rows])).astype(numpy.float32, copy=False)
+            data = data.view(numpy.complex64).reshape(len(rows), nchannels, nsamples)
+            score = scoreLines(data, heads['center_sample'][rows])
+            best = score.reshape(len(rows), -1).argmax(axis=1)
+            channel, sample = numpy.divmod(best, nsamples)
+            scores[rows] = score.reshape(len(rows), -1)[numpy.arange(len(rows)), best]
+            channels[rows] = channel
+            samples[rows] = sample
+    return scores, channels, samples
+
+
+class SpikeScores(object):
+    """
+    The spike scores of all acquisitions of a dataset.
+
+    :Parameters:
+
+    - `scores`: the score of every dataset row (NaN: not scored)
+    - `channels`: the channel of the highest z-score of every row
+    - `samples`: the sample of the highest z-score of every row
+    - `elapsed`: the duration of the pass in seconds
+    """
+
+    def __init__(self, scores, channels, samples, elapsed=0.0):
+        self.scores = scores
+        self.channels = channels
+        self.samples = samples
+        self.elapsed = elapsed
+
+    def flagged(self, threshold):
+        """The dataset rows scoring at least `threshold`, highest score
+        first."""
+        with numpy.errstate(invalid='ignore'):
+            rows = numpy.flatnonzero(self.scores >= threshold)
+        return rows[numpy.argsort(-self.scores[rows], kind='stable')]
+
+
+def detectSpikes(engine, cancelled=lambda: False, progress=None):
+    """Score all acquisitions in one chunked pass and return the
+    `SpikeScores` (None if cancelled). The blocks are sized by the shape of
+    the first acquisition (see `blockRows`).
+
+    :Parameters:
+    :param engine: the ReadEngine of the acquisition dataset
+    :param cancelled: callable returning True to stop the pass
+    :param progress: optional callable ``(rows read, total rows)``
+    """
+
+    t0 = time.perf_counter()
+    total = engine.dataset.shape[0]
+    rows = BLOCK_ROWS
+    if total:
+        head = engine.dataset.fields(['head'])[0]['head']
+        rows = blockRows(head['active_channels'], head['number_of_samples'])
+    results = []
+    for start, stop, result in engine.map(_spikeScores, fields=['head', 'data'], rows=rows):
+        if cancelled():
+            return None
+        results.append(result)
+        if progress is not None:
+            progress(stop, total)
+
+    if not results:
+        return SpikeScores(numpy.zeros(0, numpy.float32), numpy.zeros(0, numpy.int16),
+                           numpy.zeros(0, numpy.int32), time.perf_counter() - t0)
+    scores, channels, samples = (numpy.concatenate(parts) for parts in zip(*results))
+    return SpikeScores(scores, channels, samples, time.perf_counter() - t0)
+
+
+class SpikeWorker(QThread):
+    """
+    Background thread scoring the acquisitions of a dataset.
+
+    :Parameter engine: the ReadEngine of the acquisition dataset
+    """
+
+    #: Emitted with ``(rows read, total rows)`` during the pass.
+    progress = pyqtSignal(int, int)
+
+    def __init__(self, engine, parent=None):
+        super(SpikeWorker, self).__init__(parent)
+        self.engine = engine
+        self.cancelled = False
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = detectSpikes(self.engine, lambda: self.cancelled, self.progress.emit)
+        except Exception as e:
+            self.error = e
+
+    def cancel(self):
+        self.cancelled = True
+        self.wait()
+
+
+class SpikeDock(QDockWidget):
+    """
+    A dock widget detecting spikes in the shown dataset.
+
+    The flagged acquisitions are listed (activating one emits
+    `rowRequested` with its dataset row), marked in the scrollbar of the
+    table and the scores can be shown as a sortable table column. The
+    scores are kept by the DatasetView (``spikes``), changing the threshold
+    does not read the dataset again.
+
+    :Parameters:
+
+    - `parent`: the parent of this widget
+    """
+
+    #: Emitted with the dataset row of an activated acquisition.
+    rowRequested = pyqtSignal(int)
+
+    def __init__(self, parent=None):
+        super(SpikeDock, self).__init__('Spike detection', parent)
+        self.setObjectName('spike_dock')
+        self.view = None
+        self.worker = None
+
+        self.btnDetect = QPushButton('Detect')
+        self.btnDetect.clicked.connect(self.detect)
+        self.btnCancel = QPushButton('Cancel')
+        self.btnCancel.clicked.connect(self.cancel)
+        self.btnCancel.setEnabled(False)
+        self.thresholdSB = QDoubleSpinBox()
+        self.thresholdSB.setRange(3.0, 10000.0)
+        self.thresholdSB.setDecimals(1)
+        self.thresholdSB.setValue(DEFAULT_THRESHOLD)
+        self.thresholdSB.setPrefix('threshold ')
+        self.thresholdSB.setToolTip('The robust z-score from which an acquisition is flagged')
+        self.thresholdSB.valueChanged.connect(self.showResult)
+        self.cbColumn = QCheckBox('Score column')
+        self.cbColumn.setToolTip('Show the scores as a column of the table')
+        self.cbColumn.setChecked(True)
+        self.cbColumn.toggled.connect(self.updateColumn)
+        self.progressBar = QProgressBar()
+        self.progressBar.hide()
+        self.statusLabel = QLabel()
+        self.statusLabel.setWordWrap(True)
+
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(['Row', 'Score', 'Channel', 'Sample'])
+        self.tree.setRootIsDecorated(False)
+        self.tree.itemActivated.connect(self.onItemActivated)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.btnDetect)
+        buttons.addWidget(self.btnCancel)
+        buttons.addWidget(self.thresholdSB)
+        buttons.addWidget(self.cbColumn)
+        buttons.addStretch(1)
+
+        widget = QWidget()
+        layout = QVBoxLayout(widget)
+        layout.addLayout(buttons)
+        layout.addWidget(self.progressBar)
+        layout.addWidget(self.statusLabel)
+        layout.addWidget(self.tree)
+        self.setWidget(widget)
+
+    def setView(self, view):
+        """Show the scores of another dataset view (a running detection is
+        cancelled)."""
+        if view is self.view:
+            return
+        self.cancel()
+        self.view = view
+        self.showResult()
+
+    def detect(self):
+        if self.view is None or self.worker is not None:
+            return
+        rbuffer = self.view.tableModel.rbuffer
+        if rbuffer.engine is None:
+            self.statusLabel.setText('Spikes cannot be detected in streams.')
+            return
+
+        self.worker = SpikeWorker(rbuffer.engine, self)
+        self.worker.progress.connect(self.onProgress)
+        self.worker.finished.connect(self.onFinished)
+        self.progressBar.setRange(0, max(rbuffer.total_nrows(), 1))
+        self.progressBar.setValue(0)
+        self.progressBar.show()
+        self.btnDetect.setEnabled(False)
+        self.btnCancel.setEnabled(True)
+        self.statusLabel.setText('Scoring {0} acquisitions...'.format(rbuffer.total_nrows()))
+        self.worker.start()
+
+    def onProgress(self, done, total):
+        self.progressBar.setValue(done)
+
+    def onFinished(self):
+        worker, self.worker = self.worker, None
+        self.progressBar.hide()
+        self.btnDetect.setEnabled(True)
+        self.btnCancel.setEnabled(False)
+        if worker.error is not None:
+            self.statusLabel.setText('Spike detection failed: {0}'.format(worker.error))
+            return
+        if worker.result is None:
+            self.statusLabel.setText('Cancelled.')
+            return
+        self.view.spikes = worker.result
+        self.showResult()
+
+    def cancel(self):
+        worker = self.worker
+        if worker is not None:
+            self.worker = None
+            worker.finished.disconnect(self.onFinished)
+            worker.cancel()
+            worker.deleteLater()
+            self.progressBar.hide()
+            self.btnDetect.setEnabled(True)
+            self.btnCancel.setEnabled(False)
+            self.statusLabel.setText('Cancelled.')
+
+    def showResult(self):
+        """List the flagged acquisitions of the current view and mark them in
+        the table."""
+        self.tree.clear()
+        result = getattr(self.view, 'spikes', None)
+        if result is None:
+            self.statusLabel.setText('Not analysed yet.')
+            return
+
+        rows = result.flagged(self.thresholdSB.value())
+        self.statusLabel.setText('{0} of {1} acquisitions with spikes ({2:.1f} s)'.format(
+            len(rows), len(result.scores), result.elapsed))
+        items = []
+        for row in rows[:MAX_LISTED]:
+            item = QTreeWidgetItem([str(row), '{0:.1f}'.format(result.scores[row]),
+                                    str(result.channels[row]), str(result.samples[row])])
+            item.setData(0, Qt.UserRole, int(row))
+            items.append(item)
+        if len(rows) > MAX_LISTED:
+            items.append(QTreeWidgetItem(['...', '{0} more'.format(len(rows) - MAX_LISTED)]))
+        self.tree.addTopLevelItems(items)
+
+        self.view.tableView.setMarkedRows(rows)
+        self.updateColumn()
+
+    def updateColumn(self):
+        """Show or hide the score column of the current view."""
+        result = getattr(self.view, 'spikes', None)
+        if result is None:
+            return
+        model = self.view.tableModel
+        if self.cbColumn.isChecked():
+            model.setValueColumn(SCORE_COLUMN, result.scores)
+        else:
+            model.removeValueColumn(SCORE_COLUMN)
+
+    def onItemActivated(self, item, column):
+        row = item.data(0, Qt.UserRole)
+        if row is not None:
+            self.rowRequested.emit(row)
+
+    def shutdown(self):
+        self.cancel()
@@ -0,0 +1,532 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements the ingest of ISMRMRD acquisitions streamed over TCP.
+
+The viewer listens on a port and accepts the message stream a reconstruction
+client (e.g. ``gadgetron_ismrmrd_client``) sends to a reconstruction server:
+every message starts with a 16 bit message id, the XML header is sent as
+parameter script, acquisitions as 340 byte header followed by trajectory
+(float32) and data (complex64). Images and waveforms are skipped.
+
+The acquisitions are stored in a `StreamBuffer`, a ring buffer of fixed
+memory: a table of headers and an arena for the payloads, both allocated
+from one memory budget (see `StreamBuffer.withMemory`). The oldest
+acquisitions are evicted when either is full. The buffer provides the
+interface of `TableBuffer.TableBuffer`, so the table model and the plots
+work unchanged; the table grows through `LiveTail.LiveTail`.
+"""
+
+import time
+import socket
+import ctypes
+import threading
+import numpy
+import ismrmrd
+import ismrmrd.hdf5
+from PyQt5.QtCore import QThread, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QLabel
+import Instrumentation
+
+# message ids of the ISMRMRD streaming protocol
+MESSAGE_CONFIG_FILE = 1001
+MESSAGE_CONFIG_SCRIPT = 1002
+MESSAGE_PARAMETER_SCRIPT = 1003
+MESSAGE_CLOSE = 1004
+MESSAGE_TEXT = 1005
+MESSAGE_ACQUISITION = 1008
+MESSAGE_IMAGE = 1022
+MESSAGE_WAVEFORM = 1026
+
+#: The default number of acquisitions held by the ring buffer.
+DEFAULT_ROWS = 100000
+
+#: The default size of the payload arena in bytes.
+DEFAULT_PAYLOAD_BYTES = 256 * 2 ** 20
+
+#: The default memory of a StreamBuffer (header table and arena) in bytes.
+DEFAULT_MEMORY_BYTES = 256 * 2 ** 20
+
+#: The share of the memory of a StreamBuffer used for the header table at most.
+HEADER_SHARE = 0.125
+
+_HEAD_DTYPE = ismrmrd.hdf5.acquisition_header_dtype
+
+#: The bytes per row of the header table (header, payload offset and size).
+ROW_BYTES = _HEAD_DTYPE.itemsize + 2 * numpy.dtype(numpy.int64).itemsize
+_WAVEFORM_HEADER_SIZE = ctypes.sizeof(ismrmrd.WaveformHeader)
+_IMAGE_HEADER_SIZE = ctypes.sizeof(ismrmrd.ImageHeader)
+
+# bytes per image pixel by ismrmrd data type
+_PIXEL_SIZES = {
+    ismrmrd.DATATYPE_USHORT: 2, ismrmrd.DATATYPE_SHORT: 2,
+    ismrmrd.DATATYPE_UINT: 4, ismrmrd.DATATYPE_INT: 4,
+    ismrmrd.DATATYPE_FLOAT: 4, ismrmrd.DATATYPE_DOUBLE: 8,
+    ismrmrd.DATATYPE_CXFLOAT: 8, ismrmrd.DATATYPE_CXDOUBLE: 16,
+}
+
+def parseAddress(address):
+    """Split ``[host:]port`` into ``(host, port)`` (default host: localhost)."""
+    host, _, port = str(address).rpartition(':')
+    return host or 'localhost', int(port)
+
+
+class StreamBuffer(object):
+    """
+    Fixed-memory ring buffer of streamed acquisitions.
+
+    Rows are numbered by their position in the stream (the sequence number).
+    The receiver thread appends acquisitions (`reserve`, `commit`), the GUI
+    thread reads them through the `TableBuffer.TableBuffer` interface.
+
+    :Parameters:
+    :param rows: the maximum number of acquisitions held
+    :param payload_bytes: the size of the arena holding the trajectories
+        and data of the acquisitions
+    """
+
+    def __init__(self, rows=DEFAULT_ROWS, payload_bytes=DEFAULT_PAYLOAD_BYTES):
+        self.capacity = rows
+        self.heads = numpy.zeros(rows, dtype=[('head', _HEAD_DTYPE)])
+        self.offsets = numpy.zeros(rows, dtype=numpy.int64)
+        self.sizes = numpy.zeros(rows, dtype=numpy.int64)
+        self.arena = numpy.empty(payload_bytes, dtype=numpy.uint8)
+        self.lock = threading.Lock()
+
+        # live rows are the sequence numbers [first, next); their payloads
+        # occupy the arena from the payload of the first row up to pos
+        self.first = 0
+        self.next = 0
+        self.pos = 0
+        self.used = 0
+
+        # counters
+        self.received_bytes = 0
+        self.evicted = 0
+        self.dropped = 0
+
+        # TableBuffer interface: snapshot of the live rows (see refresh)
+        self.first_row = 0
+        self.total_rows = 0
+        self.chunk = numpy.zeros(0, dtype=self.heads.dtype)
+        self.chunk_first = 0
+        self.start = 0
+        self.rows = None
+        self.mmap = None
+        self.engine = None
+        self.ring = None
+
+    @classmethod
+    def withMemory(cls, nbytes=DEFAULT_MEMORY_BYTES):
+        """Return a buffer using `nbytes` of memory in total: the header
+        table gets up to `HEADER_SHARE` of it (at most `DEFAULT_ROWS` rows),
+        the payload arena the rest."""
+        rows = max(min(DEFAULT_ROWS, int(nbytes * HEADER_SHARE) // ROW_BYTES), 1)
+        return cls(rows, max(nbytes - rows * ROW_BYTES, 0))
+
+    def nbytes(self):
+        """The memory of the header table and the arena in bytes."""
+        return self.heads.nbytes + self.offsets.nbytes + self.sizes.nbytes + self.arena.nbytes
+
+    # receiver thread side
+
+    def evictOldest(self):
+        slot = self.first % self.capacity
+        self.used -= self.sizes[slot]
+        self.first += 1
+        self.evicted += 1
+
+    def reserve(self, nbytes):
+        """Make room for an acquisition with `nbytes` of payload.
+
+        Evicts the oldest acquisitions as needed and returns the arena
+        offset the payload has to be written to, or None if the payload can
+        never fit (the acquisition is dropped).
+        """
+
+        size = len(self.arena)
+        if nbytes > size:
+            self.dropped += 1
+            return None
+
+        with self.lock:
+            if self.next - self.first >= self.capacity:
+                self.evictOldest()
+            while True:
+                if self.first == self.next:
+                    self.pos = 0
+                    return 0
+                if nbytes == 0:
+                    return self.pos
+                tail = self.offsets[self.first % self.capacity]
+                if self.pos > tail or (self.pos == tail and self.used == 0):
+                    # live payloads are not wrapped around the arena end
+                    if size - self.pos >= nbytes:
+                        return self.pos
+                    if tail >= nbytes:
+                        self.pos = 0
+                        return 0
+                elif self.pos < tail and tail - self.pos >= nbytes:
+                    return self.pos
+                self.evictOldest()
+
+    def commit(self, head, offset, nbytes):
+        """Append the acquisition `head` whose payload has been written to
+        ``arena[offset:offset + nbytes]``."""
+        with self.lock:
+            slot = self.next % self.capacity
+            self.heads['head'][slot] = head
+            self.offsets[slot] = offset
+            self.sizes[slot] = nbytes
+            self.pos = offset + nbytes
+            self.used += nbytes
+            self.next += 1
+
+    # TableBuffer interface (GUI thread)
+
+    def total_nrows(self):
+        return self.total_rows
+
+    def cacheBytes(self):
+        # the ring buffer is the data itself and cannot be released
+        return 0
+
+    def releaseCache(self, keepChunk=False):
+        # the chunk is a copy of the live rows, it is read again unless the
+        # table is shown (`keepChunk`)
+        if not keepChunk:
+            self.chunk = numpy.zeros(0, dtype=self.heads.dtype)
+            self.rows = None
+
+    def refresh(self):
+        """Take a snapshot of the live rows and return their number."""
+        with self.lock:
+            self.first_row = self.first
+            self.total_rows = self.next - self.first
+        return self.total_rows
+
+    @Instrumentation.probe('StreamBuffer.readBuffer')
+    def readBuffer(self, start, stop):
+        """Copy the headers of the (snapshot) rows ``[start, stop)``."""
+        stop = min(stop, self.total_rows)
+        nrows = max(stop - start, 0)
+        chunk = numpy.zeros(nrows, dtype=self.heads.dtype)
+
+        with self.lock:
+            seq = self.first_row + start
+            slot = seq % self.capacity
+            part = min(nrows, self.capacity - slot)
+            chunk[:part] = self.heads[slot:slot + part]
+            chunk[part:] = self.heads[:nrows - part]
+
+            # rows evicted since the snapshot (their slots hold newer rows)
+            gone = min(max(self.first - seq, 0), nrows)
+            chunk[:gone] = 0
+
+        self.chunk = chunk
+        self.chunk_first = self.first_row
+        self.start = start
+        self.rows = None
+
+    def setRecords(self, records, start, rows=None):
+        self.chunk = records
+        self.chunk_first = self.first_row
+        self.start = start
+        self.rows = rows
+
+    def datasetRow(self, row):
+        """Returns the sequence number of the buffer row `row`."""
+        if self.rows is not None:
+            return int(self.rows[row])
+        return self.chunk_first + self.start + row
+
+    def getCell(self, row):
+        return self.chunk[row]
+
+    def readAcquisition(self, row):
+        """
+        Returns the header, trajectory and data of an acquisition of the
+        buffer, or None if it has been evicted meanwhile.
+        """
+
+        seq = self.datasetRow(row)
+        with self.lock:
+            if not self.first <= seq < self.next:
+                return None
+            slot = seq % self.capacity
+            head = self.heads[slot]['head'].copy()
+            offset, nbytes = self.offsets[slot], self.sizes[slot]
+            payload = self.arena[offset:offset + nbytes].copy()
+
+        ntraj = int(head['trajectory_dimensions']) * int(head['number_of_samples'])
+        payload = payload.view(numpy.float32)
+        return {'head': head, 'traj': payload[:ntraj], 'data': payload[ntraj:]}
+
+    def readAcquisitions(self, rows):
+        """
+        Returns the header, trajectory and data of several acquisitions (the
+        sequence numbers `rows`) as records like those of a file, sorted
+        by sequence number. Evicted acquisitions are left out.
+        """
+
+        rows = numpy.unique(numpy.asarray(rows, dtype=numpy.int64))
+        with self.lock:
+            rows = rows[(rows >= self.first) & (rows < self.next)]
+            slots = rows % self.capacity
+            records = numpy.empty(len(rows), dtype=[('head', _HEAD_DTYPE), ('traj', object),
+                                                    ('data', object)])
+            records['head'] = self.heads['head'][slots]
+            payloads = [self.arena[offset:offset + nbytes].copy().view(numpy.float32)
+                        for offset, nbytes in zip(self.offsets[slots], self.sizes[slots])]
+
+        heads = records['head']
+        ntraj = heads['trajectory_dimensions'].astype(numpy.int64) * heads['number_of_samples']
+        for ind, (payload, count) in enumerate(zip(payloads, ntraj)):
+            records['traj'][ind] = payload[:count]
+            records['data'][ind] = payload[count:]
+        return records
+
+    def describe(self):
+        """Return a list of ``(property, value)`` pairs describing the buffer."""
+        with self.lock:
+            live = self.next - self.first
+            used = self.used
+        return [
+            ('Source', 'TCP stream'),
+            ('Rows', '{0} of {1}'.format(live, self.capacity)),
+            ('Header table', Instrumentation.formatBytes(
+                self.heads.nbytes + self.offsets.nbytes + self.sizes.nbytes)),
+            ('Payload arena', '{0} used of {1}'.format(
+                Instrumentation.formatBytes(used),
+                Instrumentation.formatBytes(self.arena.nbytes))),
+            ('Received acquisitions', str(self.next)),
+            ('Received bytes', Instrumentation.formatBytes(self.received_bytes)),
+            ('Evicted acquisitions', str(self.evicted)),
+            ('Dropped acquisitions', str(self.dropped)),
+        ]
+
+
+class StreamSource(object):
+    """
+    Stand-in for the `ismrmrd.Dataset` of a streamed measurement.
+
+    :Parameters:
+
+    - `address`: the ``(host, port)`` the viewer listens on
+    - `buffer`: the StreamBuffer receiving the acquisitions
+    """
+
+    def __init__(self, address, buffer):
+        self.address = address
+        self.buffer = buffer
+        self.xml = None
+
+    def name(self):
+        return 'tcp://{0}:{1}'.format(*self.address)
+
+    def number_of_acquisitions(self):
+        return self.buffer.refresh()
+
+    def read_xml_header(self):
+        if self.xml is None:
+            raise LookupError('No XML header received yet.')
+        return self.xml
+
+
+class StreamReceiver(QThread):
+    """
+    Thread accepting connections and reading the ISMRMRD message stream.
+
+    :Parameter source: the StreamSource being filled
+    """
+
+    #: Emitted with the peer address when a client has connected.
+    clientConnected = pyqtSignal(str)
+
+    #: Emitted when a client has closed the stream (or disconnected).
+    clientDisconnected = pyqtSignal()
+
+    #: Emitted when the XML header has been received.
+    headerReceived = pyqtSignal()
+
+    #: Emitted with a message on protocol or socket errors.
+    error = pyqtSignal(str)
+
+    def __init__(self, source, parent=None):
+        super(StreamReceiver, self).__init__(parent)
+        self.source = source
+        self.stopped = False
+        self.head = numpy.zeros(1, dtype=_HEAD_DTYPE)
+        self.scratch = bytearray(2 ** 16)
+
+    def stop(self):
+        self.stopped = True
+        self.wait()
+
+    def run(self):
+        try:
+            server = socket.create_server(self.source.address)
+        except OSError as e:
+            self.error.emit('Cannot listen on {0}:{1}: {2}'.format(
+                self.source.address[0], self.source.address[1], e))
+            return
+
+        server.settimeout(0.5)
+        with server:
+            while not self.stopped:
+                try:
+                    conn, peer = server.accept()
+                except socket.timeout:
+                    continue
+                self.clientConnected.emit('{0}:{1}'.format(*peer[:2]))
+                try:
+                    with conn:
+                        conn.settimeout(0.5)
+                        self.receive(conn)
+                except (OSError, ValueError) as e:
+                    if not self.stopped:
+                        self.error.emit(str(e))
+                self.clientDisconnected.emit()
+
+    def receive(self, conn):
+        """Read messages until the stream is closed."""
+        msgid = numpy.zeros(1, dtype='<u2')
+        while not self.stopped:
+            if not self.recvInto(conn, memoryview(msgid).cast('B'), first=True):
+                return
+            ident = int(msgid[0])
+            if ident == MESSAGE_ACQUISITION:
+                self.receiveAcquisition(conn)
+            elif ident == MESSAGE_PARAMETER_SCRIPT:
+                self.source.xml = bytes(self.recvString(conn)).rstrip(b'\0')
+                self.headerReceived.emit()
+            elif ident in (MESSAGE_CONFIG_SCRIPT, MESSAGE_TEXT):
+                self.recvString(conn)
+            elif ident == MESSAGE_CONFIG_FILE:
+                self.skip(conn, 1024)
+            elif ident == MESSAGE_WAVEFORM:
+                header = ismrmrd.WaveformHeader.from_buffer_copy(
+                    self.recvBytes(conn, _WAVEFORM_HEADER_SIZE))
+                self.skip(conn, 4 * header.channels * header.number_of_samples)
+            elif ident == MESSAGE_IMAGE:
+                header = ismrmrd.ImageHeader.from_buffer_copy(
+                    self.recvBytes(conn, _IMAGE_HEADER_SIZE))
+                attributes = numpy.frombuffer(self.recvBytes(conn, 8), dtype='<u8')[0]
+                self.skip(conn, int(attributes))
+                self.skip(conn, int(numpy.prod(header.matrix_size)) * header.channels *
+                          _PIXEL_SIZES.get(header.data_type, 0))
+            elif ident == MESSAGE_CLOSE:
+                return
+            else:
+                raise ValueError('Unknown message id {0}, closing the connection.'.format(ident))
+
+    def receiveAcquisition(self, conn):
+        """Read an acquisition straight into the ring buffer."""
+        buffer = self.source.buffer
+        self.recvInto(conn, memoryview(self.head).cast('B'))
+        head = self.head[0]
+        nsamples = int(head['number_of_samples'])
+        nbytes = 4 * nsamples * (int(head['trajectory_dimensions']) +
+                                 2 * int(head['active_channels']))
+
+        offset = buffer.reserve(nbytes)
+        if offset is None:
+            self.skip(conn, nbytes)
+        else:
+            self.recvInto(conn, memoryview(buffer.arena)[offset:offset + nbytes])
+            buffer.commit(head, offset, nbytes)
+        buffer.received_bytes += _HEAD_DTYPE.itemsize + nbytes
+
+        if Instrumentation.ENABLED:
+            Instrumentation.count('StreamIngest.acquisitions')
+            Instrumentation.count('StreamIngest.bytes', _HEAD_DTYPE.itemsize + nbytes)
+
+    def recvInto(self, conn, view, first=False):
+        """Fill `view` from the socket.
+
+        Returns False if the peer closed the connection before a message
+        (`first`), raises ConnectionError if it did so within a message.
+        """
+
+        pos = 0
+        while pos < len(view):
+            try:
+                nread = conn.recv_into(view[pos:])
+            except socket.timeout:
+                if self.stopped:
+                    raise ConnectionError('Receiver stopped.')
+                continue
+            if nread == 0:
+                if first and pos == 0:
+                    return False
+                raise ConnectionError('Connection closed within a message.')
+            pos += nread
+        return True
+
+    def recvBytes(self, conn, nbytes):
+        data = bytearray(nbytes)
+        self.recvInto(conn, memoryview(data))
+        return data
+
+    def recvString(self, conn):
+        """Read a string message (32 bit length followed by the bytes)."""
+        length = numpy.frombuffer(self.recvBytes(conn, 4), dtype='<u4')[0]
+        return self.recvBytes(conn, int(length))
+
+    def skip(self, conn, nbytes):
+        """Read and discard `nbytes`."""
+        view = memoryview(self.scratch)
+        while nbytes > 0:
+            part = min(nbytes, len(view))
+            self.recvInto(conn, view[:part])
+            nbytes -= part
+
+
+class StreamStatus(QLabel):
+    """
+    Status bar label showing the throughput and the drop counters.
+
+    :Parameters:
+
+    - `buffer`: the StreamBuffer
+    - `interval`: the update interval in milliseconds
+    """
+
+    def __init__(self, buffer, interval=1000, parent=None):
+        super(StreamStatus, self).__init__(parent)
+        self.buffer = buffer
+        self.last = (time.perf_counter(), 0, 0)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.updateStatus)
+        self.timer.start(interval)
+        self.updateStatus()
+
+    def updateStatus(self):
+        buffer = self.buffer
+        now = time.perf_counter()
+        received, nbytes = buffer.next, buffer.received_bytes
+        then, last_received, last_bytes = self.last
+        elapsed = max(now - then, 1e-6)
+        self.last = (now, received, nbytes)
+
+        self.setText('{0} acquisitions ({1:.0f}/s, {2}/s), {3} evicted, {4} dropped'.format(
+            received, (received - last_received) / elapsed,
+            Instrumentation.formatBytes((nbytes - last_bytes) / elapsed),
+            buffer.evicted, buffer.dropped))
@@ -0,0 +1,106 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements a command line tool sending synthetic acquisitions
+with the ISMRMRD streaming protocol to a viewer started with ``--listen``
+(see `StreamIngest`), in place of a reconstruction client.
+
+The stream is made of the XML header (parameter script), the acquisitions
+(a scan counter, a trajectory and data whose real part is the scan counter)
+and a close message.
+
+Usage::
+
+    python ISMRMRDViewer.py --listen 9002
+    python StreamSender.py 9002 [--count 10000] [--rate 1000] [--channels 4] [--samples 128]
+"""
+
+import sys
+import time
+import socket
+import struct
+import argparse
+import numpy
+import ismrmrd.hdf5
+import StreamIngest
+
+#: The XML header of the stream.
+XML = (b'<?xml version="1.0"?><ismrmrdHeader xmlns="http://www.ismrm.org/ISMRMRD">'
+       b'<encoding><trajectory>radial</trajectory></encoding></ismrmrdHeader>')
+
+def connect(address, timeout=10.0):
+    """Connect to ``(host, port)``, retrying until the viewer listens or
+    `timeout` seconds have passed."""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            return socket.create_connection(address)
+        except ConnectionRefusedError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.1)
+
+def acquisitionMessage(counter, channels=4, samples=128, dimensions=2):
+    """Return the acquisition message with the scan counter `counter`."""
+    head = numpy.zeros(1, dtype=ismrmrd.hdf5.acquisition_header_dtype)
+    head['scan_counter'] = counter
+    head['number_of_samples'] = samples
+    head['active_channels'] = channels
+    head['available_channels'] = channels
+    head['trajectory_dimensions'] = dimensions
+    traj = numpy.linspace(-0.5, 0.5, dimensions * samples, dtype=numpy.float32)
+    data = numpy.full((channels, samples), counter + 1j, dtype=numpy.complex64)
+    return struct.pack('<H', StreamIngest.MESSAGE_ACQUISITION) + head.tobytes() + \
+        traj.tobytes() + data.tobytes()
+
+def send(conn, count, rate=0, channels=4, samples=128):
+    """Send the header, `count` acquisitions at `rate` acquisitions per
+    second (0: as fast as possible) and the close message."""
+    conn.sendall(struct.pack('<HI', StreamIngest.MESSAGE_PARAMETER_SCRIPT, len(XML)) + XML)
+    start = time.perf_counter()
+    for counter in range(count):
+        conn.sendall(acquisitionMessage(counter, channels, samples))
+        if rate:
+            time.sleep(max(start + (counter + 1) / rate - time.perf_counter(), 0))
+    conn.sendall(struct.pack('<H', StreamIngest.MESSAGE_CLOSE))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Send synthetic acquisitions to a viewer listening for a stream')
+    parser.add_argument('address', metavar='[HOST:]PORT', help='the address the viewer listens on')
+    parser.add_argument('--count', type=int, default=10000,
+                        help='number of acquisitions (default: 10000)')
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='acquisitions per second, 0: as fast as possible (default: 1000)')
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--samples', type=int, default=128)
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    try:
+        with connect(StreamIngest.parseAddress(args.address)) as conn:
+            send(conn, args.count, args.rate, args.channels, args.samples)
+    except (OSError, ValueError) as e:
+        print('StreamSender failed: {0}'.format(e), file=sys.stderr)
+        return 1
+    print('Sent {0} acquisitions in {1:.1f} s'.format(args.count, time.perf_counter() - t0))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
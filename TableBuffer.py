@@ -28,9 +28,33 @@ an ISMRMRD (HDF5) file.
 By using this buffer we speed up the access to the stored data. As a
 consequence, views (widgets showing a tabular representation of the dataset)
 are painted much faster too.
+
+If the acquisition dataset is stored contiguously and unfiltered, the
+acquisition headers are memory-mapped straight from the file and the buffer
+chunks are (zero-copy) views of that mapping. The payload (data and
+trajectory) of an acquisition is then read on demand by `readAcquisition`.
+
+Otherwise the headers are read with `h5py.Dataset.read_direct` into a small
+ring of preallocated buffers, so that buffer faults do not allocate memory.
+For chunked datasets these reads are aligned to chunk boundaries and served
+from the buffer without any read if the requested rows are already in it.
+Rows shared with the previous buffer are copied instead of read again.
+
+If the file has a header sidecar (see `Rechunk`), the headers are mapped
+(or read) from the sidecar instead, so browsing never touches the records
+holding the payload.
+
+For files still being written (SWMR, see `LiveTail`) the extent of the
+dataset is updated by `refresh`.
 """
 
 import numpy
+import Instrumentation
+import DatasetLayout
+import ReadEngine
+
+#: The number of preallocated buffers the chunks are read into.
+RING_SIZE = 3
 
 class TableBuffer(object):
     """Buffer used to access the real data contained in ISMRMRD (HDF5) files.
@@ -41,30 +65,153 @@ class TableBuffer(object):
     in buffer are numbered from 0 to N (as it happens with the data
     source).
 
-    :Parameter dset:
+    :Parameters:
+    :param dset:
         the data source (ismrmrd.Dataset instance) from which data are
         going to be read.
+    :param buffer_rows:
+        the (maximum) number of rows read per buffer fault, used to size
+        the HDF5 chunk cache.
+    :param name:
+        the name of the (compound) dataset within the ismrmrd group, e.g.
+        'data' (acquisitions) or 'waveforms'.
     """
 
-    def __init__(self, dset):
+    def __init__(self, dset, buffer_rows=1000, name='data'):
         """
         Initializes the buffer.
         """
         self.dset = dset
+        self.buffer_rows = buffer_rows
+
+        # open the acquisition dataset with a chunk cache matching its layout
+        self.name = name
+        self.layout = DatasetLayout.openDataset(dset._dataset, name, buffer_rows)
+        self.data = self.layout.dataset
 
         # The structure where read data will be stored.
         self.chunk = numpy.array([])
-        self.total_rows = dset.number_of_acquisitions()
+        self.start = 0
+
+        # dataset rows of the chunk if it is not a contiguous range (see
+        # setRecords)
+        self.rows = None
+
+        # number of bytes read by the last buffer fault (instrumentation)
+        self.nbytes_read = 0
+        self.total_rows = self.data.shape[0]
+
+        # the dataset row of buffer row 0 (rows are never removed from files)
+        self.first_row = 0
+
+        # rows held by the current buffer of the ring (see readDirect)
+        self.buffered = (0, 0)
+
+        # memory-map the acquisition headers if the storage layout allows it,
+        # otherwise use the header sidecar of a rewritten file (not for files
+        # still being written, the sidecar does not grow)
+        self.mmap = self.layout.memmap('head')
+        self.sidecar = None
+        if self.mmap is None and not self.data.file.swmr_mode:
+            self.sidecar = DatasetLayout.openSidecar(dset._dataset, name, self.data)
+            if self.sidecar is not None:
+                self.mmap = self.sidecar.memmap('head')
+
+        # engine for whole-dataset passes (the worker pool is started on
+        # first parallel use)
+        self.engine = ReadEngine.ReadEngine(self.data, self.layout)
+
+        # otherwise read the headers into a ring of preallocated buffers
+        head = self.layout.fieldDtype('head')
+        self.ring_dtype = numpy.dtype([('head', head[0])]) if head else None
+        self.ring = [None] * RING_SIZE
+        self.ring_pos = 0
+
+        # complete records of acquisitions restored from the session cache
+        # (see `SessionCache`) by dataset row, served without reading
+        self.warm = {}
 
     def __del__(self):
         """Release resources before destroying the buffer.
         """
         # FIXME: PY3.5+ leaks resources (use finalizer instead).
         self.chunk = None
+        self.mmap = None
+        self.ring = None
 
     def total_nrows(self):
         return self.total_rows
 
+    def cacheBytes(self):
+        """The size of the preallocated read buffers in bytes."""
+        return sum(buf.nbytes for buf in self.ring if buf is not None)
+
+    def seedRecords(self, rows, records):
+        """
+        Keep complete records (e.g. restored from the session cache) to be
+        returned by `readAcquisition` and `readAcquisitions` without reading
+        the dataset.
+
+        :Parameters:
+        - `rows`: the dataset rows of the records.
+        - `records`: the records, with the dtype of the dataset.
+        """
+
+        if records.dtype != self.data.dtype:
+            return
+        self.warm = dict(zip((int(row) for row in rows), records))
+
+    def releaseCache(self, keepChunk=False):
+        """
+        Free the read buffers (see `Workspace.CacheBudget`). The chunk is
+        dropped as well and has to be read again before it is shown, unless
+        `keepChunk` is True (the table is shown): the chunk is then copied
+        out of the ring.
+        """
+
+        if keepChunk:
+            if self.ring_dtype is not None:
+                self.chunk = self.chunk.copy()
+        else:
+            self.chunk = numpy.array([])
+            self.rows = None
+        self.ring = [None] * RING_SIZE
+        self.buffered = (0, 0)
+        self.warm = {}
+
+    def refresh(self):
+        """
+        Update the number of rows of a dataset that is still being written
+        (SWMR reader) and return it. Buffered rows stay valid.
+        """
+
+        self.data.refresh()
+        total = self.data.shape[0]
+        if total > self.total_rows:
+            # make sure the appended rows are readable (raises OSError if
+            # the file has to be reopened, see `reopen`); only the header is
+            # read, not the payload of the last acquisition
+            self.data.fields(['head'])[total - 1]
+        self.total_rows = total
+        return self.total_rows
+
+    def reopen(self):
+        """
+        Reopen the file of a dataset that is still being written.
+
+        SWMR readers do not see the file space allocated by the writer for
+        variable length data after the file has been opened, so reads of
+        appended rows may fail until the file is reopened. Buffered rows
+        stay valid.
+        """
+
+        self.dset.reopen()
+        self.layout = DatasetLayout.openDataset(self.dset._dataset, self.name, self.buffer_rows)
+        self.data = self.layout.dataset
+        self.engine.dataset = self.data
+
+    @Instrumentation.probe('TableBuffer.readBuffer',
+                           nbytes=lambda self, *args: self.nbytes_read)
     def readBuffer(self, start, stop):
         """
         Read the selected range of ismrmrd acquisitions into memory.
@@ -77,8 +224,94 @@ class TableBuffer(object):
         if stop > self.total_rows:
             stop = self.total_rows
 
-        # read acquisitions
-        self.chunk = self.dset._dataset['data'][start:stop]
+        # read acquisitions (headers only if memory-mapped or read into
+        # the buffer ring)
+        if self.mmap is not None:
+            self.chunk = self.mmap[start:stop]
+            self.nbytes_read = self.chunk.nbytes
+        elif stop <= start:
+            # e.g. a file followed before its first acquisition is written
+            self.chunk = numpy.empty(0, dtype=self.ring_dtype or self.data.dtype)
+            self.nbytes_read = 0
+        elif self.ring_dtype is not None:
+            bstart, bstop = self.buffered
+            if self.ring[self.ring_pos] is None or not (bstart <= start and stop <= bstop):
+                layout = self.sidecar if self.sidecar is not None else self.layout
+                bstart, bstop = layout.alignRange(start, stop, self.total_rows)
+                self.readDirect(bstart, bstop)
+            else:
+                self.nbytes_read = 0
+                if Instrumentation.ENABLED:
+                    Instrumentation.count('TableBuffer.hits')
+            self.chunk = self.ring[self.ring_pos][start - bstart:stop - bstart]
+        else:
+            self.chunk = self.data[start:stop]
+            self.nbytes_read = self.chunk.nbytes
+        self.start = start
+        self.rows = None
+
+        if Instrumentation.ENABLED:
+            Instrumentation.count('TableBuffer.faults')
+
+    def readDirect(self, start, stop):
+        """
+        Read the headers of the selected range into the next buffer of the
+        ring and return a view of the filled part.
+
+        A buffer is only (re)allocated if it is too small for the range. Rows
+        already held by the current buffer are copied, only the remaining
+        rows are read.
+        """
+
+        nrows = max(stop - start, 0)
+        prev = self.ring[self.ring_pos]
+        pstart, pstop = self.buffered
+        self.ring_pos = (self.ring_pos + 1) % len(self.ring)
+        buf = self.ring[self.ring_pos]
+        if buf is None or len(buf) < nrows:
+            buf = numpy.empty(nrows, dtype=self.ring_dtype)
+            self.ring[self.ring_pos] = buf
+            if Instrumentation.ENABLED:
+                Instrumentation.count('TableBuffer.allocations')
+
+        # rows shared with the previous buffer
+        lo, hi = max(start, pstart), min(stop, pstop)
+        if prev is None or lo >= hi:
+            lo = hi = stop
+        else:
+            buf[lo - start:hi - start] = prev[lo - pstart:hi - pstart]
+            if Instrumentation.ENABLED:
+                Instrumentation.count('TableBuffer.reused rows', hi - lo)
+
+        source = self.sidecar.dataset if self.sidecar is not None else self.data
+        for rstart, rstop in ((start, lo), (hi, stop)):
+            if rstop > rstart:
+                source.read_direct(buf, numpy.s_[rstart:rstop],
+                                   numpy.s_[rstart - start:rstop - start])
+        self.buffered = (start, stop)
+        self.nbytes_read = (nrows - (hi - lo)) * self.ring_dtype.itemsize
+        return buf[:nrows]
+
+    def setRecords(self, records, start, rows=None):
+        """
+        Use records taken from elsewhere (e.g. a header index) as chunk.
+
+        :Parameters:
+        :param records: the records (with a 'head' field)
+        :param start: the model row of the first record
+        :param rows: the dataset rows of the records, None if they are the
+            contiguous range starting at `start`
+        """
+
+        self.chunk = records
+        self.start = start
+        self.rows = rows
+
+    def datasetRow(self, row):
+        """Returns the dataset row of the buffer row `row`."""
+        if self.rows is not None:
+            return int(self.rows[row])
+        return self.start + row
 
     def getCell(self, row):
         """
@@ -90,3 +323,62 @@ class TableBuffer(object):
         """
 
         return self.chunk[row]
+
+    def readAcquisition(self, row):
+        """
+        Returns the complete record (header, trajectory and data) of an
+        acquisition of the buffer (header and data for waveforms).
+
+        :Parameters:
+        - `row`: the buffer row of the acquisition.
+        """
+
+        cell = self.chunk[row]
+        if 'data' in cell.dtype.names:
+            return cell
+
+        row = self.datasetRow(row)
+        if row in self.warm:
+            return self.warm[row]
+        return self.data[row]
+
+    def readAcquisitions(self, rows):
+        """
+        Returns the complete records of several acquisitions, read with a
+        single read of the dataset.
+
+        :Parameters:
+        - `rows`: the dataset rows of the acquisitions.
+        :Returns: the records, sorted by dataset row (duplicates removed)
+        """
+
+        rows = numpy.unique(numpy.asarray(rows, dtype=numpy.int64))
+        if not len(rows):
+            return self.data[0:0]
+        if self.warm and all(row in self.warm for row in rows.tolist()):
+            records = numpy.empty(len(rows), dtype=self.data.dtype)
+            for pos, row in enumerate(rows.tolist()):
+                records[pos] = self.warm[row]
+            return records
+        if rows[-1] - rows[0] + 1 == len(rows):
+            return self.data[int(rows[0]):int(rows[-1]) + 1]
+        return self.data[rows]
+
+    def describe(self):
+        """Return a list of ``(property, value)`` pairs describing how the
+        acquisitions are stored and accessed.
+        """
+
+        info = self.layout.describe()
+        if self.mmap is not None:
+            access = 'memory-mapped headers'
+        elif self.ring_dtype is not None:
+            access = 'read_direct into {0} preallocated buffers'.format(len(self.ring))
+        else:
+            access = 'h5py slicing'
+        if self.sidecar is not None:
+            access += ' (sidecar {0})'.format(self.sidecar.dataset.name)
+        info.append(('Header access', access))
+        if self.mmap is None and self.sidecar is None and self.layout.chunks is not None:
+            info.append(('Read alignment', '{0} rows'.format(self.layout.chunks[0])))
+        return info
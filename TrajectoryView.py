@@ -0,0 +1,434 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements a k-space view of the trajectories of many
+acquisitions (e.g. all interleaves of a radial or spiral slice), shown in a
+dock widget.
+
+The trajectory samples are never plotted one by one. They are binned into a
+2D histogram of about the resolution of the screen while they are read, the
+view then shows the histogram as a single image (the density of the samples
+on a logarithmic colour scale) or as a single scatter plot of the occupied
+bins. The memory and the drawing time thus do not depend on the number of
+samples, millions of samples are shown as fast as a few.
+
+The histogram covers the square ``[-radius, radius]`` of the two shown
+trajectory dimensions (a projection for 3D trajectories). The radius is a
+power of two: when a block of samples reaches beyond it, the radius is
+doubled and the bins are merged by pairs, which keeps the histogram exact.
+"""
+
+import time
+import functools
+import numpy
+from PyQt5.QtCore import QThread, QRectF, pyqtSignal
+from PyQt5.QtWidgets import (QDockWidget, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,
+                             QComboBox, QProgressBar, QLabel)
+
+# pyqtgraph is imported with the first plot
+pg = None
+
+#: The shown trajectory dimensions (the projection of 3D trajectories).
+PROJECTIONS = (('kx / ky', (0, 1)), ('kx / kz', (0, 2)), ('ky / kz', (1, 2)))
+
+#: The smallest and largest number of bins along a dimension.
+MIN_GRID = 256
+MAX_GRID = 2048
+
+#: The approximate number of acquisitions binned per block.
+BLOCK_ROWS = 1024
+
+#: The scatter plot shows at most this many bins (merged otherwise).
+MAX_POINTS = 50000
+
+
+def gridSize(pixels):
+    """The number of bins for a plot of `pixels` pixels: the next power of
+    two, within MIN_GRID and MAX_GRID."""
+    size = MIN_GRID
+    while size < pixels and size < MAX_GRID:
+        size *= 2
+    return size
+
+
+def enlarge(counts, steps=1):
+    """Double the extent of a square histogram `steps` times: the bins are
+    merged by pairs and the result is centred in an empty histogram of the
+    same size."""
+    size = len(counts)
+    for _ in range(steps):
+        merged = counts.reshape(size // 2, 2, size // 2, 2).sum(axis=(1, 3))
+        counts = numpy.zeros_like(counts)
+        counts[size // 4:size // 4 + size // 2, size // 4:size // 4 + size // 2] = merged
+    return counts
+
+
+def _trajHistogram(block, axes=(0, 1), grid=MIN_GRID):
+    """Bin the trajectory samples of a block (worker side).
+
+    Returns ``(radius, counts, samples, acquisitions, skipped)``: the
+    histogram over ``[-radius, radius]`` along `axes` (None if there is no
+    sample), the number of binned samples and acquisitions and the number of
+    acquisitions without (matching) trajectory.
+    """
+
+    heads = block['head']
+    count = len(block)
+    dims = heads['trajectory_dimensions'].astype(numpy.int64)
+    length = heads['number_of_samples'].astype(numpy.int64)
+    sizes = numpy.fromiter(map(len, block['traj']), numpy.int64, count)
+    valid = (sizes == dims * length) & (sizes > 0) & (dims > max(axes))
+    shapes = dims * 65536 + length
+
+    # stack the trajectories of every shape at once
+    points = []
+    for shape in numpy.unique(shapes[valid]):
+        rows = numpy.flatnonzero(valid & (shapes == shape))
+        ndims, nsamples = divmod(int(shape), 65536)
+        traj = numpy.stack(list(block['traj'][rows])).reshape(len(rows), nsamples, ndims)
+        points.append(traj[:, :, list(axes)].reshape(-1, 2))
+    skipped = count - int(valid.sum())
+    if not points:
+        return 0.0, None, 0, 0, skipped
+
+    points = numpy.concatenate(points)
+    points = points[numpy.isfinite(points).all(axis=1)]
+    extent = float(numpy.abs(points).max()) if len(points) else 0.0
+    radius = 2.0 ** numpy.ceil(numpy.log2(extent)) if extent > 0 else 1.0
+
+    bins = numpy.floor((points + radius) * (grid / (2 * radius))).astype(numpy.int64)
+    numpy.clip(bins, 0, grid - 1, out=bins)
+    counts = numpy.bincount(bins[:, 0] * grid + bins[:, 1], minlength=grid * grid)
+    return (radius, counts.reshape(grid, grid).astype(numpy.uint32), len(points),
+            count - skipped, skipped)
+
+
+class TrajectoryDensity(object):
+    """
+    The histogram of the trajectory samples of a set of acquisitions.
+
+    :Parameters:
+
+    - `axes`: the binned trajectory dimensions
+    - `grid`: the number of bins along a dimension
+    - `source`: a description of the acquisitions
+    """
+
+    def __init__(self, axes, grid, source=''):
+        self.axes = axes
+        self.grid = grid
+        self.source = source
+        self.radius = 0.0
+        self.counts = None
+        self.samples = 0
+        self.acquisitions = 0
+        self.skipped = 0
+        self.elapsed = 0.0
+
+    def add(self, result):
+        """Add the result of `_trajHistogram` (the histograms are brought to
+        the larger radius)."""
+        radius, counts, samples, acquisitions, skipped = result
+        self.samples += samples
+        self.acquisitions += acquisitions
+        self.skipped += skipped
+        if counts is None:
+            return
+        counts = counts.astype(numpy.int64)
+        if self.counts is None:
+            self.radius, self.counts = radius, counts
+        elif radius > self.radius:
+            self.counts = enlarge(self.counts, int(round(numpy.log2(radius / self.radius))))
+            self.counts += counts
+            self.radius = radius
+        else:
+            self.counts += enlarge(counts, int(round(numpy.log2(self.radius / radius))))
+
+    def bins(self, limit=MAX_POINTS):
+        """The centres and counts of the occupied bins, merged until there
+        are at most `limit`."""
+        counts = self.counts
+        while numpy.count_nonzero(counts) > limit and len(counts) > 2:
+            size = len(counts) // 2
+            counts = counts.reshape(size, 2, size, 2).sum(axis=(1, 3))
+        x, y = numpy.nonzero(counts)
+        width = 2 * self.radius / len(counts)
+        return (x + 0.5) * width - self.radius, (y + 0.5) * width - self.radius, counts[x, y]
+
+
+def binTrajectories(rbuffer, rows, axes, grid, cancelled=lambda: False, progress=None):
+    """Bin the trajectories of the acquisitions and return the
+    `TrajectoryDensity` (None if cancelled).
+
+    :Parameters:
+    :param rbuffer: the acquisition buffer
+    :param rows: the dataset rows of the acquisitions (None: all)
+    :param axes: the binned trajectory dimensions
+    :param grid: the number of bins along a dimension
+    :param cancelled: callable returning True to stop
+    :param progress: optional callable ``(rows read, total rows)``
+    """
+
+    t0 = time.perf_counter()
+    func = functools.partial(_trajHistogram, axes=axes, grid=grid)
+    density = TrajectoryDensity(axes, grid)
+    engine = rbuffer.engine
+    if rows is None and engine is not None:
+        # one chunked pass of the worker processes
+        total = engine.dataset.shape[0]
+        for start, stop, result in engine.map(func, fields=['head', 'traj'], rows=BLOCK_ROWS):
+            if cancelled():
+                return None
+            density.add(result)
+            if progress is not None:
+                progress(stop, total)
+    else:
+        if rows is None:
+            rows = numpy.arange(rbuffer.total_nrows())
+        total = len(rows)
+        for start in range(0, total, BLOCK_ROWS):
+            if cancelled():
+                return None
+            density.add(func(rbuffer.readAcquisitions(rows[start:start + BLOCK_ROWS])))
+            if progress is not None:
+                progress(min(start + BLOCK_ROWS, total), total)
+    density.elapsed = time.perf_counter() - t0
+    return density
+
+
+class TrajectoryWorker(QThread):
+    """
+    Background thread binning the trajectories of a set of acquisitions.
+
+    :Parameters:
+
+    - `rbuffer`: the acquisition buffer
+    - `rows`: the dataset rows (None: all)
+    - `axes`: the binned trajectory dimensions
+    - `grid`: the number of bins along a dimension
+    """
+
+    #: Emitted with ``(rows read, total rows)`` during the pass.
+    progress = pyqtSignal(int, int)
+
+    def __init__(self, rbuffer, rows, axes, grid, parent=None):
+        super(TrajectoryWorker, self).__init__(parent)
+        self.rbuffer = rbuffer
+        self.rows = rows
+        self.axes = axes
+        self.grid = grid
+        self.cancelled = False
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = binTrajectories(self.rbuffer, self.rows, self.axes, self.grid,
+                                          lambda: self.cancelled, self.progress.emit)
+        except Exception as e:
+            self.error = e
+
+    def cancel(self):
+        self.cancelled = True
+        self.wait()
+
+
+class TrajectoryDock(QDockWidget):
+    """
+    A dock widget showing the k-space trajectories of the selected
+    acquisitions or of all acquisitions passing the table filter.
+
+    The histogram is kept by the DatasetView (``trajectory``), changing the
+    rendering does not read the dataset again.
+
+    :Parameters:
+
+    - `parent`: the parent of this widget
+    """
+
+    def __init__(self, parent=None):
+        super(TrajectoryDock, self).__init__('Trajectory scatter', parent)
+        self.setObjectName('trajectory_dock')
+        self.view = None
+        self.worker = None
+        self.plot = None
+        self.source = ''
+
+        self.sourceCB = QComboBox()
+        self.sourceCB.addItems(['Filtered acquisitions', 'Selected acquisitions'])
+        self.sourceCB.setToolTip('The acquisitions whose trajectories are shown')
+        self.projectionCB = QComboBox()
+        for name, axes in PROJECTIONS:
+            self.projectionCB.addItem(name, axes)
+        self.projectionCB.setToolTip('The shown trajectory dimensions')
+        self.renderCB = QComboBox()
+        self.renderCB.addItems(['Density', 'Points'])
+        self.renderCB.setToolTip('Show the density of the samples as an image or the '
+                                 'occupied bins as points')
+        self.renderCB.currentIndexChanged.connect(self.showResult)
+        self.btnShow = QPushButton('Show')
+        self.btnShow.clicked.connect(self.compute)
+        self.btnCancel = QPushButton('Cancel')
+        self.btnCancel.clicked.connect(self.cancel)
+        self.btnCancel.setEnabled(False)
+        self.progressBar = QProgressBar()
+        self.progressBar.hide()
+        self.statusLabel = QLabel()
+        self.statusLabel.setWordWrap(True)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.sourceCB)
+        buttons.addWidget(self.projectionCB)
+        buttons.addWidget(self.renderCB)
+        buttons.addWidget(self.btnShow)
+        buttons.addWidget(self.btnCancel)
+        buttons.addStretch(1)
+
+        widget = QWidget()
+        self.plotLayout = QVBoxLayout(widget)
+        self.plotLayout.addLayout(buttons)
+        self.plotLayout.addWidget(self.progressBar)
+        self.plotLayout.addWidget(self.statusLabel)
+        self.setWidget(widget)
+
+    def setView(self, view):
+        """Show the trajectories of another dataset view (a running pass is
+        cancelled)."""
+        if view is self.view:
+            return
+        self.cancel()
+        self.view = view
+        self.showResult()
+
+    def compute(self):
+        if self.view is None or self.worker is not None:
+            return
+        model = self.view.tableModel
+        if self.sourceCB.currentIndex() == 1:
+            rows = numpy.asarray(self.view.tableView.selectedRows(), dtype=numpy.int64)
+            source = '{0} selected acquisitions'.format(len(rows))
+            if not len(rows):
+                self.statusLabel.setText('No acquisition selected.')
+                return
+        elif model.filter_expr and model.rowmap is not None:
+            rows = numpy.sort(model.rowmap)
+            source = 'the acquisitions with {0}'.format(model.filter_expr)
+        else:
+            rows = None
+            source = 'all acquisitions'
+        self.source = source
+
+        if self.plot is None:
+            self.createPlot()
+        pixels = max(self.plot.width(), self.plot.height())
+        axes = self.projectionCB.currentData()
+        self.worker = TrajectoryWorker(model.rbuffer, rows, axes, gridSize(pixels), self)
+        self.worker.progress.connect(self.onProgress)
+        self.worker.finished.connect(self.onFinished)
+        self.progressBar.setRange(0, max(model.rbuffer.total_nrows() if rows is None
+                                         else len(rows), 1))
+        self.progressBar.setValue(0)
+        self.progressBar.show()
+        self.btnShow.setEnabled(False)
+        self.btnCancel.setEnabled(True)
+        self.statusLabel.setText('Reading the trajectories of {0}...'.format(source))
+        self.worker.start()
+
+    def onProgress(self, done, total):
+        self.progressBar.setValue(done)
+
+    def onFinished(self):
+        worker, self.worker = self.worker, None
+        self.progressBar.hide()
+        self.btnShow.setEnabled(True)
+        self.btnCancel.setEnabled(False)
+        if worker.error is not None:
+            self.statusLabel.setText('Reading the trajectories failed: {0}'.format(worker.error))
+            return
+        if worker.result is None:
+            self.statusLabel.setText('Cancelled.')
+            return
+        worker.result.source = self.source
+        self.view.trajectory = worker.result
+        self.showResult()
+
+    def cancel(self):
+        worker = self.worker
+        if worker is not None:
+            self.worker = None
+            worker.finished.disconnect(self.onFinished)
+            worker.cancel()
+            worker.deleteLater()
+            self.progressBar.hide()
+            self.btnShow.setEnabled(True)
+            self.btnCancel.setEnabled(False)
+            self.statusLabel.setText('Cancelled.')
+
+    def createPlot(self):
+        global pg
+        if pg is None:
+            import pyqtgraph
+            pg = pyqtgraph
+        self.plot = pg.PlotWidget()
+        self.plot.setAspectLocked(True)
+        self.plot.setMinimumHeight(200)
+        self.plotLayout.addWidget(self.plot, 1)
+
+    def showResult(self):
+        """Show the histogram of the current view."""
+        result = getattr(self.view, 'trajectory', None)
+        if self.plot is not None:
+            self.plot.clear()
+        if result is None:
+            self.statusLabel.setText('Not shown yet.')
+            return
+
+        names = dict((axes, name) for name, axes in PROJECTIONS)[result.axes].split(' / ')
+        text = '{0} samples of {1} ({2:.1f} s)'.format(result.samples, result.source,
+                                                        result.elapsed)
+        if result.skipped:
+            text += ', {0} acquisitions without {1} trajectory'.format(
+                result.skipped, 'a 2D' if result.axes == (0, 1) else 'a 3D')
+        self.statusLabel.setText(text)
+        if result.counts is None:
+            return
+
+        if self.plot is None:
+            self.createPlot()
+        self.plot.setLabel('bottom', names[0])
+        self.plot.setLabel('left', names[1])
+        lut = pg.colormap.get('viridis').getLookupTable(nPts=256)
+        radius = result.radius
+        if self.renderCB.currentIndex() == 0:
+            density = numpy.log1p(result.counts.astype(numpy.float32))
+            image = pg.ImageItem(density, lut=lut, levels=(0, max(float(density.max()), 1e-3)))
+            image.setRect(QRectF(-radius, -radius, 2 * radius, 2 * radius))
+            self.plot.addItem(image)
+        else:
+            x, y, counts = result.bins()
+            # a few shared brushes, one per shade
+            shade = numpy.log1p(counts) / max(numpy.log1p(counts.max()), 1e-3)
+            palette = [pg.mkBrush(*color) for color in lut[::16].tolist()]
+            brushes = [palette[index] for index in
+                       numpy.minimum((shade * len(palette)).astype(int), len(palette) - 1)]
+            self.plot.addItem(pg.ScatterPlotItem(x=x, y=y, size=3, pen=None, brush=brushes))
+        self.plot.setRange(xRange=(-radius, radius), yRange=(-radius, radius))
+
+    def shutdown(self):
+        self.cancel()
@@ -0,0 +1,558 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements the validation of the acquisitions of a dataset, a
+dock widget listing the findings and a command line tool.
+
+The checks (see `checkHeaders`) are vectorized over all acquisition
+headers: gaps, duplicates and reversals of the scan counter, decreasing
+time stamps, channel and sample counts, encoding counters outside the
+encoding limits of the XML header and payload lengths not matching the
+header. The headers come from the header index or the memory-mapped
+headers if available; the payload lengths (and the headers otherwise) are
+read in a single chunked pass of the `ReadEngine`.
+
+Usage::
+
+    python Validate.py file.h5 [--group dataset] [--no-payload]
+"""
+
+import sys
+import time
+import argparse
+import collections
+import numpy
+import h5py
+import ismrmrd
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtGui import QBrush, QColor
+from PyQt5.QtWidgets import (QDockWidget, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,
+                             QCheckBox, QProgressBar, QLabel, QTreeWidget, QTreeWidgetItem)
+import DatasetLayout
+import ReadEngine
+import ISMRMRDHeader
+import ISMRMRDTableModel
+
+#: The findings listed per check (the other rows are only counted).
+MAX_FINDINGS = 1000
+
+ERROR = 'error'
+WARNING = 'warning'
+
+# acquisitions that are not imaging data (sample and channel counts and
+# encoding counters may differ)
+_SPECIAL_FLAGS = ('ACQ_IS_NOISE_MEASUREMENT', 'ACQ_IS_NAVIGATION_DATA', 'ACQ_IS_PHASECORR_DATA',
+                  'ACQ_IS_RTFEEDBACK_DATA', 'ACQ_IS_HPFEEDBACK_DATA', 'ACQ_IS_DUMMYSCAN_DATA',
+                  'ACQ_IS_SURFACECOILCORRECTIONSCAN_DATA', 'ACQ_IS_PHASE_STABILIZATION',
+                  'ACQ_IS_PHASE_STABILIZATION_REFERENCE')
+
+# encoding limits of the XML header => encoding counters of the headers
+_LIMIT_COUNTERS = collections.OrderedDict([
+    ('kspace_encoding_step_1', 'kspace_encode_step_1'),
+    ('kspace_encoding_step_2', 'kspace_encode_step_2'),
+    ('average', 'average'), ('slice', 'slice'), ('contrast', 'contrast'),
+    ('phase', 'phase'), ('repetition', 'repetition'), ('set', 'set'),
+    ('segment', 'segment')])
+
+#: The result of one check: the failing dataset rows and the descriptions of
+#: the first `MAX_FINDINGS` of them.
+Issue = collections.namedtuple('Issue', 'check severity rows details')
+
+def _payloadLengths(block):
+    """The trajectory and data lengths of every acquisition, and the headers
+    if they were read (worker side)."""
+    lengths = numpy.empty((len(block), 2), dtype=numpy.int64)
+    lengths[:, 0] = numpy.fromiter(map(len, block['traj']), numpy.int64, len(block))
+    lengths[:, 1] = numpy.fromiter(map(len, block['data']), numpy.int64, len(block))
+    heads = numpy.ascontiguousarray(block['head']) if 'head' in block.dtype.names else None
+    return heads, lengths
+
+def _issue(check, severity, rows, describe):
+    rows = numpy.asarray(rows, dtype=numpy.int64)
+    return Issue(check, severity, rows, [describe(row) for row in rows[:MAX_FINDINGS]])
+
+def specialRows(heads):
+    """Boolean mask of the acquisitions that are not imaging data."""
+    mask = numpy.uint64(0)
+    for name in _SPECIAL_FLAGS:
+        if hasattr(ismrmrd, name):
+            mask |= numpy.uint64(1) << numpy.uint64(getattr(ismrmrd, name) - 1)
+    return heads['flags'].astype(numpy.uint64) & mask != 0
+
+def _mode(values):
+    """The most frequent value of `values` (None if empty)."""
+    if not len(values):
+        return None
+    unique, counts = numpy.unique(values, return_counts=True)
+    return unique[numpy.argmax(counts)]
+
+def checkScanCounter(heads):
+    issues = []
+    counter = heads['scan_counter'].astype(numpy.int64)
+    if not len(counter):
+        return issues
+    step = numpy.diff(counter)
+
+    rows = numpy.flatnonzero(step > 1) + 1
+    if len(rows):
+        issues.append(_issue('scan_counter gap', ERROR, rows, lambda row: (
+            'scan_counter {0} -> {1} ({2} missing)'.format(
+                counter[row - 1], counter[row], counter[row] - counter[row - 1] - 1))))
+
+    unique, first, inverse, counts = numpy.unique(
+        counter, return_index=True, return_inverse=True, return_counts=True)
+    duplicate = (counts[inverse] > 1) & (numpy.arange(len(counter)) != first[inverse])
+    rows = numpy.flatnonzero(duplicate)
+    if len(rows):
+        issues.append(_issue('duplicate scan_counter', ERROR, rows, lambda row: (
+            'scan_counter {0} also in row {1}'.format(counter[row], first[inverse[row]]))))
+
+    rows = numpy.flatnonzero((step < 0) & ~duplicate[1:]) + 1
+    if len(rows):
+        issues.append(_issue('scan_counter decreases', WARNING, rows, lambda row: (
+            'scan_counter {0} -> {1}'.format(counter[row - 1], counter[row]))))
+    return issues
+
+def checkTimeStamps(heads):
+    stamps = heads['acquisition_time_stamp'].astype(numpy.int64)
+    rows = numpy.flatnonzero(numpy.diff(stamps) < 0) + 1
+    if not len(rows):
+        return []
+    return [_issue('acquisition_time_stamp decreases', WARNING, rows, lambda row: (
+        'acquisition_time_stamp {0} -> {1}'.format(stamps[row - 1], stamps[row])))]
+
+def checkChannels(heads, imaging):
+    issues = []
+    active = heads['active_channels'].astype(numpy.int64)
+    available = heads['available_channels'].astype(numpy.int64)
+    samples = heads['number_of_samples'].astype(numpy.int64)
+
+    rows = numpy.flatnonzero(active > available)
+    if len(rows):
+        issues.append(_issue('active_channels > available_channels', ERROR, rows, lambda row: (
+            'active_channels {0}, available_channels {1}'.format(active[row], available[row]))))
+
+    rows = numpy.flatnonzero((active == 0) | (samples == 0))
+    if len(rows):
+        issues.append(_issue('empty acquisition', ERROR, rows, lambda row: (
+            'number_of_samples {0}, active_channels {1}'.format(samples[row], active[row]))))
+
+    # imaging acquisitions of an encoding space usually share the sample and
+    # channel counts
+    space = heads['encoding_space_ref']
+    for name, values in (('number_of_samples', samples), ('active_channels', active)):
+        usual = numpy.zeros(len(values), dtype=numpy.int64)
+        checked = numpy.zeros(len(values), dtype=bool)
+        for ref in numpy.unique(space[imaging]):
+            rows = imaging & (space == ref)
+            usual[rows] = _mode(values[rows])
+            checked |= rows
+        rows = numpy.flatnonzero(checked & (values != usual))
+        if len(rows):
+            issues.append(_issue('inconsistent ' + name, WARNING, rows, lambda row, name=name,
+                                 values=values, usual=usual: '{0} {1} (usually {2})'.format(
+                                     name, values[row], usual[row])))
+    return issues
+
+def checkEncodingLimits(heads, limits, imaging):
+    """Check the encoding counters against the encoding limits.
+
+    :Parameters:
+    :param heads: the acquisition headers
+    :param limits: the encoding limits of every encoding of the XML header
+      (see `ISMRMRDHeader.XMLHeader.encodingLimits`)
+    :param imaging: boolean mask of the checked acquisitions
+    """
+
+    issues = []
+    space = heads['encoding_space_ref'].astype(numpy.int64)
+    rows = numpy.flatnonzero(imaging & (space >= len(limits)))
+    if len(rows) and limits:
+        issues.append(_issue('unknown encoding space', ERROR, rows, lambda row: (
+            'encoding_space_ref {0}, the XML header has {1} encodings'.format(
+                space[row], len(limits)))))
+
+    idx = heads['idx']
+    for limit, counter in _LIMIT_COUNTERS.items():
+        values = idx[counter].astype(numpy.int64)
+        low = numpy.full(len(values), numpy.iinfo(numpy.int64).min)
+        high = numpy.full(len(values), numpy.iinfo(numpy.int64).max)
+        for ref, spaceLimits in enumerate(limits):
+            if limit in spaceLimits:
+                low[space == ref], high[space == ref] = spaceLimits[limit][:2]
+        rows = numpy.flatnonzero(imaging & ((values < low) | (values > high)))
+        if len(rows):
+            issues.append(_issue(counter + ' outside encoding limits', ERROR, rows,
+                                 lambda row, counter=counter, values=values, low=low, high=high:
+                                 '{0} {1} outside [{2}, {3}]'.format(
+                                     counter, values[row], low[row], high[row])))
+    return issues
+
+def checkPayload(heads, lengths):
+    """Check the trajectory and data lengths against the header.
+
+    :Parameters:
+    :param heads: the acquisition headers
+    :param lengths: ``(trajectory length, data length)`` of every acquisition
+      (float32 values, complex data counts twice)
+    """
+
+    issues = []
+    samples = heads['number_of_samples'].astype(numpy.int64)
+    trajDims = heads['trajectory_dimensions'].astype(numpy.int64)
+    active = heads['active_channels'].astype(numpy.int64)
+    traj, data = lengths[:, 0], lengths[:, 1]
+
+    rows = numpy.flatnonzero((trajDims == 0) & (traj > 0))
+    if len(rows):
+        issues.append(_issue('trajectory without trajectory_dimensions', ERROR, rows,
+                             lambda row: '{0} trajectory values'.format(traj[row])))
+
+    expected = samples * trajDims
+    rows = numpy.flatnonzero((trajDims > 0) & (traj != expected))
+    if len(rows):
+        issues.append(_issue('trajectory length mismatch', ERROR, rows, lambda row: (
+            '{0} trajectory values, expected {1}'.format(traj[row], expected[row]))))
+
+    expectedData = 2 * samples * active
+    rows = numpy.flatnonzero(data != expectedData)
+    if len(rows):
+        issues.append(_issue('data length mismatch', ERROR, rows, lambda row: (
+            '{0} data values, expected {1} (2 x {2} samples x {3} channels)'.format(
+                data[row], expectedData[row], samples[row], active[row]))))
+    return issues
+
+def checkHeaders(heads, limits=(), lengths=None):
+    """Run all checks and return the list of `Issue` (errors first).
+
+    :Parameters:
+    :param heads: the acquisition headers (structured array)
+    :param limits: the encoding limits of every encoding of the XML header
+    :param lengths: the payload lengths (see `checkPayload`), None to skip
+      the payload checks
+    """
+
+    imaging = ~specialRows(heads)
+    issues = checkScanCounter(heads) + checkTimeStamps(heads) + \
+        checkChannels(heads, imaging) + checkEncodingLimits(heads, limits, imaging)
+    if lengths is not None:
+        issues += checkPayload(heads, lengths)
+    return sorted(issues, key=lambda issue: issue.severity != ERROR)
+
+def encodingLimits(header):
+    """The encoding limits of all encodings of a parsed XML header."""
+    return [header.encodingLimits(encoding)
+            for encoding in range(len(header.root.findall('encoding')))]
+
+def readHeaders(engine, heads=None, payload=True, cancelled=lambda: False, progress=None):
+    """Return ``(heads, lengths)`` of all acquisitions in one chunked pass.
+
+    Only the payload lengths are read if `heads` is given. Returns None if
+    cancelled; `lengths` is None if `payload` is False.
+
+    :Parameters:
+    :param engine: the ReadEngine of the acquisition dataset
+    :param heads: the headers if already available (index or memory map)
+    :param payload: read the payload lengths
+    :param cancelled: callable returning True to stop the pass
+    :param progress: optional callable ``(rows read, total rows)``
+    """
+
+    total = engine.dataset.shape[0]
+    if not payload:
+        if heads is not None:
+            return heads, None
+        fields, func = ['head'], None
+    else:
+        fields = ['traj', 'data'] if heads is not None else ['head', 'traj', 'data']
+        func = _payloadLengths
+
+    blocks, lengths = [], []
+    for start, stop, block in engine.map(func, fields=fields):
+        if cancelled():
+            return None
+        if func is None:
+            blocks.append(block['head'])
+        else:
+            if block[0] is not None:
+                blocks.append(block[0])
+            lengths.append(block[1])
+        if progress is not None:
+            progress(stop, total)
+
+    if heads is None:
+        heads = numpy.concatenate(blocks) if blocks else \
+            engine.dataset.fields(['head'])[0:0]['head']
+    if payload:
+        lengths = numpy.concatenate(lengths) if lengths else numpy.zeros((0, 2), numpy.int64)
+        return heads, lengths
+    return heads, None
+
+
+class ValidationWorker(QThread):
+    """
+    Background thread validating the acquisitions of a dataset.
+
+    :Parameters:
+
+    - `engine`: the ReadEngine of the acquisition dataset
+    - `heads`: the headers if already available (None: read them)
+    - `limits`: the encoding limits (see `encodingLimits`)
+    - `payload`: also check the payload lengths
+    """
+
+    #: Emitted with ``(rows read, total rows)`` during the pass.
+    progress = pyqtSignal(int, int)
+
+    def __init__(self, engine, heads, limits, payload=True, parent=None):
+        super(ValidationWorker, self).__init__(parent)
+        self.engine = engine
+        self.heads = heads
+        self.limits = limits
+        self.payload = payload
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.elapsed = 0.0
+
+    def run(self):
+        t0 = time.perf_counter()
+        try:
+            read = readHeaders(self.engine, self.heads, self.payload,
+                               lambda: self.cancelled, self.progress.emit)
+            if read is not None:
+                self.result = checkHeaders(read[0], self.limits, read[1])
+        except Exception as e:
+            self.error = e
+        self.elapsed = time.perf_counter() - t0
+
+    def cancel(self):
+        self.cancelled = True
+        self.wait()
+
+
+class ValidationDock(QDockWidget):
+    """
+    A dock widget validating the shown dataset and listing the findings.
+
+    Activating a finding emits `rowRequested` with its dataset row. The
+    findings are kept by the DatasetView (``validation``), so they are shown
+    again when the view is shown again.
+
+    :Parameters:
+
+    - `parent`: the parent of this widget
+    """
+
+    #: Emitted with the dataset row of an activated finding.
+    rowRequested = pyqtSignal(int)
+
+    def __init__(self, parent=None):
+        super(ValidationDock, self).__init__('Validation', parent)
+        self.setObjectName('validation_dock')
+        self.view = None
+        self.worker = None
+
+        self.btnValidate = QPushButton('Validate')
+        self.btnValidate.clicked.connect(self.validate)
+        self.btnCancel = QPushButton('Cancel')
+        self.btnCancel.clicked.connect(self.cancel)
+        self.btnCancel.setEnabled(False)
+        self.cbPayload = QCheckBox('Payload lengths')
+        self.cbPayload.setToolTip('Also read the payload of every acquisition and check its length')
+        self.cbPayload.setChecked(True)
+        self.progressBar = QProgressBar()
+        self.progressBar.hide()
+        self.statusLabel = QLabel()
+        self.statusLabel.setWordWrap(True)
+
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(['Check', 'Details'])
+        self.tree.setColumnWidth(0, 260)
+        self.tree.itemActivated.connect(self.onItemActivated)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.btnValidate)
+        buttons.addWidget(self.btnCancel)
+        buttons.addWidget(self.cbPayload)
+        buttons.addStretch(1)
+
+        widget = QWidget()
+        layout = QVBoxLayout(widget)
+        layout.addLayout(buttons)
+        layout.addWidget(self.progressBar)
+        layout.addWidget(self.statusLabel)
+        layout.addWidget(self.tree)
+        self.setWidget(widget)
+
+    def setView(self, view):
+        """Show the findings of another dataset view (a running validation
+        is cancelled)."""
+        if view is self.view:
+            return
+        self.cancel()
+        self.view = view
+        self.showResult()
+
+    def validate(self):
+        if self.view is None or self.worker is not None:
+            return
+        model = self.view.tableModel
+        engine = model.rbuffer.engine
+        if engine is None:
+            self.statusLabel.setText('Streams cannot be validated.')
+            return
+
+        heads = None
+        index = self.view.headerIndex
+        if index is not None and index.isComplete():
+            heads = index.heads()
+        elif model.rbuffer.mmap is not None:
+            heads = model.rbuffer.mmap['head']
+        try:
+            limits = encodingLimits(ISMRMRDHeader.getHeader(self.view.dset))
+        except Exception:
+            limits = []
+
+        self.worker = ValidationWorker(engine, heads, limits, self.cbPayload.isChecked(), self)
+        self.worker.progress.connect(self.onProgress)
+        self.worker.finished.connect(self.onFinished)
+        self.progressBar.setRange(0, max(model.rbuffer.total_nrows(), 1))
+        self.progressBar.setValue(0)
+        self.progressBar.show()
+        self.btnValidate.setEnabled(False)
+        self.btnCancel.setEnabled(True)
+        self.statusLabel.setText('Validating {0} acquisitions...'.format(
+            model.rbuffer.total_nrows()))
+        self.worker.start()
+
+    def onProgress(self, done, total):
+        self.progressBar.setValue(done)
+
+    def onFinished(self):
+        worker, self.worker = self.worker, None
+        self.progressBar.hide()
+        self.btnValidate.setEnabled(True)
+        self.btnCancel.setEnabled(False)
+        if worker.error is not None:
+            self.statusLabel.setText('Validation failed: {0}'.format(worker.error))
+            return
+        if worker.result is None:
+            self.statusLabel.setText('Cancelled.')
+            return
+        self.view.validation = (worker.result, worker.elapsed)
+        self.showResult()
+
+    def cancel(self):
+        worker = self.worker
+        if worker is not None:
+            self.worker = None
+            worker.finished.disconnect(self.onFinished)
+            worker.cancel()
+            worker.deleteLater()
+            self.progressBar.hide()
+            self.btnValidate.setEnabled(True)
+            self.btnCancel.setEnabled(False)
+            self.statusLabel.setText('Cancelled.')
+
+    def showResult(self):
+        """Fill the tree with the findings of the current view."""
+        self.tree.clear()
+        result = getattr(self.view, 'validation', None)
+        if result is None:
+            self.statusLabel.setText('Not validated yet.')
+            return
+        issues, elapsed = result
+        errors = sum(issue.severity == ERROR for issue in issues)
+        self.statusLabel.setText('{0} errors, {1} warnings ({2:.1f} s)'.format(
+            errors, len(issues) - errors, elapsed) if issues else
+            'No problems found ({0:.1f} s).'.format(elapsed))
+
+        for issue in issues:
+            item = QTreeWidgetItem(['{0} ({1})'.format(issue.check, len(issue.rows)),
+                                    issue.severity])
+            item.setForeground(0, QBrush(QColor(200, 0, 0) if issue.severity == ERROR
+                                         else QColor(200, 120, 0)))
+            for row, details in zip(issue.rows, issue.details):
+                child = QTreeWidgetItem(['row {0}'.format(row), details])
+                child.setData(0, Qt.UserRole, int(row))
+                item.addChild(child)
+            if len(issue.rows) > len(issue.details):
+                item.addChild(QTreeWidgetItem(['...', '{0} more rows'.format(
+                    len(issue.rows) - len(issue.details))]))
+            self.tree.addTopLevelItem(item)
+
+    def onItemActivated(self, item, column):
+        row = item.data(0, Qt.UserRole)
+        if row is not None:
+            self.rowRequested.emit(row)
+
+    def shutdown(self):
+        self.cancel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Validate the acquisitions of ISMRMRD files')
+    parser.add_argument('fileNames', nargs='+', metavar='fileName',
+                        help='ISMRMRD (HDF5) files to validate')
+    parser.add_argument('--group', default='dataset',
+                        help='the dataset group (default: dataset)')
+    parser.add_argument('--no-payload', action='store_true',
+                        help='do not read the payload (skips the payload length checks)')
+    parser.add_argument('--rows', type=int, default=10,
+                        help='findings listed per check (default: 10)')
+    args = parser.parse_args(argv)
+
+    failed = False
+    for fileName in args.fileNames:
+        t0 = time.perf_counter()
+        try:
+            with h5py.File(fileName, 'r') as h5file:
+                group = h5file[args.group]
+                layout = DatasetLayout.openDataset(group, 'data', ISMRMRDTableModel.CHUNK_SIZE)
+                heads = layout.memmap('head')
+                if heads is None:
+                    sidecar = DatasetLayout.openSidecar(group, 'data', layout.dataset)
+                    heads = sidecar.memmap('head') if sidecar is not None else None
+                limits = []
+                if 'xml' in group:
+                    limits = encodingLimits(ISMRMRDHeader.XMLHeader(group['xml'][0]))
+                heads, lengths = readHeaders(ReadEngine.ReadEngine(layout.dataset, layout),
+                                             heads['head'] if heads is not None else None,
+                                             not args.no_payload)
+                issues = checkHeaders(heads, limits, lengths)
+        except (OSError, KeyError, ValueError) as e:
+            print('{0}: {1}'.format(fileName, e), file=sys.stderr)
+            failed = True
+            continue
+
+        errors = sum(issue.severity == ERROR for issue in issues)
+        failed |= errors > 0
+        print('{0} /{1}: {2} acquisitions, {3} errors, {4} warnings ({5:.1f} s)'.format(
+            fileName, args.group, len(heads), errors, len(issues) - errors,
+            time.perf_counter() - t0))
+        for issue in issues:
+            print('  {0:<8}{1}: {2} rows'.format(issue.severity, issue.check, len(issue.rows)))
+            for row, details in list(zip(issue.rows, issue.details))[:args.rows]:
+                print('          row {0}: {1}'.format(row, details))
+    ReadEngine.shutdownPool()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,317 @@
+# Copyright (C) 2017 Institute for Biomedical Engineering, Swiss Federal
+# Institute of Technology Zurich (ETH Zurich). All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Benjamin Dietrich, dietrich@biomed.ee.ethz.ch
+
+"""
+This module implements the workspace of the viewer: several files opened in
+one window, one tab per file (`FileView`). The dataset groups of a file
+(multi-scan files) are listed by `findGroups`; a `FileView` switches between
+them and keeps one `DatasetView` per opened group.
+
+The files share the worker pool of the `ReadEngine` and the instrumentation
+probes (both are process wide) and one memory budget for their caches
+(`CacheBudget`): buffered rows, header indices and image slices. If the
+budget is exceeded, the caches of the views that are not shown are released
+first, least recently shown first.
+"""
+
+import h5py
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QStackedWidget, QComboBox, QLabel
+import ismrmrd
+import Instrumentation
+import DatasetView, LiveTail, StreamIngest
+
+#: The default memory budget of the caches in bytes.
+DEFAULT_BUDGET = 1024 * 2 ** 20
+
+#: The interval in milliseconds at which the budget is checked.
+BUDGET_INTERVAL = 2000
+
+# members identifying an ismrmrd dataset group
+_GROUP_MEMBERS = ('data', 'xml', 'waveforms')
+
+def findGroups(h5file):
+    """Return ``(name, number of acquisitions)`` of the ismrmrd dataset
+    groups at the top level of an HDF5 file.
+
+    Only the metadata of the file is read (group members and the extent of
+    the acquisition datasets).
+
+    :Parameter h5file: the h5py.File
+    """
+
+    groups = []
+    for name in h5file:
+        if h5file.get(name, getclass=True) is not h5py.Group:
+            continue
+        group = h5file[name]
+        if not any(member in group for member in _GROUP_MEMBERS):
+            continue
+        data = group.get('data')
+        count = data.shape[0] if isinstance(data, h5py.Dataset) and data.ndim == 1 else 0
+        groups.append((name, count))
+    return groups
+
+
+class CacheBudget(QObject):
+    """
+    A memory budget shared by the caches of all dataset views.
+
+    :Parameters:
+
+    - `maxBytes`: the budget in bytes
+    - `parent`: the parent of this object
+    """
+
+    def __init__(self, maxBytes=DEFAULT_BUDGET, parent=None):
+        super(CacheBudget, self).__init__(parent)
+        self.maxBytes = maxBytes
+
+        # the registered views, least recently shown first
+        self.views = []
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(BUDGET_INTERVAL)
+        self.timer.timeout.connect(self.enforce)
+        self.timer.start()
+
+    def register(self, view):
+        if view not in self.views:
+            self.views.insert(0, view)
+
+    def unregister(self, view):
+        if view in self.views:
+            self.views.remove(view)
+
+    def touch(self, view):
+        """Mark `view` as the most recently shown one."""
+        self.unregister(view)
+        self.views.append(view)
+
+    def totalBytes(self):
+        return sum(view.cacheBytes() for view in self.views)
+
+    def enforce(self):
+        """Release caches until the budget is met (GUI thread).
+
+        The views that are not shown are released first, least recently
+        shown first; the shown views only release their read buffers and
+        keep the rows on screen and their header index.
+        """
+
+        total = self.totalBytes()
+        if Instrumentation.ENABLED:
+            Instrumentation.count('CacheBudget.checks')
+        if total <= self.maxBytes:
+            return
+        hidden = [view for view in self.views if not view.isVisible()]
+        shown = [view for view in self.views if view.isVisible()]
+        for view in hidden + shown:
+            total -= view.releaseCaches(shown=view.isVisible())
+            if total <= self.maxBytes:
+                break
+        if Instrumentation.ENABLED:
+            Instrumentation.count('CacheBudget.releases')
+
+
+class FileView(QWidget):
+    """
+    The dataset groups of one file (or of a TCP stream).
+
+    The groups are listed from the file's metadata; one `DatasetView` is
+    kept per group that has been shown.
+
+    :Parameters:
+
+    - `fileName`: the ISMRMRD file (ignored for streams)
+    - `follow`: open the file as SWMR reader (see `LiveTail`)
+    - `listen`: the ``[HOST:]PORT`` address to receive a stream on
+    - `streamMemory`: the memory of a stream (headers and payloads) in bytes
+    - `sessions`: the SessionCache restoring the views (None: disabled)
+    - `parent`: the parent of this widget
+
+    Errors opening the file are raised.
+    """
+
+    #: Emitted with the DatasetView of a group opened by `selectGroup`.
+    viewCreated = pyqtSignal(object)
+
+    #: Emitted with the DatasetView shown after the group was switched.
+    viewChanged = pyqtSignal(object)
+
+    #: Emitted with a message for the status bar.
+    statusMessage = pyqtSignal(str)
+
+    def __init__(self, fileName, follow=False, listen=None, streamMemory=None, sessions=None,
+                 parent=None):
+        super(FileView, self).__init__(parent)
+        self.fileName = fileName
+        self.follow = follow
+
+        # files being written and streams change, their views are not saved
+        self.sessions = sessions if listen is None and not follow else None
+        self.groups = []
+        self.liveTail = None
+        self.streamReceiver = None
+        self.streamStatus = None
+
+        # open the ISMRMRD file (read-only as SWMR reader in follow mode)
+        # or set up the ring buffer of a TCP stream
+        rbuffer = None
+        if listen is not None:
+            rbuffer = StreamIngest.StreamBuffer.withMemory(
+                streamMemory or StreamIngest.DEFAULT_MEMORY_BYTES)
+            self.dset = StreamIngest.StreamSource(StreamIngest.parseAddress(listen), rbuffer)
+            self.title = self.dset.name()
+            groupName = 'stream'
+        else:
+            self.title = fileName
+            self.dset = self.openGroup('dataset')
+            # dataset groups of the file (metadata only), the first one is
+            # shown if there is no '/dataset'
+            self.groups = findGroups(self.dset._file)
+            groupName = 'dataset'
+            if self.groups and 'dataset' not in [name for name, _ in self.groups]:
+                groupName = self.groups[0][0]
+                self.dset.close()
+                self.dset = self.openGroup(groupName)
+
+        # one view per dataset group (created when the group is selected)
+        self.views = {}
+        self.stack = QStackedWidget()
+        self.createView(groupName, self.dset, rbuffer)
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0,0,0,0)
+        self.groupCB = None
+        if len(self.groups) > 1:
+            self.groupCB = QComboBox()
+            for name, count in self.groups:
+                self.groupCB.addItem('/{0}  ({1} acquisitions)'.format(name, count), name)
+            self.groupCB.setCurrentIndex(self.groupCB.findData(groupName))
+            self.groupCB.currentIndexChanged.connect(self.selectGroup)
+            groupBox = QHBoxLayout()
+            groupBox.addWidget(QLabel('Dataset group:'))
+            groupBox.addWidget(self.groupCB)
+            groupBox.addStretch(1)
+            layout.addLayout(groupBox)
+        layout.addWidget(self.stack)
+
+        if listen is not None:
+            self.setupStream()
+        elif follow:
+            self.setupLiveTail()
+
+    def openGroup(self, name):
+        """Open the dataset group `name` of the file (read-only, so that the
+        modification time identifying the file in the session cache does not
+        change)."""
+        if self.follow:
+            return LiveTail.SWMRDataset(self.fileName, '/' + name)
+        return ismrmrd.Dataset(self.fileName, '/' + name, False, mode='r')
+
+    def createView(self, name, dset, rbuffer=None):
+        view = DatasetView.DatasetView(dset, rbuffer=rbuffer)
+        if self.sessions is not None:
+            # the state and the warm records saved when the file was closed
+            rbuffer = view.tableModel.rbuffer
+            view.session = self.sessions.load(self.fileName, name, rbuffer.data.dtype)
+            if view.session is not None and view.session.warmRecords is not None:
+                rbuffer.seedRecords(view.session.warmRows, view.session.warmRecords)
+        self.views[name] = view
+        self.stack.addWidget(view)
+        self.viewCreated.emit(view)
+        return view
+
+    def currentView(self):
+        return self.stack.currentWidget()
+
+    def selectGroup(self, index):
+        """Show the dataset group selected in the group combo box.
+
+        The views of the groups shown before are kept (with their buffers and
+        header indices), so switching back does not read anything again.
+        """
+
+        name = self.groupCB.itemData(index)
+        view = self.views.get(name)
+        if view is None:
+            try:
+                view = self.createView(name, self.openGroup(name))
+            except (OSError, KeyError, ValueError) as e:
+                self.statusMessage.emit('Could not open /{0}: {1}'.format(name, e))
+                return
+        self.stack.setCurrentWidget(view)
+        self.dset = view.dset
+        if self.liveTail is not None:
+            self.liveTail.setTarget(view.tableModel, view.tableView)
+        self.viewChanged.emit(view)
+
+    def setupStream(self):
+        # receive the acquisitions in the background, the table grows like
+        # the one of a file being written
+        self.streamReceiver = StreamIngest.StreamReceiver(self.dset, self)
+        self.streamReceiver.clientConnected.connect(
+            lambda peer: self.statusMessage.emit('Receiving from ' + peer))
+        self.streamReceiver.clientDisconnected.connect(
+            lambda: self.statusMessage.emit('Stream closed, waiting for connections'))
+        self.streamReceiver.error.connect(self.statusMessage)
+        self.streamStatus = StreamIngest.StreamStatus(self.dset.buffer)
+        self.streamReceiver.start()
+
+        self.setupLiveTail(autoScroll=True)
+
+    def setupLiveTail(self, autoScroll=False):
+        view = self.currentView()
+        self.liveTail = LiveTail.LiveTail(view.tableModel, view.tableView, parent=self)
+        self.liveTail.rowsAppended.connect(
+            lambda appended: self.currentView().filterBar.updateStatus())
+        self.liveTail.setAutoScroll(autoScroll)
+        self.liveTail.start()
+
+    def shutdown(self):
+        """Stop the background threads before the file is closed."""
+        if self.liveTail is not None:
+            self.liveTail.stop()
+        if self.streamReceiver is not None:
+            self.streamReceiver.stop()
+        for view in self.views.values():
+            view.shutdown()
+        if self.sessions is not None:
+            self.saveSessions()
+
+    def saveSessions(self):
+        """Save the state of the views in the session cache (after the
+        background threads have been stopped)."""
+        for name, view in self.views.items():
+            if not view.startupFinished:
+                # not restored yet, the saved state is still valid
+                continue
+            rows = view.warmRows()
+            try:
+                records = view.tableModel.rbuffer.readAcquisitions(rows)
+            except (OSError, ValueError):
+                rows = records = None
+            self.sessions.save(self.fileName, name, view.sessionState(), rows, records,
+                               view.headerIndex, view.session)
+
+    def closeFiles(self):
+        """Close the files of all opened groups (after `shutdown`)."""
+        for view in self.views.values():
+            if isinstance(view.dset, ismrmrd.Dataset):
+                view.dset.close()
@@ -0,0 +1,48 @@
+"""Shared fixtures of the tests: small ISMRMRD files written with h5py."""
+
+import h5py
+import pytest
+import SWMRWriter
+
+#: The XML header of the test files.
+XML = SWMRWriter.XML
+
+
+def acquisitionRecords(nrows, channels=2, samples=64, seed=0):
+    """Acquisition records with a scan counter, 32 phase encoding steps per
+    slice (4 slices) and complex noise as data (the acquisitions written by
+    the `SWMRWriter` tool)."""
+    return SWMRWriter.acquisitionRecords(0, nrows, channels, samples, seed)
+
+
+def writeAcquisitions(fileName, records, group='dataset', chunks=None, compression=None):
+    """Write an ISMRMRD group with the XML header and `records`."""
+    with h5py.File(fileName, 'a') as f:
+        g = f.create_group(group)
+        g.create_dataset('xml', (1,), dtype=h5py.special_dtype(vlen=bytes))[0] = XML
+        options = {}
+        if chunks is not None:
+            options = dict(chunks=(chunks,), maxshape=(None,), compression=compression)
+        g.create_dataset('data', data=records, **options)
+    return fileName
+
+
+@pytest.fixture
+def acquisitionFile(tmp_path):
+    """Factory writing ``tmp_path/<name>`` with `nrows` acquisitions and
+    returning its path (keyword arguments as `writeAcquisitions`)."""
+    def make(nrows=500, name='acquisitions.h5', records=None, **options):
+        if records is None:
+            records = acquisitionRecords(nrows)
+        return writeAcquisitions(str(tmp_path / name), records, **options)
+    return make
+
+
+@pytest.fixture(scope='session')
+def qapp():
+    """The QApplication of the widget tests (offscreen)."""
+    import os
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+    yield app
@@ -0,0 +1,93 @@
+"""Tests of the acquisition flags (`AcquisitionFlags`): bit counts, rows
+with a flag and the flag columns of the table model."""
+
+import numpy
+import ismrmrd
+import pytest
+from PyQt5.QtCore import Qt
+import AcquisitionFlags
+import HeaderIndex
+import ISMRMRDTableModel
+from conftest import acquisitionRecords
+
+NOISE = ismrmrd.ACQ_IS_NOISE_MEASUREMENT
+LAST = ismrmrd.ACQ_LAST_IN_SLICE
+
+#: the dataset rows carrying a flag (bit 40 has no name, bit 64 is the
+#: highest bit)
+FLAGGED = {NOISE: [3, 10, 40], LAST: [10, 100], 40: [200], 64: [10, 499]}
+
+
+@pytest.fixture
+def model(acquisitionFile, qapp):
+    records = acquisitionRecords(500)
+    flags = records['head']['flags']
+    for bit, rows in FLAGGED.items():
+        flags[rows] |= numpy.uint64(1) << numpy.uint64(bit - 1)
+    dset = ismrmrd.Dataset(acquisitionFile(records=records, chunks=64), '/dataset', False,
+                           mode='r')
+    model = ISMRMRDTableModel.TableModel(dset)
+    rbuffer = model.rbuffer
+    index = HeaderIndex.HeaderIndex(rbuffer.engine, rbuffer.total_nrows())
+    HeaderIndex.IndexBuilder(index).run()
+    model.setIndex(index)
+    yield model
+    dset.close()
+
+
+def test_flag_names():
+    assert AcquisitionFlags.flagName(NOISE) == 'ACQ_IS_NOISE_MEASUREMENT'
+    assert AcquisitionFlags.flagName(40) == 'bit 40'
+    assert AcquisitionFlags.flagNames((1 << (LAST - 1)) | (1 << 39)) == ['ACQ_LAST_IN_SLICE',
+                                                                         'bit 40']
+
+
+def test_bit_counts(model):
+    flags = AcquisitionFlags.FlagIndex(model.header_index)
+    # 0, noise, noise | last | bit 64, last, bit 40, bit 64
+    assert flags.values == 6
+    for bit in range(1, 65):
+        assert flags.counts[bit - 1] == len(FLAGGED.get(bit, []))
+    summary = dict((name, count) for _, name, count in flags.summary())
+    assert summary['ACQ_IS_NOISE_MEASUREMENT'] == 3 and summary['bit 40'] == 1
+    assert summary['ACQ_USER8'] == 2 and 'bit 41' not in summary
+    assert flags.isCurrent(model.header_index)
+
+
+def test_rows_and_steps(model):
+    flags = AcquisitionFlags.FlagIndex(model.header_index)
+    for bit, rows in FLAGGED.items():
+        assert flags.rows(bit).tolist() == rows
+
+    assert flags.step(NOISE, None, -1) == 3
+    assert flags.step(NOISE, None, 3) == 10
+    assert flags.step(NOISE, None, 40) is None
+    assert flags.step(NOISE, None, 499, forward=False) == 40
+    assert flags.step(NOISE, None, 10, forward=False) == 3
+    assert flags.step(NOISE, None, 3, forward=False) is None
+
+    # a model showing the dataset rows in reverse order
+    rowmap = numpy.arange(499, -1, -1)
+    assert flags.modelRows(NOISE, rowmap).tolist() == [459, 489, 496]
+    assert flags.modelRows(NOISE, rowmap) is flags.modelRows(NOISE, rowmap)
+    assert flags.step(NOISE, rowmap, 0) == 459
+    assert flags.step(NOISE, rowmap, 496) is None
+    assert flags.step(NOISE, rowmap, 459, forward=False) is None
+    assert flags.nbytes() > 0
+
+
+def test_flag_columns(model):
+    assert model.columnValues('ACQ_IS_NOISE_MEASUREMENT', [2, 3, 10, 11]).tolist() == \
+        [False, True, True, False]
+    assert numpy.flatnonzero(model.columnValues('bit 40', numpy.arange(500))).tolist() == [200]
+
+    model.setFlagColumns([LAST, 40])
+    names = [model.columnName(col) for col in range(model.columnCount())]
+    assert names[-2:] == ['ACQ_LAST_IN_SLICE', 'bit 40']
+
+    # filter by a flag and sort by a flag column
+    model.setFilter('flag(ACQ_IS_NOISE_MEASUREMENT)')
+    assert model.rowmap.tolist() == [3, 10, 40]
+    model.setFilter('~flag(ACQ_IS_NOISE_MEASUREMENT)')
+    model.sort(names.index('ACQ_LAST_IN_SLICE'), Qt.DescendingOrder)
+    assert model.rowmap[:1].tolist() == [100] and len(model.rowmap) == 497
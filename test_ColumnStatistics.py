@@ -0,0 +1,71 @@
+"""Tests of the column statistics: histogram bars and their filters."""
+
+import numpy
+import pytest
+import ColumnStatistics
+
+
+def selected(stats, values, bar):
+    """The number of values selected by the filter expression of a bar."""
+    mask = eval(stats.expression(bar), {'np': numpy, stats.name: values})
+    return int(numpy.count_nonzero(mask))
+
+
+def checkBars(stats, values):
+    assert stats.counts.sum() == len(values)
+    for bar in range(len(stats.counts)):
+        assert selected(stats, values, bar) == stats.counts[bar]
+
+
+def test_few_distinct_values():
+    values = numpy.array([3, 1, 3, 2, 3], dtype=numpy.uint16)
+    stats = ColumnStatistics.ColumnStats('slice', values)
+    assert stats.kind == 'values' and stats.unique == 3
+    assert stats.values.tolist() == [1, 2, 3] and stats.counts.tolist() == [1, 1, 3]
+    assert stats.expression(2) == 'slice == 3'
+    checkBars(stats, values)
+
+
+def test_integer_bins():
+    values = numpy.arange(1000, dtype=numpy.uint32)
+    stats = ColumnStatistics.ColumnStats('scan_counter', values)
+    assert stats.kind == 'bins'
+    assert len(stats.counts) == 63 and stats.counts[0] == 16 and stats.counts[-1] == 8
+    assert stats.label(0) == '0-15' and stats.label(62) == '992-999'
+    checkBars(stats, values)
+
+
+@pytest.mark.parametrize('first', [2 ** 63 - 500, 2 ** 64 - 1000])
+def test_uint64_bins_near_the_int64_limit(first):
+    values = numpy.arange(1000, dtype=numpy.uint64) + numpy.uint64(first)
+    stats = ColumnStatistics.ColumnStats('flags', values)
+    assert stats.kind == 'bins'
+    assert stats.edges[0] == first
+    assert stats.label(0) == '{0}-{1}'.format(first, first + 15)
+    assert stats.label(len(stats.counts) - 1).endswith('-{0}'.format(first + 999))
+    checkBars(stats, values)
+
+
+def test_int64_bins_over_the_whole_range():
+    values = numpy.concatenate((numpy.arange(-100, 100), [-2 ** 63, 2 ** 63 - 1])).astype(numpy.int64)
+    stats = ColumnStatistics.ColumnStats('offset', values)
+    assert stats.kind == 'bins'
+    assert stats.counts[0] == 1 and stats.counts[-1] == 1
+    checkBars(stats, values)
+
+
+def test_float_bins():
+    values = numpy.linspace(-1, 1, 500, dtype=numpy.float32)
+    stats = ColumnStatistics.ColumnStats('sample_time_us', values)
+    assert stats.kind == 'bins' and len(stats.counts) == ColumnStatistics.MAX_BARS
+    checkBars(stats, values)
+
+
+def test_most_frequent_vectors():
+    values = numpy.zeros((200, 3), dtype=numpy.float32)
+    values[:, 0] = numpy.arange(200) % 100
+    values[:10, 0] = 7
+    stats = ColumnStatistics.ColumnStats('position', values)
+    assert stats.kind == 'most frequent' and stats.vector
+    assert stats.values[0].tolist() == [7, 0, 0] and stats.counts[0] == 11
+    assert len(stats.counts) == ColumnStatistics.MAX_BARS
@@ -0,0 +1,51 @@
+"""Tests of the storage layout inspection (`DatasetLayout`) and the header sidecar."""
+
+import h5py
+import numpy
+import DatasetLayout
+import Rechunk
+
+
+def test_describe_labels_the_vlen_payload(tmp_path):
+    dtype = numpy.dtype([('head', numpy.int32, (4,)),
+                         ('data', h5py.vlen_dtype(numpy.float32))])
+    with h5py.File(str(tmp_path / 'vlen.h5'), 'w') as f:
+        dataset = f.create_dataset('data', shape=(100,), dtype=dtype, chunks=(10,),
+                                   compression='gzip')
+        records = numpy.zeros(100, dtype=dtype)
+        for row in range(100):
+            records['data'][row] = numpy.zeros(1000, numpy.float32)
+        dataset[:] = records
+        info = dict(DatasetLayout.DatasetLayout(dataset).describe())
+
+    assert 'Compression ratio' not in info
+    assert 'Compression ratio (records only)' in info
+    assert info['Variable length payload'] == 'data: global heap, not compressed'
+
+
+def test_describe_fixed_size_records(tmp_path):
+    with h5py.File(str(tmp_path / 'fixed.h5'), 'w') as f:
+        dataset = f.create_dataset('data', data=numpy.zeros((100, 4), numpy.int32),
+                                   chunks=(10, 4), compression='gzip')
+        info = dict(DatasetLayout.DatasetLayout(dataset).describe())
+
+    assert float(info['Compression ratio']) > 1
+    assert 'Variable length payload' not in info
+
+
+def test_sidecar_is_ignored_once_the_headers_change(acquisitionFile, tmp_path):
+    target = str(tmp_path / 'rechunked.h5')
+    Rechunk.rechunk(acquisitionFile(300), target, chunkRows=64)
+
+    def sidecar():
+        with h5py.File(target, 'r') as f:
+            group = f['dataset']
+            return DatasetLayout.openSidecar(group, 'data', group['data']) is not None
+
+    assert sidecar()
+    with h5py.File(target, 'a') as f:
+        data = f['dataset/data']
+        record = data[299]
+        record['head']['idx']['slice'] = 3
+        data[299] = record
+    assert not sidecar()
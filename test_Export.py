@@ -0,0 +1,83 @@
+"""Tests of the export of acquisition subsets."""
+
+import numpy
+import h5py
+import pytest
+from PyQt5.QtWidgets import QMessageBox
+import Export
+import ReadEngine
+import Workspace
+
+
+def test_coalesce_runs():
+    rows = [40, 3, 4, 5, 5, 20, 100, 101, 103]
+    batches = Export.coalesce(rows, maxGap=20, maxRows=100)
+    assert [(start, stop) for start, stop, _ in batches] == [(3, 41), (100, 104)]
+    assert batches[0][2].tolist() == [3, 4, 5, 20, 40]
+    assert batches[1][2].tolist() == [100, 101, 103]
+    assert Export.coalesce([]) == []
+
+
+def test_coalesce_splits_long_runs():
+    batches = Export.coalesce(numpy.arange(0, 1000, 2), maxGap=1, maxRows=300)
+    assert [(start, stop) for start, stop, _ in batches] == [(0, 299), (300, 599),
+                                                             (600, 899), (900, 999)]
+    assert sum(len(rows) for _, _, rows in batches) == 500
+    assert all(stop - start <= 300 for start, stop, _ in batches)
+
+
+@pytest.mark.parametrize('compression,workers', [(None, 1), ('gzip', 1), ('gzip', 2)])
+def test_export_rows(acquisitionFile, tmp_path, monkeypatch, compression, workers):
+    # compressed blocks are read by the worker processes of the ReadEngine
+    monkeypatch.setattr(ReadEngine, 'workerCount', lambda: workers)
+    source = acquisitionFile(500, chunks=64, compression=compression)
+    target = str(tmp_path / 'subset.h5')
+    rows = numpy.array([499, 3, 4, 200, 201, 250])
+    worker = Export.ExportWorker(h5py.File(source, 'r'), '/dataset/data', rows, target)
+    worker.run()
+    assert worker.error is None and worker.written == 6
+
+    with h5py.File(source, 'r') as f, h5py.File(target, 'r') as out:
+        data = out['dataset/data']
+        assert data.compression == compression
+        assert out['dataset/xml'][0] == f['dataset/xml'][0]
+        expected = f['dataset/data'][numpy.sort(rows)]
+        assert (data['head'] == expected['head']).all()
+        assert numpy.array_equal(data[5]['data'], expected[5]['data'])
+    ReadEngine.shutdownPool()
+
+
+def test_overwrite_is_confirmed(acquisitionFile, tmp_path, qapp, monkeypatch):
+    fileView = Workspace.FileView(acquisitionFile(100))
+    target = tmp_path / 'exists.h5'
+    target.write_bytes(b'keep')
+    questions = []
+    answer = [QMessageBox.No]
+    monkeypatch.setattr(QMessageBox, 'question',
+                        lambda *args: questions.append(args[2]) or answer[0])
+    try:
+        dialog = Export.ExportDialog(fileView.currentView())
+        dialog.fileEdit.setText(str(target))
+        dialog.export()
+        assert len(questions) == 1 and dialog.worker is None
+        assert target.read_bytes() == b'keep'
+
+        answer[0] = QMessageBox.Yes
+        dialog.export()
+        worker = dialog.worker
+        worker.wait()
+        qapp.processEvents()
+        assert worker.error is None, worker.error
+        assert len(questions) == 2
+        with h5py.File(str(target), 'r') as out:
+            assert len(out['dataset/data']) == 100
+
+        # a file chosen in the file dialog is not asked for again
+        dialog.confirmedName = str(target)
+        dialog.export()
+        dialog.worker.wait()
+        assert len(questions) == 2
+        dialog.done(0)
+    finally:
+        fileView.shutdown()
+        fileView.closeFiles()
@@ -0,0 +1,71 @@
+"""Tests of the header diff: row matching and the comparison worker."""
+
+import numpy
+import h5py
+from conftest import acquisitionRecords
+import HeaderDiff
+
+
+def test_match_by_scan_counter():
+    headsA = acquisitionRecords(10)['head']
+    # B: rows 2 and 7 missing, the others in reverse order, one extra row
+    headsB = numpy.concatenate((headsA[[0, 1, 3, 4, 5, 6, 8, 9]][::-1],
+                                acquisitionRecords(11)['head'][10:]))
+    rowsA, rowsB, onlyA, onlyB, method = HeaderDiff.alignRows(headsA, headsB)
+    assert method == 'scan_counter'
+    assert rowsA.tolist() == [0, 1, 3, 4, 5, 6, 8, 9]
+    assert (headsB['scan_counter'][rowsB] == headsA['scan_counter'][rowsA]).all()
+    assert onlyA.tolist() == [2, 7] and onlyB.tolist() == [8]
+
+
+def test_match_by_row_if_scan_counters_repeat():
+    headsA = acquisitionRecords(6)['head']
+    headsA['scan_counter'] = 0
+    headsB = headsA[:4].copy()
+    rowsA, rowsB, onlyA, onlyB, method = HeaderDiff.alignRows(headsA, headsB)
+    assert method == 'row'
+    assert rowsA.tolist() == rowsB.tolist() == [0, 1, 2, 3]
+    assert onlyA.tolist() == [4, 5] and onlyB.tolist() == []
+
+
+def test_differing_columns():
+    headsA = acquisitionRecords(20)['head']
+    headsB = headsA[::-1].copy()
+    headsB['idx']['slice'][headsB['scan_counter'] == 5] = 3
+    headsB['position'][headsB['scan_counter'] == 12] = (1, 0, 0)
+    diff = HeaderDiff.HeaderDiff(headsA, headsB)
+    assert diff.columns == ['position', 'slice']
+    assert diff.counts == {'position': 1, 'slice': 1}
+    assert diff.rowsA[diff.diffPairs].tolist() == [5, 12]
+    assert diff.value(0, diff.pairs['slice'][0], 'slice') == '0'
+    assert diff.value(1, diff.pairs['slice'][0], 'slice') == '3'
+    assert diff.summary() == '20 matched acquisitions (by scan counter), 2 differ'
+
+
+def test_worker_compares_files(acquisitionFile, qapp):
+    recordsB = acquisitionRecords(300)
+    recordsB['head']['idx']['slice'][10] = 3
+    recordsB[20]['data'] = recordsB[20]['data'] + 1
+    fileA = acquisitionFile(300, name='a.h5', chunks=64)
+    fileB = acquisitionFile(name='b.h5', records=recordsB)
+
+    # the files as opened by the GUI thread
+    openA, openB = h5py.File(fileA, 'r'), h5py.File(fileB, 'r')
+    sources = [HeaderDiff.DiffSource.fromFile('A', openA, 'dataset'),
+               HeaderDiff.DiffSource.fromFile('B', openB, 'dataset')]
+    try:
+        worker = HeaderDiff.DiffWorker(sources[0], sources[1], payload=True)
+        worker.start()
+        worker.wait()
+        assert worker.error is None
+        diff = worker.result
+        assert diff.columns == ['slice', HeaderDiff.PAYLOAD_COLUMN]
+        assert diff.rowsA[diff.pairs['slice']].tolist() == [10]
+        assert diff.rowsA[diff.pairs[HeaderDiff.PAYLOAD_COLUMN]].tolist() == [20]
+    finally:
+        for source in sources:
+            source.close()
+    assert all(source.h5file is None for source in sources)
+    assert openA['dataset/data'].shape == (300,)
+    openA.close()
+    openB.close()
@@ -0,0 +1,94 @@
+"""Tests of the header index: filter expressions and sorting."""
+
+import numpy
+import ismrmrd
+import pytest
+from PyQt5.QtCore import Qt
+import HeaderIndex
+import ISMRMRDTableModel
+
+
+def buildIndex(model):
+    """Attach a header index to the model and fill it in this thread."""
+    rbuffer = model.rbuffer
+    index = HeaderIndex.HeaderIndex(rbuffer.engine, rbuffer.total_nrows())
+    HeaderIndex.IndexBuilder(index).run()
+    model.setIndex(index)
+    return index
+
+
+@pytest.fixture
+def model(acquisitionFile, qapp):
+    dset = ismrmrd.Dataset(acquisitionFile(500, chunks=64), '/dataset', False, mode='r')
+    model = ISMRMRDTableModel.TableModel(dset)
+    buildIndex(model)
+    yield model
+    dset.close()
+
+
+def test_filter_expression(model):
+    index = model.header_index
+    rows = index.indexedRows()
+    assert index.isComplete() and len(rows) == 500
+
+    mask = index.evaluate('(slice == 1) & (kspace_encode_step_1 < 4)', rows)
+    assert numpy.array_equal(numpy.flatnonzero(mask), numpy.arange(32, 36).tolist() +
+                             numpy.arange(160, 164).tolist() + numpy.arange(288, 292).tolist() +
+                             numpy.arange(416, 420).tolist())
+    assert numpy.array_equal(numpy.flatnonzero(index.evaluate('isin(row, [3, 7])', rows)), [3, 7])
+    assert index.evaluate('np.abs(row - 10) < 2', rows).sum() == 3
+
+
+def test_filter_rejects_attributes_and_unknown_names(model):
+    index = model.header_index
+    rows = index.indexedRows()
+    for expression in ('slice.tofile("x")', 'np.load("x")', '__import__("os")',
+                       'row.__class__', 'open("x")'):
+        with pytest.raises((ValueError, NameError)):
+            index.evaluate(expression, rows)
+
+
+def test_model_filter_and_sort(model):
+    model.setFilter('slice == 2')
+    assert model.leaf_numrows == 128
+    assert (model.header_index.column('slice', model.rowmap) == 2).all()
+
+    column = model.colnames.index('kspace_encode_step_1')
+    model.sort(column, Qt.AscendingOrder)
+    steps = model.header_index.column('kspace_encode_step_1', model.rowmap)
+    assert (numpy.diff(steps.astype(int)) >= 0).all()
+    # stable: equal keys keep the dataset order
+    assert numpy.array_equal(model.rowmap[:4], [64, 192, 320, 448])
+
+    model.sort(column, Qt.DescendingOrder)
+    steps = model.header_index.column('kspace_encode_step_1', model.rowmap)
+    assert (numpy.diff(steps.astype(int)) <= 0).all() and steps[0] == 31
+
+    model.sort(-1)
+    model.setFilter('')
+    assert model.rowmap is None and model.leaf_numrows == 500
+
+
+def test_growing_index_keeps_the_filtered_rows(acquisitionFile, qapp):
+    dset = ismrmrd.Dataset(acquisitionFile(500, chunks=64), '/dataset', False, mode='r')
+    model = ISMRMRDTableModel.TableModel(dset)
+    rbuffer = model.rbuffer
+    index = HeaderIndex.HeaderIndex(rbuffer.engine, rbuffer.total_nrows())
+    model.setIndex(index)
+
+    # index the first blocks only, then the rest: the row map is extended
+    # without a model reset
+    blocks = index.missing()
+    first = blocks[:len(blocks) // 2]
+    for start, stop, block in rbuffer.engine.map(ranges=first, fields=['head']):
+        index.records['head'][start:stop] = block['head']
+        index.markIndexed(start, stop)
+    model.setFilter('slice == 0')
+    partial = model.leaf_numrows
+    resets = []
+    model.modelAboutToBeReset.connect(lambda: resets.append(True))
+    HeaderIndex.IndexBuilder(index).run()
+    model.updateRowMap(keep_position=True)
+    assert not resets
+    assert model.leaf_numrows == 128 and model.leaf_numrows > partial
+    dset.close()
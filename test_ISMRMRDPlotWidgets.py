@@ -0,0 +1,72 @@
+"""Tests of the acquisition plots (`ISMRMRDPlotWidgets`)."""
+
+import numpy
+from ismrmrd.hdf5 import acquisition_header_dtype
+import ISMRMRDPlotWidgets
+
+
+def header(channels, samples, dimensions=0):
+    head = numpy.zeros((), dtype=acquisition_header_dtype)
+    head['active_channels'] = channels
+    head['number_of_samples'] = samples
+    head['trajectory_dimensions'] = dimensions
+    return head
+
+
+def test_aggregate_limit_by_payload_size():
+    assert ISMRMRDPlotWidgets.aggregateLimit(header(2, 64)) == ISMRMRDPlotWidgets.MAX_AGGREGATE_ROWS
+    assert ISMRMRDPlotWidgets.aggregateLimit(header(2, 64), 32) == 32
+    # 32 channels of 2048 samples and a 3D trajectory: 548 kB per acquisition
+    limit = ISMRMRDPlotWidgets.aggregateLimit(header(32, 2048, 3))
+    assert limit == ISMRMRDPlotWidgets.MAX_AGGREGATE_BYTES // (8 * 32 * 2048 + 4 * 3 * 2048)
+    assert ISMRMRDPlotWidgets.aggregateLimit(header(0, 0)) == ISMRMRDPlotWidgets.MAX_AGGREGATE_ROWS
+    assert ISMRMRDPlotWidgets.aggregateLimit(header(1024, 2 ** 16 - 1)) == 1
+
+
+def test_reset_plot_keeps_the_legend(qapp, capsys):
+    import pyqtgraph
+    ISMRMRDPlotWidgets.pg = pyqtgraph
+    plot = pyqtgraph.PlotWidget()
+    widget = ISMRMRDPlotWidgets.ISMRMRDPlotWidget
+    for title in ('first', 'second'):
+        widget.resetPlot(None, plot, title)
+        widget.plotLines(None, plot, numpy.zeros((3, 8)))
+        legend = plot.getPlotItem().legend
+        assert legend is not None and legend.scene() is plot.scene()
+        assert len(legend.items) == 3 and len(plot.listDataItems()) == 3
+    assert capsys.readouterr().out == ''
+
+
+def test_selection_evicted_from_stream(qapp):
+    import socket
+    import Workspace
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        port = s.getsockname()[1]
+    # room for the payloads of about 60 acquisitions
+    fileView = Workspace.FileView(None, listen=str(port), streamMemory=2 ** 16)
+    try:
+        view = fileView.currentView()
+        rbuffer = view.tableModel.rbuffer
+        head = header(2, 64)
+        payload = numpy.ones(2 * 2 * 64, numpy.float32).view(numpy.uint8)
+        for counter in range(100):
+            head['scan_counter'] = counter
+            offset = rbuffer.reserve(len(payload))
+            rbuffer.arena[offset:offset + len(payload)] = payload
+            rbuffer.commit(head, offset, len(payload))
+        rbuffer.refresh()
+        first = rbuffer.first_row
+        assert 0 < first < 90
+        plot = view.plotWidget
+        plot.createPlots()
+
+        # the first selected rows are gone, the others are plotted
+        plot.plotSelection(numpy.arange(first - 5, first + 5), 'Mean', 'Magnitude', '')
+        assert not plot.rawPlot.isHidden()
+        assert 'mean of 5 of 10 acquisitions' in plot.rawPlot.getPlotItem().titleLabel.text
+
+        # all selected rows are gone (the current acquisition is plotted)
+        plot.plotSelection(numpy.arange(first - 10, first), 'Mean', 'Magnitude', '')
+    finally:
+        fileView.shutdown()
@@ -0,0 +1,69 @@
+"""Tests of the waveform tab: time alignment with the acquisitions."""
+
+import numpy
+import h5py
+import ismrmrd
+import pytest
+from ismrmrd.hdf5 import waveform_dtype
+import ISMRMRDTableModel, ISMRMRDTableView
+import ISMRMRDWaveforms
+
+
+@pytest.fixture
+def waveformTab(acquisitionFile, qapp):
+    fileName = acquisitionFile(500, chunks=64)
+    waveforms = numpy.zeros(100, dtype=waveform_dtype)
+    waveforms['head']['time_stamp'] = numpy.arange(100) * 10 + 1
+    waveforms['head']['number_of_samples'] = 4
+    waveforms['head']['channels'] = 1
+    for row in range(100):
+        waveforms[row]['data'] = numpy.zeros(4, numpy.uint32)
+    with h5py.File(fileName, 'a') as f:
+        f['dataset'].create_dataset('waveforms', data=waveforms)
+
+    dset = ismrmrd.Dataset(fileName, '/dataset', False, mode='r')
+    acqModel = ISMRMRDTableModel.TableModel(dset)
+    acqView = ISMRMRDTableView.TableView(acqModel)
+    tab = ISMRMRDWaveforms.WaveformTab(dset, acqModel, acqView)
+    yield tab
+    tab.shutdown()
+    dset.close()
+
+
+def waitForStamps(tab, qapp):
+    for builder in list(tab.stampBuilders.values()):
+        builder.wait()
+    qapp.processEvents()
+
+
+def test_alignment_is_built_in_the_background(waveformTab, qapp):
+    tab = waveformTab
+    # the acquisitions have no header index: the time stamps are read by a
+    # builder thread
+    tab.tableView.selectRow(3)
+    assert tab.alignLabel.text() == 'Aligning...'
+    assert 'acquisition_time_stamp' in tab.stampBuilders
+
+    waitForStamps(tab, qapp)
+    assert not tab.stampBuilders
+    # waveform time stamp 31: acquisition 15 (30) and 16 (32) are as close,
+    # the earlier one is taken
+    assert 'nearest acquisition 15 ' in tab.alignLabel.text()
+
+    requested = []
+    tab.acquisitionRequested.connect(requested.append)
+    tab.goToAcquisition()
+    assert requested == [15]
+
+
+def test_go_to_acquisition_time_waits_for_the_stamps(waveformTab, qapp):
+    tab = waveformTab
+    tab.headerIndex.cancel()
+    tab.tableModel.setIndex(None)
+    tab.acqView.selectRow(100)  # acquisition time stamp 200
+
+    tab.goToAcquisitionTime()
+    assert tab.pendingAction is not None
+    waitForStamps(tab, qapp)
+    assert tab.pendingAction is None
+    assert tab.tableView.currentIndex().row() == 20  # waveform time stamp 201
@@ -0,0 +1,30 @@
+"""Tests of the timing probes (`Instrumentation`)."""
+
+import Instrumentation
+
+
+def test_profiling_requested_by_environment():
+    for value in ('1', 'true', 'yes', 'on'):
+        assert Instrumentation.profilingRequested({'ISMRMRDVIEWER_PROFILE': value}, [])
+    for value in ('', '0', 'false', 'FALSE', 'no', 'off', ' 0 '):
+        assert not Instrumentation.profilingRequested({'ISMRMRDVIEWER_PROFILE': value}, [])
+    assert not Instrumentation.profilingRequested({}, ['viewer.py'])
+
+
+def test_profiling_requested_by_command_line():
+    assert Instrumentation.profilingRequested({'ISMRMRDVIEWER_PROFILE': '0'},
+                                              ['viewer.py', '--profile'])
+
+
+def test_histogram_text():
+    stats = Instrumentation.ProbeStats('test')
+    assert stats.histogramText() == ''
+    for _ in range(10):
+        stats.add(10e-6)
+    stats.add(1e-3)
+    text = stats.histogramText()
+    # buckets 8-16us ... 512-1024us, the fullest bucket is the first one
+    assert text.startswith('8us-1ms ')
+    bars = text.split(' ', 1)[1]
+    assert len(bars) == 7
+    assert bars[0] == '@' and bars[-1] != ' ' and set(bars[1:-1]) == {' '}
@@ -0,0 +1,74 @@
+"""Tests of the follow mode (`LiveTail`) with a file written by `SWMRWriter`."""
+
+import os
+import sys
+import subprocess
+import pytest
+import Workspace
+
+pytestmark = pytest.mark.usefixtures('qapp')
+
+
+@pytest.fixture(params=[100])
+def writer(tmp_path, request):
+    """A SWMRWriter process writing `request.param` acquisitions and
+    appending 50 acquisitions per line written to it."""
+    fileName = str(tmp_path / 'growing.h5')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(__file__), 'SWMRWriter.py'), fileName,
+         '--rows', str(request.param), '--append', '50', '--stdin', '--count', '0'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    assert process.stdout.readline().strip() == 'ready'
+
+    def append():
+        process.stdin.write('\n')
+        process.stdin.flush()
+        return int(process.stdout.readline())
+
+    yield fileName, append
+    process.stdin.close()
+    process.wait(timeout=30)
+    process.stdout.close()
+
+
+def test_poll_shows_appended_rows(writer):
+    fileName, append = writer
+    fileView = Workspace.FileView(fileName, follow=True)
+    try:
+        fileView.liveTail.stop()
+        view = fileView.currentView()
+        appended = []
+        fileView.liveTail.rowsAppended.connect(appended.append)
+        assert view.tableModel.leaf_numrows == 100
+
+        fileView.liveTail.poll()
+        assert appended == []
+
+        for total in (150, 200):
+            assert append() == total
+            fileView.liveTail.poll()
+            assert view.tableModel.leaf_numrows == total
+            rbuffer = view.tableModel.rbuffer
+            record = rbuffer.readAcquisitions([total - 1])[0]
+            assert record['head']['scan_counter'] == total - 1
+            assert len(record['data']) == 2 * 2 * 64
+        assert appended == [50, 50]
+    finally:
+        fileView.shutdown()
+
+
+@pytest.mark.parametrize('writer', [0], indirect=True)
+def test_follow_file_without_acquisitions(writer):
+    fileName, append = writer
+    fileView = Workspace.FileView(fileName, follow=True)
+    try:
+        fileView.liveTail.stop()
+        view = fileView.currentView()
+        assert view.tableModel.leaf_numrows == 0
+
+        assert append() == 50
+        fileView.liveTail.poll()
+        assert view.tableModel.leaf_numrows == 50
+        assert view.tableModel.rbuffer.chunk['head']['scan_counter'].tolist() == list(range(50))
+    finally:
+        fileView.shutdown()
@@ -0,0 +1,40 @@
+"""Tests of the cine playback pipeline (`Playback`)."""
+
+import numpy
+import pytest
+import Playback
+from conftest import acquisitionRecords
+
+pytestmark = pytest.mark.usefixtures('qapp')
+
+
+def transformed(records, rawMode='Magnitude'):
+    """Run the transform stage on `records` (queued at positions 0, 1, ...)
+    and return the Playback."""
+    playback = Playback.Playback(None, numpy.arange(len(records)), 0, 100, rawMode, '')
+    for position, record in enumerate(records):
+        playback.records.put((position, position, record))
+    playback.records.put(None)
+    playback.transform.run()
+    return playback
+
+
+def test_transform_drops_bad_records():
+    records = acquisitionRecords(4)
+    # an odd number of floats is not complex data
+    records[2]['data'] = numpy.zeros(3, numpy.float32)
+    playback = transformed(list(records))
+    assert [frame.position for frame in playback.frames] == [0, 1, 3]
+    assert playback.frames[0].raw.shape == (2, 64)
+    assert playback.dropped == 1
+    assert playback.transformDone and playback.error is None
+
+
+def test_transform_error_stops_the_playback(monkeypatch):
+    def fail(*args):
+        raise RuntimeError('plotting failed')
+    monkeypatch.setattr(Playback, 'transformRecord', fail)
+    playback = transformed(list(acquisitionRecords(2)))
+    assert not playback.frames
+    assert str(playback.error) == 'plotting failed'
+    assert playback.transformDone
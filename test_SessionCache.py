@@ -0,0 +1,63 @@
+"""Tests of the session cache (`SessionCache`): saving and loading entries."""
+
+import os
+import numpy
+import ismrmrd
+import pytest
+import HeaderIndex
+import ISMRMRDTableModel
+import SessionCache
+
+pytestmark = pytest.mark.usefixtures('qapp')
+
+
+@pytest.fixture
+def dataset(acquisitionFile):
+    fileName = acquisitionFile(500, chunks=64)
+    dset = ismrmrd.Dataset(fileName, '/dataset', False, mode='r')
+    yield fileName, dset
+    dset.close()
+
+
+def test_round_trip(dataset, tmp_path):
+    fileName, dset = dataset
+    model = ISMRMRDTableModel.TableModel(dset)
+    rbuffer = model.rbuffer
+    index = HeaderIndex.HeaderIndex(rbuffer.engine, rbuffer.total_nrows())
+    HeaderIndex.IndexBuilder(index).run()
+    rows = numpy.array([3, 64, 499])
+    records = rbuffer.readAcquisitions(rows)
+
+    cache = SessionCache.SessionCache(str(tmp_path / 'cache'))
+    cache.save(fileName, 'dataset', {'top': 3, 'filter': 'slice == 1'}, rows, records, index)
+    session = cache.load(fileName, 'dataset', rbuffer.data.dtype)
+    assert session.state == {'top': 3, 'filter': 'slice == 1',
+                             'version': SessionCache.STATE_VERSION}
+    assert session.warmRows.tolist() == rows.tolist()
+    assert session.warmRecords['head'].tobytes() == records['head'].tobytes()
+    for name in ('traj', 'data'):
+        for saved, record in zip(session.warmRecords[name], records[name]):
+            assert numpy.array_equal(saved, record)
+
+    heads, filled = session.loadIndex(index.total, index.blockRows)
+    assert heads.tobytes() == index.records['head'].tobytes()
+    assert filled.tolist() == index.filled.tolist()
+    assert session.indexedRows == 500
+
+    # a changed file does not use the entry
+    os.utime(fileName, ns=(0, 0))
+    assert cache.load(fileName, 'dataset', rbuffer.data.dtype) is None
+
+
+def test_large_index_is_not_saved(dataset, tmp_path, monkeypatch):
+    fileName, dset = dataset
+    rbuffer = ISMRMRDTableModel.TableModel(dset).rbuffer
+    index = HeaderIndex.HeaderIndex(rbuffer.engine, rbuffer.total_nrows())
+    HeaderIndex.IndexBuilder(index).run()
+    monkeypatch.setattr(SessionCache, 'MAX_INDEX_BYTES', index.nbytes() - 1)
+
+    cache = SessionCache.SessionCache(str(tmp_path / 'cache'))
+    cache.save(fileName, 'dataset', {}, index=index)
+    session = cache.load(fileName, 'dataset', rbuffer.data.dtype)
+    assert session.warmRecords is None
+    assert session.loadIndex(index.total, index.blockRows) is None
@@ -0,0 +1,64 @@
+"""Tests of the spike detection (`SpikeDetector`)."""
+
+import numpy
+import h5py
+import ismrmrd
+import ISMRMRDTableModel, ISMRMRDTableView
+import SpikeDetector
+from ReadEngine import ReadEngine
+from conftest import acquisitionRecords
+
+#: (row, channel, sample) of the injected spikes
+SPIKES = [(17, 1, 10), (200, 0, 50), (301, 1, 3)]
+
+
+def spikyRecords(nrows=400):
+    records = acquisitionRecords(nrows)
+    for row, channel, sample in SPIKES:
+        data = records[row]['data'].view(numpy.complex64).reshape(2, 64)
+        data[channel, sample] = 100 + 100j
+    # the echo peak is not a spike
+    records[5]['data'].view(numpy.complex64).reshape(2, 64)[0, 33] = 100
+    # a payload not matching its header is not scored
+    records[7]['data'] = numpy.zeros(10, numpy.float32)
+    return records
+
+
+def checkScores(scores, channels, samples):
+    rows = [row for row, _, _ in SPIKES]
+    assert numpy.isnan(scores[7])
+    flagged = numpy.flatnonzero(scores >= SpikeDetector.DEFAULT_THRESHOLD)
+    assert flagged.tolist() == rows
+    assert channels[rows].tolist() == [channel for _, channel, _ in SPIKES]
+    assert samples[rows].tolist() == [sample for _, _, sample in SPIKES]
+
+
+def test_scores_in_groups(monkeypatch):
+    records = spikyRecords()
+    checkScores(*SpikeDetector._spikeScores(records))
+    # 3 acquisitions (2 x 64 samples) scored at once
+    monkeypatch.setattr(SpikeDetector, 'BLOCK_SAMPLES', 3 * 128)
+    assert SpikeDetector.blockRows(2, 64) == 3
+    checkScores(*SpikeDetector._spikeScores(records))
+
+
+def test_detect_spikes(acquisitionFile):
+    fileName = acquisitionFile(records=spikyRecords(), chunks=64)
+    with h5py.File(fileName, 'r') as f:
+        result = SpikeDetector.detectSpikes(ReadEngine(f['dataset/data']))
+    assert len(result.scores) == 400
+    checkScores(result.scores, result.channels, result.samples)
+    flagged = result.flagged(SpikeDetector.DEFAULT_THRESHOLD)
+    assert sorted(flagged.tolist()) == [17, 200, 301]
+    assert (numpy.diff(result.scores[flagged]) <= 0).all()
+
+
+def test_markers_without_tricky_scrollbar(acquisitionFile, qapp):
+    dset = ismrmrd.Dataset(acquisitionFile(100), '/dataset', False, mode='r')
+    try:
+        view = ISMRMRDTableView.TableView(ISMRMRDTableModel.TableModel(dset))
+        assert view.tricky_vscrollbar is None
+        view.setMarkedRows([0, 33, 99])
+        assert view.vscrollbar.markers.tolist() == [0.0, 1 / 3, 1.0]
+    finally:
+        dset.close()
@@ -0,0 +1,73 @@
+"""Tests of the stream ingest (`StreamIngest`) with a `StreamSender` client."""
+
+import os
+import sys
+import time
+import socket
+import subprocess
+import numpy
+import pytest
+import StreamIngest
+import StreamSender
+
+pytestmark = pytest.mark.usefixtures('qapp')
+
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def receive(buffer, count):
+    """Send `count` acquisitions with the StreamSender tool to a receiver
+    filling `buffer` and return the StreamSource."""
+    source = StreamIngest.StreamSource(('localhost', freePort()), buffer)
+    receiver = StreamIngest.StreamReceiver(source)
+    receiver.start()
+    try:
+        sender = os.path.join(os.path.dirname(__file__), 'StreamSender.py')
+        subprocess.run([sys.executable, sender, '{0}:{1}'.format(*source.address),
+                        '--count', str(count), '--rate', '0'], check=True, timeout=60)
+        deadline = time.perf_counter() + 10
+        while buffer.next < count and time.perf_counter() < deadline:
+            time.sleep(0.01)
+    finally:
+        receiver.stop()
+    return source
+
+
+def test_memory_budget_includes_the_header_table():
+    for nbytes in (2 ** 20, 16 * 2 ** 20, StreamIngest.DEFAULT_MEMORY_BYTES):
+        buffer = StreamIngest.StreamBuffer.withMemory(nbytes)
+        assert buffer.nbytes() <= nbytes
+        assert buffer.capacity <= StreamIngest.DEFAULT_ROWS
+        assert buffer.heads.nbytes < nbytes * StreamIngest.HEADER_SHARE
+
+
+def test_receive_from_sender():
+    buffer = StreamIngest.StreamBuffer.withMemory(4 * 2 ** 20)
+    source = receive(buffer, 200)
+    assert source.xml == StreamSender.XML
+    assert buffer.refresh() == 200 and buffer.evicted == 0
+
+    records = buffer.readAcquisitions([0, 57, 199])
+    assert records['head']['scan_counter'].tolist() == [0, 57, 199]
+    data = records['data'][1].view(numpy.complex64)
+    assert data.shape == (4 * 128,) and (data == 57 + 1j).all()
+    assert len(records['traj'][1]) == 2 * 128
+
+
+def test_oldest_acquisitions_are_evicted():
+    # room for the payloads of about 10 acquisitions
+    buffer = StreamIngest.StreamBuffer.withMemory(64 * 2 ** 10)
+    receive(buffer, 100)
+    live = buffer.refresh()
+    assert 0 < live < 100 and buffer.evicted == 100 - live
+    assert buffer.dropped == 0
+
+    buffer.readBuffer(0, live)
+    counters = buffer.chunk['head']['scan_counter']
+    assert counters.tolist() == list(range(100 - live, 100))
+    record = buffer.readAcquisition(live - 1)
+    assert (record['data'].view(numpy.complex64) == 99 + 1j).all()
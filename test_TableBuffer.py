@@ -0,0 +1,84 @@
+"""Tests of the acquisition buffer (`TableBuffer`): buffer faults through
+the memory map, the ring of read buffers and plain h5py reads."""
+
+import numpy
+import ismrmrd
+import pytest
+import TableBuffer
+import Workspace
+from conftest import acquisitionRecords
+
+#: the storage layouts of the acquisition dataset (writeAcquisitions options)
+LAYOUTS = {'contiguous': {}, 'chunked': {'chunks': 64},
+           'gzip': {'chunks': 64, 'compression': 'gzip'}}
+
+
+@pytest.mark.parametrize('layout', sorted(LAYOUTS))
+def test_empty_file(acquisitionFile, qapp, layout):
+    fileName = acquisitionFile(records=acquisitionRecords(0), **LAYOUTS[layout])
+    dset = ismrmrd.Dataset(fileName, '/dataset', False, mode='r')
+    try:
+        rbuffer = TableBuffer.TableBuffer(dset)
+        rbuffer.readBuffer(0, 0)
+        assert len(rbuffer.chunk) == 0
+    finally:
+        dset.close()
+
+    fileView = Workspace.FileView(fileName)
+    try:
+        assert fileView.currentView().tableModel.leaf_numrows == 0
+    finally:
+        fileView.shutdown()
+
+
+def faultRanges(total, count=40, seed=0):
+    """Random row ranges ``[start, stop)``, some beyond the last row."""
+    rng = numpy.random.default_rng(seed)
+    starts = rng.integers(0, total, count)
+    return [(int(start), int(start + size)) for start, size in
+            zip(starts, rng.integers(1, 300, count))]
+
+
+@pytest.fixture
+def headers(acquisitionFile, request):
+    """``(dset, expected headers)`` of a file with 2000 acquisitions in the
+    layout `request.param`."""
+    fileName = acquisitionFile(2000, **LAYOUTS[request.param])
+    dset = ismrmrd.Dataset(fileName, '/dataset', False, mode='r')
+    yield dset, dset._dataset['data'].fields(['head'])[:]
+    dset.close()
+
+
+@pytest.mark.parametrize('headers', ['contiguous'], indirect=True)
+def test_memory_mapped_headers(headers):
+    dset, expected = headers
+    rbuffer = TableBuffer.TableBuffer(dset)
+    assert rbuffer.mmap is not None and rbuffer.sidecar is None
+    for start, stop in faultRanges(2000):
+        rbuffer.readBuffer(start, stop)
+        assert rbuffer.chunk['head'].tobytes() == expected[start:stop].tobytes()
+        assert rbuffer.nbytes_read == rbuffer.chunk.nbytes
+
+
+@pytest.mark.parametrize('headers', ['chunked', 'gzip'], indirect=True)
+def test_ring_of_read_buffers(headers):
+    dset, expected = headers
+    rbuffer = TableBuffer.TableBuffer(dset)
+    assert rbuffer.mmap is None and rbuffer.ring_dtype is not None
+
+    # ranges within, overlapping and away from the buffered rows
+    ranges = faultRanges(2000) + [(0, 100), (10, 50), (90, 200), (1500, 1600), (1550, 1650)]
+    views = []
+    for start, stop in ranges:
+        position = rbuffer.ring_pos
+        rbuffer.readBuffer(start, stop)
+        if rbuffer.ring_pos != position:
+            # a fault: the chunk is a view of the next buffer of the ring
+            views.append((rbuffer.chunk, expected[start:stop]))
+        assert rbuffer.chunk.base is rbuffer.ring[rbuffer.ring_pos]
+        # the chunks of the last faults are not overwritten by later ones
+        for chunk, rows in views[-TableBuffer.RING_SIZE:]:
+            assert chunk['head'].tobytes() == rows.tobytes()
+    # the ring wrapped several times, some ranges were served without reading
+    assert 2 * TableBuffer.RING_SIZE < len(views) < len(ranges)
+    assert rbuffer.cacheBytes() == sum(buf.nbytes for buf in rbuffer.ring)
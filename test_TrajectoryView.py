@@ -0,0 +1,62 @@
+"""Tests of the trajectory density (`TrajectoryView`): binning blocks of
+trajectories and merging histograms of different extents."""
+
+import numpy
+import pytest
+import TrajectoryView
+from conftest import acquisitionRecords
+
+GRID = 64
+
+
+def trajectoryBlock(extent, count=8, samples=100, dims=3, seed=0):
+    """Acquisitions with random trajectory samples within ``±extent``."""
+    records = acquisitionRecords(count)
+    records['head']['trajectory_dimensions'] = dims
+    records['head']['number_of_samples'] = samples
+    rng = numpy.random.default_rng(seed)
+    points = rng.uniform(-extent, extent, (count, samples, dims)).astype(numpy.float32)
+    for row in range(count):
+        records[row]['traj'] = points[row].ravel()
+    return records, points
+
+
+def histogram(points, axes, radius):
+    pairs = numpy.concatenate([block[:, :, list(axes)].reshape(-1, 2) for block in points])
+    counts, _, _ = numpy.histogram2d(pairs[:, 0].astype(numpy.float64),
+                                     pairs[:, 1].astype(numpy.float64), bins=GRID,
+                                     range=[[-radius, radius], [-radius, radius]])
+    return counts.astype(numpy.int64)
+
+
+@pytest.mark.parametrize('axes', [(0, 1), (1, 2)])
+@pytest.mark.parametrize('order', [(0, 1), (1, 0)])
+def test_merge_blocks_of_different_extents(axes, order):
+    small, smallPoints = trajectoryBlock(0.3, seed=1)
+    large, largePoints = trajectoryBlock(1.7, seed=2)
+    # one acquisition without trajectory
+    small[0]['traj'] = numpy.zeros(0, numpy.float32)
+    blocks = [TrajectoryView._trajHistogram(block, axes, GRID) for block in (small, large)]
+    assert blocks[0][0] == 0.5 and blocks[1][0] == 2.0
+
+    density = TrajectoryView.TrajectoryDensity(axes, GRID)
+    for ind in order:
+        density.add(blocks[ind])
+    assert density.radius == 2.0
+    assert density.samples == 15 * 100 and density.acquisitions == 15 and density.skipped == 1
+    assert numpy.array_equal(density.counts,
+                             histogram([smallPoints[1:], largePoints], axes, 2.0))
+
+    # the occupied bins add up to all samples
+    x, y, counts = density.bins(limit=100)
+    assert counts.sum() == 1500 and len(counts) <= 100
+    assert (numpy.abs(x) < 2.0).all() and (numpy.abs(y) < 2.0).all()
+
+
+def test_enlarge_keeps_the_counts():
+    counts = numpy.arange(GRID * GRID, dtype=numpy.int64).reshape(GRID, GRID)
+    enlarged = TrajectoryView.enlarge(counts, 2)
+    assert enlarged.sum() == counts.sum()
+    quarter = GRID // 4
+    assert numpy.array_equal(enlarged[3 * GRID // 8:5 * GRID // 8, 3 * GRID // 8:5 * GRID // 8],
+                             counts.reshape(quarter, 4, quarter, 4).sum(axis=(1, 3)))
@@ -0,0 +1,121 @@
+"""Tests of the acquisition checks (`Validate`)."""
+
+import numpy
+import h5py
+import pytest
+import ReadEngine
+import Validate
+from conftest import acquisitionRecords
+
+#: the encoding limits of the test data (32 phase encoding steps, 4 slices)
+LIMITS = [{'kspace_encoding_step_1': (0, 31, 16), 'slice': (0, 3, 0)}]
+
+
+def findings(records, limits=LIMITS, payload=True):
+    """Return ``{check: rows}`` of the issues found in `records`."""
+    lengths = Validate._payloadLengths(records)[1] if payload else None
+    issues = Validate.checkHeaders(records['head'], limits, lengths)
+    return {issue.check: issue.rows.tolist() for issue in issues}
+
+
+def test_valid_records():
+    assert findings(acquisitionRecords(300)) == {}
+
+
+def test_scan_counter():
+    records = acquisitionRecords(300)
+    records['head']['scan_counter'][50:] += 3
+    assert findings(records) == {'scan_counter gap': [50]}
+
+    records = acquisitionRecords(300)
+    records['head']['scan_counter'][61:] -= 1
+    assert findings(records) == {'duplicate scan_counter': [61]}
+
+    records = acquisitionRecords(300)
+    records['head']['scan_counter'][[100, 101]] = [101, 100]
+    # 99 -> 101 -> 100 -> 102
+    assert findings(records) == {'scan_counter gap': [100, 102], 'scan_counter decreases': [101]}
+
+
+def test_time_stamps():
+    records = acquisitionRecords(300)
+    records['head']['acquisition_time_stamp'][70] = 0
+    issues = Validate.checkHeaders(records['head'], LIMITS)
+    assert [(issue.check, issue.severity, issue.rows.tolist()) for issue in issues] == [
+        ('acquisition_time_stamp decreases', Validate.WARNING, [70])]
+    assert issues[0].details == ['acquisition_time_stamp 138 -> 0']
+
+
+def test_encoding_limits():
+    records = acquisitionRecords(300)
+    records['head']['idx']['kspace_encode_step_1'][80] = 40
+    records['head']['idx']['slice'][[81, 82]] = 4
+    records['head']['encoding_space_ref'][90] = 1
+    assert findings(records) == {'kspace_encode_step_1 outside encoding limits': [80],
+                                 'slice outside encoding limits': [81, 82],
+                                 'unknown encoding space': [90]}
+    # the counters of non-imaging acquisitions are not checked
+    records['head']['flags'][80] = 1 << (Validate.ismrmrd.ACQ_IS_NOISE_MEASUREMENT - 1)
+    assert 'kspace_encode_step_1 outside encoding limits' not in findings(records)
+
+
+def test_channels():
+    records = acquisitionRecords(300)
+    records['head']['active_channels'][110] = 3
+    records['head']['number_of_samples'][120] = 0
+    assert findings(records, payload=False) == {
+        'active_channels > available_channels': [110], 'empty acquisition': [120],
+        'inconsistent number_of_samples': [120], 'inconsistent active_channels': [110]}
+
+
+def test_payload():
+    records = acquisitionRecords(300)
+    records[100]['data'] = numpy.zeros(10, numpy.float32)
+    records[101]['traj'] = numpy.zeros(6, numpy.float32)
+    records['head']['trajectory_dimensions'][102] = 2
+    issues = findings(records)
+    assert issues == {'data length mismatch': [100],
+                      'trajectory without trajectory_dimensions': [101],
+                      'trajectory length mismatch': [102]}
+    assert 'data length mismatch' not in findings(records, payload=False)
+
+
+def anomalousRecords():
+    records = acquisitionRecords(500)
+    records['head']['scan_counter'][50:] += 3
+    records['head']['acquisition_time_stamp'][70] = 0
+    records[300]['data'] = numpy.zeros(10, numpy.float32)
+    return records
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_read_headers(acquisitionFile, compression):
+    records = anomalousRecords()
+    fileName = acquisitionFile(records=records, chunks=64, compression=compression)
+    expected = {'scan_counter gap': [50], 'acquisition_time_stamp decreases': [70],
+                'data length mismatch': [300]}
+    with h5py.File(fileName, 'r') as f:
+        engine = ReadEngine.ReadEngine(f['dataset/data'])
+        heads, lengths = Validate.readHeaders(engine)
+        assert heads.tobytes() == records['head'].tobytes()
+        assert numpy.array_equal(lengths, Validate._payloadLengths(records)[1])
+        issues = Validate.checkHeaders(heads, LIMITS, lengths)
+        assert {issue.check: issue.rows.tolist() for issue in issues} == expected
+        assert issues[-1].severity == Validate.WARNING
+
+        # the payload lengths only, and the headers only
+        heads, lengths = Validate.readHeaders(engine, records['head'])
+        assert numpy.array_equal(lengths, Validate._payloadLengths(records)[1])
+        heads, lengths = Validate.readHeaders(engine, payload=False)
+        assert heads.tobytes() == records['head'].tobytes() and lengths is None
+
+        assert Validate.readHeaders(engine, cancelled=lambda: True) is None
+
+
+def test_command_line(acquisitionFile, capsys):
+    assert Validate.main([acquisitionFile(300, name='valid.h5', chunks=64)]) == 0
+    assert Validate.main([acquisitionFile(records=anomalousRecords(), chunks=64)]) == 1
+    out = capsys.readouterr().out
+    assert '300 acquisitions, 0 errors, 0 warnings' in out
+    assert '500 acquisitions, 2 errors, 1 warnings' in out
+    assert 'row 300: 10 data values, expected 256' in out
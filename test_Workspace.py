@@ -0,0 +1,99 @@
+"""Tests of the workspace: dataset groups of a file and the cache budget."""
+
+import h5py
+import pytest
+from conftest import acquisitionRecords, writeAcquisitions
+import Workspace
+
+pytestmark = pytest.mark.usefixtures('qapp')
+
+
+@pytest.fixture
+def multiScanFile(tmp_path):
+    """A file with the groups /scan1 (300 rows) and /scan2 (200 rows)."""
+    fileName = str(tmp_path / 'multi.h5')
+    writeAcquisitions(fileName, acquisitionRecords(300), group='scan1')
+    writeAcquisitions(fileName, acquisitionRecords(200, seed=1), group='scan2')
+    return fileName
+
+
+def test_find_groups(multiScanFile):
+    with h5py.File(multiScanFile, 'a') as f:
+        f.create_group('other')
+        assert Workspace.findGroups(f) == [('scan1', 300), ('scan2', 200)]
+
+
+def test_switch_groups(multiScanFile):
+    fileView = Workspace.FileView(multiScanFile)
+    try:
+        # no /dataset: the first group is shown
+        assert list(fileView.views) == ['scan1']
+        assert fileView.currentView().tableModel.leaf_numrows == 300
+        created = []
+        fileView.viewCreated.connect(created.append)
+
+        fileView.groupCB.setCurrentIndex(1)
+        view = fileView.currentView()
+        assert created == [view] and view.tableModel.leaf_numrows == 200
+        assert fileView.dset is view.dset
+
+        # switching back reuses the view of the first group
+        fileView.groupCB.setCurrentIndex(0)
+        assert fileView.currentView() is fileView.views['scan1']
+        assert len(created) == 1
+    finally:
+        fileView.shutdown()
+        fileView.closeFiles()
+
+
+def test_budget_below_one_shown_view(acquisitionFile, qapp):
+    fileView = Workspace.FileView(acquisitionFile(3000, chunks=256))
+    budget = Workspace.CacheBudget(1)
+    try:
+        fileView.show()
+        view = fileView.currentView()
+        budget.register(view)
+        model = view.tableModel
+        assert view.isVisible() and view.cacheBytes() > 1
+
+        budget.enforce()
+        assert model.rbuffer.cacheBytes() == 0
+        # the rows shown stay readable without reading them again
+        for row in (0, model.numrows - 1):
+            assert model.data(model.index(row, 0)) is not None
+
+        # scrolling reads the rows into the buffers again
+        view.tableView.goToRow(2500)
+        budget.enforce()
+        row = view.tableView.currentIndex().row()
+        assert model.rbuffer.datasetRow(row) == 2500
+        assert model.data(model.index(row, 0)) is not None
+    finally:
+        budget.timer.stop()
+        fileView.shutdown()
+        fileView.closeFiles()
+
+
+def test_budget_with_stream_view(acquisitionFile, qapp):
+    import socket
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        port = s.getsockname()[1]
+    streamView = Workspace.FileView(None, listen=str(port))
+    fileView = Workspace.FileView(acquisitionFile(3000, chunks=256))
+    budget = Workspace.CacheBudget(1)
+    try:
+        fileView.show()
+        budget.register(fileView.currentView())
+        budget.register(streamView.currentView())
+        assert not streamView.currentView().isVisible()
+
+        # the hidden stream view is released first
+        budget.enforce()
+        assert fileView.currentView().tableModel.rbuffer.cacheBytes() == 0
+        assert streamView.currentView().tableModel.released
+    finally:
+        budget.timer.stop()
+        for view in (streamView, fileView):
+            view.shutdown()
+        fileView.closeFiles()